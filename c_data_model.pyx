@@ -57,6 +57,26 @@ DataModel某种程度上支持仅对对象数据有改变部分做序列化。
     result = rect.pack('dict', only_changed=True)
     >> result => {'lt': {'x': 100}, 'rb': {'y': 100}}
 
+clear_changed()，或者打包时指定clear_changed=True以后，没有改变的子对象和容器会设置clean标志，
+并记住自己所属的对象。字段改变的时候沿着所属对象向上清除clean标志，所以has_changed(recursive=True)
+和增量打包可以直接跳过clean的子树，开销只和有改变的部分有关。
+同一个子对象(不是ref)同时放在多个地方的时候，只会通知最后一次清除changed标志时所属的对象。
+
+changed标志只能给一个消费者用。第一次调用current_version()以后，字段和容器的每次修改还会记下递增的
+版本号，多个消费者(比如存盘和同步给客户端)可以各自记住看到的版本号，用pack_since取得之后的增量，
+不需要清除changed标志。没有消费者用版本号的时候不记录，每个对象不用多带一个版本号dict：
+
+    seen = current_version()
+    ...
+    delta, seen = rect.pack_since(seen)
+
+也可以用MutationRecorder按发生顺序记录修改，打包以后在另一端用replay_mutations重放。
+记录的开销只和修改的次数有关，不需要遍历对象：
+
+    recorder = MutationRecorder(rect)
+    rect.lt.x = 30
+    replay_mutations(rect2, recorder.pack())
+
 支持数据类型
 =============
 
@@ -76,6 +96,8 @@ DataModel用Field来定义字段的数据类型。支持的基本数据类型有
     double                    : double
     bool                      : bool
     string                    : 变长字符串
+    bytes                     : 变长二进制数据，长度上限4G。二进制格式解码成引用源数据的memoryview，
+                                memoryview不能hash，所以bytes不能作为map的key和oid的类型
     DataModel的子类           : -----
 
 除了基本类型。DataModel还支持定义Array和Map，IdMap三种集合。Array和Map即数组和字典：
@@ -108,6 +130,8 @@ Field附加属性
     min_value    【可选】如果字段是数字类型，表示最小值取值范围。sub_xxx函数会在发
                   现将减少到比min_value更小的数值前抛出异常。
     skip_changed 【可选】表示这个被排除在增量变化检测之外。总是会被判定为无改变。
+    typed        【可选】只用于元素是定长数值(bool除外)的ArrayField。数组用array.array
+                  存储(TypedArray)，二进制格式整块编解码。可以用numpy.frombuffer直接访问。
 
 除了标准附加属性外，使用者可以给Field附加任意属性，来修饰字段类型的定义。这些附加属
 性由使用者自己来使用和解释。
@@ -116,8 +140,35 @@ Field附加属性
 '''
 
 include "codes_bin.pxi"
+include "codes_bin2.pxi"
+include "codes_bson.pxi"
 
+import copy_reg
+import gc
+import weakref
 from functools import partial
+from itertools import izip
+from collections import OrderedDict, deque
+from array import array
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cpython.object cimport PyObject, PyTypeObject
+from cpython.dict cimport PyDict_Copy, PyDict_SetItem, PyDict_Next
+from cpython.string cimport PyString_CheckExact, PyString_AS_STRING, PyString_GET_SIZE
+from cpython.set cimport PySet_New
+from cpython.list cimport PyList_Append, PyList_GET_ITEM, PyList_GET_SIZE
+from cpython.ref cimport Py_INCREF, Py_XDECREF
+from cpython.int cimport PyInt_AS_LONG
+from cpython.float cimport PyFloat_AS_DOUBLE
+from libc.string cimport memset
+
+cdef extern from "Python.h":
+    PyObject** _PyObject_GetDictPtr(object obj)
+    dict _PyDict_NewPresized(Py_ssize_t minused)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # pylint: disable=protected-access,invalid-name,eval-used,too-many-branches,redefined-builtin
 # pylint: disable=too-many-instance-attributes,too-many-statements,too-many-locals
@@ -153,6 +204,18 @@ SKIP_FROM_PACK = SkipFromPack()
 
 cdef bint CONFIG_CHECK_INIT_ARGS = False
 
+# 数组记录的操作个数上限。超过以后增量数据里输出整个数组
+cdef Py_ssize_t MAX_ARRAY_OPS = 64
+
+# dict格式里数组操作的名字
+cdef dict _array_op_names = {
+    ARRAY_OP_APPEND: 'append',
+    ARRAY_OP_SET: 'set',
+    ARRAY_OP_INSERT: 'insert',
+    ARRAY_OP_REMOVE: 'remove',
+}
+cdef dict _array_op_codes = dict((name, op) for op, name in _array_op_names.iteritems())
+
 def set_CHECK_INIT_ARGS(value):
     CONFIG_CHECK_INIT_ARGS = value
 
@@ -170,6 +233,7 @@ cdef dict _default_values = {
     'double' : 0.0,
     'bool'   : False,
     'string' : '',
+    'bytes'  : '',
 }
 
 cdef dict _value2string = {
@@ -255,12 +319,13 @@ cdef inline object _create_object(Field field, object cls, dict dict_data):
         obj = cls()
     return obj
 
-cdef inline void _replace_obj_dict(object obj, dict new_obj_dict):
+cdef inline _replace_obj_dict(object obj, dict new_obj_dict):
     old_dict = obj.__dict__
     obj.__dict__ = new_obj_dict
     for k, v in old_dict.iteritems():
         if k not in new_obj_dict:
             new_obj_dict[k] = v
+    _move_to_slots(obj, new_obj_dict)
 
 cdef inline str _value_short_repr(object value):
     if isinstance(value, DataModel):
@@ -276,6 +341,11 @@ cdef object _make_autogen_func_name(attrs, str op_prefix, str name):
         func_name = '_' + op_prefix + '_' + name
     return func_name
 
+def _dict_encode_bytes(value):
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return bytes(value)
+
 cdef inline object _dict_get_encoder(str type_name):
     if type_name in _default_values:
         if type_name == 'int8':
@@ -302,6 +372,8 @@ cdef inline object _dict_get_encoder(str type_name):
             return bool
         if type_name == 'string':
             return str
+        if type_name == 'bytes':
+            return _dict_encode_bytes
     return None
 
 cdef inline object _dict_get_decoder(str type_name):
@@ -330,6 +402,8 @@ cdef inline object _dict_get_decoder(str type_name):
             return bool
         if type_name == 'string':
             return str
+        if type_name == 'bytes':
+            return bytes
     return None
 
 cdef inline object _bin_get_encoder(str type_name):
@@ -358,6 +432,8 @@ cdef inline object _bin_get_encoder(str type_name):
             return bin_encode_bool
         if type_name == 'string':
             return bin_encode_string
+        if type_name == 'bytes':
+            return bin_encode_bytes
     return None
 
 cdef inline object _bin_get_decoder(str type_name):
@@ -386,6 +462,8 @@ cdef inline object _bin_get_decoder(str type_name):
             return bin_decode_bool
         if type_name == 'string':
             return bin_decode_string
+        if type_name == 'bytes':
+            return bin_decode_bytes
     return None
 
 cdef inline void _mark_changed(int field_index, object self):
@@ -404,9 +482,206 @@ cdef inline bint _try_check_changed(object v):
         return v.has_changed()
     return False
 
+cdef unsigned long long _version = 0
+cdef bint _track_versions = False  # 有消费者用版本号以后才给字段和map的key记版本号
+cdef unsigned long long _track_since = 0  # 开始记录时的版本号，更早的修改没有记下来
+cdef int _recorders = 0  # 活动的MutationRecorder个数。没有的时候修改不需要查找记录器
+
+cdef inline unsigned long long _next_version():
+    global _version
+    _version += 1
+    return _version
+
+def current_version():
+    '''当前的修改版本号。字段和容器的每次修改都分配一个新的、递增的版本号，参见pack_since。
+        第一次调用时开始给字段和map的key记录版本号
+    '''
+    _start_track_versions()
+    return _version
+
+cdef inline void _start_track_versions():
+    global _track_versions, _track_since
+    if not _track_versions:
+        _track_versions = True
+        _track_since = _version
+
 cdef inline void _mark_changed_self_dict(int field_index, dict self_dict):
     cdef set changed_set = self_dict.setdefault('__changed_set__', set())
     changed_set.add(field_index)
+    if _track_versions:
+        self_dict.setdefault('__versions__', {})[field_index] = _next_version()
+    if '__clean__' in self_dict:
+        _drop_clean(self_dict)
+
+cdef void _drop_clean(dict obj_dict):
+    '''对象有了改变，沿着所属对象向上清除clean标志。
+        对象没有clean标志的时候，它的祖先也都没有，可以在这里停止。
+        容器不一定设置clean标志(比如ref容器)，总是继续向上。map同时记下改变了的元素的key，
+        数组记下对元素的set操作。
+    '''
+    while obj_dict.pop('__clean__', False):
+        owner = obj_dict.get('__owner__')
+        if owner is None:
+            return
+        if not isinstance(owner, DataModel):
+            if isinstance(owner, Map):
+                (<Map>owner)._dirty.add(obj_dict.get('__owner_key__'))
+            elif isinstance(owner, Array):
+                (<Array>owner)._log_element(obj_dict.get('__owner_key__'), obj_dict)
+            owner._clean = False
+            owner = owner._owner
+            if owner is None:
+                return
+        obj_dict = owner.__dict__
+
+cdef void _propagate_dirty(object container):
+    '''容器有了改变，清除容器和祖先的clean标志'''
+    container._clean = False
+    owner = container._owner
+    if owner is not None:
+        _drop_clean(owner.__dict__)
+
+cdef bint _is_held_by(object owner, object key, object value):
+    '''value是否还在owner里。owner是对象时检查所有字段，是容器时检查key处的元素'''
+    if isinstance(owner, DataModel):
+        for v in owner.__dict__.itervalues():
+            if v is value:
+                return True
+        return False
+    if isinstance(owner, Map):
+        return dict.get(owner, key) is value
+    if isinstance(owner, Array):
+        return key is not None and 0 <= key < len(owner) and list.__getitem__(owner, key) is value
+    return False
+
+cdef bint _claim_owner(dict value_dict, object owner, object key, object value):
+    '''把子对象value的所属对象设成owner，key是在所属容器里的key。
+        value还在原来的所属对象里(同一个对象放在了两个地方)的时候返回False，不修改：
+        改变只通知原来的所属对象，所以owner不能设置clean标志，打包时总是要检查value
+    '''
+    old = value_dict.get('__owner__')
+    if old is not None:
+        old_key = value_dict.get('__owner_key__')
+        if (old is not owner or old_key != key) and _is_held_by(old, old_key, value):
+            return False
+    value_dict['__owner__'] = owner
+    if key is None:
+        value_dict.pop('__owner_key__', None)
+    else:
+        value_dict['__owner_key__'] = key
+    return True
+
+cdef bint _claim_container(object container, object owner):
+    '''把容器的所属对象设成owner。同_claim_owner，容器还在原来的所属对象里的时候返回False'''
+    old = container._owner
+    if old is not None and old is not owner and _is_held_by(old, None, container):
+        return False
+    container._owner = owner
+    return True
+
+cdef void _mark_clean(object self, dict self_dict):
+    '''对象自己的changed标志清除以后调用。子对象和容器都clean的时候，设置对象的clean标志。
+        子对象和容器的__owner__指向对象，它们有改变的时候向上清除clean标志。
+        还没有解码的lazy字段算是clean的，解码的时候清除clean标志。
+        放在了多个地方的子对象和容器只指向一个所属对象，其他所属对象不设置clean标志。
+    '''
+    cdef Field field
+    cdef dict value_dict
+    cdef LazyFields lazy = self_dict.get('__lazy__')
+    if lazy is not None and lazy.mark_change:
+        return
+    for field in self._fields:
+        if field.skip_changed:
+            continue
+        value = self_dict.get(field.key)
+        if value is None:
+            continue
+        if field.container_class is not None:
+            if not _claim_container(value, self):
+                return
+            if not field.ref and not value._clean:
+                return
+        elif field.is_data_model_type and not field.ref:
+            value_dict = value.__dict__
+            if '__clean__' not in value_dict or not _claim_owner(value_dict, self, None, value):
+                return
+    self_dict['__clean__'] = True
+
+cdef inline bint _is_ref_container(object container):
+    cdef Field field = getattr(container, 'value_field', None)
+    return field is not None and field.ref
+
+cdef dict _map_entries(Map m, bint only_changed):
+    '''打包时需要处理的元素。增量打包并且map记下了改变的key的时候只返回这些元素，否则返回map自己'''
+    cdef dict items
+    if only_changed and m._tracked:
+        items = {}
+        for k in m._dirty:
+            if k in m:
+                items[k] = m[k]
+        return items
+    return m
+
+cdef list _array_ops(dict obj_dict, Field field, arr, bint only_changed):
+    '''增量打包时代替整个数组的操作列表。没有记录操作，操作不比元素少，
+        或者字段自己设置了changed标志(比如调用了set_changed)的时候返回None，输出整个数组
+    '''
+    if not only_changed or field.typed:
+        return None
+    cdef list ops = (<Array>arr)._ops
+    if ops is None or len(ops) >= len(arr):
+        return None
+    cdef set changed_set = obj_dict.get('__changed_set__')
+    if changed_set and (field.index in changed_set or '*' in changed_set):
+        return None
+    return ops
+
+cdef int _apply_array_op(list items, int op, Py_ssize_t index, value) except -1:
+    '''把一个数组操作应用到list。位置和list不符的时候抛出UnpackError'''
+    cdef Py_ssize_t size = len(items)
+    if op == ARRAY_OP_APPEND and index == size:
+        list.append(items, value)
+    elif op == ARRAY_OP_SET and 0 <= index < size:
+        list.__setitem__(items, index, value)
+    elif op == ARRAY_OP_INSERT and 0 <= index <= size:
+        list.insert(items, index, value)
+    elif op == ARRAY_OP_REMOVE and 0 <= index < size:
+        list.__delitem__(items, index)
+    else:
+        raise UnpackError('bad array op: op={}, index={}, size={}'.format(op, index, size))
+    return 0
+
+cdef void _mark_container_dirty(object container):
+    '''整个容器都需要打包的时候调用，比如容器赋值给了字段。map记下全部key，数组丢掉操作记录。
+        map的元素按增量打包，需要全部设置changed；数组的元素总是完整打包，不需要
+    '''
+    if isinstance(container, Map):
+        container.broadcast_changed()
+        (<Map>container)._dirty.update(container.iterkeys())
+        (<Map>container)._tracked = True
+    elif isinstance(container, Array):
+        (<Array>container)._ops = None
+
+cdef bint _is_elements_clean(object container, object items):
+    '''items是容器的(key, 元素)。返回元素是否都clean。对象元素的__owner__指向容器，
+        __owner_key__是元素的key。ref容器的元素属于别的对象，不算clean。
+        元素同时放在了别的地方(包括同一个容器的另一个位置)的时候也不算clean
+    '''
+    cdef Field field = getattr(container, 'value_field', None)
+    cdef dict v_dict
+    if field is not None:
+        if field.ref:
+            return False
+        if not field.is_data_model_type:
+            return True
+    for k, v in items:
+        if isinstance(v, DataModel):
+            v_dict = v.__dict__
+            if '__clean__' not in v_dict or not _claim_owner(v_dict, container, k, v):
+                return False
+        elif isinstance(v, (Array, Map)):
+            return False
+    return True
 
 cdef void _set_changed(object self, tuple field_names):
     cdef set change_set
@@ -414,9 +689,14 @@ cdef void _set_changed(object self, tuple field_names):
     cdef str name
     cdef Field field
 
+    if '__clean__' in self.__dict__:
+        _drop_clean(self.__dict__)
+    cdef dict versions = self.__dict__.setdefault('__versions__', {}) if _track_versions else None
     if len(field_names) == 0:
         changed_set = self.__dict__.setdefault('__changed_set__', set())
         changed_set.add('*')
+        if versions is not None:
+            versions['*'] = _next_version()
         return
     changed_set = self.__dict__.setdefault('__changed_set__', set())
     _fields_by_name = self._fields_by_name
@@ -426,10 +706,16 @@ cdef void _set_changed(object self, tuple field_names):
             raise NoFieldError('no such field: %s' % name)
         index = field.index
         changed_set.add(index)
+        if versions is not None:
+            versions[index] = _next_version()
 
 cdef void _clear_field_changed(object self, Field field, dict self_dict, bint recursive):
     if not _can_clear_change(self, field):
         return
+    if recursive and _is_lazy_pending(self_dict, field.key):
+        if (<LazyFields>self_dict['__lazy__']).mark_change:
+            # 延迟解码时还会设置changed标志，先解码出来再清除
+            _load_lazy_field(self_dict, field.key)
 
     cdef set changed_set = self_dict.get('__changed_set__', None)
     cdef dict _fields_is_container = self._fields_is_container
@@ -462,6 +748,9 @@ cdef void _clear_changed(object self, tuple field_names, bint recursive=True):
     cdef dict self_dict = self.__dict__
     cdef dict _fields_by_name
     cdef str name
+    cdef LazyFields lazy = self_dict.get('__lazy__')
+    if lazy is not None and recursive and not field_names:
+        lazy.mark_change = False
     if field_names:
         _fields_by_name = self._fields_by_name
         for name in field_names:
@@ -471,12 +760,15 @@ cdef void _clear_changed(object self, tuple field_names, bint recursive=True):
     else:
         for field in self._fields:
             _clear_field_changed(self, field, self_dict, recursive)
+        _mark_clean(self, self_dict)
 
 cdef bint _has_field_changed(object self, Field field, bint recursive):
     if field.skip_changed:
         return False
 
     cdef dict self_dict = self.__dict__
+    if '__clean__' in self_dict:
+        return False
     _fields_is_container = self._fields_is_container
     cdef set changed_set = self_dict.get('__changed_set__')
 
@@ -517,6 +809,8 @@ cdef inline bint _can_clear_change(object self, Field field):
 
 cdef inline bint _has_changed(object self, bint recursive=False):
     cdef Field field
+    if '__clean__' in self.__dict__:
+        return False
     for field in self._fields:
         if _has_field_changed(self, field, recursive):
             return True
@@ -527,36 +821,244 @@ cdef inline bint _is_default_value(object self, str name):
     if not field:
         raise NoFieldError('no such field: %s' % name)
     cdef str key = field.key
-    return self.__dict__.get(key) is None
+    if _is_lazy_pending(self.__dict__, key):
+        return False
+    return _field_value(self, self.__dict__, field) is None
 
 def _fget(key, default, self):
     return self.__dict__.get(key, default)
 
+def _fget_lazy(key, default, self):
+    cdef dict obj_dict = self.__dict__
+    if key not in obj_dict and '__lazy__' in obj_dict:
+        _load_lazy_field(obj_dict, key)
+    return obj_dict.get(key, default)
+
 def _fget_container(key, container_class, self):
-    return self.__dict__.setdefault(key, container_class())
+    cdef dict obj_dict = self.__dict__
+    if key not in obj_dict and '__lazy__' in obj_dict:
+        _load_lazy_field(obj_dict, key)
+    if key in obj_dict:
+        return obj_dict[key]
+    value = obj_dict[key] = container_class()
+    value._owner = self
+    if _recorders:
+        value._rec_parent = (self, self._fields_by_key[key])
+    return value
 
 cdef _fset(key, field_index, self, value):
     if self.__dict__.get(key) != value:
         self.__dict__[key] = value
         _mark_changed(field_index, self)
+        if _recorders:
+            _record_field(self, field_index)
+
+cdef _fset_lazy(key, field_index, self, value):
+    _drop_lazy_field(self.__dict__, key)
+    _fset(key, field_index, self, value)
 
 cdef _fset_container(key, field_index, container_class, self, value):
-    if isinstance(value, container_class):
-        value.broadcast_changed()
-        self.__dict__[key] = value
-    else:
+    _drop_lazy_field(self.__dict__, key)
+    if not isinstance(value, container_class):
         value = container_class(value)
-        value.broadcast_changed()
-        self.__dict__[key] = value
+    self.__dict__[key] = value
+    _mark_container_dirty(value)
     _mark_changed(field_index, self)
+    if _recorders:
+        _record_field(self, field_index)
 
 cdef _fdel(key, self):
+    _drop_lazy_field(self.__dict__, key)
     if hasattr(self, key):
         delattr(self, key)
+        if _recorders:
+            _record_mutation(self, MUTATION_DEL_FIELD, self._fields_by_key[key])
 
 cdef _fdel_container(key, self):
     raise OperateError('cannot del a container field')
 
+cdef union SlotValue:
+    long i
+    double d
+    PyObject* o
+
+# slot里的值的存储类型
+cdef enum:
+    SLOT_EMPTY = 0
+    SLOT_INT = 1
+    SLOT_DOUBLE = 2
+    SLOT_BOOL = 3
+    SLOT_OBJECT = 4
+    SLOT_NONE = 5
+
+cdef class SlotStorage(object):
+    '''SlotDataModel的字段存储。基本类型的字段按MetaDataModel分配的slot存放在C数组里，
+        int, float和bool值直接存成C的long和double，不占用__dict__，也不创建数值对象。
+        其他的值(string, bytes, 超出long范围的整数等)存对象引用。
+        没有设置(SLOT_EMPTY)和设置成None(SLOT_NONE)分开记录，对应__dict__里没有key和值是None
+    '''
+    cdef SlotValue* values
+    cdef unsigned char* kinds
+    cdef Py_ssize_t count
+
+    def __cinit__(self, *args, **kwargs):
+        cdef Py_ssize_t count = getattr(type(self), '_slot_count', 0)
+        if count:
+            self.values = <SlotValue*>PyMem_Malloc(count * (sizeof(SlotValue) + 1))
+            if not self.values:
+                raise MemoryError()
+            self.kinds = <unsigned char*>(self.values + count)
+            memset(self.kinds, SLOT_EMPTY, count)
+        self.count = count
+
+    def __dealloc__(self):
+        cdef Py_ssize_t i
+        for i in range(self.count):
+            if self.kinds[i] == SLOT_OBJECT:
+                Py_XDECREF(self.values[i].o)
+        PyMem_Free(self.values)
+
+    def __reduce_ex__(self, protocol):
+        # 默认的reduce会调用SlotStorage(obj)，这里直接创建对象再恢复__getstate__的数据
+        return copy_reg.__newobj__, (type(self),), self.__getstate__()
+
+    cdef inline object get(self, int slot):
+        cdef unsigned char kind = self.kinds[slot]
+        if kind == SLOT_INT:
+            return self.values[slot].i
+        if kind == SLOT_DOUBLE:
+            return self.values[slot].d
+        if kind == SLOT_BOOL:
+            return True if self.values[slot].i else False
+        if kind == SLOT_OBJECT:
+            return <object>self.values[slot].o
+        return None
+
+    cdef inline bint has(self, int slot):
+        return self.kinds[slot] != SLOT_EMPTY
+
+    cdef inline void set(self, int slot, object value):
+        cdef PyObject* old = NULL
+        if self.kinds[slot] == SLOT_OBJECT:
+            old = self.values[slot].o
+        if value is None:
+            self.kinds[slot] = SLOT_NONE
+        elif type(value) is int:
+            self.values[slot].i = PyInt_AS_LONG(value)
+            self.kinds[slot] = SLOT_INT
+        elif type(value) is float:
+            self.values[slot].d = PyFloat_AS_DOUBLE(value)
+            self.kinds[slot] = SLOT_DOUBLE
+        elif type(value) is bool:
+            self.values[slot].i = value is True
+            self.kinds[slot] = SLOT_BOOL
+        else:
+            Py_INCREF(value)
+            self.values[slot].o = <PyObject*>value
+            self.kinds[slot] = SLOT_OBJECT
+        # 旧的值最后释放，释放时运行的代码看到的是新的值
+        Py_XDECREF(old)
+
+    cdef inline void clear(self, int slot):
+        '''删除slot里的值，回到没有设置的状态'''
+        cdef PyObject* old = NULL
+        if self.kinds[slot] == SLOT_OBJECT:
+            old = self.values[slot].o
+        self.kinds[slot] = SLOT_EMPTY
+        Py_XDECREF(old)
+
+    cdef void copy_from(self, SlotStorage other):
+        cdef Py_ssize_t i
+        for i in range(self.count):
+            self.clear(i)
+        memcpy(self.values, other.values, self.count * (sizeof(SlotValue) + 1))
+        for i in range(self.count):
+            if self.kinds[i] == SLOT_OBJECT:
+                Py_INCREF(<object>self.values[i].o)
+
+cdef class SlotField(object):
+    '''SlotDataModel基本类型字段的descriptor。
+        raw为False时是字段名的属性，没有设置的时候返回默认值，赋值时设置changed标志；
+        raw为True时是字段key('_'加字段名)的属性，和普通DataModel的__dict__[key]一样，
+        没有设置的时候抛出AttributeError，赋值不设置changed标志。
+    '''
+    cdef Field field
+    cdef int slot
+    cdef bint raw
+
+    def __cinit__(self, Field field, bint raw):
+        self.field = field
+        self.slot = field.slot
+        self.raw = raw
+
+    def __get__(self, obj, objtype):
+        if obj is None:
+            return self
+        cdef SlotStorage storage = obj
+        if not storage.has(self.slot):
+            if self.raw:
+                raise AttributeError(self.field.key)
+            return self.field.default
+        return storage.get(self.slot)
+
+    def __set__(self, obj, value):
+        cdef SlotStorage storage = obj
+        if self.raw:
+            storage.set(self.slot, value)
+        elif storage.get(self.slot) != value:
+            storage.set(self.slot, value)
+            _mark_changed(self.field.index, obj)
+            if _recorders:
+                _record_field(obj, self.field.index)
+
+    def __delete__(self, obj):
+        cdef SlotStorage storage = obj
+        if storage.kinds[self.slot] == SLOT_EMPTY:
+            if self.raw:
+                raise AttributeError(self.field.key)
+            return
+        storage.clear(self.slot)
+        if not self.raw and _recorders:
+            _record_mutation(obj, MUTATION_DEL_FIELD, self.field)
+
+cdef object _make_slot_get_func(SlotField slot_field):
+    cdef int slot = slot_field.slot
+    default_value = slot_field.field.default
+    def get_func(self):
+        cdef SlotStorage storage = self
+        if not storage.has(slot):
+            storage.set(slot, default_value)
+        return storage.get(slot)
+    return get_func
+
+cdef inline bint _is_slot_field(Field field):
+    '''SlotDataModel里存放在slot里的字段：基本类型的非集合字段'''
+    return field.container_class is None and not field.is_data_model_type
+
+cdef inline object _field_value(object obj, dict obj_dict, Field field):
+    '''字段的值，没有设置时返回None。SlotDataModel的基本类型字段在slot里，其他字段在__dict__里'''
+    if field.slot < 0:
+        return obj_dict.get(field.key)
+    return (<SlotStorage>obj).get(field.slot)
+
+cdef inline _set_field_value(object obj, dict obj_dict, Field field, object value):
+    '''直接设置字段的值，不设置changed标志'''
+    if field.slot < 0:
+        obj_dict[field.key] = value
+    else:
+        (<SlotStorage>obj).set(field.slot, value)
+
+cdef _move_to_slots(object obj, dict obj_dict):
+    '''解码直接把字段的值写进__dict__。解码完以后把SlotDataModel的基本类型字段移到slot里'''
+    cdef SlotStorage storage
+    cdef Field field
+    if not isinstance(obj, SlotStorage):
+        return
+    storage = obj
+    for field in type(obj)._slot_fields:
+        if field.key in obj_dict:
+            storage.set(field.slot, obj_dict.pop(field.key))
+
 cdef object _field_value_to_dict(encoder, Field field, object value,
                                  bint recursive, bint only_changed,
                                  bint clear_changed, FieldFilter field_filter,
@@ -588,6 +1090,8 @@ cdef bint _encode_to_dict(dict dict_data, object cls, object obj,
                           FieldFilter field_filter, object included_fields=None):
     '''将对象数据转储到dict'''
     cdef dict obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
 
     cdef Field field
     cdef dict d
@@ -601,7 +1105,7 @@ cdef bint _encode_to_dict(dict dict_data, object cls, object obj,
             if field.name not in included_fields:
                 continue
 
-        value = obj_dict.get(field.key)
+        value = _field_value(obj, obj_dict, field)
         if value is None:
             continue
 
@@ -616,22 +1120,39 @@ cdef bint _encode_to_dict(dict dict_data, object cls, object obj,
         kencoder = field.dict_key_encoder
 
         if field.array:
-            dict_data[field.name] = [
-                _field_value_to_dict(
-                    encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=field_filter,
-                    with_skip_from_pack=False)
-                for v in value
-            ]
+            # 解码的时候整个替换数组，或者按操作修改数组，元素需要完整打包
+            ops = _array_ops(obj_dict, field, value, only_changed)
+            if ops is not None:
+                dict_data[field.name] = {'ops': [
+                    [_array_op_names[op], index] if op == ARRAY_OP_REMOVE else
+                    [_array_op_names[op], index, _field_value_to_dict(
+                        encoder, field, v,
+                        recursive=recursive,
+                        only_changed=False,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter,
+                        with_skip_from_pack=False)]
+                    for op, index, v in ops
+                ]}
+            else:
+                dict_data[field.name] = [
+                    _field_value_to_dict(
+                        encoder, field, v,
+                        recursive=recursive,
+                        only_changed=False,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter,
+                        with_skip_from_pack=False)
+                    for v in value
+                ]
             have_data = True
         elif field.map:
             d = dict_data[field.name] = {}
             map_value = value
-            for k, v in map_value.iteritems():
-                if only_changed:
+            entries = _map_entries(map_value, only_changed)
+            for k, v in entries.iteritems():
+                # 没有记下改变的key时，逐个检查元素
+                if only_changed and entries is map_value:
                     if not map_value.is_item_changed(k, v):
                         continue
                 key = kencoder(k)
@@ -645,14 +1166,15 @@ cdef bint _encode_to_dict(dict dict_data, object cls, object obj,
                     d[key] = fvalue
                     have_data = True
             if only_changed:
-                for key in map_value.get_removed_keys():
-                    d[key] = None
+                for key in _removed_map_keys(map_value):
+                    d[kencoder(key)] = None
                     have_data = True
         elif field.id_map:
             d = dict_data[field.name] = {}
             i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
-            for k, v in value.iteritems():
-                if only_changed:
+            entries = _map_entries(value, only_changed)
+            for k, v in entries.iteritems():
+                if only_changed and entries is value:
                     if not value.is_item_changed(k, v):
                         continue
                 key = kencoder(v.oid)
@@ -666,8 +1188,8 @@ cdef bint _encode_to_dict(dict dict_data, object cls, object obj,
                     d[key] = fvalue
                     have_data = True
             if only_changed:
-                for key in value.get_removed_keys():
-                    d[key] = None
+                for key in _removed_map_keys(value):
+                    d[kencoder(key)] = None
                     have_data = True
         else:
             fvalue = _field_value_to_dict(
@@ -684,13 +1206,48 @@ cdef bint _encode_to_dict(dict dict_data, object cls, object obj,
 
     return have_data
 
-cdef inline _field_value_from_dict(decoder, field, dict_value, old_value, context):
+def _make_field_paths(cls, fields):
+    '''把字段路径列表转成嵌套的dict。'a.b'表示子对象a(或者容器a里的对象)的b字段。
+        只指定到某个字段的时候需要它的全部子字段，用None表示。
+    '''
+    cdef dict paths = {}
+    cdef dict node
+    cdef Field field
+    for path in fields:
+        node = paths
+        fcls = cls
+        names = path.split('.')
+        for i, name in enumerate(names):
+            field = fcls._fields_by_name.get(name) if fcls else None
+            if not field:
+                raise NoFieldError('no such field: %s' % path)
+            if i == len(names) - 1:
+                node[name] = None
+            elif name in node and node[name] is None:
+                # 已经需要全部子字段
+                break
+            else:
+                node = node.setdefault(name, {})
+                fcls = field.value_type if field.is_data_model_type and not field.ref else None
+    return paths
+
+cdef inline bint _is_decode_skipped(Field field, dict paths, DecodeContext context) except -1:
+    '''解码的时候是否跳过字段'''
+    if paths is not None and field.name not in paths:
+        return True
+    return context.field_filter is not None and context.field_filter.is_filted(field)
+
+cdef inline dict _sub_paths(Field field, dict paths):
+    return paths[field.name] if paths is not None else None
+
+cdef inline _field_value_from_dict(decoder, field, dict_value, old_value, context, dict paths=None):
     if decoder:
         return decoder(dict_value)
     else:
-        return _field_object_from_dict(field, None, dict_value, old_value, context)
+        return _field_object_from_dict(field, None, dict_value, old_value, context, paths)
 
-cdef _field_object_from_dict(Field field, oid, dict_value, old_value, DecodeContext context):
+cdef _field_object_from_dict(Field field, oid, dict_value, old_value, DecodeContext context,
+                             dict paths=None):
     if field.ref:
         return field.dict_ref_decoder(dict_value)
     else:
@@ -701,7 +1258,7 @@ cdef _field_object_from_dict(Field field, oid, dict_value, old_value, DecodeCont
             fobj = None
             obj_dict = {}
         fcls = field.value_type
-        _decode_from_dict(fobj, fcls, obj_dict, dict_value, context)
+        _decode_from_dict(fobj, fcls, obj_dict, dict_value, context, paths)
         if fobj is None:
             fobj = _create_object(field, fcls, obj_dict)
             _replace_obj_dict(fobj, obj_dict)
@@ -709,33 +1266,76 @@ cdef _field_object_from_dict(Field field, oid, dict_value, old_value, DecodeCont
         if oid is not None:
             fobj._oid = oid
         else:
-            oid = obj_dict.get('_oid')
+            oid = getattr(fobj, '_oid', None)
         context.add_known_object(oid, fobj)
         return fobj
 
-cdef _decode_from_dict(obj, cls, obj_dict, dict_data, DecodeContext context):
+cdef Array _field_array(dict obj_dict, Field field):
+    '''按操作修改的数组。字段还没有数组的时候创建一个空数组'''
+    arr = obj_dict.get(field.key)
+    if arr is None:
+        arr = obj_dict[field.key] = field.container_class()
+    return arr
+
+cdef _add_array_refs(Array arr, DecodeContext context):
+    '''按操作修改了ref数组以后，把还没有解析的元素加入待解析列表。操作会改变元素的位置，
+        所以在全部操作完成以后再加入
+    '''
+    for k, v in enumerate(arr):
+        if not isinstance(v, DataModel):
+            context.add_unsolved_ref(('array', arr, k, v))
+
+cdef _decode_array_ops_from_dict(dict obj_dict, Field field, dict dvalue, DecodeContext context,
+                                 dict paths=None):
+    '''把dict格式的数组操作应用到字段的数组'''
+    cdef Array arr = _field_array(obj_dict, field)
+    decoder = field.dict_decoder
+    for dop in dvalue.get('ops', ()):
+        op = _array_op_codes.get(dop[0])
+        if op is None:
+            raise UnpackError('unknown array op: {}'.format(dop[0]))
+        value = None
+        if op != ARRAY_OP_REMOVE:
+            value = _field_value_from_dict(decoder, field, dop[2], None, context, paths)
+        arr._apply_op(op, dop[1], value)
+    if field.ref:
+        _add_array_refs(arr, context)
+
+cdef _decode_from_dict(obj, cls, obj_dict, dict_data, DecodeContext context, dict paths=None):
     '''从dict_data恢复对象数据
         recursive       -> 是否递归子对象
         only_changed    -> 是否仅包含有改变的字段
+        paths           -> 需要解码的字段路径，参见_make_field_paths。None表示全部字段
     '''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
     mark_change = context.mark_change
 
     cdef Field field
+    cdef dict sub_paths
     for field in cls._fields:
         fname = field.name
         dvalue = dict_data.get(fname)
         if dvalue is None: # 数据容错：不解码为None的值
             continue
+        if _is_decode_skipped(field, paths, context):
+            continue
+        sub_paths = _sub_paths(field, paths)
         decoder = field.dict_decoder
         kdecoder = field.dict_key_decoder
         field_key = field.key
-        if field.array:
+        if isinstance(dvalue, dict) and field.array:
+            if not context.sync_mode:
+                continue  # 非sync模式忽略数组操作
+            _decode_array_ops_from_dict(obj_dict, field, dvalue, context, sub_paths)
+        elif field.array:
             arr = obj_dict[field_key] = field.container_class()
             for dv in dvalue:
                 if not context.sync_mode:
                     if dv is None: # 数据容错：不解码为None的值
                         continue
-                value = _field_value_from_dict(decoder, field, dv, None, context)
+                value = _field_value_from_dict(decoder, field, dv, None, context, sub_paths)
                 arr._append(value)
                 if field.ref:
                     context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
@@ -758,7 +1358,7 @@ cdef _decode_from_dict(obj, cls, obj_dict, dict_data, DecodeContext context):
                     continue
                 if context.sync_mode:
                     old_value = m.get(key)
-                value = _field_value_from_dict(decoder, field, v, old_value, context)
+                value = _field_value_from_dict(decoder, field, v, old_value, context, sub_paths)
                 m._setitem(key, value)
                 if field.ref:
                     context.add_unsolved_ref(('map', m, key, value))
@@ -781,7 +1381,7 @@ cdef _decode_from_dict(obj, cls, obj_dict, dict_data, DecodeContext context):
                     continue
                 if context.sync_mode:
                     old_value = m.get(oid)
-                value = _field_object_from_dict(field, oid, v, old_value, context)
+                value = _field_object_from_dict(field, oid, v, old_value, context, sub_paths)
                 m._setitem(oid, value)
                 if field.ref:
                     context.add_unsolved_ref(('map', m, oid, value))
@@ -789,7 +1389,7 @@ cdef _decode_from_dict(obj, cls, obj_dict, dict_data, DecodeContext context):
             old_value = None
             if context.sync_mode:
                 old_value = obj_dict.get(field_key)
-            value = _field_value_from_dict(decoder, field, dvalue, old_value, context)
+            value = _field_value_from_dict(decoder, field, dvalue, old_value, context, sub_paths)
             obj_dict[field_key] = value
             if field.ref:
                 context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
@@ -797,10 +1397,13 @@ cdef _decode_from_dict(obj, cls, obj_dict, dict_data, DecodeContext context):
         if mark_change:
             _mark_changed_self_dict(field.index, obj_dict)
 
+    _move_to_slots(obj, obj_dict)
+
 
 cdef _field_value_to_binary(
         buf, encoder, Field field, value, bint recursive,
-        bint only_changed, bint clear_changed, field_filter=None):
+        bint only_changed, bint clear_changed, FieldFilter field_filter,
+        bint framed=False):
     if encoder:
         encoder(buf, value)
     elif recursive:
@@ -811,83 +1414,261 @@ cdef _field_value_to_binary(
                               recursive=recursive,
                               only_changed=only_changed,
                               clear_changed=clear_changed,
-                              field_filter=field_filter)
+                              field_filter=field_filter,
+                              framed=framed)
+
+cdef list _removed_map_keys(m):
+    '''增量数据里需要删除的key。删除以后又重新设置的key不算'''
+    return [k for k in m.get_removed_keys() if k not in m]
+
+cdef int _encode_tombstones(WriteBuffer buf, Field field, m) except -1:
+    '''增量数据里，在map数据前面写入删除了的key'''
+    cdef list removed = _removed_map_keys(m)
+    if removed:
+        buf.write_container_head(C_TOMBSTONES_32, len(removed))
+        for k in removed:
+            buf.write_value(field.bin_key_type, k)
+    return 0
+
+cdef _encode_field_to_binary(WriteBuffer buf, Field field, object obj, dict obj_dict,
+                             bint recursive, bint only_changed, bint clear_changed,
+                             FieldFilter field_filter, bint framed=False):
+    value = _field_value(obj, obj_dict, field)
+    if value is None:
+        return
+
+    if field_filter.is_filted(field):
+        return
+
+    if only_changed:
+        if not _has_field_changed(obj, field, recursive):
+            return
+
+    encoder = field.bin_encoder
+    kencoder = field.bin_key_encoder
+
+    cdef FieldFilter i_field_filter
+    cdef Py_ssize_t frame_offset
+    cdef list ops
+
+    bin_encode_field_index(buf, field.index)
+    if framed:
+        frame_offset = buf.begin_frame()
+    if field.typed:
+        buf.write_typed_array(value)
+    elif field.array:
+        # 增量数据里数组整个替换，或者按操作修改，元素需要完整打包
+        ops = _array_ops(obj_dict, field, value, only_changed)
+        if ops is not None:
+            buf.write_container_head(C_ARRAY_OPS_32, len(ops))
+            for op, index, v in ops:
+                buf.write_array_op(op, index)
+                if op != ARRAY_OP_REMOVE:
+                    _field_value_to_binary(
+                        buf, encoder, field, v,
+                        recursive=recursive,
+                        only_changed=False,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter,
+                        framed=framed)
+        else:
+            bin_encode_array_head(buf, len(value))
+            for v in value:
+                _field_value_to_binary(
+                    buf, encoder, field, v,
+                    recursive=recursive,
+                    only_changed=False,
+                    clear_changed=clear_changed,
+                    field_filter=field_filter,
+                    framed=framed)
+    elif field.map:
+        if only_changed:
+            _encode_tombstones(buf, field, value)
+        entries = _map_entries(value, only_changed)
+        bin_encode_map_head(buf, len(entries))
+        for k, v in entries.iteritems():
+            kencoder(buf, k)
+            _field_value_to_binary(
+                buf, encoder, field, v,
+                recursive=recursive,
+                only_changed=only_changed,
+                clear_changed=clear_changed,
+                field_filter=field_filter,
+                framed=framed)
+    elif field.id_map:
+        if only_changed:
+            _encode_tombstones(buf, field, value)
+        entries = _map_entries(value, only_changed)
+        bin_encode_id_map_head(buf, len(entries))
+        i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+        for v in entries.itervalues():
+            k = v.oid
+            kencoder(buf, k)
+            _field_value_to_binary(
+                buf, encoder, field, v,
+                recursive=recursive,
+                only_changed=only_changed,
+                clear_changed=clear_changed,
+                field_filter=i_field_filter,
+                framed=framed)
+    else:
+        _field_value_to_binary(
+            buf, encoder, field, value,
+            recursive=recursive,
+            only_changed=only_changed,
+            clear_changed=clear_changed,
+            field_filter=field_filter,
+            framed=framed)
+    if framed:
+        buf.end_frame(frame_offset)
+
+cdef bint _encode_scalar_run(WriteBuffer buf, ScalarRun run, object obj, dict obj_dict,
+                             bint recursive, bint only_changed,
+                             FieldFilter field_filter) except -1:
+    '''一次打包run内的全部字段。
+        run内有字段不需要输出时返回False，由调用者逐个字段打包。
+    '''
+    cdef Py_ssize_t i
+    cdef Field field
+    for field in run.fields:
+        if _field_value(obj, obj_dict, field) is None:
+            return False
+        if field_filter.is_filted(field):
+            return False
+        if only_changed:
+            if not _has_field_changed(obj, field, recursive):
+                return False
+    buf.check_size(buf.offset + run.size)
+    for i in range(run.count):
+        buf.write_uint16(run.index_values[i])
+        buf.write_value(run.bin_types[i], _field_value(obj, obj_dict, <Field>run.fields[i]))
+    return True
 
-cdef _encode_to_binary(buf, cls, obj, recursive, only_changed, clear_changed,
-                       field_filter=None):
+cdef _encode_to_binary(buf, cls, obj, bint recursive, bint only_changed,
+                       bint clear_changed, FieldFilter field_filter, bint framed=False):
     '''将对象数据转储到binary buff。
         recursive       -> 是否递归子对象
         only_changed    -> 是否仅包含有改变的字段
+        framed          -> 是否使用分帧格式。每个字段index后面带4字节的字段数据长度
     '''
-    obj_dict = obj.__dict__
+    cdef dict obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef BinaryCodec codec = cls._bin_codec
+    cdef Field field
+
+    for item in codec.items:
+        if type(item) is ScalarRun:
+            if not framed and _encode_scalar_run(buf, <ScalarRun>item, obj, obj_dict, recursive,
+                                                 only_changed, field_filter):
+                continue
+            for field in (<ScalarRun>item).fields:
+                _encode_field_to_binary(buf, field, obj, obj_dict, recursive,
+                                        only_changed, clear_changed, field_filter, framed)
+        else:
+            _encode_field_to_binary(buf, <Field>item, obj, obj_dict, recursive,
+                                    only_changed, clear_changed, field_filter, framed)
+
+    if clear_changed:
+        _clear_changed(obj, None, recursive=False)
+
+    bin_encode_field_index(buf, 0)
 
+cdef Py_ssize_t _field_value_binary_size(Field field, object value, bint recursive,
+                                         bint only_changed, FieldFilter field_filter,
+                                         bint framed=False) except -1:
+    cdef Field oid_field
+    if not field.is_data_model_type:
+        return calc_value_size(field.type_name, value)
+    elif recursive:
+        if field.ref:
+            oid_field = field.value_type._fields_by_name['oid']
+            return calc_value_size(oid_field.type_name, value.oid)
+        else:
+            return _calc_binary_size(field.value_type, value,
+                                     recursive=recursive,
+                                     only_changed=only_changed,
+                                     field_filter=field_filter,
+                                     framed=framed)
+    return 0
+
+cdef Py_ssize_t _tombstones_size(Field field, m) except -1:
+    cdef list removed = _removed_map_keys(m)
+    cdef Py_ssize_t size
+    if not removed:
+        return 0
+    size = CONTAINER_HEAD_SIZE
+    for k in removed:
+        size += calc_value_size(field.key_type_name, k)
+    return size
+
+cdef Py_ssize_t _calc_binary_size(cls, obj, bint recursive, bint only_changed,
+                                  FieldFilter field_filter, bint framed=False) except -1:
+    '''计算_encode_to_binary输出的字节数。不修改对象的changed标志。'''
+    cdef dict obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef Py_ssize_t size = FIELD_INDEX_SIZE  # 结束标志
     cdef Field field
+    cdef FieldFilter i_field_filter
+    cdef list ops
+
     for field in cls._fields:
-        value = obj_dict.get(field.key)
+        value = _field_value(obj, obj_dict, field)
         if value is None:
             continue
 
-        if field_filter:
-            if not field_filter(field):
-                continue
+        if field_filter.is_filted(field):
+            continue
 
         if only_changed:
             if not _has_field_changed(obj, field, recursive):
                 continue
 
-        encoder = field.bin_encoder
-        kencoder = field.bin_key_encoder
-
-        bin_encode_field_index(buf, field.index)
-        if field.array:
-            bin_encode_array_head(buf, len(value))
-            for v in value:
-                _field_value_to_binary(
-                    buf, encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=field_filter)
+        size += FIELD_INDEX_SIZE
+        if framed:
+            size += FIELD_FRAME_SIZE
+        if field.typed:
+            size += CONTAINER_HEAD_SIZE + len(value) * value.itemsize
+        elif field.array:
+            size += CONTAINER_HEAD_SIZE
+            ops = _array_ops(obj_dict, field, value, only_changed)
+            if ops is not None:
+                for op, _, v in ops:
+                    size += ARRAY_OP_HEAD_SIZE
+                    if op != ARRAY_OP_REMOVE:
+                        size += _field_value_binary_size(field, v, recursive, False,
+                                                         field_filter, framed)
+            else:
+                for v in value:
+                    size += _field_value_binary_size(field, v, recursive, False,
+                                                     field_filter, framed)
         elif field.map:
-            bin_encode_map_head(buf, len(value))
-            for k, v in value.iteritems():
-                kencoder(buf, k)
-                _field_value_to_binary(
-                    buf, encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=field_filter)
+            size += CONTAINER_HEAD_SIZE
+            if only_changed:
+                size += _tombstones_size(field, value)
+            for k, v in _map_entries(value, only_changed).iteritems():
+                size += calc_value_size(field.key_type_name, k)
+                size += _field_value_binary_size(field, v, recursive, only_changed, field_filter, framed)
         elif field.id_map:
-            bin_encode_id_map_head(buf, len(value))
+            size += CONTAINER_HEAD_SIZE
+            if only_changed:
+                size += _tombstones_size(field, value)
             i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
-            for v in value.itervalues():
-                k = v.oid
-                kencoder(buf, k)
-                _field_value_to_binary(
-                    buf, encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=i_field_filter)
+            for v in _map_entries(value, only_changed).itervalues():
+                size += calc_value_size(field.key_type_name, v.oid)
+                size += _field_value_binary_size(field, v, recursive, only_changed, i_field_filter, framed)
         else:
-            _field_value_to_binary(
-                buf, encoder, field, value,
-                recursive=recursive,
-                only_changed=only_changed,
-                clear_changed=clear_changed,
-                field_filter=field_filter)
+            size += _field_value_binary_size(field, value, recursive, only_changed, field_filter, framed)
 
-    if clear_changed:
-        _clear_changed(obj, None, recursive=False)
-
-    bin_encode_field_index(buf, 0)
+    return size
 
-cdef _field_value_from_binary(buf, decoder, field, old_value, oid, context):
-    if decoder:
-        return decoder(buf)
+cdef _field_value_from_binary(ReadBuffer buf, Field field, old_value, oid,
+                              DecodeContext context, dict paths=None):
+    if field.bin_type != BT_NONE:
+        return buf.read_value(field.bin_type)
     elif field.ref:
-        return field.bin_ref_decoder(buf)
+        return buf.read_value(field.bin_ref_type)
     else:
         if old_value is not None:
             fobj = old_value
@@ -896,7 +1677,10 @@ cdef _field_value_from_binary(buf, decoder, field, old_value, oid, context):
             fobj = None
             obj_dict = {}
         fcls = field.value_type
-        _decode_from_binary(buf, fobj, fcls, obj_dict, context)
+        if context.lazy:
+            _decode_from_binary_lazy(buf, fcls, obj_dict, context, paths)
+        else:
+            _decode_from_binary(buf, fobj, fcls, obj_dict, context, paths)
         if fobj is None:
             fobj = _create_object(field, fcls, obj_dict)
             _replace_obj_dict(fobj, obj_dict)
@@ -905,79 +1689,567 @@ cdef _field_value_from_binary(buf, decoder, field, old_value, oid, context):
             context.add_known_object(oid, fobj)
         return fobj
 
-cdef _decode_from_binary(buf, obj, cls, obj_dict, context):
-    '''从binary buff恢复对象数据'''
-    mark_change = context.mark_change
-    _fields_by_index = cls._fields_by_index
+cdef bint _decode_scalar_run(ReadBuffer buf, ScalarRun run, dict obj_dict) except -1:
+    '''run的第一个字段index已经读出。先按预计算的偏移校验后续字段的index，再逐个直接解出字段值。
+        数据里的字段序列和run不一致时(比如增量数据)返回False，且不移动读偏移。
+    '''
+    cdef Py_ssize_t i
+    cdef const unsigned char* p
+    if buf.size - buf.offset < run.tail_size:
+        return False
+    p = buf.p + buf.offset
+    for i in range(1, run.count):
+        if load_be16(p + run.index_offsets[i]) != run.index_values[i]:
+            return False
+    obj_dict[run.keys[0]] = buf.read_value(run.bin_types[0])
+    for i in range(1, run.count):
+        buf.offset += FIELD_INDEX_SIZE
+        obj_dict[run.keys[i]] = buf.read_value(run.bin_types[i])
+    return True
 
-    while True:
-        if buf.is_end():
+cdef int _decode_tombstones(ReadBuffer buf, Field field, m, DecodeContext context) except -1:
+    '''解码增量数据里删除了的key。sync模式下从m里删除，否则忽略'''
+    cdef uint32_t i
+    for i in range(buf.read_tombstones_head()):
+        key = buf.read_value(field.bin_key_type)
+        if context.sync_mode and key in m:
+            m._delitem(key)  # 调用_delitem避免修改changed标志
+    return 0
+
+cdef _decode_field_from_binary(ReadBuffer buf, Field field, dict obj_dict, DecodeContext context,
+                               dict paths=None):
+    '''字段index已经读出。解码一个字段的数据到obj_dict。paths是字段值对象需要解码的字段路径'''
+    cdef uint32_t asize, i
+    cdef Py_ssize_t op_count, index
+    cdef int op
+    cdef Array ops_arr
+    field_key = field.key
+    if field.typed:
+        arr = obj_dict[field_key] = field.container_class()
+        buf.read_typed_array(arr)
+    elif field.array:
+        op_count = buf.read_array_ops_head()
+        if op_count >= 0 and not context.sync_mode:
+            _skip_array_ops(buf, field, op_count)  # 非sync模式忽略数组操作
+            return
+        if op_count >= 0:
+            ops_arr = _field_array(obj_dict, field)
+            for i in range(op_count):
+                op = buf.read_uint8()
+                index = buf.read_uint32()
+                value = None
+                if op != ARRAY_OP_REMOVE:
+                    value = _field_value_from_binary(
+                        buf, field, old_value=None,
+                        oid=None, context=context, paths=paths)
+                ops_arr._apply_op(op, index, value)
+            if field.ref:
+                _add_array_refs(ops_arr, context)
+            return
+        arr = obj_dict[field_key] = field.container_class()
+        asize = buf.read_container_head(C_ARRAY_32)
+        for i in range(asize):
+            value = _field_value_from_binary(
+                buf, field, old_value=None,
+                oid=None, context=context, paths=paths)
+            arr._append(value)  # 调用_append避免修改changed标志
+            if field.ref:
+                context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
+    elif field.map:
+        m = None
+        if context.sync_mode:
+            m = obj_dict.get(field_key)
+        if m is None:
+            m = field.container_class()
+            obj_dict[field_key] = m
+        _decode_tombstones(buf, field, m, context)
+        asize = buf.read_container_head(C_MAP_32)
+        for i in range(asize):
+            old_value = None
+            key = buf.read_value(field.bin_key_type)
+            if context.sync_mode:
+                old_value = m.get(key)
+            value = _field_value_from_binary(
+                buf, field, old_value=old_value,
+                oid=None, context=context, paths=paths)
+            m._setitem(key, value)  # 调用_setitem避免修改changed标志
+            if field.ref:
+                context.add_unsolved_ref(('map', m, key, value))
+    elif field.id_map:
+        m = None
+        if context.sync_mode:
+            m = obj_dict.get(field_key)
+        if m is None:
+            m = field.container_class()
+            obj_dict[field_key] = m
+        _decode_tombstones(buf, field, m, context)
+        asize = buf.read_container_head(C_ID_MAP_32)
+        for i in range(asize):
+            old_value = None
+            oid = buf.read_value(field.bin_key_type)
+            if context.sync_mode:
+                old_value = m.get(oid)
+            value = _field_value_from_binary(
+                buf, field, old_value=old_value,
+                oid=oid, context=context, paths=paths)
+            m._setitem(oid, value)  # 调用_setitem避免修改changed标志
+            if field.ref:
+                context.add_unsolved_ref(('map', m, oid, value))
+    else:
+        old_value = None
+        if context.sync_mode:
+            old_value = obj_dict.get(field_key)
+        value = _field_value_from_binary(
+            buf, field, old_value=old_value,
+            oid=None, context=context, paths=paths)
+        obj_dict[field_key] = value
+        if field.ref:
+            context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
+
+cdef inline int _check_frame_end(ReadBuffer buf, Py_ssize_t frame_end, uint16_t field_index) except -1:
+    if buf.offset != frame_end:
+        raise PackError('field size mismatch, index={}'.format(field_index))
+    return 0
+
+cdef inline int _encode_framed_mark(WriteBuffer buf, bint framed) except -1:
+    if framed:
+        buf.write_uint16(FRAMED_MARK)
+    return 0
+
+cdef int _decode_framed_mark(ReadBuffer buf, bint framed) except -1:
+    '''检查数据开头的FRAMED_MARK和framed参数是否一致，不一致的话按另一种格式解码会得到错误的值'''
+    if buf.at_end():
+        return 0
+    cdef Py_ssize_t offset = buf.offset
+    if buf.read_uint16() == FRAMED_MARK:
+        if not framed:
+            raise UnpackError('data is framed, unpack with framed=True')
+    else:
+        if framed:
+            raise UnpackError('data is not framed, unpack with framed=False')
+        buf.offset = offset
+    return 0
+
+cdef inline bint _is_lazy_field(Field field):
+    '''延迟解码的时候，子对象和容器字段只记录数据偏移'''
+    return field.container_class is not None or (field.is_data_model_type and not field.ref)
+
+cdef class LazyFields(object):
+    '''延迟解码的字段。保存在对象的__dict__['__lazy__']里。
+        data        -> 源数据
+        cls         -> 对象类型
+        offsets     -> 字段key => 字段数据在源数据里的偏移
+        context     -> 解码用的DecodeContext
+        paths       -> 需要解码的字段路径
+        mark_change -> 解码出来的字段是否设置changed标志
+        copy_bytes  -> 同ReadBuffer
+    '''
+    cdef object data
+    cdef object cls
+    cdef readonly dict offsets
+    cdef DecodeContext context
+    cdef dict paths
+    cdef public bint mark_change
+    cdef bint copy_bytes
+
+    def __cinit__(self, data, cls, dict offsets, DecodeContext context, dict paths,
+                  bint copy_bytes=False):
+        self.data = data
+        self.copy_bytes = copy_bytes
+        self.cls = cls
+        self.offsets = offsets
+        self.context = context
+        self.paths = paths
+        self.mark_change = context.mark_change
+
+cdef inline bint _is_lazy_pending(dict obj_dict, key):
+    cdef LazyFields lazy = obj_dict.get('__lazy__')
+    return lazy is not None and key in lazy.offsets
+
+cdef _drop_lazy_field(dict obj_dict, key):
+    cdef LazyFields lazy = obj_dict.get('__lazy__')
+    if lazy is not None:
+        lazy.offsets.pop(key, None)
+        if not lazy.offsets:
+            del obj_dict['__lazy__']
+
+cdef _load_lazy_field(dict obj_dict, key):
+    _drop_clean(obj_dict)
+    cdef LazyFields lazy = obj_dict['__lazy__']
+    offset = lazy.offsets.pop(key, None)
+    if not lazy.offsets:
+        del obj_dict['__lazy__']
+    if offset is None:
+        return
+    cdef ReadBuffer buf = ReadBuffer(lazy.data, lazy.copy_bytes)
+    buf.offset = offset
+    cdef DecodeContext context = lazy.context
+    context.mark_change = lazy.mark_change
+    cdef Field field = lazy.cls._fields_by_key[key]
+    _decode_field_from_binary(buf, field, obj_dict, context, _sub_paths(field, lazy.paths))
+    context.resolve_ref()
+
+cdef _load_all_lazy(dict obj_dict):
+    cdef LazyFields lazy = obj_dict.get('__lazy__')
+    if lazy is None:
+        return
+    for key in lazy.offsets.keys():
+        _load_lazy_field(obj_dict, key)
+
+cdef int _skip_binary_value(ReadBuffer buf, Field field) except -1:
+    if field.bin_type != BT_NONE:
+        return buf.skip_value(field.bin_type)
+    elif field.ref:
+        return buf.skip_value(field.bin_ref_type)
+    else:
+        return _skip_binary_object(buf, field.value_type)
+
+cdef int _skip_array_ops(ReadBuffer buf, Field field, Py_ssize_t op_count) except -1:
+    cdef Py_ssize_t i
+    cdef int op
+    for i in range(op_count):
+        op = buf.read_uint8()
+        buf.read_uint32()
+        if op != ARRAY_OP_REMOVE:
+            _skip_binary_value(buf, field)
+    return 0
+
+cdef int _skip_binary_field(ReadBuffer buf, Field field) except -1:
+    '''字段index已经读出。跳过字段数据，不解码'''
+    cdef uint32_t asize, i
+    cdef Py_ssize_t op_count
+    if field.array:
+        op_count = buf.read_array_ops_head()
+        if op_count >= 0:
+            _skip_array_ops(buf, field, op_count)
+        else:
+            asize = buf.read_container_head(C_ARRAY_32)
+            for i in range(asize):
+                _skip_binary_value(buf, field)
+    elif field.map or field.id_map:
+        asize = buf.read_tombstones_head()
+        for i in range(asize):
+            buf.skip_value(field.bin_key_type)
+        asize = buf.read_container_head(C_MAP_32 if field.map else C_ID_MAP_32)
+        for i in range(asize):
+            buf.skip_value(field.bin_key_type)
+            _skip_binary_value(buf, field)
+    else:
+        _skip_binary_value(buf, field)
+    return 0
+
+cdef int _skip_binary_object(ReadBuffer buf, cls) except -1:
+    cdef dict _fields_by_index = cls._fields_by_index
+    cdef Field field
+    cdef uint16_t field_index
+    while not buf.at_end():
+        field_index = buf.read_uint16()
+        if field_index == 0:
             break
-        field_index = bin_decode_field_index(buf)
+        field = _fields_by_index.get(field_index)
+        if not field:
+            raise PackError('unkown field, ndex={}'.format(field_index))
+        _skip_binary_field(buf, field)
+    return 0
+
+cdef _decode_from_binary_lazy(ReadBuffer buf, cls, dict obj_dict, DecodeContext context,
+                              dict paths=None):
+    '''从binary buff恢复对象数据。基本类型的字段直接解码，子对象和容器字段只记录
+        数据偏移，在第一次访问的时候再解码。
+    '''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef bint mark_change = context.mark_change
+    cdef bint framed = context.framed
+    cdef dict _fields_by_index = cls._fields_by_index
+    cdef dict offsets = {}
+    cdef Field field
+    cdef uint16_t field_index
+    cdef uint32_t frame_size = 0
+    cdef Py_ssize_t frame_end = 0
+
+    while not buf.at_end():
+        field_index = buf.read_uint16()
         if field_index == 0:
             # end of field
             break
+        if framed:
+            frame_size = buf.read_uint32()
+            frame_end = buf.offset + frame_size
         field = _fields_by_index.get(field_index)
         if not field:
+            if framed:
+                buf.push(frame_size)
+                continue
             raise PackError('unkown field, ndex={}'.format(field_index))
-        decoder = field.bin_decoder
-        kdecoder = field.bin_key_decoder
-        field_key = field.key
-        if field.array:
-            arr = obj_dict[field_key] = field.container_class()
-            asize = bin_decode_array_head(buf)
-            for _ in xrange(asize):
-                value = _field_value_from_binary(
-                    buf, decoder, field, old_value=None,
-                    oid=None, context=context)
-                arr._append(value)  # 调用_append避免修改changed标志
-                if field.ref:
-                    context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
-        elif field.map:
-            m = None
-            if context.sync_mode:
-                m = obj_dict.get(field_key)
-            if m is None:
-                m = field.container_class()
-                obj_dict[field_key] = m
-            asize = bin_decode_map_head(buf)
-            for _ in xrange(asize):
-                old_value = None
-                key = kdecoder(buf)
-                if context.sync_mode:
-                    old_value = m.get(key)
-                value = _field_value_from_binary(
-                    buf, decoder, field, old_value=old_value,
-                    oid=None, context=context)
-                m._setitem(key, value)  # 调用_setitem避免修改changed标志
-                if field.ref:
-                    context.add_unsolved_ref(('map', m, key, value))
-        elif field.id_map:
-            m = None
-            if context.sync_mode:
-                m = obj_dict.get(field_key)
-            if m is None:
-                m = field.container_class()
-                obj_dict[field_key] = m
-            asize = bin_decode_id_map_head(buf)
-            for _ in xrange(asize):
-                old_value = None
-                oid = kdecoder(buf)
-                if context.sync_mode:
-                    old_value = m.get(oid)
-                value = _field_value_from_binary(
-                    buf, decoder, field, old_value=old_value,
-                    oid=oid, context=context)
-                m._setitem(oid, value)  # 调用_setitem避免修改changed标志
-                if field.ref:
-                    context.add_unsolved_ref(('map', m, oid, value))
+        if _is_decode_skipped(field, paths, context):
+            if framed:
+                buf.push(frame_size)
+            else:
+                _skip_binary_field(buf, field)
+            continue
+        if _is_lazy_field(field):
+            offsets[field.key] = buf.offset
+            obj_dict.pop(field.key, None)
+            if framed:
+                buf.push(frame_size)
+            else:
+                _skip_binary_field(buf, field)
         else:
-            old_value = None
-            if context.sync_mode:
-                old_value = obj_dict.get(field_key)
-            value = _field_value_from_binary(
-                buf, decoder, field, old_value=old_value,
-                oid=None, context=context)
+            _decode_field_from_binary(buf, field, obj_dict, context)
+            if framed:
+                _check_frame_end(buf, frame_end, field_index)
+
+        if mark_change:
+            _mark_changed_self_dict(field_index, obj_dict)
+
+    if offsets:
+        obj_dict['__lazy__'] = LazyFields(buf.src, cls, offsets, context, paths, buf.copy_bytes)
+
+cdef _decode_from_binary(ReadBuffer buf, obj, cls, dict obj_dict, DecodeContext context,
+                         dict paths=None):
+    '''从binary buff恢复对象数据。paths是需要解码的字段路径，参见_make_field_paths'''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef bint mark_change = context.mark_change
+    cdef bint framed = context.framed
+    cdef bint filtered = paths is not None or context.field_filter is not None
+    cdef dict _fields_by_index = cls._fields_by_index
+    cdef dict runs_by_index = (<BinaryCodec>cls._bin_codec).runs_by_index
+    cdef ScalarRun run
+    cdef Field field
+    cdef uint16_t field_index
+    cdef uint32_t frame_size = 0
+    cdef Py_ssize_t frame_end = 0
+
+    while True:
+        if buf.at_end():
+            break
+        field_index = buf.read_uint16()
+        if field_index == 0:
+            # end of field
+            break
+        if framed:
+            frame_size = buf.read_uint32()
+            frame_end = buf.offset + frame_size
+        elif not filtered:
+            run = runs_by_index.get(field_index)
+            if run is not None and _decode_scalar_run(buf, run, obj_dict):
+                if mark_change:
+                    for index in run.indexes:
+                        _mark_changed_self_dict(index, obj_dict)
+                continue
+        field = _fields_by_index.get(field_index)
+        if not field:
+            if framed:
+                # 分帧格式可以直接跳过不认识的字段
+                buf.push(frame_size)
+                continue
+            raise PackError('unkown field, ndex={}'.format(field_index))
+        if filtered and _is_decode_skipped(field, paths, context):
+            if framed:
+                buf.push(frame_size)
+            else:
+                _skip_binary_field(buf, field)
+            continue
+        _decode_field_from_binary(buf, field, obj_dict, context, _sub_paths(field, paths))
+        if framed:
+            _check_frame_end(buf, frame_end, field_index)
+
+        if mark_change:
+            _mark_changed_self_dict(field_index, obj_dict)
+
+    _move_to_slots(obj, obj_dict)
+
+cdef int _field_value_to_binary2(WriteBuffer buf, Field field, value, bint recursive,
+                                 bint only_changed, bint clear_changed,
+                                 FieldFilter field_filter) except -1:
+    if field.bin_type != BT_NONE:
+        return bin2_write_value(buf, field.bin_type, value)
+    elif field.ref:
+        return bin2_write_value(buf, field.bin_ref_type, value.oid)
+    else:
+        return _encode_to_binary2(buf, field.value_type, value,
+                                  recursive=recursive,
+                                  only_changed=only_changed,
+                                  clear_changed=clear_changed,
+                                  field_filter=field_filter)
+
+cdef int _write_bin2_map_head(WriteBuffer buf, Field field, Py_ssize_t size, list removed) except -1:
+    '''写入bin2格式的map头。增量数据里有删除了的key时，类型字节带上标志，后面接着写入删除了的key'''
+    cdef uint64_t types = (field.bin2_key_wire_type << 3) | field.bin2_wire_type
+    write_varint(buf, size)
+    if not removed:
+        return write_varint(buf, types)
+    write_varint(buf, types | BIN2_MAP_TOMBSTONES)
+    write_varint(buf, len(removed))
+    for k in removed:
+        bin2_write_value(buf, field.bin_key_type, k)
+    return 0
+
+cdef int _encode_to_binary2(WriteBuffer buf, cls, obj, bint recursive, bint only_changed,
+                            bint clear_changed, FieldFilter field_filter) except -1:
+    '''将对象数据转储成bin2格式。参数同_encode_to_binary。'''
+    cdef dict obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef Field field
+    cdef FieldFilter i_field_filter
+
+    for field in cls._fields:
+        value = _field_value(obj, obj_dict, field)
+        if value is None:
+            continue
+
+        if field_filter.is_filted(field):
+            continue
+
+        if not recursive and field.bin2_wire_type == WT_OBJECT:
+            continue
+
+        if only_changed:
+            if not _has_field_changed(obj, field, recursive):
+                continue
+
+        write_tag(buf, field.index, field.bin2_field_wire_type)
+        if field.array:
+            # 解码的时候整个替换数组，元素需要完整打包
+            write_varint(buf, len(value))
+            write_varint(buf, field.bin2_wire_type)
+            for v in value:
+                _field_value_to_binary2(buf, field, v, recursive, False,
+                                        clear_changed, field_filter)
+        elif field.map:
+            entries = _map_entries(value, only_changed)
+            _write_bin2_map_head(buf, field, len(entries),
+                                 _removed_map_keys(value) if only_changed else None)
+            for k, v in entries.iteritems():
+                bin2_write_value(buf, field.bin_key_type, k)
+                _field_value_to_binary2(buf, field, v, recursive, only_changed,
+                                        clear_changed, field_filter)
+        elif field.id_map:
+            entries = _map_entries(value, only_changed)
+            _write_bin2_map_head(buf, field, len(entries),
+                                 _removed_map_keys(value) if only_changed else None)
+            i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+            for v in entries.itervalues():
+                bin2_write_value(buf, field.bin_key_type, v.oid)
+                _field_value_to_binary2(buf, field, v, recursive, only_changed,
+                                        clear_changed, i_field_filter)
+        else:
+            _field_value_to_binary2(buf, field, value, recursive, only_changed,
+                                    clear_changed, field_filter)
+
+    if clear_changed:
+        _clear_changed(obj, None, recursive=False)
+
+    write_varint(buf, 0)
+    return 0
+
+cdef _field_value_from_binary2(ReadBuffer buf, Field field, old_value, oid,
+                               DecodeContext context, dict paths=None):
+    if field.bin_type != BT_NONE:
+        return bin2_read_value(buf, field.bin_type)
+    elif field.ref:
+        return bin2_read_value(buf, field.bin_ref_type)
+    else:
+        if old_value is not None:
+            fobj = old_value
+            obj_dict = fobj.__dict__
+        else:
+            fobj = None
+            obj_dict = {}
+        fcls = field.value_type
+        _decode_from_binary2(buf, fobj, fcls, obj_dict, context, paths)
+        if fobj is None:
+            fobj = _create_object(field, fcls, obj_dict)
+            _replace_obj_dict(fobj, obj_dict)
+        if oid is not None:
+            fobj._oid = oid
+            context.add_known_object(oid, fobj)
+        return fobj
+
+cdef inline int _check_wire_type(Field field, uint64_t wire_type, int expected) except -1:
+    if wire_type != <uint64_t>expected:
+        raise PackError('wire type mismatch, field={}, wire_type={}'.format(field.name, wire_type))
+    return 0
+
+cdef int _decode_from_binary2(ReadBuffer buf, obj, cls, dict obj_dict,
+                              DecodeContext context, dict paths=None) except -1:
+    '''从bin2格式的数据恢复对象数据。不认识的字段会被跳过。paths同_decode_from_binary'''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef bint mark_change = context.mark_change
+    cdef dict _fields_by_index = cls._fields_by_index
+    cdef Field field
+    cdef dict sub_paths
+    cdef uint64_t tag, field_index, asize, i, types
+    cdef bint tombstones
+
+    while True:
+        if buf.at_end():
+            break
+        tag = read_varint(buf)
+        field_index = tag >> 3
+        if field_index == 0:
+            # end of field
+            break
+        field = _fields_by_index.get(field_index)
+        if not field:
+            bin2_skip_value(buf, tag & 0x07)
+            continue
+        if _is_decode_skipped(field, paths, context):
+            bin2_skip_value(buf, tag & 0x07)
+            continue
+        _check_wire_type(field, tag & 0x07, field.bin2_field_wire_type)
+        sub_paths = _sub_paths(field, paths)
+        field_key = field.key
+        if field.array:
+            arr = obj_dict[field_key] = field.container_class()
+            asize = read_varint(buf)
+            _check_wire_type(field, read_varint(buf), field.bin2_wire_type)
+            for i in range(asize):
+                value = _field_value_from_binary2(buf, field, None, None, context, sub_paths)
+                arr._append(value)  # 调用_append避免修改changed标志
+                if field.ref:
+                    context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
+        elif field.map or field.id_map:
+            m = None
+            if context.sync_mode:
+                m = obj_dict.get(field_key)
+            if m is None:
+                m = field.container_class()
+                obj_dict[field_key] = m
+            asize = read_varint(buf)
+            types = read_varint(buf)
+            tombstones = types & BIN2_MAP_TOMBSTONES
+            types &= ~(<uint64_t>BIN2_MAP_TOMBSTONES)
+            _check_wire_type(field, types >> 3, field.bin2_key_wire_type)
+            _check_wire_type(field, types & 0x07, field.bin2_wire_type)
+            if tombstones:
+                # 删除了的key。sync模式下从m里删除，否则忽略
+                for i in range(read_varint(buf)):
+                    key = bin2_read_value(buf, field.bin_key_type)
+                    if context.sync_mode and key in m:
+                        m._delitem(key)  # 调用_delitem避免修改changed标志
+            for i in range(asize):
+                old_value = None
+                key = bin2_read_value(buf, field.bin_key_type)
+                if context.sync_mode:
+                    old_value = m.get(key)
+                value = _field_value_from_binary2(
+                    buf, field, old_value, key if field.id_map else None, context, sub_paths)
+                m._setitem(key, value)  # 调用_setitem避免修改changed标志
+                if field.ref:
+                    context.add_unsolved_ref(('map', m, key, value))
+        else:
+            old_value = None
+            if context.sync_mode:
+                old_value = obj_dict.get(field_key)
+            value = _field_value_from_binary2(buf, field, old_value, None, context, sub_paths)
             obj_dict[field_key] = value
             if field.ref:
                 context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
@@ -985,6 +2257,218 @@ cdef _decode_from_binary(buf, obj, cls, obj_dict, context):
         if mark_change:
             _mark_changed_self_dict(field_index, obj_dict)
 
+    _move_to_slots(obj, obj_dict)
+    return 0
+
+cdef int _field_value_to_bson(WriteBuffer buf, Field field, value, bint recursive,
+                              bint only_changed, bint clear_changed,
+                              FieldFilter field_filter) except -1:
+    if field.bin_type != BT_NONE:
+        return bson_write_value(buf, field.bin_type, value)
+    elif field.ref:
+        return bson_write_value(buf, field.bin_ref_type, value.oid)
+    else:
+        return _encode_to_bson(buf, field.value_type, value,
+                               recursive=recursive,
+                               only_changed=only_changed,
+                               clear_changed=clear_changed,
+                               field_filter=field_filter)
+
+cdef int _encode_to_bson(WriteBuffer buf, cls, obj, bint recursive, bint only_changed,
+                         bint clear_changed, FieldFilter field_filter) except -1:
+    '''将对象数据转储成BSON文档。参数同_encode_to_binary。
+        和pack_to_dict一样，增量打包时map里删除的key输出为null。
+    '''
+    cdef dict obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef Field field
+    cdef FieldFilter i_field_filter
+    cdef Py_ssize_t i
+    cdef Py_ssize_t doc_offset = bson_begin_document(buf)
+    cdef Py_ssize_t offset
+
+    for field in cls._fields:
+        value = _field_value(obj, obj_dict, field)
+        if value is None:
+            continue
+
+        if field_filter.is_filted(field):
+            continue
+
+        if not recursive and field.bson_type == BSON_DOCUMENT:
+            continue
+
+        if only_changed:
+            if not _has_field_changed(obj, field, recursive):
+                continue
+
+        if field.array:
+            bson_write_element_head(buf, BSON_ARRAY, field.name)
+            offset = bson_begin_document(buf)
+            i = 0
+            for v in value:
+                bson_write_element_head(buf, field.bson_type, str(i))
+                _field_value_to_bson(buf, field, v, recursive, False,
+                                     clear_changed, field_filter)
+                i += 1
+            bson_end_document(buf, offset)
+        elif field.map or field.id_map:
+            bson_write_element_head(buf, BSON_DOCUMENT, field.name)
+            offset = bson_begin_document(buf)
+            kencoder = field.dict_key_encoder
+            entries = _map_entries(value, only_changed)
+            if field.map:
+                for k, v in entries.iteritems():
+                    bson_write_element_head(buf, field.bson_type, kencoder(k))
+                    _field_value_to_bson(buf, field, v, recursive, only_changed,
+                                         clear_changed, field_filter)
+            else:
+                i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+                for v in entries.itervalues():
+                    bson_write_element_head(buf, field.bson_type, kencoder(v.oid))
+                    _field_value_to_bson(buf, field, v, recursive, only_changed,
+                                         clear_changed, i_field_filter)
+            if only_changed:
+                for k in _removed_map_keys(value):
+                    bson_write_element_head(buf, BSON_NULL, kencoder(k))
+            bson_end_document(buf, offset)
+        else:
+            bson_write_element_head(buf, field.bson_type, field.name)
+            _field_value_to_bson(buf, field, value, recursive, only_changed,
+                                 clear_changed, field_filter)
+
+    if clear_changed:
+        _clear_changed(obj, None, recursive=False)
+
+    bson_end_document(buf, doc_offset)
+    return 0
+
+cdef inline int _check_bson_type(Field field, int bson_type, int bin_type) except -1:
+    if not bson_type_accepted(bin_type, bson_type):
+        raise PackError('bson type mismatch, field={}, bson_type={}'.format(field.name, bson_type))
+    return 0
+
+cdef _field_value_from_bson(ReadBuffer buf, Field field, int bson_type, old_value, oid,
+                            DecodeContext context, dict paths=None):
+    if field.bin_type != BT_NONE:
+        _check_bson_type(field, bson_type, field.bin_type)
+        return bson_read_value(buf, field.bin_type, bson_type)
+    elif field.ref:
+        _check_bson_type(field, bson_type, field.bin_ref_type)
+        return bson_read_value(buf, field.bin_ref_type, bson_type)
+    else:
+        _check_bson_type(field, bson_type, BT_NONE)
+        if old_value is not None:
+            fobj = old_value
+            obj_dict = fobj.__dict__
+        else:
+            fobj = None
+            obj_dict = {}
+        fcls = field.value_type
+        _decode_from_bson(buf, fobj, fcls, obj_dict, context, paths)
+        if fobj is None:
+            fobj = _create_object(field, fcls, obj_dict)
+            _replace_obj_dict(fobj, obj_dict)
+        if oid is not None:
+            fobj._oid = oid
+            context.add_known_object(oid, fobj)
+        return fobj
+
+cdef int _decode_from_bson(ReadBuffer buf, obj, cls, dict obj_dict,
+                           DecodeContext context, dict paths=None) except -1:
+    '''从BSON文档恢复对象数据。不认识的字段(比如MongoDB的_id)会被跳过。
+        和unpack_from_dict一样，不解码为null的值。sync模式下map里为null的key会被删除。
+        paths同_decode_from_binary
+    '''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef bint mark_change = context.mark_change
+    cdef dict _fields_by_name = cls._fields_by_name
+    cdef Field field
+    cdef dict sub_paths
+    cdef int bson_type, elem_type
+    cdef Py_ssize_t end = bson_read_document_begin(buf)
+    cdef Py_ssize_t container_end
+
+    while True:
+        bson_type = bson_read_type(buf)
+        if bson_type == 0:
+            # end of document
+            break
+        field = _fields_by_name.get(bson_read_cstring(buf))
+        if not field or bson_type == BSON_NULL or _is_decode_skipped(field, paths, context):
+            bson_skip_value(buf, bson_type)
+            continue
+        sub_paths = _sub_paths(field, paths)
+        field_key = field.key
+        if field.array:
+            if bson_type != BSON_ARRAY:
+                raise PackError('bson type mismatch, field={}, bson_type={}'.format(
+                    field.name, bson_type))
+            arr = obj_dict[field_key] = field.container_class()
+            container_end = bson_read_document_begin(buf)
+            while True:
+                elem_type = bson_read_type(buf)
+                if elem_type == 0:
+                    break
+                bson_skip_cstring(buf)
+                if elem_type == BSON_NULL:
+                    continue
+                value = _field_value_from_bson(buf, field, elem_type, None, None,
+                                               context, sub_paths)
+                arr._append(value)  # 调用_append避免修改changed标志
+                if field.ref:
+                    context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
+            bson_read_document_end(buf, container_end)
+        elif field.map or field.id_map:
+            if bson_type != BSON_DOCUMENT:
+                raise PackError('bson type mismatch, field={}, bson_type={}'.format(
+                    field.name, bson_type))
+            m = None
+            if context.sync_mode:
+                m = obj_dict.get(field_key)
+            if m is None:
+                m = field.container_class()
+                obj_dict[field_key] = m
+            kdecoder = field.dict_key_decoder
+            container_end = bson_read_document_begin(buf)
+            while True:
+                elem_type = bson_read_type(buf)
+                if elem_type == 0:
+                    break
+                key = kdecoder(bson_read_cstring(buf))
+                if elem_type == BSON_NULL:
+                    if context.sync_mode and key in m:
+                        del m[key]
+                    continue
+                old_value = None
+                if context.sync_mode:
+                    old_value = m.get(key)
+                value = _field_value_from_bson(buf, field, elem_type, old_value,
+                                               key if field.id_map else None, context, sub_paths)
+                m._setitem(key, value)  # 调用_setitem避免修改changed标志
+                if field.ref:
+                    context.add_unsolved_ref(('map', m, key, value))
+            bson_read_document_end(buf, container_end)
+        else:
+            old_value = None
+            if context.sync_mode:
+                old_value = obj_dict.get(field_key)
+            value = _field_value_from_bson(buf, field, bson_type, old_value, None,
+                                           context, sub_paths)
+            obj_dict[field_key] = value
+            if field.ref:
+                context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
+
+        if mark_change:
+            _mark_changed_self_dict(field.index, obj_dict)
+
+    bson_read_document_end(buf, end)
+    _move_to_slots(obj, obj_dict)
+    return 0
+
 cdef class DecodeContext(object):
     cdef dict known_objects
     cdef list tmp_unsolved_ref
@@ -993,8 +2477,16 @@ cdef class DecodeContext(object):
     cdef bint mark_change
     cdef str mode
     cdef bint sync_mode
-
-    def __cinit__(self, mode=None, resolve_ref=None, mark_change=False):
+    cdef bint lazy
+    cdef bint framed
+    cdef FieldFilter field_filter
+
+    def __cinit__(self, mode=None, resolve_ref=None, mark_change=False, lazy=False, framed=False,
+                  field_filter=None):
+        self.lazy = lazy
+        self.framed = framed
+        if field_filter is not None:
+            self.field_filter = FieldFilter(field_filter)
         self.known_objects = {}
         self.tmp_unsolved_ref = []
         self.unsolved_ref = {}
@@ -1038,21 +2530,40 @@ cdef class DecodeContext(object):
                     self.unsolved_ref[v] = True
                     continue
                 container[k] = obj
+        self.tmp_unsolved_ref = []
 
 cdef class Array(list):
+    '''数组。清除changed标志以后记录append, set, insert, remove操作，增量打包时输出操作代替整个数组。
+        操作个数超过MAX_ARRAY_OPS，或者有sort这样不能记录的改变时，增量数据里输出整个数组。
+    '''
     cdef bint _changed
+    cdef public bint _clean
+    cdef public object _owner
+    cdef list _ops
+    cdef unsigned long long _version
+    cdef public object _rec_parent
 
     def __cinit__(self, *arg, **kwargs):
         list.__init__(self, *arg, **kwargs)
         self._changed = False
+        self._clean = False
+        self._owner = None
+        self._ops = None
+        self._version = 0
+        self._rec_parent = None
 
     cpdef set_changed(self):
         self._changed = True
+        self._ops = None
+        self._version = _next_version()
+        _propagate_dirty(self)
+        if _recorders:
+            _record_container(self, MUTATION_SET_FIELD)
 
     cpdef has_changed(self, recursive=False):
         if self._changed:
             return self._changed
-        if recursive:
+        if recursive and not self._clean:
             for value in self:
                 if _try_check_changed(value):
                     return True
@@ -1063,46 +2574,117 @@ cdef class Array(list):
         if recursive:
             for value in self:
                 _try_clear_changed(value)
+            self._clean = _is_elements_clean(self, enumerate(self))
+        else:
+            self._clean = _is_elements_clean(self, self._changed_items())
+        # 元素都clean以后，元素的改变都会记成set操作。ref的元素不算改变
+        self._ops = [] if self._clean or _is_ref_container(self) else None
+
+    cdef object _changed_items(self):
+        '''清除changed标志时需要检查的(位置, 元素)。只有append和set操作的时候，
+            其他元素的位置没有变，还是clean的
+        '''
+        cdef set indexes = set()
+        cdef Py_ssize_t size = len(self)
+        if self._ops is None:
+            return enumerate(self)
+        for op, index, _ in self._ops:
+            if op != ARRAY_OP_APPEND and op != ARRAY_OP_SET:
+                return enumerate(self)
+            indexes.add(index)
+        return [(k, self[k]) for k in indexes if k < size]
+
+    cdef int _log_op(self, int op, Py_ssize_t index, object value, bint record=True) except -1:
+        self._changed = True
+        self._version = _next_version()
+        _propagate_dirty(self)
+        if self._ops is not None:
+            if len(self._ops) < MAX_ARRAY_OPS:
+                self._ops.append((op, index, value))
+            else:
+                self._ops = None
+        if record and _recorders:
+            _record_container(self, MUTATION_ARRAY_OP, None, value, op, index)
+        return 0
+
+    cdef int _log_element(self, object k, dict v_dict) except -1:
+        '''位置k的对象元素有了改变，记成当前位置的set操作。之前的insert和remove改变了元素的位置时，
+            重新查找元素的位置
+        '''
+        cdef Py_ssize_t i
+        if self._ops is None:
+            return 0
+        if k >= len(self) or getattr(self[k], '__dict__', None) is not v_dict:
+            for i, v in enumerate(self):
+                if getattr(v, '__dict__', None) is v_dict:
+                    k = i
+                    break
+            else:
+                return 0  # 元素已经不在数组里
+        self._log_op(ARRAY_OP_SET, k, self[k], False)  # 元素自己的修改已经记录了
+        return 0
+
+    cpdef _apply_op(self, int op, Py_ssize_t index, value):
+        '''解码的时候应用增量数据里的数组操作，不修改changed标志'''
+        _apply_array_op(self, op, index, value)
+        self._ops = None
+        _propagate_dirty(self)
 
     def __setitem__(self, k, v):
-        self._changed = True
-        self.broadcast_changed()
         list.__setitem__(self, k, v)
+        if isinstance(k, slice):
+            self.set_changed()
+        else:
+            self._log_op(ARRAY_OP_SET, k + len(self) if k < 0 else k, v)
 
     def __delitem__(self, k):
-        self._changed = True
-        self.broadcast_changed()
-        list.__delitem__(self, k)
+        if isinstance(k, slice):
+            list.__delitem__(self, k)
+            self.set_changed()
+        else:
+            if k < 0:
+                k += len(self)
+            list.__delitem__(self, k)
+            self._log_op(ARRAY_OP_REMOVE, k, None)
+
+    def __setslice__(self, Py_ssize_t i, Py_ssize_t j, v):
+        list.__setslice__(self, i, j, v)
+        self.set_changed()
+
+    def __delslice__(self, Py_ssize_t i, Py_ssize_t j):
+        list.__delslice__(self, i, j)
+        self.set_changed()
 
     def __iadd__(self, other):
-        self._changed = True
-        self.broadcast_changed()
-        return list.__iadd__(self, other)
+        self.extend(other)
+        return self
 
     def __imul__(self, other):
         raise NotImplementedError('unsupport')
 
     def append(self, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.append(self, v)
+        list.append(self, v)
+        self._log_op(ARRAY_OP_APPEND, len(self) - 1, v)
 
     cpdef _append(self, v):
         return list.append(self, v)
 
     def extend(self, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.extend(self, v)
-
-    def insert(self, k, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.insert(self, k, v)
+        cdef Py_ssize_t k, start = len(self)
+        list.extend(self, v)
+        for k in range(start, len(self)):
+            self._log_op(ARRAY_OP_APPEND, k, self[k])
+
+    def insert(self, Py_ssize_t k, v):
+        cdef Py_ssize_t size = len(self)
+        if k < 0:
+            k = max(k + size, 0)
+        elif k > size:
+            k = size
+        list.insert(self, k, v)
+        self._log_op(ARRAY_OP_INSERT, k, v)
 
     def pop(self, k=None):
-        self._changed = True
-        self.broadcast_changed()
         if k is None:
             k = -1
         x = self[k]
@@ -1110,37 +2692,197 @@ cdef class Array(list):
         return x
 
     def remove(self, x):
-        self._changed = True
-        self.broadcast_changed()
-        list.remove(self, x)
+        cdef Py_ssize_t k = list.index(self, x)
+        list.__delitem__(self, k)
+        self._log_op(ARRAY_OP_REMOVE, k, None)
 
     def sort(self, *arg, **kwargs):
-        self._changed = True
-        self.broadcast_changed()
-        return list.sort(self, *arg, **kwargs)
+        list.sort(self, *arg, **kwargs)
+        self.set_changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self.set_changed()
 
     def broadcast_changed(self):
         for v in self:
             _try_set_changed(v)
 
+class TypedArray(array):
+    '''typed数组。元素是定长数值，存储在连续的buffer里，二进制格式编解码的时候整块复制。
+        支持buffer协议，可以用numpy.frombuffer(arr, dtype)直接访问数据，不需要复制。
+        通过numpy修改的数据不会设置changed标志，需要自己调用set_changed。
+    '''
+    _typecode = None
+
+    def __new__(cls, *arg):
+        return array.__new__(cls, cls._typecode, *arg)
+
+    def __init__(self, *arg):
+        self._changed = False
+        self._clean = False
+        self._owner = None
+        self._version = 0
+        self._rec_parent = None
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self, memo):
+        return self.__class__(self)
+
+    def _touch(self):
+        '''修改以后调用。typed数组的修改记成整个字段的赋值'''
+        self._changed = True
+        self._version = _next_version()
+        _propagate_dirty(self)
+        if _recorders:
+            _record_container(self, MUTATION_SET_FIELD)
+
+    def set_changed(self):
+        self._touch()
+
+    def has_changed(self, recursive=False):
+        return self._changed
+
+    def clear_changed(self, recursive=False):
+        self._changed = False
+        self._clean = True
+
+    def broadcast_changed(self):
+        pass
+
+    def __setitem__(self, k, v):
+        result = array.__setitem__(self, k, v)
+        self._touch()
+        return result
+
+    def __delitem__(self, k):
+        result = array.__delitem__(self, k)
+        self._touch()
+        return result
+
+    def __setslice__(self, i, j, v):
+        result = array.__setslice__(self, i, j, v)
+        self._touch()
+        return result
+
+    def __delslice__(self, i, j):
+        result = array.__delslice__(self, i, j)
+        self._touch()
+        return result
+
+    def __iadd__(self, other):
+        result = array.__iadd__(self, other)
+        self._touch()
+        return result
+
+    def __imul__(self, other):
+        raise NotImplementedError('unsupport')
+
+    def append(self, v):
+        result = array.append(self, v)
+        self._touch()
+        return result
+
+    def _append(self, v):
+        return array.append(self, v)
+
+    def extend(self, v):
+        result = array.extend(self, v)
+        self._touch()
+        return result
+
+    def insert(self, k, v):
+        result = array.insert(self, k, v)
+        self._touch()
+        return result
+
+    def pop(self, k=-1):
+        result = array.pop(self, k)
+        self._touch()
+        return result
+
+    def remove(self, x):
+        result = array.remove(self, x)
+        self._touch()
+        return result
+
+    def reverse(self):
+        result = array.reverse(self)
+        self._touch()
+        return result
+
+    def byteswap(self):
+        result = array.byteswap(self)
+        self._touch()
+        return result
+
+    def fromlist(self, v):
+        result = array.fromlist(self, v)
+        self._touch()
+        return result
+
+    def fromstring(self, s):
+        result = array.fromstring(self, s)
+        self._touch()
+        return result
+
+    def fromfile(self, f, n):
+        result = array.fromfile(self, f, n)
+        self._touch()
+        return result
+
 cdef class Map(dict):
     cdef set _removed
     cdef set _changed
+    cdef set _dirty
+    cdef bint _tracked
+    cdef public bint _clean
+    cdef public object _owner
+    cdef dict _versions
+    cdef unsigned long long _version
+    cdef public object _rec_parent
 
     def __cinit__(self, *arg, **kwargs):
         dict.__init__(self, *arg, **kwargs)
         self._removed = set()
         self._changed = set()
+        self._dirty = set()
+        self._tracked = False
+        self._clean = False
+        self._owner = None
+        self._versions = {}
+        self._version = 0
+        self._rec_parent = None
 
     cpdef void set_changed(self):
         self._changed.add('*')
+        self._stamp(self.iterkeys())
+        _propagate_dirty(self)
+
+    cdef void _stamp(self, object keys):
+        '''记下修改了的key(包括删除了的key)的版本号'''
+        cdef unsigned long long version = _next_version()
+        self._version = version
+        if _track_versions:
+            for k in keys:
+                self._versions[k] = version
+
+    cpdef void prune_versions(self, unsigned long long min_version):
+        '''删除不晚于min_version的key版本号(包括删除了的key)。没有版本号的key当作没有修改过，
+            所以pack_since(version)的version不小于min_version时结果不变
+        '''
+        cdef dict versions = self._versions
+        for k in [k for k, ver in versions.iteritems() if ver <= min_version]:
+            del versions[k]
 
     cpdef bint has_changed(self, bint recursive=False):
         if self._changed:
             return True
         if self._removed:
             return True
-        if recursive:
+        if recursive and not self._clean:
             for value in self.itervalues():
                 if _try_check_changed(value):
                     return True
@@ -1152,52 +2894,110 @@ cdef class Map(dict):
         if recursive:
             for value in self.itervalues():
                 _try_clear_changed(value)
+            self._clean = _is_elements_clean(self, self.iteritems())
+        elif self._tracked:
+            # 没有记下key的元素都还是clean的
+            self._clean = _is_elements_clean(self, _map_entries(self, True).iteritems())
+        else:
+            self._clean = _is_elements_clean(self, self.iteritems())
+        # 元素都clean以后，只有记下了key的元素会有改变。ref的元素不算改变
+        self._tracked = self._clean or _is_ref_container(self)
+        self._dirty.clear()
 
     def __setitem__(self, k, v):
         dict.__setitem__(self, k, v)
         _try_set_changed(v)
         self._changed.add(k)
+        self._dirty.add(k)
+        self._stamp((k,))
+        _propagate_dirty(self)
         if k in self._removed:
             self._removed.remove(k)
+        if _recorders:
+            _record_container(self, MUTATION_MAP_SET, k, v)
 
     def __delitem__(self, k):
         dict.__delitem__(self, k)
         self._removed.add(k)
+        self._stamp((k,))
+        _propagate_dirty(self)
         if k in self._changed:
             self._changed.remove(k)
+        if _recorders:
+            _record_container(self, MUTATION_MAP_DEL, k)
 
     def _setitem(self, k, v):
+        self._tracked = False
+        _propagate_dirty(self)
         dict.__setitem__(self, k, v)
 
+    def _delitem(self, k):
+        _propagate_dirty(self)
+        dict.__delitem__(self, k)
+
     def clear(self):
         self._changed.clear()
         self._removed.update(self.iterkeys())
-        return dict.clear(self)
+        # 清空以后记下的key都是删除了的，重新记录成这次修改的版本号，可以一次prune_versions掉
+        cdef set keys = set(self._versions)
+        keys.update(self.iterkeys())
+        self._versions = {}
+        self._stamp(keys)
+        _propagate_dirty(self)
+        dict.clear(self)
+        if _recorders:
+            _record_container(self, MUTATION_SET_FIELD)
 
     def pop(self, key, *args, **kwargs):
+        cdef bint existed = _recorders != 0 and key in self
         cdef object v = dict.pop(self, key, *args, **kwargs)
+        self._stamp((key,))
+        _propagate_dirty(self)
         if key in self._changed:
             self._changed.remove(key)
         self._removed.add(key)
+        if existed:
+            _record_container(self, MUTATION_MAP_DEL, key)
         return v
 
     def popitem(self):
         key, value = dict.popitem(self)
+        self._stamp((key,))
+        _propagate_dirty(self)
         if key in self._changed:
             self._changed.remove(key)
         self._removed.add(key)
+        if _recorders:
+            _record_container(self, MUTATION_MAP_DEL, key)
         return (key, value)
 
     def setdefault(self, key, default=None):
         if default is None:
             default = self.value_field.value_type()
         self._changed.add(key)
+        self._dirty.add(key)
+        self._stamp((key,))
+        _propagate_dirty(self)
+        if _recorders and key not in self:
+            dict.__setitem__(self, key, default)
+            _record_container(self, MUTATION_MAP_SET, key, default)
+            return default
         return dict.setdefault(self, key, default)
 
     def update(self, *arg, **kwargs):
-        self.broadcast_changed()
-        self._changed.add('*')
-        return dict.update(self, *arg, **kwargs)
+        # 只记下更新了的key，不需要遍历其它元素
+        cdef dict items = dict(*arg, **kwargs)
+        dict.update(self, items)
+        for v in items.itervalues():
+            _try_set_changed(v)
+        self._changed.update(items)
+        self._dirty.update(items)
+        self._removed.difference_update(items)
+        self._stamp(items)
+        _propagate_dirty(self)
+        if _recorders:
+            for k, v in items.iteritems():
+                _record_container(self, MUTATION_MAP_SET, k, v)
 
     def broadcast_changed(self):
         for v in self.itervalues():
@@ -1240,6 +3040,7 @@ cdef class Field(object):
     cdef bint is_unsigned
     cdef bint ref
     cdef bint skip_changed
+    cdef bint typed
     cdef object create
     cdef object default
 
@@ -1256,6 +3057,14 @@ cdef class Field(object):
     cdef object bin_key_decoder
     cdef object bin_ref_encoder
     cdef object bin_ref_decoder
+    cdef int bin_type
+    cdef int bin_key_type
+    cdef int bin_ref_type
+    cdef int bin2_wire_type
+    cdef int bin2_key_wire_type
+    cdef int bin2_field_wire_type
+    cdef int bson_type
+    cdef int slot  # SlotDataModel里字段值在SlotStorage里的位置，-1表示字段值存放在__dict__里
 
     cdef dict __dict__
 
@@ -1263,9 +3072,13 @@ cdef class Field(object):
         def __get__(self):
             return self.index
 
+    property typed:
+        def __get__(self):
+            return self.typed
+
     def __cinit__(self, object typ, int index, bint array=False, bint map=False, bint id_map=False,
                   str key=None, object default=None, object min_value=None, bint arithm=False,
-                  bint ref=False, bint skip_changed=False, **kwargs):
+                  bint ref=False, bint skip_changed=False, bint typed=False, **kwargs):
         self.value_type = None
         if isinstance(typ, (str, unicode)) and typ in _default_values:
             self.type_name = typ
@@ -1279,11 +3092,13 @@ cdef class Field(object):
             raise DefineError('unsupported type')
 
         self.index = index
-        if index <= 0 or index > 2 ** 16:
+        if index <= 0 or index >= FRAMED_MARK:
             raise DefineError('invalid index')
 
         self.define_in_class = None
         self.array = array
+        if key == 'bytes':
+            raise DefineError('bytes can not be used as map key')
         self.key_type_name = key
         self.map = map
         self.id_map = id_map
@@ -1299,7 +3114,9 @@ cdef class Field(object):
         self.is_unsigned = True if self.type_name in _unsigned_types else False
         self.ref = ref
         self.skip_changed = skip_changed
+        self.typed = typed
         self.create = None
+        self.slot = -1
 
         self.__dict__.update(kwargs)
 
@@ -1330,15 +3147,39 @@ cdef class Field(object):
         self.bin_key_decoder = None
         self.bin_ref_encoder = None
         self.bin_ref_decoder = None
+        self.bin_type = get_bin_type(self.type_name)
+        self.bin_key_type = get_bin_type(self.key_type_name)
+        self.bin_ref_type = BT_NONE
         if self.ref:
             value_field = self.value_type._fields_by_name['oid']
             self.bin_ref_encoder = value_field.bin_encoder
             self.bin_ref_decoder = value_field.bin_decoder
+            self.bin_ref_type = value_field.bin_type
+
+        self.bin2_wire_type = bin2_wire_type(self.bin_ref_type if self.ref else self.bin_type)
+        self.bin2_key_wire_type = bin2_wire_type(self.bin_key_type)
+        # 字段tag里的wire_type
+        if self.array:
+            self.bin2_field_wire_type = WT_ARRAY
+        elif self.map:
+            self.bin2_field_wire_type = WT_MAP
+        elif self.id_map:
+            self.bin2_field_wire_type = WT_ID_MAP
+        else:
+            self.bin2_field_wire_type = self.bin2_wire_type
+
+        self.bson_type = bson_element_type(self.bin_ref_type if self.ref else self.bin_type)
 
         if [self, array, self.map, self.id_map].count(True) > 1:
             raise DefineError('conflicted properties: array, map, id_map')
 
-        if self.array:
+        if self.typed:
+            typecode = TYPED_ARRAY_CODES.get(self.type_name)
+            if not self.array or typecode is None:
+                raise DefineError('unsupported typed array: {}'.format(self.type_name))
+            self.container_class = type('TypedArray_'+self.type_name,
+                                        (TypedArray,), {'value_field': self, '_typecode': typecode})
+        elif self.array:
             self.container_class = type('Array_'+self.type_name,
                                         (Array,), {'value_field': self})
         elif self.map or self.id_map:
@@ -1371,6 +3212,112 @@ cdef class Field(object):
     def __getattr__(self, name):
         return self.__dict__.get(name)
 
+cdef class ScalarRun:
+    '''一段按index顺序连续排列的定长标量字段。
+        打包的时候按预计算的编码类型直接写入所有字段的(index, value)。
+        解包的时候按预计算的偏移校验字段index，再直接从读缓冲区里解出字段值。
+        省去逐个字段查找和调用编解码函数的开销。
+    '''
+    cdef list fields
+    cdef list keys
+    cdef tuple indexes
+    cdef Py_ssize_t size
+    cdef Py_ssize_t tail_size
+    cdef Py_ssize_t count
+    cdef int* bin_types
+    cdef uint16_t* index_values
+    cdef Py_ssize_t* index_offsets
+
+    def __cinit__(self, list fields):
+        cdef Field field
+        cdef Py_ssize_t i, offset
+        self.fields = fields
+        self.keys = [field.key for field in fields]
+        self.indexes = tuple([field.index for field in fields])
+        self.size = sum([FIELD_INDEX_SIZE + SCALAR_SIZES[field.type_name] for field in fields])
+        # 解包时第一个字段的index已经被读出，所以不计入
+        self.tail_size = self.size - FIELD_INDEX_SIZE
+
+        self.count = len(fields)
+        self.bin_types = <int*>PyMem_Malloc(self.count * sizeof(int))
+        self.index_values = <uint16_t*>PyMem_Malloc(self.count * sizeof(uint16_t))
+        self.index_offsets = <Py_ssize_t*>PyMem_Malloc(self.count * sizeof(Py_ssize_t))
+        if not self.bin_types or not self.index_values or not self.index_offsets:
+            raise MemoryError()
+        # index_offsets[i]: 第i个字段的index相对于第一个字段值的偏移
+        offset = -FIELD_INDEX_SIZE
+        for i in range(self.count):
+            field = fields[i]
+            self.bin_types[i] = field.bin_type
+            self.index_values[i] = field.index
+            self.index_offsets[i] = offset
+            offset += FIELD_INDEX_SIZE + SCALAR_SIZES[field.type_name]
+
+    def __dealloc__(self):
+        PyMem_Free(self.bin_types)
+        PyMem_Free(self.index_values)
+        PyMem_Free(self.index_offsets)
+
+cdef inline bint _is_scalar_run_field(Field field):
+    if field.is_container() or field.is_data_model_type:
+        return False
+    return field.type_name in SCALAR_SIZES
+
+cdef class BinaryCodec:
+    '''DataModel类的二进制编解码器。由MetaDataModel在创建类的时候生成。
+        items       -> 按index顺序排列的ScalarRun或者Field
+        runs_by_index -> ScalarRun第一个字段的index => ScalarRun
+    '''
+    cdef list items
+    cdef dict runs_by_index
+
+    def __cinit__(self, list fields):
+        cdef Field field
+        cdef list run_fields = []
+        self.items = []
+        self.runs_by_index = {}
+        for field in fields:
+            if _is_scalar_run_field(field):
+                run_fields.append(field)
+                continue
+            self._add_run(run_fields)
+            run_fields = []
+            self.items.append(field)
+        self._add_run(run_fields)
+
+    cdef _add_run(self, list fields):
+        if not fields:
+            return
+        cdef ScalarRun run = ScalarRun(fields)
+        self.items.append(run)
+        self.runs_by_index[run.indexes[0]] = run
+
+cdef bint _fields_has_ref(fields):
+    '''字段里是否有引用字段，包括子对象的字段'''
+    cdef Field field
+    for field in fields:
+        if field.ref or (field.is_data_model_type and field.value_type._has_ref):
+            return True
+    return False
+
+cdef list _fields_to_clone(fields):
+    '''复制对象时需要处理的字段：子对象和容器字段。基本类型的字段直接复制'''
+    cdef Field field
+    return [field for field in fields
+            if field.container_class is not None or field.is_data_model_type]
+
+cdef int _bases_slot_count(bases) except -1:
+    '''SlotDataModel子类的字段接着基类的slot分配。slot记在基类的Field上，所以最多只能有一个
+        基类的字段使用slot。不使用slot的基类的字段仍然存放在__dict__里
+    '''
+    cdef int count = 0
+    for base in bases:
+        if getattr(base, '_slot_count', 0):
+            if count:
+                raise DefineError('more than one base class has slot fields')
+            count = base._slot_count
+    return count
+
 cdef _copy_any_base_fields(bases, _fields, _fields_by_index, _fields_by_name, _fields_by_key):
     for base in bases:
         if getattr(base, '_fields_by_index', None) is not None:
@@ -1444,7 +3391,10 @@ cdef _add_func(self, name, key, value):
 def _make_get_func(key, default_type=None, default_value=None):
     if default_type is not None:
         def get_func(self):
-            return self.__dict__.setdefault(key, default_type())
+            obj_dict = self.__dict__
+            if key not in obj_dict and '__lazy__' in obj_dict:
+                _load_lazy_field(obj_dict, key)
+            return obj_dict.setdefault(key, default_type())
         return get_func
     else:
         def get_func(self):
@@ -1499,6 +3449,10 @@ class MetaDataModel(type):
         cdef dict attrs = dict(_attrs)
 
         cdef Field field
+        cdef SlotField slot_field
+
+        cdef bint slotted = any(issubclass(base, SlotStorage) for base in bases)
+        cdef int slot_count = _bases_slot_count(bases) if slotted else 0
 
         for name, _field in _attrs.iteritems():
             if name.startswith('__'):
@@ -1513,14 +3467,29 @@ class MetaDataModel(type):
             key = '_' + name
             field.name = name
             field.key = key
-
-            if field.is_container():
+            if name == 'oid' and field.type_name == 'bytes':
+                raise DefineError('bytes can not be used as oid')
+
+            if slotted and _is_slot_field(field):
+                field.slot = slot_count
+                slot_count += 1
+                slot_field = SlotField(field, False)
+                attrs[name] = slot_field
+                attrs[key] = SlotField(field, True)
+                get_func_name = _make_autogen_func_name(attrs, 'get', name)
+                attrs[get_func_name] = _make_slot_get_func(slot_field)
+            elif field.is_container():
                 attrs[name] = property(
                     partial(_fget_container, key, field.container_class),
                     partial(_fset_container, key, field.index, field.container_class),
                     partial(_fdel_container, key))
                 get_func_name = _make_autogen_func_name(attrs, 'get', name)
                 attrs[get_func_name] = _make_get_func(key, default_type=field.container_class)
+            elif _is_lazy_field(field):
+                attrs[name] = property(
+                    partial(_fget_lazy, key, field.default),
+                    partial(_fset_lazy, key, field.index),
+                    partial(_fdel, key))
             else:
                 attrs[name] = property(
                     partial(_fget, key, field.default),
@@ -1570,6 +3539,11 @@ class MetaDataModel(type):
         newcls._fields_by_name = fields_define._fields_by_name
         newcls._fields_by_key = fields_define._fields_by_key
         newcls._fields_is_container = fields_define._fields_is_container
+        newcls._bin_codec = BinaryCodec(newcls._fields)
+        newcls._has_ref = _fields_has_ref(newcls._fields)
+        newcls._clone_fields = _fields_to_clone(newcls._fields)
+        newcls._slot_count = slot_count
+        newcls._slot_fields = [field for field in newcls._fields if field.slot >= 0]
 
         return newcls
 
@@ -1580,12 +3554,16 @@ class DataModel(object):
         self.set_data(**kwargs)
 
     def set_data(self, **kwargs):
+        cdef Field field
         obj_dict = self.__dict__
+        _drop_clean(obj_dict)
         _fields_by_name = self._fields_by_name
         for name, value in kwargs.iteritems():
             field = _fields_by_name.get(name)
             if field:
-                obj_dict[field.key] = value
+                if field.typed and not isinstance(value, field.container_class):
+                    value = field.container_class(value)
+                _set_field_value(self, obj_dict, field, value)
             else:
                 if CONFIG_CHECK_INIT_ARGS:
                     raise ValueError("unexpected field name `{}'".format(name))
@@ -1620,6 +3598,7 @@ class DataModel(object):
 
     def clear_data(self):
         cdef Field field
+        self.__dict__.pop('__lazy__', None)
         for field in self._fields:
             if hasattr(self, field.key):
                 delattr(self, field.key)
@@ -1641,37 +3620,236 @@ class DataModel(object):
                         included_fields=fields)
         return dict_data
 
-    def unpack_from_dict(self, dict_data, mode=None, resolve_ref=None, mark_change=False):
-        cdef DecodeContext context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change)
-        _decode_from_dict(self, type(self), self.__dict__, dict_data, context)
+    def unpack_from_dict(self, dict_data, mode=None, resolve_ref=None, mark_change=False,
+                         fields=None, field_filter=None):
+        '''
+        @memo:
+            fields       只解码这些字段。可以用'a.b'指定子对象(或者容器里的对象)的字段，
+                         其他字段的数据会被跳过
+            field_filter 同pack_to_dict，返回False的字段不解码
+        '''
+        cdef DecodeContext context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                                   field_filter=field_filter)
+        cdef dict paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_from_dict(self, type(self), self.__dict__, dict_data, context, paths)
         context.resolve_ref()
         return context.unsolved_ref
 
     def get_changed_dict(self, recursive=False):
         return self.pack_to_dict(recursive, only_changed=True)
 
+    def pack_since(self, version, fmt='dict', field_filter=None):
+        '''打包version之后修改了的数据，返回(增量数据, 当前版本号)。不修改changed标志。
+            增量数据的格式同pack_to_dict(only_changed=True)，可以用unpack_from_dict(mode='sync')应用。
+            修改过的字段完整打包，没有修改的子对象和容器递归检查，开销和整个对象树的大小有关。
+            只支持dict格式。没有指定mark_change的解码不记录版本号。
+            version早于开始记录版本号的时候(参见current_version)不知道改了什么，打包全部数据
+        '''
+        if fmt != 'dict':
+            raise PackError('unsupported format: {}'.format(fmt))
+        if not _track_versions or version < _track_since:
+            _start_track_versions()
+            return self.pack_to_dict(field_filter=field_filter), _version
+        cdef dict dict_data = {}
+        cdef FieldFilter ff
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
+        _encode_since_to_dict(dict_data, type(self), self, version, ff)
+        return dict_data, _version
+
+    def prune_versions(self, min_version):
+        '''删除对象树里map为删除了的key记下的版本号，避免反复增删key的时候占用的内存一直增长。
+            所有消费者都用pack_since同步到min_version以后调用，之后pack_since的version不能小于min_version
+        '''
+        _prune_versions(self, min_version)
+
+    def clone(self, deep=True, with_changed=False):
+        '''复制对象，比打包再解码快得多。deep为False时新对象和原对象共享子对象和容器里的对象，
+            容器总是复制。with_changed为True时保留changed标志和版本号，否则新对象没有改变。
+            ref字段(包括ref容器的元素)指向被复制了的对象时，改成指向复制出来的对象
+        '''
+        return _clone(self, deep, with_changed)
+
+    def calc_packed_size(self, recursive=True, only_changed=False, field_filter=None,
+                         framed=False):
+        '''计算pack_to_binary输出的字节数'''
+        cdef FieldFilter ff
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
+        return _calc_binary_size(type(self), self,
+                                 recursive=recursive,
+                                 only_changed=only_changed,
+                                 field_filter=ff,
+                                 framed=framed) + (FIELD_INDEX_SIZE if framed else 0)
+
     def pack_to_binary(self, recursive=True, only_changed=False,
-                       clear_changed=False, field_filter=None):
-        buf = WriteBuffer()
-        _encode_to_binary(buf, type(self), self,
-                          recursive=recursive,
-                          only_changed=only_changed,
-                          clear_changed=clear_changed,
-                          field_filter=field_filter)
-        return buf.tostring()
+                       clear_changed=False, field_filter=None, out=None, framed=False):
+        '''
+        @memo:
+            out    如果指定了out(bytearray或者可写的memoryview)，数据从out的开头写入，
+                   返回写入的字节数。out的大小可以用calc_packed_size预先算出。
+            framed 使用分帧格式。每个字段带有数据长度，解码时可以直接跳过不认识的字段。
+                   数据以FRAMED_MARK开头，解码时也需要指定framed，不一致的时候抛出UnpackError。
+        '''
+        cdef WriteBuffer buf
+        cdef FieldFilter ff
+        cdef Py_ssize_t size
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
 
-    def unpack_from_binary(self, data, mode=None, resolve_ref=None, mark_change=False):
-        buf = ReadBuffer(data)
-        cdef context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change)
+        if out is not None:
+            if clear_changed:
+                # 写到一半空间不够的话，已经清除的changed标志无法恢复，所以先检查大小
+                size = self.calc_packed_size(recursive, only_changed, ff, framed)
+                if len(out) < size:
+                    raise PackError('output buffer too small: {} < {}'.format(len(out), size))
+            buf = WriteBuffer(out=out)
+            try:
+                _encode_framed_mark(buf, framed)
+                _encode_to_binary(buf, type(self), self,
+                                  recursive=recursive,
+                                  only_changed=only_changed,
+                                  clear_changed=clear_changed,
+                                  field_filter=ff,
+                                  framed=framed)
+            except MemoryError:
+                raise PackError('output buffer too small: {}'.format(len(out)))
+            return buf.offset
+
+        buf = acquire_write_buffer()
+        try:
+            _encode_framed_mark(buf, framed)
+            _encode_to_binary(buf, type(self), self,
+                              recursive=recursive,
+                              only_changed=only_changed,
+                              clear_changed=clear_changed,
+                              field_filter=ff,
+                              framed=framed)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def unpack_from_binary(self, data, mode=None, resolve_ref=None, mark_change=False,
+                           lazy=False, framed=False, fields=None, field_filter=None,
+                           copy_bytes=False):
+        '''
+        @memo:
+            lazy   延迟解码。子对象和容器字段在第一次访问的时候才从data解码，解码前data
+                   不能被修改。不支持sync模式。有引用字段的时候需要指定resolve_ref。
+            framed data是分帧格式。不认识的字段会被跳过。
+            fields, field_filter 同unpack_from_dict。跳过的字段不分配对象
+            copy_bytes bytes字段解码成str。默认解码成引用data的memoryview，不复制数据，
+                   这时data在对象使用期间不能被修改
+        '''
+        cdef ReadBuffer buf = ReadBuffer(data, copy_bytes)
+        cdef DecodeContext context = DecodeContext(mode=mode, resolve_ref=resolve_ref,
+                                                   mark_change=mark_change, lazy=lazy,
+                                                   framed=framed, field_filter=field_filter)
+        cdef dict paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_framed_mark(buf, framed)
+        if lazy:
+            if context.sync_mode:
+                raise UnpackError('lazy unpack does not support sync mode')
+            if self._has_ref and resolve_ref is None:
+                raise UnpackError('lazy unpack of ref fields needs resolve_ref')
+            _decode_from_binary_lazy(buf, type(self), self.__dict__, context, paths)
+            _move_to_slots(self, self.__dict__)
+        else:
+            _decode_from_binary(buf, self, type(self), self.__dict__, context, paths)
+        context.resolve_ref()
+        return context.unsolved_ref
+
+    def apply_patch(self, data, resolve_ref=None, mark_change=False, framed=False,
+                    copy_bytes=False):
+        '''把pack_to_binary(only_changed=True)打包的增量数据直接应用到对象上。
+            子对象和map里已有的对象原地修改，不创建新对象；数组整个替换，或者原地应用增量数据里的
+            数组操作；增量数据里删除了的map key也会被删除。参数同unpack_from_binary
+        '''
+        cdef ReadBuffer buf = ReadBuffer(data, copy_bytes)
+        cdef DecodeContext context = DecodeContext(mode='sync', resolve_ref=resolve_ref,
+                                                   mark_change=mark_change, framed=framed)
+        _decode_framed_mark(buf, framed)
         _decode_from_binary(buf, self, type(self), self.__dict__, context)
         context.resolve_ref()
         return context.unsolved_ref
 
+    def pack_to_binary2(self, recursive=True, only_changed=False,
+                        clear_changed=False, field_filter=None):
+        '''打包成紧凑的bin2格式。参见codes_bin2'''
+        cdef WriteBuffer buf
+        cdef FieldFilter ff
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
+        buf = acquire_write_buffer()
+        try:
+            _encode_to_binary2(buf, type(self), self,
+                               recursive=recursive,
+                               only_changed=only_changed,
+                               clear_changed=clear_changed,
+                               field_filter=ff)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def unpack_from_binary2(self, data, mode=None, resolve_ref=None, mark_change=False,
+                            fields=None, field_filter=None, copy_bytes=False):
+        '''fields, field_filter同unpack_from_dict。copy_bytes同unpack_from_binary'''
+        cdef ReadBuffer buf = ReadBuffer(data, copy_bytes)
+        cdef DecodeContext context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                                   field_filter=field_filter)
+        cdef dict paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_from_binary2(buf, self, type(self), self.__dict__, context, paths)
+        context.resolve_ref()
+        return context.unsolved_ref
+
+    def pack_to_bson(self, recursive=True, only_changed=False,
+                     clear_changed=False, field_filter=None):
+        '''打包成BSON文档。参见codes_bson'''
+        cdef WriteBuffer buf
+        cdef FieldFilter ff
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
+        buf = acquire_write_buffer()
+        try:
+            _encode_to_bson(buf, type(self), self,
+                            recursive=recursive,
+                            only_changed=only_changed,
+                            clear_changed=clear_changed,
+                            field_filter=ff)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def unpack_from_bson(self, data, mode=None, resolve_ref=None, mark_change=False,
+                         fields=None, field_filter=None, copy_bytes=False):
+        '''fields, field_filter同unpack_from_dict。copy_bytes同unpack_from_binary'''
+        cdef ReadBuffer buf = ReadBuffer(data, copy_bytes)
+        cdef DecodeContext context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                                   field_filter=field_filter)
+        cdef dict paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_from_bson(buf, self, type(self), self.__dict__, context, paths)
+        context.resolve_ref()
+        return context.unsolved_ref
+
     def pack(self, fmt, *args, **kwargs):
         if fmt == 'dict':
             return self.pack_to_dict(*args, **kwargs)
         elif fmt == 'bin':
             return self.pack_to_binary(*args, **kwargs)
+        elif fmt == 'bin2':
+            return self.pack_to_binary2(*args, **kwargs)
+        elif fmt == 'bson':
+            return self.pack_to_bson(*args, **kwargs)
         else:
             raise PackError('unsupported format: {}'.format(fmt))
 
@@ -1680,9 +3858,32 @@ class DataModel(object):
             return self.unpack_from_dict(*args, **kwargs)
         elif fmt == 'bin':
             return self.unpack_from_binary(*args, **kwargs)
+        elif fmt == 'bin2':
+            return self.unpack_from_binary2(*args, **kwargs)
+        elif fmt == 'bson':
+            return self.unpack_from_bson(*args, **kwargs)
         else:
             raise PackError('unsupported format: {}'.format(fmt))
 
+    def __getstate__(self):
+        # 所属对象和clean标志只对原来的对象有效，复制和pickle的时候去掉
+        cdef Field field
+        state = self.__dict__.copy()
+        state.pop('__owner__', None)
+        state.pop('__owner_key__', None)
+        state.pop('__clean__', None)
+        state.pop('__rec_parent__', None)
+        state.pop('__recorder__', None)
+        for field in self._slot_fields:
+            if (<SlotStorage>self).has(field.slot):
+                state[field.key] = _field_value(self, None, field)
+        return state
+
+    def __setstate__(self, state):
+        obj_dict = self.__dict__
+        obj_dict.update(state)
+        _move_to_slots(self, obj_dict)
+
     def __str__(self):
         return self._long_repr_()
 
@@ -1712,6 +3913,20 @@ class DataModel(object):
     def _long_repr_(self):
         return self._get_info_(4)
 
+class SlotDataModel(SlotStorage, DataModel):
+    '''基本类型的非集合字段存放在按字段分配的slot里，而不是__dict__里的'_'加字段名。
+        int, float和bool值直接存成C的long和double。对象占用的内存更少，字段的读写也更快，
+        适合数量很多的小对象：
+
+            class Item(SlotDataModel):
+                oid = Field('string', 1)
+                count = Field('int32', 2)
+
+        子对象和容器字段，以及changed标志等内部状态仍然在__dict__里。
+        obj.__dict__里看不到slot里的字段，需要用getattr(obj, '_'+字段名)代替。
+        子类的字段接着基类分配slot，最多只能有一个基类带有slot字段。
+    '''
+
 def ArrayField(*arg, **kwarg):
     kwarg['array'] = True
     return Field(*arg, **kwarg)
@@ -1724,3 +3939,1124 @@ def IdMapField(*arg, **kwarg):
     kwarg['id_map'] = True
     return Field(*arg, **kwarg)
 
+
+def pack_many(objs, fmt='bin', recursive=True, only_changed=False,
+              clear_changed=False, field_filter=None, framed=False):
+    '''把objs依次打包到同一个buffer。
+    返回(data, offsets)。offsets是array('L')，第i个对象的数据是data[offsets[i]:offsets[i + 1]]。
+        fmt     -> 'bin', 'bin2'或者'bson'。'bson'格式的数据是依次排列的BSON文档
+        framed  -> 同pack_to_binary，只用于'bin'格式
+    '''
+    cdef bint is_bin = fmt == 'bin'
+    if not is_bin and fmt != 'bin2' and fmt != 'bson':
+        raise PackError('unsupported format: {}'.format(fmt))
+    cdef FieldFilter ff
+    if not isinstance(field_filter, FieldFilter):
+        ff = FieldFilter(field_filter)
+    else:
+        ff = field_filter
+    offsets = array('L')
+    cdef WriteBuffer buf = acquire_write_buffer()
+    try:
+        for obj in objs:
+            offsets.append(buf.offset)
+            if is_bin:
+                _encode_framed_mark(buf, framed)
+                _encode_to_binary(buf, type(obj), obj,
+                                  recursive=recursive,
+                                  only_changed=only_changed,
+                                  clear_changed=clear_changed,
+                                  field_filter=ff,
+                                  framed=framed)
+            elif fmt == 'bin2':
+                _encode_to_binary2(buf, type(obj), obj,
+                                   recursive=recursive,
+                                   only_changed=only_changed,
+                                   clear_changed=clear_changed,
+                                   field_filter=ff)
+            else:
+                _encode_to_bson(buf, type(obj), obj,
+                                recursive=recursive,
+                                only_changed=only_changed,
+                                clear_changed=clear_changed,
+                                field_filter=ff)
+        offsets.append(buf.offset)
+        return buf.tostring(), offsets
+    finally:
+        release_write_buffer(buf)
+
+def unpack_many(cls, data, offsets=None, fmt='bin', resolve_ref=None, mark_change=False,
+                framed=False, copy_bytes=False):
+    '''从pack_many打包的数据解码出cls对象的列表。
+        offsets -> pack_many返回的offsets。为None时从头到尾依次解码
+        copy_bytes -> 同DataModel.unpack_from_binary
+    所有对象共用一个DecodeContext。有oid的对象也会被当作已知对象，对象之间的引用在最后统一解析。
+    '''
+    cdef bint is_bin = fmt == 'bin'
+    if not is_bin and fmt != 'bin2' and fmt != 'bson':
+        raise PackError('unsupported format: {}'.format(fmt))
+    cdef ReadBuffer buf = ReadBuffer(data, copy_bytes)
+    cdef DecodeContext context = DecodeContext(resolve_ref=resolve_ref, mark_change=mark_change,
+                                               framed=framed)
+    cdef list objs = []
+    cdef dict obj_dict
+    cdef Py_ssize_t i = 0, count = 0
+    if offsets is not None:
+        count = len(offsets) - 1
+    while True:
+        if offsets is not None:
+            if i >= count:
+                break
+            buf.offset = offsets[i]
+        elif buf.at_end():
+            break
+        obj = cls()
+        obj_dict = obj.__dict__
+        if is_bin:
+            _decode_framed_mark(buf, framed)
+            _decode_from_binary(buf, obj, cls, obj_dict, context)
+        elif fmt == 'bin2':
+            _decode_from_binary2(buf, obj, cls, obj_dict, context)
+        else:
+            _decode_from_bson(buf, obj, cls, obj_dict, context)
+        if offsets is not None and buf.offset != offsets[i + 1]:
+            raise UnpackError('record size mismatch, index={}'.format(i))
+        oid = getattr(obj, '_oid', None)
+        if oid is not None:
+            context.add_known_object(oid, obj)
+        objs.append(obj)
+        i += 1
+    context.resolve_ref()
+    return objs
+
+# 列数据的numpy dtype。string和bytes是变长的，用object
+# pylint: disable=bad-whitespace
+_COLUMN_DTYPES = {
+    'int8'   : 'int8',
+    'uint8'  : 'uint8',
+    'int16'  : 'int16',
+    'uint16' : 'uint16',
+    'int32'  : 'int32',
+    'uint32' : 'uint32',
+    'int64'  : 'int64',
+    'uint64' : 'uint64',
+    'float'  : 'float32',
+    'double' : 'float64',
+    'bool'   : 'bool',
+    'string' : 'object',
+    'bytes'  : 'object',
+}
+# pylint: enable=bad-whitespace
+
+cdef list _column_fields(cls, names):
+    '''返回names对应的字段。只支持基本类型的非集合字段，names为None时返回全部这样的字段'''
+    cdef Field field
+    if names is None:
+        return [field for field in cls._fields
+                if not field.is_container() and not field.is_data_model_type]
+    fields = []
+    for name in names:
+        field = cls._fields_by_name.get(name)
+        if field is None:
+            raise NoFieldError('no such field: %s' % name)
+        if field.is_container() or field.is_data_model_type:
+            raise PackError('unsupported column field: {}'.format(name))
+        fields.append(field)
+    return fields
+
+def to_columns(container, fields=None, structured=False):
+    '''把Array或者IdMap里的对象按字段导出成列数据，返回{字段名: 列}。
+        fields      -> 导出的字段名列表。默认导出全部基本类型的非集合字段
+        structured  -> 返回一个numpy结构化数组，而不是dict
+    安装了numpy时每一列是dtype和字段类型对应的numpy数组。否则数值列是array.array，其他列是list。
+    '''
+    if isinstance(container, dict):
+        objs = container.values()
+    else:
+        objs = list(container)
+    value_field = getattr(container, 'value_field', None)
+    if value_field is not None:
+        cls = value_field.value_type
+    elif objs:
+        cls = type(objs[0])
+    else:
+        raise PackError('unknown object class of empty container')
+    if structured and numpy is None:
+        raise PackError('structured columns require numpy')
+
+    cdef Field field
+    fields = _column_fields(cls, fields)
+    columns = {}
+    for field in fields:
+        name = field.name
+        values = [getattr(obj, name) for obj in objs]
+        if numpy is not None:
+            columns[name] = numpy.array(values, dtype=_COLUMN_DTYPES[field.type_name])
+        else:
+            typecode = TYPED_ARRAY_CODES.get(field.type_name)
+            columns[name] = array(typecode, values) if typecode else values
+    if not structured:
+        return columns
+
+    result = numpy.empty(len(objs), dtype=[(field.name, columns[field.name].dtype)
+                                           for field in fields])
+    for field in fields:
+        result[field.name] = columns[field.name]
+    return result
+
+def from_columns(cls, columns):
+    '''to_columns的逆操作。从{字段名: 列}或者numpy结构化数组批量构造cls对象，返回对象列表。
+        构造出的对象不带changed标志。
+    '''
+    cdef Field field
+    names = getattr(getattr(columns, 'dtype', None), 'names', None)
+    if names is not None:
+        columns = dict((name, columns[name]) for name in names)
+    keys = []
+    values = []
+    count = None
+    for field in _column_fields(cls, list(columns)):
+        column = columns[field.name]
+        column = column.tolist() if hasattr(column, 'tolist') else list(column)
+        if count is None:
+            count = len(column)
+        elif len(column) != count:
+            raise UnpackError('column size mismatch: {}'.format(field.name))
+        keys.append(field.key)
+        values.append(column)
+    objs = []
+    if cls._slot_fields:
+        fields = [cls._fields_by_key[key] for key in keys]
+        for row in izip(*values):
+            obj = cls()
+            obj_dict = obj.__dict__
+            for field, value in izip(fields, row):
+                _set_field_value(obj, obj_dict, field, value)
+            objs.append(obj)
+        return objs
+    for row in izip(*values):
+        obj = cls()
+        obj.__dict__.update(izip(keys, row))
+        objs.append(obj)
+    return objs
+
+cdef inline bint _is_object_value(Field field):
+    '''字段的值(或者容器的元素)是否是嵌入的子对象'''
+    return field.is_data_model_type and not field.ref
+
+cdef inline unsigned long long _field_version(dict versions, Field field):
+    '''字段最后一次修改的版本号。set_changed()修改的是全部字段'''
+    if not versions:
+        return 0
+    return max(versions.get(field.index, 0), versions.get('*', 0))
+
+cdef bint _has_changed_since(object value, unsigned long long version):
+    '''对象或容器在version之后有没有修改。ref的对象属于别的对象，不检查'''
+    cdef dict obj_dict
+    cdef dict versions
+    cdef Field field
+    if isinstance(value, DataModel):
+        obj_dict = value.__dict__
+        versions = obj_dict.get('__versions__')
+        if versions and max(versions.itervalues()) > version:
+            return True
+        for field in value._fields:
+            if field.ref or field.skip_changed:
+                continue
+            if field.container_class is not None or field.is_data_model_type:
+                v = obj_dict.get(field.key)
+                if v is not None and _has_changed_since(v, version):
+                    return True
+        return False
+    if isinstance(value, Map):
+        if (<Map>value)._version > version:
+            return True
+        if not _is_ref_container(value):
+            for v in value.itervalues():
+                if _has_changed_since(v, version):
+                    return True
+    elif isinstance(value, Array):
+        if (<Array>value)._version > version:
+            return True
+        if not _is_ref_container(value):
+            for v in value:
+                if _has_changed_since(v, version):
+                    return True
+    elif isinstance(value, TypedArray):
+        return value._version > version
+    return False
+
+cdef int _prune_versions(object value, unsigned long long min_version) except -1:
+    '''删除对象树里map记下的不晚于min_version的key版本号。ref的对象属于别的对象，不处理'''
+    cdef dict obj_dict
+    cdef Field field
+    if isinstance(value, DataModel):
+        obj_dict = value.__dict__
+        for field in value._fields:
+            if field.ref or field.skip_changed:
+                continue
+            if field.container_class is not None or field.is_data_model_type:
+                v = obj_dict.get(field.key)
+                if v is not None:
+                    _prune_versions(v, min_version)
+    elif isinstance(value, Map):
+        (<Map>value).prune_versions(min_version)
+        if not _is_ref_container(value):
+            for v in value.itervalues():
+                _prune_versions(v, min_version)
+    elif isinstance(value, Array):
+        if not _is_ref_container(value):
+            for v in value:
+                _prune_versions(v, min_version)
+    return 0
+
+cdef inline object _full_value_to_dict(Field field, object value, FieldFilter field_filter):
+    return _field_value_to_dict(field.dict_encoder, field, value,
+                                recursive=True,
+                                only_changed=False,
+                                clear_changed=False,
+                                field_filter=field_filter,
+                                with_skip_from_pack=False)
+
+cdef dict _map_since_to_dict(Field field, Map value, unsigned long long version,
+                             FieldFilter field_filter):
+    '''map在version之后的增量。修改过的key输出完整的值，删除了的key输出None，
+        其他对象元素输出它们自己的增量
+    '''
+    cdef dict d = {}
+    cdef dict sub
+    cdef dict versions = value._versions
+    cdef bint nested = _is_object_value(field)
+    kencoder = field.dict_key_encoder
+    if field.id_map:
+        field_filter = FieldFilter(field_filter, _exclude_oid_field)
+    for k, v in value.iteritems():
+        if versions.get(k, 0) > version:
+            d[kencoder(k)] = _full_value_to_dict(field, v, field_filter)
+        elif nested:
+            sub = {}
+            if _encode_since_to_dict(sub, field.value_type, v, version, field_filter):
+                d[kencoder(k)] = sub
+    for k, ver in versions.iteritems():
+        if ver > version and k not in value:
+            d[kencoder(k)] = None
+    return d
+
+cdef bint _encode_since_to_dict(dict dict_data, object cls, object obj,
+                                unsigned long long version, FieldFilter field_filter):
+    '''把obj在version之后修改了的数据转储到dict_data，格式和pack_to_dict(only_changed=True)一样。
+        修改过的字段完整打包；没有修改的子对象和容器递归检查。返回是否有数据
+    '''
+    cdef dict obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cdef dict versions = obj_dict.get('__versions__')
+    cdef bint have_data = False
+    cdef bint changed
+    cdef Field field
+    cdef dict d
+    cdef FieldFilter ff
+    for field in cls._fields:
+        value = _field_value(obj, obj_dict, field)
+        if value is None or field.skip_changed:
+            continue
+        if field_filter.is_filted(field):
+            continue
+        changed = _field_version(versions, field) > version
+        if field.array:
+            if changed or _has_changed_since(value, version):
+                dict_data[field.name] = [
+                    _full_value_to_dict(field, v, field_filter) for v in value]
+                have_data = True
+        elif field.map or field.id_map:
+            if changed:
+                ff = FieldFilter(field_filter, _exclude_oid_field) if field.id_map \
+                    else field_filter
+                kencoder = field.dict_key_encoder
+                d = dict((kencoder(k), _full_value_to_dict(field, v, ff))
+                         for k, v in value.iteritems())
+            else:
+                d = _map_since_to_dict(field, value, version, field_filter)
+            if d:
+                dict_data[field.name] = d
+                have_data = True
+        elif changed:
+            dict_data[field.name] = _full_value_to_dict(field, value, field_filter)
+            have_data = True
+        elif _is_object_value(field):
+            d = {}
+            if _encode_since_to_dict(d, field.value_type, value, version, field_filter):
+                dict_data[field.name] = d
+                have_data = True
+    return have_data
+
+# 只对原来的对象有效的内部状态，复制的时候去掉
+cdef frozenset _CLONE_DROP_KEYS = frozenset(
+    ('__owner__', '__owner_key__', '__rec_parent__', '__recorder__'))
+
+cdef class _CloneContext(object):
+    '''复制对象树的状态。
+        memo       -> 已经复制了的对象，id => 新对象。同一个对象放在多个地方时只复制一次
+        refs       -> ref字段和ref容器的元素，(新dict或容器, key, 原对象)，复制完以后再指向新对象
+        keep_clean -> 深复制并且保留changed标志时，同时保留clean标志，所属对象改成复制出来的对象
+    '''
+    cdef bint deep
+    cdef bint with_changed
+    cdef bint keep_clean
+    cdef dict memo
+    cdef list refs
+
+cdef inline object _object_id(object obj):
+    '''memo的key。对象地址的低位都是0，直接用作int的hash会让dict里大量冲突，所以循环右移4位'''
+    cdef size_t p = <size_t><PyObject*>obj
+    return <Py_ssize_t>((p >> 4) | (p << (8 * sizeof(size_t) - 4)))
+
+cdef inline dict _object_dict(object obj):
+    '''直接取对象的__dict__，不经过属性查找'''
+    cdef PyObject** dictptr = _PyObject_GetDictPtr(obj)
+    if dictptr == NULL or dictptr[0] == NULL:
+        return obj.__dict__
+    return <dict>dictptr[0]
+
+cdef inline object _new_with_dict(type cls, dict obj_dict):
+    '''创建cls的对象并直接设置__dict__，不调用__init__'''
+    cdef object obj = (<PyTypeObject*>cls).tp_new(cls, (), None)
+    cdef PyObject** dictptr = _PyObject_GetDictPtr(obj)
+    if dictptr == NULL:
+        obj.__dict__ = obj_dict
+        return obj
+    Py_INCREF(obj_dict)
+    Py_XDECREF(dictptr[0])
+    dictptr[0] = <PyObject*>obj_dict
+    return obj
+
+cdef inline bint _is_internal_key(object key):
+    '''__xxx__形式的key是对象的内部状态，字段的key是'_' + 字段名'''
+    cdef char* s
+    cdef Py_ssize_t n
+    if not PyString_CheckExact(key):
+        return False
+    s = PyString_AS_STRING(key)
+    n = PyString_GET_SIZE(key)
+    return n > 4 and s[1] == '_' and s[0] == '_' and s[n - 1] == '_' and s[n - 2] == '_'
+
+cdef _clone_object(obj, _CloneContext ctx, owner, owner_key, bint shared=True):
+    '''复制一个对象。保留clean标志时所属对象改成owner，owner_key是在所属容器里的key。
+        shared为False时对象只被所在的容器引用，不会再从别的地方找到它，不需要记到memo里
+    '''
+    cdef dict obj_dict = _object_dict(obj)
+    cdef dict new_dict
+    cdef Field field
+    cdef PyObject* pkey
+    cdef PyObject* pvalue
+    cdef Py_ssize_t pos = 0
+    cdef bint clean = False
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    # 按原对象的key数预先分配，不会在复制过程中扩容，而且比逐个设置字段建出来的dict紧凑
+    new_dict = _PyDict_NewPresized(len(obj_dict))
+    # 一次遍历复制字段，内部状态按ctx处理，不需要复制以后再逐个删除
+    while PyDict_Next(obj_dict, &pos, &pkey, &pvalue):
+        key = <object>pkey
+        value = <object>pvalue
+        if not _is_internal_key(key):
+            PyDict_SetItem(new_dict, key, value)
+        elif key == '__changed_set__' or key == '__versions__':
+            if ctx.with_changed:
+                PyDict_SetItem(new_dict, key, PySet_New(value) if key == '__changed_set__'
+                               else PyDict_Copy(value))
+        elif key == '__clean__':
+            if ctx.keep_clean:
+                PyDict_SetItem(new_dict, key, value)
+                clean = True
+        elif key not in _CLONE_DROP_KEYS:
+            PyDict_SetItem(new_dict, key, value)
+    if clean and owner is not None:
+        new_dict['__owner__'] = owner
+        if owner_key is not None:
+            new_dict['__owner_key__'] = owner_key
+    cls = type(obj)
+    new = _new_with_dict(cls, new_dict)
+    if isinstance(obj, SlotStorage):
+        (<SlotStorage>new).copy_from(obj)
+    if shared:
+        ctx.memo[_object_id(obj)] = new
+    for field in cls._clone_fields:
+        key = field.key
+        value = new_dict.get(key)
+        if value is None:
+            continue
+        if field.container_class is not None:
+            new_dict[key] = _clone_container(value, field, new, ctx)
+        elif field.ref:
+            ctx.refs.append((new_dict, key, value))
+        elif ctx.deep:
+            new_dict[key] = _clone_value(value, ctx, new, None)
+    return new
+
+cdef inline _clone_value(value, _CloneContext ctx, owner, owner_key):
+    new = ctx.memo.get(_object_id(value))
+    if new is None:
+        new = _clone_object(value, ctx, owner, owner_key)
+    return new
+
+cdef inline _clone_element(PyObject* value, _CloneContext ctx, owner, owner_key):
+    '''复制容器里的元素。引用计数为1时元素只被这个容器引用，不可能共享或者被ref指向，不用查memo'''
+    if value.ob_refcnt == 1:
+        return _clone_object(<object>value, ctx, owner, owner_key, False)
+    return _clone_value(<object>value, ctx, owner, owner_key)
+
+cdef _clone_container(value, Field field, owner, _CloneContext ctx):
+    '''复制容器。元素是对象并且deep为True时复制元素，否则新容器和原容器共享元素。
+        共享的元素或者不保留clean标志的时候，元素的改变不会通知新容器，
+        所以map不再只跟踪记下的key，对象数组也不保留操作记录
+    '''
+    cdef Array arr, new_arr
+    cdef Map m, new_map
+    cdef Py_ssize_t i
+    cdef bint with_changed = ctx.with_changed
+    cdef bint object_elements, cloned, exact
+    container_class = field.container_class
+    if field.typed:
+        new = container_class(value)
+        if with_changed:
+            new._changed = value._changed
+            new._version = value._version
+            if ctx.keep_clean:
+                new._clean = value._clean
+                new._owner = owner
+        return new
+    object_elements = field.is_data_model_type and not field.ref
+    cloned = object_elements and ctx.deep
+    exact = ctx.keep_clean or not object_elements
+    if field.array:
+        arr = value
+        if cloned:
+            # 先创建容器，复制出来的元素直接指向新容器
+            new_arr = container_class()
+            for i in range(PyList_GET_SIZE(arr)):
+                PyList_Append(new_arr, _clone_element(PyList_GET_ITEM(arr, i), ctx, new_arr, i))
+        else:
+            new_arr = container_class(arr)
+        if field.ref:
+            for i, v in enumerate(arr):
+                ctx.refs.append((new_arr, i, v))
+        if with_changed:
+            new_arr._changed = arr._changed
+            new_arr._version = arr._version
+            if exact and arr._ops is not None:
+                if cloned:
+                    new_arr._ops = [(op, i, None if v is None else _clone_value(v, ctx, None, None))
+                                    for op, i, v in arr._ops]
+                else:
+                    new_arr._ops = list(arr._ops)
+        if ctx.keep_clean:
+            new_arr._clean = arr._clean
+            new_arr._owner = owner
+        return new_arr
+    cdef PyObject* pkey
+    cdef PyObject* pvalue
+    cdef Py_ssize_t pos = 0
+    m = value
+    if cloned:
+        new_map = container_class()
+        while PyDict_Next(m, &pos, &pkey, &pvalue):
+            PyDict_SetItem(new_map, <object>pkey, _clone_element(pvalue, ctx, new_map, <object>pkey))
+    else:
+        new_map = container_class(m)
+    if field.ref:
+        for k, v in m.iteritems():
+            ctx.refs.append((new_map, k, v))
+    if with_changed:
+        new_map._changed = set(m._changed)
+        new_map._removed = set(m._removed)
+        new_map._versions = dict(m._versions)
+        new_map._version = m._version
+        if exact:
+            new_map._dirty = set(m._dirty)
+            new_map._tracked = m._tracked
+    if ctx.keep_clean:
+        new_map._clean = m._clean
+        new_map._owner = owner
+    return new_map
+
+cdef _clone(obj, bint deep, bint with_changed):
+    cdef _CloneContext ctx = _CloneContext.__new__(_CloneContext)
+    ctx.deep = deep
+    ctx.with_changed = with_changed
+    ctx.keep_clean = deep and with_changed
+    ctx.memo = {}
+    ctx.refs = []
+    # 复制只创建新对象，不会产生循环垃圾。大量分配会反复触发分代回收，开销随对象树变大而增长
+    cdef bint gc_enabled = gc.isenabled()
+    if gc_enabled:
+        gc.disable()
+    try:
+        new = _clone_object(obj, ctx, None, None)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    # ref指向被复制了的对象时，改成指向复制出来的对象。不修改changed标志
+    for container, k, v in ctx.refs:
+        target = ctx.memo.get(_object_id(v))
+        if target is not None:
+            if isinstance(container, list):
+                list.__setitem__(container, k, target)
+            else:
+                dict.__setitem__(container, k, target)
+    return new
+
+cdef _copy_delta(value):
+    '''复制解析出来的增量数据。合并时会原地修改dict和_MapDelta，不能引用输入的数据'''
+    if isinstance(value, dict):
+        return dict((k, _copy_delta(v)) for k, v in value.iteritems())
+    if isinstance(value, _MapDelta):
+        m = _MapDelta()
+        m.removed.update(value.removed)
+        for k, v in value.entries.iteritems():
+            m.entries[k] = _copy_delta(v)
+        return m
+    if isinstance(value, _ArrayDelta):
+        return _ArrayDelta(value.items, value.ops)
+    return value
+
+cdef _merge_dict_array_delta(old, new):
+    '''合并dict格式的数组数据。new是完整的数组时整个替换，是操作列表时应用到old，
+        old也是操作列表的时候把操作连起来
+    '''
+    if not isinstance(new, dict):
+        return new
+    if isinstance(old, dict):
+        return {'ops': old.get('ops', []) + new.get('ops', [])}
+    cdef list items = list(old)
+    for dop in new.get('ops', ()):
+        op = _array_op_codes.get(dop[0])
+        if op is None:
+            raise UnpackError('unknown array op: {}'.format(dop[0]))
+        _apply_array_op(items, op, dop[1], None if op == ARRAY_OP_REMOVE else dop[2])
+    return items
+
+cdef _merge_dict_delta(cls, dict old, dict new):
+    '''把dict格式的增量数据new合并到old。后面的值覆盖前面的值，子对象逐字段合并'''
+    cdef dict _fields_by_name = cls._fields_by_name
+    cdef Field field
+    for name, value in new.iteritems():
+        old_value = old.get(name)
+        field = _fields_by_name.get(name)
+        if field is None or old_value is None or value is None:
+            old[name] = _copy_delta(value)
+        elif field.array:
+            old[name] = _merge_dict_array_delta(old_value, value)
+        elif field.map or field.id_map:
+            for k, v in value.iteritems():
+                ov = old_value.get(k)
+                # None是删除标记。删除后又设置的key只能保留设置的值
+                if _is_object_value(field) and ov is not None and v is not None:
+                    _merge_dict_delta(field.value_type, ov, v)
+                else:
+                    old_value[k] = _copy_delta(v)
+        elif _is_object_value(field):
+            _merge_dict_delta(field.value_type, old_value, value)
+        else:
+            old[name] = value
+
+class _MapDelta(object):
+    '''从binary格式解析出来的map增量数据。key和基本类型的值都是原始数据。
+        removed -> 删除了的key。先删除再设置的key同时在removed和entries里
+        entries -> 设置了的key和值
+    '''
+    def __init__(self):
+        self.removed = OrderedDict()
+        self.entries = OrderedDict()
+
+class _ArrayDelta(object):
+    '''从binary格式解析出来的数组增量数据(typed数组除外)。元素都是原始数据
+        items -> 完整的数组。是操作列表时为None
+        ops   -> [(操作码, 位置, 元素)]。remove操作的元素是None
+    '''
+    def __init__(self, items=None, ops=None):
+        self.items = list(items) if items is not None else None
+        self.ops = list(ops) if ops is not None else None
+
+cdef _merge_array_delta(old, new):
+    '''合并_ArrayDelta。规则同_merge_dict_array_delta'''
+    cdef list items
+    if new.items is not None:
+        return _copy_delta(new)
+    if old.items is None:
+        return _ArrayDelta(ops=old.ops + new.ops)
+    items = list(old.items)
+    for op, index, v in new.ops:
+        _apply_array_op(items, op, index, v)
+    return _ArrayDelta(items=items)
+
+cdef _merge_binary_delta(cls, dict old, dict new):
+    '''把解析出来的binary格式增量数据new合并到old。规则同_merge_dict_delta'''
+    cdef dict _fields_by_index = cls._fields_by_index
+    cdef Field field
+    for index, value in new.iteritems():
+        old_value = old.get(index)
+        field = _fields_by_index[index]
+        if old_value is None:
+            old[index] = _copy_delta(value)
+        elif field.map or field.id_map:
+            for k in value.removed:
+                old_value.entries.pop(k, None)
+                old_value.removed[k] = True
+            for k, v in value.entries.iteritems():
+                ov = old_value.entries.get(k)
+                if _is_object_value(field) and ov is not None and k not in value.removed:
+                    _merge_binary_delta(field.value_type, ov, v)
+                else:
+                    old_value.entries[k] = _copy_delta(v)
+        elif isinstance(value, _ArrayDelta):
+            old[index] = _merge_array_delta(old_value, value)
+        elif _is_object_value(field) and not field.array:
+            _merge_binary_delta(field.value_type, old_value, value)
+        else:
+            old[index] = value
+
+cdef inline bytes _raw_since(ReadBuffer buf, Py_ssize_t start):
+    '''返回start到当前读偏移之间数据的复制'''
+    return PyBytes_FromStringAndSize(<const char*>(buf.p + start), buf.offset - start)
+
+cdef dict _read_binary_delta(ReadBuffer buf, cls):
+    '''把binary格式的增量数据解析成{字段index: 值}，不创建对象。
+        子对象解析成嵌套的dict，map解析成_MapDelta，其他字段保留原始数据
+    '''
+    cdef dict delta = {}
+    cdef dict _fields_by_index = cls._fields_by_index
+    cdef Field field
+    cdef uint16_t field_index
+    cdef uint32_t asize, i
+    cdef Py_ssize_t start
+    while not buf.at_end():
+        field_index = buf.read_uint16()
+        if field_index == 0:
+            break
+        field = _fields_by_index.get(field_index)
+        if field is None:
+            raise UnpackError('unknown field, index={}'.format(field_index))
+        start = buf.offset
+        if field.map or field.id_map:
+            m = delta[field_index] = _MapDelta()
+            for i in range(buf.read_tombstones_head()):
+                start = buf.offset
+                buf.skip_value(field.bin_key_type)
+                m.removed[_raw_since(buf, start)] = True
+            asize = buf.read_container_head(C_MAP_32 if field.map else C_ID_MAP_32)
+            for i in range(asize):
+                start = buf.offset
+                buf.skip_value(field.bin_key_type)
+                key = _raw_since(buf, start)
+                if _is_object_value(field):
+                    m.entries[key] = _read_binary_delta(buf, field.value_type)
+                else:
+                    start = buf.offset
+                    _skip_binary_value(buf, field)
+                    m.entries[key] = _raw_since(buf, start)
+        elif field.array and not field.typed:
+            delta[field_index] = _read_array_delta(buf, field)
+        elif _is_object_value(field):
+            delta[field_index] = _read_binary_delta(buf, field.value_type)
+        else:
+            _skip_binary_field(buf, field)
+            delta[field_index] = _raw_since(buf, start)
+    return delta
+
+cdef _read_array_delta(ReadBuffer buf, Field field):
+    cdef Py_ssize_t op_count = buf.read_array_ops_head()
+    cdef uint32_t i, asize
+    cdef Py_ssize_t start
+    cdef list items, ops
+    if op_count < 0:
+        items = []
+        asize = buf.read_container_head(C_ARRAY_32)
+        for i in range(asize):
+            start = buf.offset
+            _skip_binary_value(buf, field)
+            items.append(_raw_since(buf, start))
+        return _ArrayDelta(items=items)
+    ops = []
+    for i in range(op_count):
+        op = buf.read_uint8()
+        index = buf.read_uint32()
+        v = None
+        if op != ARRAY_OP_REMOVE:
+            start = buf.offset
+            _skip_binary_value(buf, field)
+            v = _raw_since(buf, start)
+        ops.append((op, index, v))
+    return _ArrayDelta(ops=ops)
+
+cdef inline int _write_raw(WriteBuffer buf, bytes data) except -1:
+    cdef Py_ssize_t n = len(data)
+    memcpy(buf.reserve(n), <const char*>data, n)
+    return 0
+
+cdef int _write_binary_delta(WriteBuffer buf, cls, dict delta) except -1:
+    cdef Field field
+    for field in cls._fields:
+        value = delta.get(field.index)
+        if value is None:
+            continue
+        buf.write_uint16(field.index)
+        if field.map or field.id_map:
+            if value.removed:
+                buf.write_container_head(C_TOMBSTONES_32, len(value.removed))
+                for k in value.removed:
+                    _write_raw(buf, k)
+            buf.write_container_head(C_MAP_32 if field.map else C_ID_MAP_32, len(value.entries))
+            for k, v in value.entries.iteritems():
+                _write_raw(buf, k)
+                if _is_object_value(field):
+                    _write_binary_delta(buf, field.value_type, v)
+                else:
+                    _write_raw(buf, v)
+        elif isinstance(value, _ArrayDelta):
+            if value.items is not None:
+                buf.write_container_head(C_ARRAY_32, len(value.items))
+                for v in value.items:
+                    _write_raw(buf, v)
+            else:
+                buf.write_container_head(C_ARRAY_OPS_32, len(value.ops))
+                for op, k, v in value.ops:
+                    buf.write_array_op(op, k)
+                    if v is not None:
+                        _write_raw(buf, v)
+        elif isinstance(value, dict):
+            _write_binary_delta(buf, field.value_type, value)
+        else:
+            _write_raw(buf, value)
+    buf.write_uint16(0)
+    return 0
+
+def merge_deltas(cls, deltas, fmt='dict'):
+    '''把依次打包的一组cls对象的增量数据(only_changed=True)合并成一个等价的增量数据。
+        fmt -> 'dict'或者'bin'。'bin'格式不支持分帧数据
+    同一字段后面的值覆盖前面的值；子对象和map里的子对象逐字段合并；数组整个替换，或者应用
+    数组操作；map里删除了的key会被保留下来。合并的时候不创建cls对象。
+    dict格式不能同时表示删除和重新设置同一个key，这样的key只保留最后设置的值。
+    '''
+    cdef dict merged = {}
+    cdef WriteBuffer buf
+    if fmt == 'dict':
+        for delta in deltas:
+            _merge_dict_delta(cls, merged, delta)
+        return merged
+    if fmt != 'bin':
+        raise PackError('unsupported format: {}'.format(fmt))
+    for delta in deltas:
+        _merge_binary_delta(cls, merged, _read_binary_delta(ReadBuffer(delta), cls))
+    buf = acquire_write_buffer()
+    try:
+        _write_binary_delta(buf, cls, merged)
+        return buf.tostring()
+    finally:
+        release_write_buffer(buf)
+
+# MutationRecorder记录的修改类型
+MUTATION_SET_FIELD = 1  # 字段赋值。值是字段的完整数据
+MUTATION_DEL_FIELD = 2  # 删除字段
+MUTATION_MAP_SET = 3    # 设置map(或IdMap)的key
+MUTATION_MAP_DEL = 4    # 删除map的key
+MUTATION_ARRAY_OP = 5   # 数组操作，同增量数据里的数组操作
+
+cdef _link_tree(value, parent, key):
+    '''记下value以及它的子对象和容器在树里的位置(所属的对象或容器, 字段或key)，
+        修改的时候沿着位置找到根对象的记录器。数组元素的key是位置。ref的对象属于别的对象，不记录
+    '''
+    cdef Field field
+    cdef dict obj_dict
+    if isinstance(value, DataModel):
+        obj_dict = value.__dict__
+        obj_dict['__rec_parent__'] = (parent, key)
+        if '__lazy__' in obj_dict:
+            _load_all_lazy(obj_dict)
+        for field in value._fields:
+            v = obj_dict.get(field.key)
+            if v is not None and not field.ref and \
+                    (field.container_class is not None or field.is_data_model_type):
+                _link_tree(v, value, field)
+    elif isinstance(value, (Array, Map, TypedArray)):
+        value._rec_parent = (parent, key)
+        if isinstance(value, TypedArray) or _is_ref_container(value) or \
+                not (<Field>value.value_field).is_data_model_type:
+            return
+        if isinstance(value, Map):
+            for k, v in value.iteritems():
+                _link_tree(v, value, k)
+        else:
+            for k, v in enumerate(value):
+                _link_tree(v, value, k)
+
+cdef int _relink_elements(arr, Py_ssize_t start) except -1:
+    '''insert和remove以后，更新start之后的数组元素记下的位置'''
+    cdef Py_ssize_t k
+    if _is_ref_container(arr) or not (<Field>arr.value_field).is_data_model_type:
+        return 0
+    for k in range(start, len(arr)):
+        v = arr[k]
+        if v is not None:
+            v.__dict__['__rec_parent__'] = (arr, k)
+    return 0
+
+cdef tuple _container_owner(container):
+    '''返回容器所属的(对象, 字段)。容器已经不在所属对象上的时候返回(None, None)'''
+    cdef Field field
+    link = getattr(container, '_rec_parent', None)
+    if link is None:
+        return None, None
+    owner, field = link
+    if owner is None or owner.__dict__.get(field.key) is not container:
+        return None, None
+    return owner, field
+
+cdef tuple _find_recorder(obj):
+    '''返回(记录器, 从根对象到obj的路径)。路径是[(字段, key)]，子对象字段的key是None，
+        容器元素的key是map的key或者数组的位置。obj不在记录的树里时返回(None, None)
+    '''
+    cdef list steps = []
+    cdef dict obj_dict
+    while True:
+        obj_dict = obj.__dict__
+        recorder_ref = obj_dict.get('__recorder__')
+        if recorder_ref is not None:
+            recorder = recorder_ref()
+            if recorder is None:
+                return None, None
+            steps.reverse()
+            return recorder, steps
+        link = obj_dict.get('__rec_parent__')
+        if link is None or link[0] is None:
+            return None, None
+        parent, key = link
+        if isinstance(parent, DataModel):
+            if parent.__dict__.get((<Field>key).key) is not obj:
+                return None, None
+            steps.append((key, None))
+        else:
+            # 容器的元素。数组元素记下的位置在insert和remove的时候更新
+            if isinstance(parent, Array):
+                if key is None or key >= len(parent) or parent[key] is not obj:
+                    return None, None
+            elif parent.get(key) is not obj:
+                return None, None
+            container = parent
+            parent, field = _container_owner(container)
+            if parent is None:
+                return None, None
+            steps.append((field, key))
+        obj = parent
+
+cdef int _encode_mutation_head(WriteBuffer buf, int kind, list steps, Field field) except -1:
+    cdef Field sfield
+    buf.write_uint8(kind)
+    buf.write_uint8(len(steps))
+    for sfield, key in steps:
+        buf.write_uint16(sfield.index)
+        if sfield.array:
+            buf.write_uint32(key)
+        elif key is not None:
+            buf.write_value(sfield.bin_key_type, key)
+    buf.write_uint16(field.index)
+    return 0
+
+cdef _record_mutation(obj, int kind, Field field, key=None, value=None,
+                      int op=0, Py_ssize_t index=0):
+    '''obj在记录的树里时，把obj上field的修改打包后交给记录器'''
+    cdef dict obj_dict = obj.__dict__
+    cdef WriteBuffer buf
+    recorder, steps = _find_recorder(obj)
+    if recorder is None:
+        return
+    buf = acquire_write_buffer()
+    try:
+        _encode_mutation_head(buf, kind, steps, field)
+        if kind == MUTATION_SET_FIELD:
+            value = _field_value(obj, obj_dict, field)
+            _encode_field_to_binary(buf, field, obj, obj_dict, True, False, False, FieldFilter())
+            if not field.ref:
+                _link_tree(value, obj, field)
+        elif kind == MUTATION_MAP_SET or kind == MUTATION_MAP_DEL:
+            buf.write_value(field.bin_key_type, key)
+            if kind == MUTATION_MAP_SET:
+                ff = FieldFilter(_exclude_oid_field) if field.id_map else FieldFilter()
+                _field_value_to_binary(buf, field.bin_encoder, field, value, True, False, False, ff)
+                if not field.ref:
+                    _link_tree(value, obj_dict[field.key], key)
+        elif kind == MUTATION_ARRAY_OP:
+            buf.write_array_op(op, index)
+            if op != ARRAY_OP_REMOVE:
+                _field_value_to_binary(buf, field.bin_encoder, field, value, True, False, False,
+                                       FieldFilter())
+            if not field.ref:
+                arr = obj_dict[field.key]
+                if op != ARRAY_OP_REMOVE:
+                    _link_tree(value, arr, index)
+                if op == ARRAY_OP_INSERT:
+                    _relink_elements(arr, index + 1)
+                elif op == ARRAY_OP_REMOVE:
+                    _relink_elements(arr, index)
+        recorder._push(buf.tostring())
+    finally:
+        release_write_buffer(buf)
+
+cdef _record_field(obj, int field_index):
+    '''字段赋值以后调用。值是None的时候记成删除字段'''
+    cdef Field field = obj._fields_by_index[field_index]
+    if _field_value(obj, obj.__dict__, field) is None:
+        _record_mutation(obj, MUTATION_DEL_FIELD, field)
+    else:
+        _record_mutation(obj, MUTATION_SET_FIELD, field)
+
+cdef _record_container(container, int kind, key=None, value=None, int op=0, Py_ssize_t index=0):
+    '''容器修改以后调用。整个容器的改变(比如sort)记成所属字段的赋值'''
+    owner, field = _container_owner(container)
+    if owner is not None:
+        _record_mutation(owner, kind, field, key, value, op, index)
+
+class MutationRecorder(object):
+    '''记录root对象树上的修改：字段赋值(包括add_xxx, sub_xxx)、map和数组的修改。
+        每个修改在发生时打包成(路径, 操作, 值)，保存在容量为capacity的环形缓冲里。
+        pack()把记录的修改打包成binary格式，另一端用replay_mutations依次重放。
+        开销只和修改的次数有关，和对象树的大小无关。
+
+        缓冲满了以后最早的修改被丢弃，pack()会抛出PackError，这时需要重新同步整个对象，再调用reset()。
+        和changed标志一样，解码修改的数据不记录。解码替换了子对象或容器以后，需要调用reset()。
+        root只保存记录器的弱引用，记录器没有close()就被回收的时候也会停止记录。
+    '''
+    def __init__(self, root, capacity=4096):
+        global _recorders
+        self._active = False
+        recorder_ref = root.__dict__.get('__recorder__')
+        if recorder_ref is not None and recorder_ref() is not None:
+            raise OperateError('object already has a recorder')
+        self.root = root
+        self.dropped = 0
+        self._ops = deque(maxlen=capacity)
+        self._ref = weakref.ref(self)
+        root.__dict__['__recorder__'] = self._ref
+        self._active = True
+        _recorders += 1
+        _link_tree(root, None, None)
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def _push(self, data):
+        if len(self._ops) == self._ops.maxlen:
+            self.dropped += 1
+        self._ops.append(data)
+
+    def pack(self, clear=True):
+        '''把记录的修改打包成binary格式。clear为True时清空记录'''
+        cdef WriteBuffer buf
+        if self.dropped:
+            raise PackError('{} mutations dropped, resync needed'.format(self.dropped))
+        buf = acquire_write_buffer()
+        try:
+            buf.write_uint32(len(self._ops))
+            for data in self._ops:
+                _write_raw(buf, data)
+            if clear:
+                self._ops.clear()
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def reset(self):
+        '''清空记录，重新记下对象树里每个子对象和容器的位置'''
+        self._ops.clear()
+        self.dropped = 0
+        _link_tree(self.root, None, None)
+
+    def close(self):
+        '''停止记录'''
+        global _recorders
+        if self._active:
+            self._active = False
+            _recorders -= 1
+            if self.root.__dict__.get('__recorder__') is self._ref:
+                del self.root.__dict__['__recorder__']
+
+cdef Field _mutation_field(obj, int field_index):
+    cdef Field field = obj._fields_by_index.get(field_index)
+    if field is None:
+        raise UnpackError('unknown field, index={}'.format(field_index))
+    return field
+
+def replay_mutations(obj, data, resolve_ref=None, copy_bytes=False):
+    '''把MutationRecorder.pack()打包的修改依次应用到obj上。obj和记录的根对象是同一个类型，
+        并且和记录开始时的数据一致。和解码一样，不修改changed标志。返回没有解析的引用。
+        resolve_ref, copy_bytes同unpack_from_binary
+    '''
+    cdef ReadBuffer buf = ReadBuffer(data, copy_bytes)
+    cdef DecodeContext context = DecodeContext(resolve_ref=resolve_ref)
+    cdef Field field
+    cdef dict obj_dict
+    cdef uint32_t count, nsteps, i, j
+    cdef int kind, op
+    cdef Py_ssize_t index
+    count = buf.read_uint32()
+    for i in range(count):
+        kind = buf.read_uint8()
+        target = obj
+        nsteps = buf.read_uint8()
+        for j in range(nsteps):
+            field = _mutation_field(target, buf.read_uint16())
+            value = getattr(target, field.name)
+            try:
+                if field.array:
+                    value = value[buf.read_uint32()]
+                elif field.map or field.id_map:
+                    value = value[buf.read_value(field.bin_key_type)]
+            except (IndexError, KeyError):
+                raise UnpackError('bad mutation path: {}'.format(field.name))
+            if not isinstance(value, DataModel):
+                raise UnpackError('bad mutation path: {}'.format(field.name))
+            target = value
+        obj_dict = target.__dict__
+        _drop_clean(obj_dict)
+        field = _mutation_field(target, buf.read_uint16())
+        if kind == MUTATION_SET_FIELD:
+            if buf.read_uint16() != field.index:
+                raise UnpackError('bad mutation field: {}'.format(field.name))
+            _drop_lazy_field(obj_dict, field.key)
+            _decode_field_from_binary(buf, field, obj_dict, context)
+            _move_to_slots(target, obj_dict)
+        elif kind == MUTATION_DEL_FIELD:
+            _drop_lazy_field(obj_dict, field.key)
+            if field.slot >= 0:
+                (<SlotStorage>target).clear(field.slot)
+            else:
+                obj_dict.pop(field.key, None)
+        elif kind == MUTATION_MAP_SET or kind == MUTATION_MAP_DEL:
+            m = getattr(target, field.name)
+            key = buf.read_value(field.bin_key_type)
+            if kind == MUTATION_MAP_DEL:
+                if key in m:
+                    m._delitem(key)
+                continue
+            value = _field_value_from_binary(buf, field, None,
+                                             key if field.id_map else None, context)
+            m._setitem(key, value)
+            if field.ref:
+                context.add_unsolved_ref(('map', m, key, value))
+        elif kind == MUTATION_ARRAY_OP:
+            arr = getattr(target, field.name)
+            op = buf.read_uint8()
+            index = buf.read_uint32()
+            value = None
+            if op != ARRAY_OP_REMOVE:
+                value = _field_value_from_binary(buf, field, None, None, context)
+            arr._apply_op(op, index, value)
+            if field.ref:
+                _add_array_refs(arr, context)
+        else:
+            raise UnpackError('unknown mutation: {}'.format(kind))
+    context.resolve_ref()
+    return context.unsolved_ref
@@ -125,13 +125,17 @@ cdef extern from "field_dirty_set.h":
     cdef cppclass FieldDirtySet:
         bint is_field_dirty(FieldIdx f)
         bint has_any_dirty()
+        int get_dirty_count()
         void set_field_dirty(FieldIdx f)
         void clear_field_dirty(FieldIdx f)
         void clear_all_dirty()
+        int next_dirty(int start)
 
 ctypedef long long int64
 ctypedef unsigned long long uint64
 
+include "codes_bin.pxi"
+
 
 class DataModelError(Exception):
     pass
@@ -469,8 +473,10 @@ cdef bint _encode_to_dict(dict dict_data, DataModelProtocol protocol, object obj
     cdef DataModel dm_obj = <DataModel>obj
     cdef object value
     cdef FieldFilter i_field_filter
+    cdef list fields = dm_obj._changed_fields(recursive) if only_changed \
+        else protocol.fields_define.fields
 
-    for field in protocol.fields_define.fields:
+    for field in fields:
         value = obj_dict.get(field.key)
         if value is None:
             continue
@@ -486,11 +492,12 @@ cdef bint _encode_to_dict(dict dict_data, DataModelProtocol protocol, object obj
         kencoder = field.dict_key_encoder
 
         if field.array:
+            # 数组的改变不再设置元素的changed标志，元素需要完整打包
             dict_data[field.name] = [
                 _field_value_to_dict(
                     encoder, field, v,
                     recursive=recursive,
-                    only_changed=only_changed,
+                    only_changed=False,
                     clear_changed=clear_changed,
                     field_filter=field_filter,
                     with_skip_from_pack=False)
@@ -710,6 +717,250 @@ cdef void _decode_from_dict(DataModelProtocol protocol,
             dm_obj._set_field_changed(field)
 
 
+cdef int _field_value_to_binary(WriteBuffer buf, Field field, object value,
+                                bint recursive, bint only_changed,
+                                bint clear_changed, FieldFilter field_filter) except -1:
+    if field.bin_type != BT_NONE:
+        return buf.write_value(field.bin_type, value)
+    elif recursive:
+        if field.ref:
+            return buf.write_value(field.bin_ref_type, getattr(value, "oid", None))
+        else:
+            return _encode_to_binary(buf, field.data_model_protocol, value,
+                                     recursive=recursive,
+                                     only_changed=only_changed,
+                                     clear_changed=clear_changed,
+                                     field_filter=field_filter)
+    return 0
+
+
+cdef int _encode_to_binary(WriteBuffer buf, DataModelProtocol protocol, object obj,
+                           bint recursive, bint only_changed, bint clear_changed,
+                           FieldFilter field_filter) except -1:
+    '''将对象数据转储到binary buff。数据格式和c_data_model一致。'''
+    cdef dict obj_dict = obj.__dict__
+    cdef Field field
+    cdef DataModel dm_obj = <DataModel>obj
+    cdef object value
+    cdef FieldFilter i_field_filter
+    cdef list fields = dm_obj._changed_fields(recursive) if only_changed \
+        else protocol.fields_define.fields
+
+    for field in fields:
+        value = obj_dict.get(field.key)
+        if value is None:
+            continue
+
+        if field_filter.is_filted(field):
+            continue
+
+        if only_changed:
+            if not dm_obj._has_field_changed(field, obj_dict, recursive):
+                continue
+
+        buf.write_uint16(field.index)
+        if field.array:
+            buf.write_container_head(C_ARRAY_32, len(value))
+            for v in value:
+                _field_value_to_binary(buf, field, v,
+                                       recursive=recursive,
+                                       only_changed=False,
+                                       clear_changed=clear_changed,
+                                       field_filter=field_filter)
+            if clear_changed:
+                _container_clear_changed(field, value, recursive=False)
+        elif field.map:
+            buf.write_container_head(C_MAP_32, len(value))
+            for k, v in value.iteritems():
+                buf.write_value(field.bin_key_type, k)
+                _field_value_to_binary(buf, field, v,
+                                       recursive=recursive,
+                                       only_changed=only_changed,
+                                       clear_changed=clear_changed,
+                                       field_filter=field_filter)
+            if clear_changed:
+                _container_clear_changed(field, value, recursive=False)
+        elif field.id_map:
+            buf.write_container_head(C_ID_MAP_32, len(value))
+            i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+            for v in value.itervalues():
+                buf.write_value(field.bin_key_type, v.oid)
+                _field_value_to_binary(buf, field, v,
+                                       recursive=recursive,
+                                       only_changed=only_changed,
+                                       clear_changed=clear_changed,
+                                       field_filter=i_field_filter)
+            if clear_changed:
+                _container_clear_changed(field, value, recursive=False)
+        else:
+            _field_value_to_binary(buf, field, value,
+                                   recursive=recursive,
+                                   only_changed=only_changed,
+                                   clear_changed=clear_changed,
+                                   field_filter=field_filter)
+
+    if clear_changed:
+        dm_obj._clear_changed(None, recursive=False)
+
+    buf.write_uint16(0)
+    return 0
+
+
+cdef Py_ssize_t _field_value_binary_size(Field field, object value, bint recursive,
+                                         bint only_changed, FieldFilter field_filter) except -1:
+    cdef Field oid_field
+    if not field.is_data_model_type():
+        return calc_value_size(field.type_name, value)
+    elif recursive:
+        if field.ref:
+            oid_field = field.data_model_protocol.fields_define.fields_by_name['oid']
+            return calc_value_size(oid_field.type_name, getattr(value, "oid", None))
+        else:
+            return _calc_binary_size(field.data_model_protocol, value,
+                                     recursive=recursive,
+                                     only_changed=only_changed,
+                                     field_filter=field_filter)
+    return 0
+
+
+cdef Py_ssize_t _calc_binary_size(DataModelProtocol protocol, object obj,
+                                  bint recursive, bint only_changed,
+                                  FieldFilter field_filter) except -1:
+    '''计算_encode_to_binary输出的字节数。不修改对象的changed标志。'''
+    cdef dict obj_dict = obj.__dict__
+    cdef Py_ssize_t size = FIELD_INDEX_SIZE  # 结束标志
+    cdef Field field
+    cdef DataModel dm_obj = <DataModel>obj
+    cdef object value
+    cdef FieldFilter i_field_filter
+    cdef list fields = dm_obj._changed_fields(recursive) if only_changed \
+        else protocol.fields_define.fields
+
+    for field in fields:
+        value = obj_dict.get(field.key)
+        if value is None:
+            continue
+
+        if field_filter.is_filted(field):
+            continue
+
+        if only_changed:
+            if not dm_obj._has_field_changed(field, obj_dict, recursive):
+                continue
+
+        size += FIELD_INDEX_SIZE
+        if field.array:
+            size += CONTAINER_HEAD_SIZE
+            for v in value:
+                size += _field_value_binary_size(field, v, recursive, False, field_filter)
+        elif field.map:
+            size += CONTAINER_HEAD_SIZE
+            for k, v in value.iteritems():
+                size += calc_value_size(field.key_type_name, k)
+                size += _field_value_binary_size(field, v, recursive, only_changed, field_filter)
+        elif field.id_map:
+            size += CONTAINER_HEAD_SIZE
+            i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+            for v in value.itervalues():
+                size += calc_value_size(field.key_type_name, v.oid)
+                size += _field_value_binary_size(field, v, recursive, only_changed, i_field_filter)
+        else:
+            size += _field_value_binary_size(field, value, recursive, only_changed, field_filter)
+
+    return size
+
+
+cdef object _field_value_from_binary(ReadBuffer buf, Field field, object oid,
+                                     object old_value, DecodeContext context):
+    cdef dict obj_dict
+    if field.bin_type != BT_NONE:
+        return buf.read_value(field.bin_type)
+    elif field.ref:
+        return buf.read_value(field.bin_ref_type)
+    else:
+        if old_value is not None:
+            fobj = old_value
+            obj_dict = fobj.__dict__
+        else:
+            fobj = None
+            obj_dict = {}
+        _decode_from_binary(buf, field.data_model_protocol, fobj, obj_dict, context)
+        if fobj is None:
+            fobj = _create_object(field, obj_dict)
+            _replace_obj_dict(fobj, obj_dict)
+
+        if oid is not None:
+            fobj.__dict__['_oid'] = oid
+            context.add_known_object(oid, fobj)
+        return fobj
+
+
+cdef int _decode_from_binary(ReadBuffer buf, DataModelProtocol protocol,
+                             object obj, dict obj_dict,
+                             DecodeContext context) except -1:
+    '''从binary buff恢复对象数据'''
+    cdef dict fields_by_index = protocol.fields_define.fields_by_index
+    cdef Field field
+    cdef uint16_t field_index
+    cdef uint32_t asize, i
+    cdef Array arr
+    cdef Map m
+    cdef object key
+    cdef object value
+    cdef object old_value
+
+    while not buf.at_end():
+        field_index = buf.read_uint16()
+        if field_index == 0:
+            # end of field
+            break
+        field = fields_by_index.get(field_index)
+        if field is None:
+            raise PackError('unkown field, ndex={}'.format(field_index))
+        if field.array:
+            arr = obj_dict[field.key] = _new_array(field)
+            asize = buf.read_container_head(C_ARRAY_32)
+            for i in range(asize):
+                value = _field_value_from_binary(buf, field, None, None, context)
+                arr._append(value)
+                if field.ref:
+                    context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
+        elif field.map or field.id_map:
+            m = None
+            if context.sync_mode:
+                m = obj_dict.get(field.key)
+            if m is None:
+                m = _new_container(field)
+                obj_dict[field.key] = m
+            if field.map:
+                asize = buf.read_container_head(C_MAP_32)
+            else:
+                asize = buf.read_container_head(C_ID_MAP_32)
+            for i in range(asize):
+                old_value = None
+                key = buf.read_value(field.bin_key_type)
+                if context.sync_mode:
+                    old_value = m.get(key)
+                value = _field_value_from_binary(buf, field,
+                                                 key if field.id_map else None,
+                                                 old_value, context)
+                m._raw_setitem(key, value)
+                if field.ref:
+                    context.add_unsolved_ref(('map', m, key, value))
+        else:
+            old_value = None
+            if context.sync_mode:
+                old_value = obj_dict.get(field.key)
+            value = _field_value_from_binary(buf, field, None, old_value, context)
+            obj_dict[field.key] = value
+            if field.ref:
+                context.add_unsolved_ref(('obj_dict', obj_dict, field.key, value))
+
+        if context.mark_change and obj is not None:
+            (<DataModel>obj)._set_field_changed(field)
+    return 0
+
+
 cdef class DecodeContext(object):
     cdef dict known_objects
     cdef list tmp_unsolved_ref
@@ -810,19 +1061,16 @@ cdef class Array(list):
 
     def __setitem__(self, k, v):
         self.changed = True
-        self._broadcast_changed(False)
         list.__setitem__(self, k, v)
 
 
     def __delitem__(self, k):
         self.changed = True
-        self._broadcast_changed(False)
         list.__delitem__(self, k)
 
 
     def __iadd__(self, other):
         self.changed = True
-        self._broadcast_changed(False)
         return list.__iadd__(self, other)
 
 
@@ -832,7 +1080,6 @@ cdef class Array(list):
 
     def append(self, v):
         self.changed = True
-        self._broadcast_changed(False)
         return list.append(self, v)
 
 
@@ -842,19 +1089,16 @@ cdef class Array(list):
 
     def extend(self, v):
         self.changed = True
-        self._broadcast_changed(False)
         return list.extend(self, v)
 
 
     def insert(self, k, v):
         self.changed = True
-        self._broadcast_changed(False)
         return list.insert(self, k, v)
 
 
     def pop(self, k=None):
         self.changed = True
-        self._broadcast_changed(False)
         if k is None:
             return list.pop(self)
         else:
@@ -863,13 +1107,11 @@ cdef class Array(list):
 
     def remove(self, x):
         self.changed = True
-        self._broadcast_changed(False)
         return list.remove(self, x)
 
 
     def sort(self, *arg, **kwargs):
         self.changed = True
-        self._broadcast_changed(False)
         return list.sort(self, *arg, **kwargs)
 
     def has_changed(self, bint recursive=False):
@@ -961,9 +1203,12 @@ cdef class Map(dict):
 
 
     def update(self, *arg, **kwargs):
+        # 只设置更新了的元素的changed标志，不需要遍历其它元素
+        cdef dict items = dict(*arg, **kwargs)
         self.changed = True
-        self._broadcast_changed(False)
-        return dict.update(self, *arg, **kwargs)
+        for v in items.itervalues():
+            _container_item_set_changed(self.field, v, False)
+        return dict.update(self, items)
 
 
 
@@ -1049,6 +1294,10 @@ cdef class Field(object):
     cdef object dict_ref_encoder
     cdef object dict_ref_decoder
 
+    cdef int bin_type
+    cdef int bin_key_type
+    cdef int bin_ref_type
+
     cdef dict __dict__
 
 
@@ -1128,10 +1377,15 @@ cdef class Field(object):
 
         cdef Field value_field
 
+        self.bin_type = get_bin_type(self.base_value_type)
+        self.bin_key_type = get_bin_type(self.key_type_name)
+        self.bin_ref_type = BT_NONE
+
         if self.ref:
             value_field = self.data_model_protocol.fields_define.fields_by_name['oid']
             self.dict_ref_encoder = value_field.dict_encoder
             self.dict_ref_decoder = value_field.dict_decoder
+            self.bin_ref_type = value_field.bin_type
 
         if [self, array, self.map, self.id_map].count(True) > 1:
             raise DefineError('conflicted properties: array, map, id_map')
@@ -1189,6 +1443,7 @@ cdef class FieldsDefine:
     cdef dict fields_by_name
     cdef dict fields_by_key
     cdef dict fields_is_container
+    cdef list nested_fields
 
     def __init__(self):
         self.fields = []
@@ -1196,6 +1451,7 @@ cdef class FieldsDefine:
         self.fields_by_name = {}
         self.fields_by_key = {}
         self.fields_is_container = {}
+        self.nested_fields = []
 
     def add_field(self, Field field):
         self.fields.append(field)
@@ -1214,7 +1470,13 @@ cdef class FieldsDefine:
 
 
     def sort_fields(self):
+        cdef Field field
         self.fields.sort(lambda a, b: cmp(a.index, b.index))
+        # 增量打包时，没有改变标志的字段里只有对象和容器字段需要检查
+        self.nested_fields = []
+        for field in self.fields:
+            if field.is_container() or (field.is_data_model_type() and not field.ref):
+                self.nested_fields.append(field)
 
     def copy_class_fields(self, FieldsDefine other):
         '''
@@ -1581,6 +1843,34 @@ cdef class DataModel(object):
         return False
 
 
+    cdef list _changed_fields(self, bint recursive):
+        '''增量打包时需要检查的字段，按index排序。只遍历有改变标志的字段，
+            recursive的时候再加上可能有改变的对象和容器字段
+        '''
+        cdef FieldsDefine fields_define = self.protocol.fields_define
+        cdef dict fields_by_index = fields_define.fields_by_index
+        cdef list nested = fields_define.nested_fields if recursive else []
+        cdef Py_ssize_t i = 0
+        cdef Py_ssize_t n = len(nested)
+        cdef int index = self.changed_set.next_dirty(0)
+        cdef list result = []
+        cdef Field field
+        while index >= 0 or i < n:
+            if i < n:
+                field = nested[i]
+                if index < 0 or field.index < index:
+                    result.append(field)
+                    i += 1
+                    continue
+                if field.index == index:
+                    i += 1
+            field = fields_by_index.get(index)
+            if field is not None:
+                result.append(field)
+            index = self.changed_set.next_dirty(index + 1)
+        return result
+
+
     cdef void _clear_changed(self, object field_names, bint recursive):
         cdef Field field
         cdef object value
@@ -1684,6 +1974,8 @@ cdef class DataModel(object):
     def pack(self, fmt, *args, **kwargs):
         if fmt == 'dict':
             return self.pack_to_dict(*args, **kwargs)
+        elif fmt == 'bin':
+            return self.pack_to_binary(*args, **kwargs)
         else:
             raise PackError('unsupported format: {}'.format(fmt))
 
@@ -1691,6 +1983,8 @@ cdef class DataModel(object):
     def unpack(self, fmt, *args, **kwargs):
         if fmt == 'dict':
             return self.unpack_from_dict(*args, **kwargs)
+        elif fmt == 'bin':
+            return self.unpack_from_binary(*args, **kwargs)
         else:
             raise PackError('unsupported format: {}'.format(fmt))
 
@@ -1720,6 +2014,73 @@ cdef class DataModel(object):
         return context.unsolved_ref
 
 
+    def calc_packed_size(self, recursive=True, only_changed=False, field_filter=None):
+        '''计算pack_to_binary输出的字节数'''
+        cdef FieldFilter ff
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
+        return _calc_binary_size(self._get_protocol(), self,
+                                 recursive=recursive,
+                                 only_changed=only_changed,
+                                 field_filter=ff)
+
+
+    def pack_to_binary(self, recursive=True, only_changed=False,
+                       clear_changed=False, field_filter=None, out=None):
+        '''
+        @memo:
+            out 如果指定了out(bytearray或者可写的memoryview)，数据从out的开头写入，
+                返回写入的字节数。out的大小可以用calc_packed_size预先算出。
+        '''
+        cdef WriteBuffer buf
+        cdef FieldFilter ff
+        cdef Py_ssize_t size
+        cdef DataModelProtocol protocol = self._get_protocol()
+        if not isinstance(field_filter, FieldFilter):
+            ff = FieldFilter(field_filter)
+        else:
+            ff = field_filter
+
+        if out is not None:
+            if clear_changed:
+                # 写到一半空间不够的话，已经清除的changed标志无法恢复，所以先检查大小
+                size = _calc_binary_size(protocol, self, recursive, only_changed, ff)
+                if len(out) < size:
+                    raise PackError('output buffer too small: {} < {}'.format(len(out), size))
+            buf = WriteBuffer(out=out)
+            try:
+                _encode_to_binary(buf, protocol, self,
+                                  recursive=recursive,
+                                  only_changed=only_changed,
+                                  clear_changed=clear_changed,
+                                  field_filter=ff)
+            except MemoryError:
+                raise PackError('output buffer too small: {}'.format(len(out)))
+            return buf.offset
+
+        buf = acquire_write_buffer()
+        try:
+            _encode_to_binary(buf, protocol, self,
+                              recursive=recursive,
+                              only_changed=only_changed,
+                              clear_changed=clear_changed,
+                              field_filter=ff)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+
+    def unpack_from_binary(self, data, str mode=None, object resolve_ref=None, bint mark_change=False):
+        cdef ReadBuffer buf = ReadBuffer(data)
+        cdef DecodeContext context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change)
+        cdef DataModelProtocol protocol = self._get_protocol()
+        _decode_from_binary(buf, protocol, self, self.__dict__, context)
+        context.resolve_ref()
+        return context.unsolved_ref
+
+
     def clear_changed(self, *field_names, **options):
         cdef bint recursive
         _recursive = options.get('recursive')
@@ -1,202 +1,641 @@
 # encoding=utf-8
 
-from struct import pack_into, unpack_from
-
-cdef int INIT_BUFF_SIZE = 1024 * 4
-cdef str MORE_BUFF_SPACE = '\0' * 1024
-
-cdef str C_ARRAY_32 = chr(0xd0)
-cdef str C_MAP_32 = chr(0xd1)
-cdef str C_ID_MAP_32 = chr(0xd2)
+import sys
+import threading
+from array import array
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.bytearray cimport PyByteArray_AS_STRING, PyByteArray_Resize
+from cpython.buffer cimport PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE, PyBUF_WRITABLE
+from libc.string cimport memcpy
+from libc.stdint cimport int8_t, uint8_t, int16_t, uint16_t, int32_t, uint32_t, int64_t, uint64_t
+
+cdef extern from "Python.h":
+    int PyObject_AsReadBuffer(object obj, const void** buffer, Py_ssize_t* buffer_len) except -1
+
+cdef Py_ssize_t INIT_BUFF_SIZE = 1024 * 4
+# 超过这个大小的buffer用完后不放回线程缓冲池，避免长期占用内存
+cdef Py_ssize_t MAX_POOLED_BUFF_SIZE = 1024 * 1024
+# 每个线程缓冲池里最多保留的buffer个数
+cdef Py_ssize_t MAX_POOLED_BUFF_COUNT = 4
+
+cdef enum:
+    C_ARRAY_32 = 0xd0
+    C_MAP_32 = 0xd1
+    C_ID_MAP_32 = 0xd2
+    # 增量数据里map/id_map数据前面的删除key列表
+    C_TOMBSTONES_32 = 0xd3
+    # 增量数据里代替整个数组的操作列表
+    C_ARRAY_OPS_32 = 0xd4
+
+# 数组操作。每个操作是1字节操作码 + uint32位置，remove以外的操作后面跟着元素的数据
+cdef enum:
+    ARRAY_OP_APPEND = 1
+    ARRAY_OP_SET = 2
+    ARRAY_OP_INSERT = 3
+    ARRAY_OP_REMOVE = 4
+
+cdef Py_ssize_t ARRAY_OP_HEAD_SIZE = 5
+
+# 定长标量类型编码后的字节数
+cdef dict SCALAR_SIZES = {
+    'int8'   : 1,
+    'uint8'  : 1,
+    'int16'  : 2,
+    'uint16' : 2,
+    'int32'  : 4,
+    'uint32' : 4,
+    'int64'  : 8,
+    'uint64' : 8,
+    'float'  : 4,
+    'double' : 8,
+    'bool'   : 1,
+}
+
+# typed数组的元素类型对应的array类型码。只保留元素字节数和编码字节数一致的类型码，
+# 比如int64只在long是8字节的平台上可以用
+cdef dict TYPED_ARRAY_CODES = dict(
+    (type_name, code) for type_name, code in (
+        ('int8', 'b'), ('uint8', 'B'), ('int16', 'h'), ('uint16', 'H'),
+        ('int32', 'i'), ('uint32', 'I'), ('int64', 'l'), ('uint64', 'L'),
+        ('float', 'f'), ('double', 'd'))
+    if array(code).itemsize == SCALAR_SIZES[type_name])
+
+cdef bint LITTLE_ENDIAN = sys.byteorder == 'little'
+
+cdef Py_ssize_t FIELD_INDEX_SIZE = 2
+cdef Py_ssize_t CONTAINER_HEAD_SIZE = 5
+# 分帧格式里，每个字段index后面的4字节字段数据长度
+cdef Py_ssize_t FIELD_FRAME_SIZE = 4
+# 分帧格式的数据以这个保留的字段index开头，解码时用来检查framed参数
+cdef uint16_t FRAMED_MARK = 0xffff
+# bytes类型的4字节数据长度
+cdef Py_ssize_t BYTES_HEAD_SIZE = 4
+
+# 基本类型的二进制编码类型。Field在创建的时候确定，解码的时候直接分派到ReadBuffer的cdef方法
+cdef enum:
+    BT_NONE = 0
+    BT_INT8
+    BT_UINT8
+    BT_INT16
+    BT_UINT16
+    BT_INT32
+    BT_UINT32
+    BT_INT64
+    BT_UINT64
+    BT_FLOAT
+    BT_DOUBLE
+    BT_BOOL
+    BT_STRING
+    BT_BYTES
+
+cdef dict BIN_TYPES = {
+    'int8'   : BT_INT8,
+    'uint8'  : BT_UINT8,
+    'int16'  : BT_INT16,
+    'uint16' : BT_UINT16,
+    'int32'  : BT_INT32,
+    'uint32' : BT_UINT32,
+    'int64'  : BT_INT64,
+    'uint64' : BT_UINT64,
+    'float'  : BT_FLOAT,
+    'double' : BT_DOUBLE,
+    'bool'   : BT_BOOL,
+    'string' : BT_STRING,
+    'bytes'  : BT_BYTES,
+}
+
+cdef inline int get_bin_type(str type_name):
+    if type_name is None:
+        return BT_NONE
+    return BIN_TYPES.get(type_name, BT_NONE)
+
+cdef inline void store_be16(unsigned char* p, uint16_t v):
+    p[0] = <unsigned char>(v >> 8)
+    p[1] = <unsigned char>v
+
+cdef inline void store_be32(unsigned char* p, uint32_t v):
+    p[0] = <unsigned char>(v >> 24)
+    p[1] = <unsigned char>(v >> 16)
+    p[2] = <unsigned char>(v >> 8)
+    p[3] = <unsigned char>v
+
+cdef inline void store_be64(unsigned char* p, uint64_t v):
+    store_be32(p, <uint32_t>(v >> 32))
+    store_be32(p + 4, <uint32_t>v)
+
+cdef void copy_big_endian(unsigned char* dst, const unsigned char* src, Py_ssize_t n,
+                          Py_ssize_t itemsize):
+    '''复制n个字节的定长数值，在小端机器上同时交换每个数值的字节序'''
+    cdef Py_ssize_t i, j
+    if not LITTLE_ENDIAN or itemsize == 1:
+        memcpy(dst, src, n)
+        return
+    for i in range(0, n, itemsize):
+        for j in range(itemsize):
+            dst[i + j] = src[i + itemsize - 1 - j]
 
 cdef class WriteBuffer:
-    cdef bytearray b
-    cdef int offset
-
-    def __cinit__(self):
-        self.b = bytearray(INIT_BUFF_SIZE)
+    '''写缓冲区。
+        默认使用内部的bytearray，空间不够时按倍数增长。
+        如果指定了out(bytearray或者可写的memoryview)，直接写入out，且不会扩展out的大小。
+    '''
+    cdef object b
+    cdef bint growable
+    cdef Py_ssize_t offset
+    cdef Py_buffer view
+    cdef bint has_view
+
+    def __cinit__(self, Py_ssize_t size=INIT_BUFF_SIZE, object out=None):
+        if out is not None:
+            PyObject_GetBuffer(out, &self.view, PyBUF_WRITABLE)
+            self.has_view = True
+            self.b = out
+            self.growable = False
+        else:
+            self.b = bytearray(size)
+            self.growable = True
         self.offset = 0
 
-    cdef void check_size(self, int new_size):
-        if len(self.b) < new_size:
-            self.b.expand(MORE_BUFF_SPACE)
+    def __dealloc__(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+
+    cdef int check_size(self, Py_ssize_t new_size) except -1:
+        cdef Py_ssize_t size
+        if not self.growable:
+            if self.view.len < new_size:
+                raise MemoryError('no more space')
+            return 0
+        size = len(self.b)
+        if size < new_size:
+            PyByteArray_Resize(self.b, max(size * 2, new_size))
+        return 0
+
+    cdef inline unsigned char* base(self):
+        '''数据的起始指针，在下次扩展前有效'''
+        if self.growable:
+            return <unsigned char*>PyByteArray_AS_STRING(self.b)
+        return <unsigned char*>self.view.buf
+
+    cdef inline unsigned char* reserve(self, Py_ssize_t n) except NULL:
+        '''扩展n个字节的写空间。返回新空间的数据指针，在下次扩展前有效。'''
+        cdef Py_ssize_t offset = self.offset
+        self.check_size(offset + n)
+        self.offset = offset + n
+        return self.base() + offset
+
+    cdef inline Py_ssize_t begin_frame(self) except -1:
+        '''预留字段数据长度的空间。返回预留空间的偏移，字段数据写完后调用end_frame回填长度'''
+        cdef Py_ssize_t offset = self.offset
+        self.reserve(FIELD_FRAME_SIZE)
+        return offset
+
+    cdef inline void end_frame(self, Py_ssize_t offset):
+        store_be32(self.base() + offset, <uint32_t>(self.offset - offset - FIELD_FRAME_SIZE))
+
+    cdef inline int write_uint8(self, uint8_t v) except -1:
+        self.reserve(1)[0] = v
+        return 0
+
+    cdef inline int write_uint16(self, uint16_t v) except -1:
+        store_be16(self.reserve(2), v)
+        return 0
+
+    cdef inline int write_uint32(self, uint32_t v) except -1:
+        store_be32(self.reserve(4), v)
+        return 0
+
+    cdef inline int write_uint64(self, uint64_t v) except -1:
+        store_be64(self.reserve(8), v)
+        return 0
+
+    cdef inline int write_float(self, float v) except -1:
+        cdef uint32_t u
+        memcpy(&u, &v, 4)
+        return self.write_uint32(u)
+
+    cdef inline int write_double(self, double v) except -1:
+        cdef uint64_t u
+        memcpy(&u, &v, 8)
+        return self.write_uint64(u)
+
+    cdef int write_string(self, bytes value) except -1:
+        cdef Py_ssize_t ssize = len(value)
+        if ssize >= 2 ** 16:
+            raise RuntimeError('length of string, %d' % ssize)
+        cdef unsigned char* p = self.reserve(2 + ssize)
+        store_be16(p, <uint16_t>ssize)
+        memcpy(p + 2, <const char*>value, ssize)
+        return 0
+
+    cdef int write_bytes(self, object value) except -1:
+        '''value可以是str, bytearray, memoryview等支持buffer协议的对象'''
+        cdef Py_buffer view
+        cdef unsigned char* p
+        PyObject_GetBuffer(value, &view, PyBUF_SIMPLE)
+        try:
+            if view.len >= 2 ** 32:
+                raise RuntimeError('length of bytes, %d' % view.len)
+            p = self.reserve(BYTES_HEAD_SIZE + view.len)
+            store_be32(p, <uint32_t>view.len)
+            memcpy(p + BYTES_HEAD_SIZE, view.buf, view.len)
+        finally:
+            PyBuffer_Release(&view)
+        return 0
+
+    cdef int write_value(self, int bin_type, object value) except -1:
+        '''按基本类型的编码类型编码一个数值'''
+        if bin_type == BT_INT8:
+            return self.write_uint8(<uint8_t><int8_t>value)
+        if bin_type == BT_UINT8:
+            return self.write_uint8(<uint8_t>value)
+        if bin_type == BT_INT16:
+            return self.write_uint16(<uint16_t><int16_t>value)
+        if bin_type == BT_UINT16:
+            return self.write_uint16(<uint16_t>value)
+        if bin_type == BT_INT32:
+            return self.write_uint32(<uint32_t><int32_t>value)
+        if bin_type == BT_UINT32:
+            return self.write_uint32(<uint32_t>value)
+        if bin_type == BT_INT64:
+            return self.write_uint64(<uint64_t><int64_t>value)
+        if bin_type == BT_UINT64:
+            return self.write_uint64(<uint64_t>value)
+        if bin_type == BT_FLOAT:
+            return self.write_float(value)
+        if bin_type == BT_DOUBLE:
+            return self.write_double(value)
+        if bin_type == BT_BOOL:
+            return self.write_uint8(1 if value else 0)
+        if bin_type == BT_STRING:
+            return self.write_string(value)
+        if bin_type == BT_BYTES:
+            return self.write_bytes(value)
+        raise TypeError('unsupported binary type: {}'.format(bin_type))
+
+    cdef inline int write_container_head(self, unsigned char marker, uint32_t size) except -1:
+        cdef unsigned char* p = self.reserve(CONTAINER_HEAD_SIZE)
+        p[0] = marker
+        store_be32(p + 1, size)
+        return 0
+
+    cdef inline int write_array_op(self, unsigned char op, uint32_t index) except -1:
+        cdef unsigned char* p = self.reserve(ARRAY_OP_HEAD_SIZE)
+        p[0] = op
+        store_be32(p + 1, index)
+        return 0
+
+    cdef int write_typed_array(self, object value) except -1:
+        '''编码typed数组。格式和普通数组相同，元素数据整块复制'''
+        cdef const void* ptr
+        cdef Py_ssize_t n
+        cdef Py_ssize_t itemsize = value.itemsize
+        PyObject_AsReadBuffer(value, &ptr, &n)
+        self.write_container_head(C_ARRAY_32, <uint32_t>(n // itemsize))
+        copy_big_endian(self.reserve(n), <const unsigned char*>ptr, n, itemsize)
+        return 0
 
     def pull(self, n):
         '''扩展更多写空间。返回内部buffer对象和新扩展的空间偏移地址。'''
-        cdef int new_offset = self.offset + n
-        self.check_size(new_offset)
-        offset = self.offset
-        self.offset = new_offset
+        cdef Py_ssize_t offset = self.offset
+        self.reserve(n)
         return self.b, offset
 
-    def tostring(self):
-        return str(self.b[:self.offset])
+    cpdef reset(self):
+        self.offset = 0
 
-class ReadBuffer(object):
-    def __init__(self, src):
-        self.b = memoryview(src)
+    def tostring(self):
+        if self.growable:
+            return PyBytes_FromStringAndSize(PyByteArray_AS_STRING(self.b), self.offset)
+        return PyBytes_FromStringAndSize(<const char*>self.view.buf, self.offset)
+
+    property growable:
+        def __get__(self):
+            return self.growable
+
+    property offset:
+        def __get__(self):
+            return self.offset
+
+_local = threading.local()
+
+cpdef WriteBuffer acquire_write_buffer():
+    '''从当前线程的缓冲池里取一个WriteBuffer。用完需调用release_write_buffer归还。'''
+    cdef list pool = getattr(_local, 'write_buffers', None)
+    cdef WriteBuffer buf
+    if pool:
+        buf = pool.pop()
+        buf.reset()
+        return buf
+    return WriteBuffer()
+
+cpdef release_write_buffer(WriteBuffer buf):
+    if not buf.growable or len(buf.b) > MAX_POOLED_BUFF_SIZE:
+        return
+    cdef list pool = getattr(_local, 'write_buffers', None)
+    if pool is None:
+        pool = _local.write_buffers = []
+    if len(pool) < MAX_POOLED_BUFF_COUNT:
+        pool.append(buf)
+
+cdef inline Py_ssize_t calc_value_size(str type_name, object value) except -1:
+    '''计算基本类型数值编码后的字节数'''
+    size = SCALAR_SIZES.get(type_name)
+    if size is not None:
+        return size
+    if type_name == 'bytes':
+        return BYTES_HEAD_SIZE + len(value)
+    return 2 + len(value)
+
+cdef inline uint16_t load_be16(const unsigned char* p):
+    return (<uint16_t>p[0] << 8) | p[1]
+
+cdef inline uint32_t load_be32(const unsigned char* p):
+    return ((<uint32_t>p[0] << 24) | (<uint32_t>p[1] << 16) |
+            (<uint32_t>p[2] << 8) | p[3])
+
+cdef inline uint64_t load_be64(const unsigned char* p):
+    return (<uint64_t>load_be32(p) << 32) | load_be32(p + 4)
+
+cdef class ReadBuffer:
+    '''读缓冲区。通过buffer协议直接引用源数据，解码的时候不复制数据。
+        copy_bytes  -> bytes字段解码成复制出来的str。默认解码成引用源数据的memoryview
+    '''
+    cdef object src
+    cdef Py_buffer view
+    cdef bint has_view
+    cdef const unsigned char* p
+    cdef Py_ssize_t size
+    cdef Py_ssize_t offset
+    cdef bint copy_bytes
+    cdef object src_view
+
+    def __cinit__(self, object src, bint copy_bytes=False):
+        cdef const void* ptr
+        self.src = src
+        self.copy_bytes = copy_bytes
+        self.src_view = None
+        if PyObject_CheckBuffer(src):
+            PyObject_GetBuffer(src, &self.view, PyBUF_SIMPLE)
+            self.has_view = True
+            self.p = <const unsigned char*>self.view.buf
+            self.size = self.view.len
+        else:
+            # 只支持旧buffer协议的对象，比如python2的mmap, array
+            PyObject_AsReadBuffer(src, &ptr, &self.size)
+            self.p = <const unsigned char*>ptr
         self.offset = 0
 
-    def push(self, n):
-        '''增加读缓冲区内的读偏移地址。返回内部buff对象和push前的读偏移地址。'''
-        old_offset = self.offset
-        new_offset = old_offset + n
-        if new_offset > len(self.b):
+    def __dealloc__(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+
+    cdef inline const unsigned char* push(self, Py_ssize_t n) except NULL:
+        '''增加读偏移地址。返回push前读偏移处的数据指针。'''
+        cdef const unsigned char* p = self.p + self.offset
+        if n < 0 or n > self.size - self.offset:
             raise MemoryError('no more data')
-        self.offset = new_offset
-        return self.b, old_offset
+        self.offset += n
+        return p
+
+    cdef inline bint at_end(self):
+        return self.offset >= self.size
+
+    cdef inline int8_t read_int8(self) except? -1:
+        return <int8_t>self.push(1)[0]
+
+    cdef inline uint8_t read_uint8(self) except? 0xff:
+        return self.push(1)[0]
+
+    cdef inline int16_t read_int16(self) except? -1:
+        return <int16_t>load_be16(self.push(2))
+
+    cdef inline uint16_t read_uint16(self) except? 0xffff:
+        return load_be16(self.push(2))
+
+    cdef inline int32_t read_int32(self) except? -1:
+        return <int32_t>load_be32(self.push(4))
+
+    cdef inline uint32_t read_uint32(self) except? 0xffffffff:
+        return load_be32(self.push(4))
+
+    cdef inline int64_t read_int64(self) except? -1:
+        return <int64_t>load_be64(self.push(8))
+
+    cdef inline uint64_t read_uint64(self) except? 0xffffffffffffffff:
+        return load_be64(self.push(8))
+
+    cdef inline float read_float(self) except? -1:
+        cdef uint32_t u = load_be32(self.push(4))
+        cdef float f
+        memcpy(&f, &u, 4)
+        return f
+
+    cdef inline double read_double(self) except? -1:
+        cdef uint64_t u = load_be64(self.push(8))
+        cdef double d
+        memcpy(&d, &u, 8)
+        return d
+
+    cdef inline bytes read_string(self):
+        cdef Py_ssize_t n = self.read_uint16()
+        return PyBytes_FromStringAndSize(<const char*>self.push(n), n)
+
+    cdef object read_slice(self, Py_ssize_t n):
+        '''读出n个字节。copy_bytes时返回str，否则返回引用源数据的memoryview'''
+        cdef Py_ssize_t offset = self.offset
+        cdef const unsigned char* p = self.push(n)
+        if self.copy_bytes:
+            return PyBytes_FromStringAndSize(<const char*>p, n)
+        if self.src_view is None:
+            self.src_view = memoryview(self.src if self.has_view else buffer(self.src))
+        return self.src_view[offset:offset + n]
+
+    cdef inline object read_bytes(self):
+        return self.read_slice(self.read_uint32())
+
+    cdef object read_value(self, int bin_type):
+        '''按基本类型的编码类型解码一个数值'''
+        if bin_type == BT_INT8:
+            return self.read_int8()
+        if bin_type == BT_UINT8:
+            return self.read_uint8()
+        if bin_type == BT_INT16:
+            return self.read_int16()
+        if bin_type == BT_UINT16:
+            return self.read_uint16()
+        if bin_type == BT_INT32:
+            return self.read_int32()
+        if bin_type == BT_UINT32:
+            return self.read_uint32()
+        if bin_type == BT_INT64:
+            return self.read_int64()
+        if bin_type == BT_UINT64:
+            return self.read_uint64()
+        if bin_type == BT_FLOAT:
+            return self.read_float()
+        if bin_type == BT_DOUBLE:
+            return self.read_double()
+        if bin_type == BT_BOOL:
+            return True if self.read_uint8() else False
+        if bin_type == BT_STRING:
+            return self.read_string()
+        if bin_type == BT_BYTES:
+            return self.read_bytes()
+        raise TypeError('unsupported binary type: {}'.format(bin_type))
+
+    cdef int skip_value(self, int bin_type) except -1:
+        '''按基本类型的编码类型跳过一个数值，不解码'''
+        if bin_type == BT_INT8 or bin_type == BT_UINT8 or bin_type == BT_BOOL:
+            self.push(1)
+        elif bin_type == BT_INT16 or bin_type == BT_UINT16:
+            self.push(2)
+        elif bin_type == BT_INT32 or bin_type == BT_UINT32 or bin_type == BT_FLOAT:
+            self.push(4)
+        elif bin_type == BT_INT64 or bin_type == BT_UINT64 or bin_type == BT_DOUBLE:
+            self.push(8)
+        elif bin_type == BT_STRING:
+            self.push(self.read_uint16())
+        elif bin_type == BT_BYTES:
+            self.push(self.read_uint32())
+        else:
+            raise TypeError('unsupported binary type: {}'.format(bin_type))
+        return 0
+
+    cdef inline uint32_t read_container_head(self, unsigned char marker) except? 0xffffffff:
+        cdef uint8_t head = self.read_uint8()
+        assert marker == head
+        return self.read_uint32()
+
+    cdef inline uint32_t read_tombstones_head(self) except? 0xffffffff:
+        '''返回删除key的个数。没有删除key列表时返回0，不移动读偏移'''
+        if self.offset >= self.size or self.p[self.offset] != C_TOMBSTONES_32:
+            return 0
+        self.offset += 1
+        return self.read_uint32()
+
+    cdef inline Py_ssize_t read_array_ops_head(self) except -2:
+        '''返回数组操作的个数。不是操作列表(是完整的数组)时返回-1，不移动读偏移'''
+        if self.offset >= self.size or self.p[self.offset] != C_ARRAY_OPS_32:
+            return -1
+        self.offset += 1
+        return self.read_uint32()
+
+    cdef int read_typed_array(self, object arr) except -1:
+        '''解码typed数组的数据，追加到arr，不修改arr的changed标志'''
+        cdef Py_ssize_t itemsize = arr.itemsize
+        cdef Py_ssize_t n = self.read_container_head(C_ARRAY_32) * itemsize
+        cdef const unsigned char* p = self.push(n)
+        cdef bytes data = PyBytes_FromStringAndSize(NULL, n)
+        copy_big_endian(<unsigned char*><char*>data, p, n, itemsize)
+        array.fromstring(arr, data)
+        return 0
 
     def is_end(self):
-        return self.offset >= len(self.b)
-
-def bin_encode_int8(buf, value):
-    b, offset = buf.pull(1)
-    pack_into('!b', b, offset, value)
-
-def bin_encode_uint8(buf, value):
-    b, offset = buf.pull(1)
-    pack_into('!B', b, offset, value)
-
-def bin_encode_int16(buf, value):
-    b, offset = buf.pull(2)
-    pack_into('!h', b, offset, value)
-
-def bin_encode_uint16(buf, value):
-    b, offset = buf.pull(2)
-    pack_into('!H', b, offset, value)
-
-def bin_encode_int32(buf, value):
-    b, offset = buf.pull(4)
-    pack_into('!i', b, offset, value)
-
-def bin_encode_uint32(buf, value):
-    b, offset = buf.pull(4)
-    pack_into('!I', b, offset, value)
-
-def bin_encode_int64(buf, value):
-    b, offset = buf.pull(8)
-    pack_into('!q', b, offset, value)
-
-def bin_encode_uint64(buf, value):
-    b, offset = buf.pull(8)
-    pack_into('!Q', b, offset, value)
-
-def bin_encode_float(buf, value):
-    b, offset = buf.pull(4)
-    pack_into('!f', b, offset, value)
-
-def bin_encode_double(buf, value):
-    b, offset = buf.pull(8)
-    pack_into('!d', b, offset, value)
-
-def bin_encode_bool(buf, value):
-    _value = 1 if value else 0
-    b, offset = buf.pull(1)
-    pack_into('!B', b, offset, _value)
-
-def bin_encode_string(buf, value):
-    ssize = len(value)
-    if ssize >= 2 ** 16:
-        raise RuntimeError('length of string, %d' % ssize)
-    b, offset = buf.pull(2 + len(value))
-    pack_into('!H', b, offset, ssize)
-    offset += 2
-    fmt = str(ssize) + 's'
-    pack_into(fmt, b, offset, value)
-
-def bin_encode_field_index(buf, index):
-    b, offset = buf.pull(2)
-    pack_into('!H', b, offset, index)
-
-def bin_encode_array_head(buf, size):
-    b, offset = buf.pull(1)
-    pack_into('c', b, offset, C_ARRAY_32)
-    b, offset = buf.pull(4)
-    pack_into('!I', b, offset, size)
-
-def bin_encode_map_head(buf, size):
-    b, offset = buf.pull(1)
-    pack_into('c', b, offset, C_MAP_32)
-    b, offset = buf.pull(4)
-    pack_into('!I', b, offset, size)
-
-def bin_encode_id_map_head(buf, size):
-    b, offset = buf.pull(1)
-    pack_into('c', b, offset, C_ID_MAP_32)
-    b, offset = buf.pull(4)
-    pack_into('!I', b, offset, size)
-
-def bin_decode_int8(buf):
-    b, offset = buf.push(1)
-    return unpack_from('!b', b, offset)[0]
-
-def bin_decode_uint8(buf):
-    b, offset = buf.push(1)
-    return unpack_from('!B', b, offset)[0]
-
-def bin_decode_int16(buf):
-    b, offset = buf.push(2)
-    return unpack_from('!h', b, offset)[0]
-
-def bin_decode_uint16(buf):
-    b, offset = buf.push(2)
-    return unpack_from('!H', b, offset)[0]
-
-def bin_decode_int32(buf):
-    b, offset = buf.push(4)
-    return unpack_from('!i', b, offset)[0]
-
-def bin_decode_uint32(buf):
-    b, offset = buf.push(4)
-    return unpack_from('!I', b, offset)[0]
-
-def bin_decode_int64(buf):
-    b, offset = buf.push(8)
-    return unpack_from('!q', b, offset)[0]
-
-def bin_decode_uint64(buf):
-    b, offset = buf.push(8)
-    return unpack_from('!Q', b, offset)[0]
-
-def bin_decode_float(buf):
-    b, offset = buf.push(4)
-    return unpack_from('!f', b, offset)[0]
-
-def bin_decode_double(buf):
-    b, offset = buf.push(8)
-    return unpack_from('!d', b, offset)[0]
-
-def bin_decode_bool(buf):
-    b, offset = buf.push(1)
-    value = unpack_from('!B', b, offset)[0]
-    return True if value else False
-
-def bin_decode_string(buf):
-    b, offset = buf.push(2)
-    ssize = unpack_from('!H', b, offset)[0]
-    b, offset = buf.push(ssize)
-    fmt = str(ssize) + 's'
-    return unpack_from(fmt, b, offset)[0]
-
-def bin_decode_field_index(buf):
-    b, offset = buf.push(2)
-    return unpack_from('!H', b, offset)[0]
-
-def bin_decode_array_head(buf):
-    b, offset = buf.push(1)
-    assert C_ARRAY_32 == unpack_from('c', b, offset)[0]
-    b, offset = buf.push(4)
-    return unpack_from('!I', b, offset)[0]
-
-def bin_decode_map_head(buf):
-    b, offset = buf.push(1)
-    assert C_MAP_32 == unpack_from('c', b, offset)[0]
-    b, offset = buf.push(4)
-    return unpack_from('!I', b, offset)[0]
-
-def bin_decode_id_map_head(buf):
-    b, offset = buf.push(1)
-    assert C_ID_MAP_32 == unpack_from('c', b, offset)[0]
-    b, offset = buf.push(4)
-    return unpack_from('!I', b, offset)[0]
+        return self.at_end()
+
+    def left(self):
+        '''剩余可读字节数'''
+        return self.size - self.offset
+
+def bin_encode_int8(WriteBuffer buf, value):
+    buf.write_value(BT_INT8, value)
+
+def bin_encode_uint8(WriteBuffer buf, value):
+    buf.write_value(BT_UINT8, value)
+
+def bin_encode_int16(WriteBuffer buf, value):
+    buf.write_value(BT_INT16, value)
+
+def bin_encode_uint16(WriteBuffer buf, value):
+    buf.write_value(BT_UINT16, value)
+
+def bin_encode_int32(WriteBuffer buf, value):
+    buf.write_value(BT_INT32, value)
+
+def bin_encode_uint32(WriteBuffer buf, value):
+    buf.write_value(BT_UINT32, value)
+
+def bin_encode_int64(WriteBuffer buf, value):
+    buf.write_value(BT_INT64, value)
+
+def bin_encode_uint64(WriteBuffer buf, value):
+    buf.write_value(BT_UINT64, value)
+
+def bin_encode_float(WriteBuffer buf, value):
+    buf.write_value(BT_FLOAT, value)
+
+def bin_encode_double(WriteBuffer buf, value):
+    buf.write_value(BT_DOUBLE, value)
+
+def bin_encode_bool(WriteBuffer buf, value):
+    buf.write_value(BT_BOOL, value)
+
+def bin_encode_string(WriteBuffer buf, value):
+    buf.write_value(BT_STRING, value)
+
+def bin_encode_bytes(WriteBuffer buf, value):
+    buf.write_value(BT_BYTES, value)
+
+def bin_encode_field_index(WriteBuffer buf, index):
+    buf.write_uint16(index)
+
+def bin_encode_array_head(WriteBuffer buf, size):
+    buf.write_container_head(C_ARRAY_32, size)
+
+def bin_encode_map_head(WriteBuffer buf, size):
+    buf.write_container_head(C_MAP_32, size)
+
+def bin_encode_id_map_head(WriteBuffer buf, size):
+    buf.write_container_head(C_ID_MAP_32, size)
+
+def bin_decode_int8(ReadBuffer buf):
+    return buf.read_int8()
+
+def bin_decode_uint8(ReadBuffer buf):
+    return buf.read_uint8()
+
+def bin_decode_int16(ReadBuffer buf):
+    return buf.read_int16()
+
+def bin_decode_uint16(ReadBuffer buf):
+    return buf.read_uint16()
+
+def bin_decode_int32(ReadBuffer buf):
+    return buf.read_int32()
+
+def bin_decode_uint32(ReadBuffer buf):
+    return buf.read_uint32()
+
+def bin_decode_int64(ReadBuffer buf):
+    return buf.read_int64()
+
+def bin_decode_uint64(ReadBuffer buf):
+    return buf.read_uint64()
+
+def bin_decode_float(ReadBuffer buf):
+    return buf.read_float()
+
+def bin_decode_double(ReadBuffer buf):
+    return buf.read_double()
+
+def bin_decode_bool(ReadBuffer buf):
+    return True if buf.read_uint8() else False
+
+def bin_decode_string(ReadBuffer buf):
+    return buf.read_string()
+
+def bin_decode_bytes(ReadBuffer buf):
+    return buf.read_bytes()
+
+def bin_decode_field_index(ReadBuffer buf):
+    return buf.read_uint16()
+
+def bin_decode_array_head(ReadBuffer buf):
+    return buf.read_container_head(C_ARRAY_32)
+
+def bin_decode_map_head(ReadBuffer buf):
+    return buf.read_container_head(C_MAP_32)
 
+def bin_decode_id_map_head(ReadBuffer buf):
+    return buf.read_container_head(C_ID_MAP_32)
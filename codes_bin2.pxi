@@ -0,0 +1,198 @@
+# encoding=utf-8
+
+# 紧凑二进制格式(bin2)的编解码函数。格式说明参见fallback/codes_bin2.py
+
+cdef enum:
+    WT_VARINT = 0
+    WT_FIXED64 = 1
+    WT_BYTES = 2
+    WT_OBJECT = 3
+    WT_ARRAY = 4
+    WT_FIXED32 = 5
+    WT_MAP = 6
+    WT_ID_MAP = 7
+    # map的类型字节带有这个标志时，后面接着删除了的key(增量数据)
+    BIN2_MAP_TOMBSTONES = 0x40
+
+# 跳过不认识的字段时允许的最大嵌套层数。数据可能来自不可信的来源，递归不能没有限制
+cdef int BIN2_MAX_SKIP_DEPTH = 64
+
+cdef inline int bin2_wire_type(int bin_type):
+    '''基本类型的编码类型对应的wire_type。不是基本类型的时候返回WT_OBJECT'''
+    if bin_type == BT_NONE:
+        return WT_OBJECT
+    if bin_type == BT_FLOAT:
+        return WT_FIXED32
+    if bin_type == BT_DOUBLE:
+        return WT_FIXED64
+    if bin_type == BT_STRING or bin_type == BT_BYTES:
+        return WT_BYTES
+    return WT_VARINT
+
+cdef inline uint64_t zigzag_encode(int64_t v):
+    return (<uint64_t>v << 1) ^ <uint64_t>(v >> 63)
+
+cdef inline int64_t zigzag_decode(uint64_t v):
+    return <int64_t>(v >> 1) ^ -<int64_t>(v & 1)
+
+cdef int write_varint(WriteBuffer buf, uint64_t v) except -1:
+    cdef unsigned char tmp[10]
+    cdef Py_ssize_t n = 0
+    while v > 0x7f:
+        tmp[n] = <unsigned char>((v & 0x7f) | 0x80)
+        v >>= 7
+        n += 1
+    tmp[n] = <unsigned char>v
+    n += 1
+    memcpy(buf.reserve(n), tmp, n)
+    return 0
+
+cdef uint64_t read_varint(ReadBuffer buf) except? 0xffffffffffffffff:
+    cdef uint64_t result = 0
+    cdef int shift = 0
+    cdef unsigned char byte
+    while True:
+        byte = buf.push(1)[0]
+        result |= (<uint64_t>(byte & 0x7f)) << shift
+        if not byte & 0x80:
+            return result
+        shift += 7
+        if shift >= 70:
+            raise MemoryError('varint too long')
+
+cdef inline int write_tag(WriteBuffer buf, uint32_t index, int wire_type) except -1:
+    return write_varint(buf, (<uint64_t>index << 3) | wire_type)
+
+cdef int write_fixed32_le(WriteBuffer buf, uint32_t v) except -1:
+    cdef unsigned char* p = buf.reserve(4)
+    p[0] = <unsigned char>v
+    p[1] = <unsigned char>(v >> 8)
+    p[2] = <unsigned char>(v >> 16)
+    p[3] = <unsigned char>(v >> 24)
+    return 0
+
+cdef inline uint32_t load_le32(const unsigned char* p):
+    return ((<uint32_t>p[3] << 24) | (<uint32_t>p[2] << 16) |
+            (<uint32_t>p[1] << 8) | p[0])
+
+cdef int bin2_write_value(WriteBuffer buf, int bin_type, object value) except -1:
+    '''按基本类型的编码类型，用bin2格式编码一个数值'''
+    cdef float f
+    cdef double d
+    cdef uint32_t u32
+    cdef uint64_t u64
+    cdef Py_ssize_t ssize
+    cdef Py_buffer view
+    if bin_type == BT_INT8:
+        return write_varint(buf, zigzag_encode(<int8_t>value))
+    if bin_type == BT_INT16:
+        return write_varint(buf, zigzag_encode(<int16_t>value))
+    if bin_type == BT_INT32:
+        return write_varint(buf, zigzag_encode(<int32_t>value))
+    if bin_type == BT_INT64:
+        return write_varint(buf, zigzag_encode(<int64_t>value))
+    if bin_type == BT_UINT8:
+        return write_varint(buf, <uint8_t>value)
+    if bin_type == BT_UINT16:
+        return write_varint(buf, <uint16_t>value)
+    if bin_type == BT_UINT32:
+        return write_varint(buf, <uint32_t>value)
+    if bin_type == BT_UINT64:
+        return write_varint(buf, <uint64_t>value)
+    if bin_type == BT_BOOL:
+        return write_varint(buf, 1 if value else 0)
+    if bin_type == BT_FLOAT:
+        f = value
+        memcpy(&u32, &f, 4)
+        return write_fixed32_le(buf, u32)
+    if bin_type == BT_DOUBLE:
+        d = value
+        memcpy(&u64, &d, 8)
+        write_fixed32_le(buf, <uint32_t>u64)
+        return write_fixed32_le(buf, <uint32_t>(u64 >> 32))
+    if bin_type == BT_STRING:
+        ssize = len(<bytes?>value)
+        write_varint(buf, ssize)
+        memcpy(buf.reserve(ssize), <const char*><bytes>value, ssize)
+        return 0
+    if bin_type == BT_BYTES:
+        PyObject_GetBuffer(value, &view, PyBUF_SIMPLE)
+        try:
+            write_varint(buf, view.len)
+            memcpy(buf.reserve(view.len), view.buf, view.len)
+        finally:
+            PyBuffer_Release(&view)
+        return 0
+    raise TypeError('unsupported binary type: {}'.format(bin_type))
+
+cdef object bin2_read_value(ReadBuffer buf, int bin_type):
+    '''按基本类型的编码类型，从bin2格式解码一个数值'''
+    cdef float f
+    cdef double d
+    cdef uint32_t u32
+    cdef uint64_t u64
+    cdef const unsigned char* p
+    cdef Py_ssize_t ssize
+    if bin_type == BT_INT8 or bin_type == BT_INT16 or bin_type == BT_INT32:
+        return <int32_t>zigzag_decode(read_varint(buf))
+    if bin_type == BT_INT64:
+        return zigzag_decode(read_varint(buf))
+    if bin_type == BT_UINT8 or bin_type == BT_UINT16 or bin_type == BT_UINT32:
+        return <uint32_t>read_varint(buf)
+    if bin_type == BT_UINT64:
+        return read_varint(buf)
+    if bin_type == BT_BOOL:
+        return True if read_varint(buf) else False
+    if bin_type == BT_FLOAT:
+        u32 = load_le32(buf.push(4))
+        memcpy(&f, &u32, 4)
+        return f
+    if bin_type == BT_DOUBLE:
+        p = buf.push(8)
+        u64 = (<uint64_t>load_le32(p + 4) << 32) | load_le32(p)
+        memcpy(&d, &u64, 8)
+        return d
+    if bin_type == BT_STRING:
+        ssize = read_varint(buf)
+        return PyBytes_FromStringAndSize(<const char*>buf.push(ssize), ssize)
+    if bin_type == BT_BYTES:
+        return buf.read_slice(read_varint(buf))
+    raise TypeError('unsupported binary type: {}'.format(bin_type))
+
+cdef int bin2_skip_value(ReadBuffer buf, int wire_type, int depth=0) except -1:
+    '''跳过一个值，不解码。depth是值所在的嵌套层数'''
+    cdef uint64_t tag, size, i, types
+    if depth >= BIN2_MAX_SKIP_DEPTH:
+        raise UnpackError('bin2 data nested too deep')
+    if wire_type == WT_VARINT:
+        read_varint(buf)
+    elif wire_type == WT_FIXED64:
+        buf.push(8)
+    elif wire_type == WT_FIXED32:
+        buf.push(4)
+    elif wire_type == WT_BYTES:
+        buf.push(read_varint(buf))
+    elif wire_type == WT_OBJECT:
+        while True:
+            tag = read_varint(buf)
+            if tag >> 3 == 0:
+                break
+            bin2_skip_value(buf, tag & 0x07, depth + 1)
+    elif wire_type == WT_ARRAY:
+        size = read_varint(buf)
+        types = read_varint(buf)
+        for i in range(size):
+            bin2_skip_value(buf, <int>types, depth + 1)
+    elif wire_type == WT_MAP or wire_type == WT_ID_MAP:
+        size = read_varint(buf)
+        types = read_varint(buf)
+        if types & BIN2_MAP_TOMBSTONES:
+            types &= ~(<uint64_t>BIN2_MAP_TOMBSTONES)
+            for i in range(read_varint(buf)):
+                bin2_skip_value(buf, <int>(types >> 3), depth + 1)
+        for i in range(size):
+            bin2_skip_value(buf, <int>(types >> 3), depth + 1)
+            bin2_skip_value(buf, <int>(types & 0x07), depth + 1)
+    else:
+        raise UnpackError('unknown wire type: {}'.format(wire_type))
+    return 0
@@ -0,0 +1,227 @@
+# encoding=utf-8
+
+# BSON格式的编解码函数。格式说明参见fallback/codes_bson.py
+
+from libc.string cimport memchr
+
+cdef enum:
+    BSON_DOUBLE = 0x01
+    BSON_STRING = 0x02
+    BSON_DOCUMENT = 0x03
+    BSON_ARRAY = 0x04
+    BSON_BINARY = 0x05
+    BSON_OBJECT_ID = 0x07
+    BSON_BOOL = 0x08
+    BSON_DATETIME = 0x09
+    BSON_NULL = 0x0A
+    BSON_REGEX = 0x0B
+    BSON_JS_CODE = 0x0D
+    BSON_INT32 = 0x10
+    BSON_TIMESTAMP = 0x11
+    BSON_INT64 = 0x12
+    BSON_DECIMAL128 = 0x13
+    BSON_MAX_KEY = 0x7F
+    BSON_MIN_KEY = 0xFF
+
+cdef inline int bson_element_type(int bin_type):
+    '''基本类型的编码类型对应的BSON类型。不是基本类型的时候返回BSON_DOCUMENT'''
+    if bin_type == BT_NONE:
+        return BSON_DOCUMENT
+    if bin_type == BT_FLOAT or bin_type == BT_DOUBLE:
+        return BSON_DOUBLE
+    if bin_type == BT_BOOL:
+        return BSON_BOOL
+    if bin_type == BT_STRING:
+        return BSON_STRING
+    if bin_type == BT_BYTES:
+        return BSON_BINARY
+    if bin_type == BT_UINT32 or bin_type == BT_INT64 or bin_type == BT_UINT64:
+        return BSON_INT64
+    return BSON_INT32
+
+cdef inline bint bson_type_accepted(int bin_type, int bson_type):
+    '''解码时bin_type类型的值是否接受bson_type类型的数据。整数也可以解码成浮点数'''
+    if bin_type == BT_NONE:
+        return bson_type == BSON_DOCUMENT
+    if bin_type == BT_BOOL:
+        return bson_type == BSON_BOOL
+    if bin_type == BT_STRING:
+        return bson_type == BSON_STRING
+    if bin_type == BT_BYTES:
+        return bson_type == BSON_BINARY
+    if bson_type == BSON_INT32 or bson_type == BSON_INT64:
+        return True
+    return bson_type == BSON_DOUBLE and (bin_type == BT_FLOAT or bin_type == BT_DOUBLE)
+
+cdef inline void store_le32(unsigned char* p, uint32_t v):
+    p[0] = <unsigned char>v
+    p[1] = <unsigned char>(v >> 8)
+    p[2] = <unsigned char>(v >> 16)
+    p[3] = <unsigned char>(v >> 24)
+
+cdef inline void store_le64(unsigned char* p, uint64_t v):
+    store_le32(p, <uint32_t>v)
+    store_le32(p + 4, <uint32_t>(v >> 32))
+
+cdef inline uint64_t load_le64(const unsigned char* p):
+    return (<uint64_t>load_le32(p + 4) << 32) | load_le32(p)
+
+cdef inline Py_ssize_t bson_begin_document(WriteBuffer buf) except -1:
+    '''预留文档长度的空间。返回文档的开始偏移，文档写完后调用bson_end_document回填长度'''
+    cdef Py_ssize_t offset = buf.offset
+    buf.reserve(4)
+    return offset
+
+cdef inline int bson_end_document(WriteBuffer buf, Py_ssize_t offset) except -1:
+    buf.reserve(1)[0] = 0
+    store_le32(buf.base() + offset, <uint32_t>(buf.offset - offset))
+    return 0
+
+cdef int bson_write_element_head(WriteBuffer buf, int bson_type, bytes name) except -1:
+    cdef Py_ssize_t nsize = len(name)
+    cdef const char* s = name
+    cdef unsigned char* p
+    if memchr(s, 0, nsize) != NULL:
+        raise ValueError('bson key contains NUL: {!r}'.format(name))
+    p = buf.reserve(nsize + 2)
+    p[0] = <unsigned char>bson_type
+    memcpy(p + 1, s, nsize)
+    p[nsize + 1] = 0
+    return 0
+
+cdef Py_ssize_t bson_read_document_begin(ReadBuffer buf) except -1:
+    '''返回文档的结束偏移'''
+    cdef Py_ssize_t offset = buf.offset
+    cdef int32_t size = <int32_t>load_le32(buf.push(4))
+    if size < 5 or size > buf.size - offset:
+        raise MemoryError('bad bson document size: {}'.format(size))
+    return offset + size
+
+cdef inline int bson_read_document_end(ReadBuffer buf, Py_ssize_t end) except -1:
+    if buf.offset != end:
+        raise MemoryError('bson document size mismatch')
+    return 0
+
+cdef inline int bson_read_type(ReadBuffer buf) except -1:
+    '''读出元素的类型。文档结束时返回0'''
+    return buf.push(1)[0]
+
+cdef Py_ssize_t bson_skip_cstring(ReadBuffer buf) except -1:
+    '''跳过元素名。返回元素名的长度'''
+    cdef const unsigned char* p = buf.p + buf.offset
+    cdef const unsigned char* q = <const unsigned char*>memchr(p, 0, buf.size - buf.offset)
+    if q == NULL:
+        raise MemoryError('no more data')
+    buf.push(q - p + 1)
+    return q - p
+
+cdef inline bytes bson_read_cstring(ReadBuffer buf):
+    cdef const unsigned char* p = buf.p + buf.offset
+    cdef Py_ssize_t n = bson_skip_cstring(buf)
+    return PyBytes_FromStringAndSize(<const char*>p, n)
+
+cdef int bson_write_value(WriteBuffer buf, int bin_type, object value) except -1:
+    '''按基本类型的编码类型，用BSON格式编码一个数值'''
+    cdef double d
+    cdef uint64_t u64
+    cdef Py_ssize_t ssize
+    cdef unsigned char* p
+    cdef Py_buffer view
+    if bin_type == BT_INT8 or bin_type == BT_UINT8 or bin_type == BT_INT16 or \
+            bin_type == BT_UINT16 or bin_type == BT_INT32:
+        store_le32(buf.reserve(4), <uint32_t><int32_t>value)
+        return 0
+    if bin_type == BT_UINT32 or bin_type == BT_INT64:
+        store_le64(buf.reserve(8), <uint64_t><int64_t>value)
+        return 0
+    if bin_type == BT_UINT64:
+        store_le64(buf.reserve(8), <uint64_t>value)
+        return 0
+    if bin_type == BT_FLOAT or bin_type == BT_DOUBLE:
+        d = value
+        memcpy(&u64, &d, 8)
+        store_le64(buf.reserve(8), u64)
+        return 0
+    if bin_type == BT_BOOL:
+        buf.reserve(1)[0] = 1 if value else 0
+        return 0
+    if bin_type == BT_STRING:
+        ssize = len(<bytes?>value)
+        p = buf.reserve(ssize + 5)
+        store_le32(p, <uint32_t>(ssize + 1))
+        memcpy(p + 4, <const char*><bytes>value, ssize)
+        p[ssize + 4] = 0
+        return 0
+    if bin_type == BT_BYTES:
+        PyObject_GetBuffer(value, &view, PyBUF_SIMPLE)
+        try:
+            p = buf.reserve(view.len + 5)
+            store_le32(p, <uint32_t>view.len)
+            p[4] = 0  # subtype: generic binary
+            memcpy(p + 5, view.buf, view.len)
+        finally:
+            PyBuffer_Release(&view)
+        return 0
+    raise TypeError('unsupported binary type: {}'.format(bin_type))
+
+cdef inline int64_t bson_read_integer(ReadBuffer buf, int bson_type) except? -1:
+    if bson_type == BSON_INT32:
+        return <int32_t>load_le32(buf.push(4))
+    return <int64_t>load_le64(buf.push(8))
+
+cdef object bson_read_value(ReadBuffer buf, int bin_type, int bson_type):
+    '''按基本类型的编码类型，解码一个bson_type类型的数值。bson_type需要先用bson_type_accepted检查'''
+    cdef double d
+    cdef uint64_t u64
+    cdef int32_t ssize
+    if bin_type == BT_FLOAT or bin_type == BT_DOUBLE:
+        if bson_type != BSON_DOUBLE:
+            return <double>bson_read_integer(buf, bson_type)
+        u64 = load_le64(buf.push(8))
+        memcpy(&d, &u64, 8)
+        return d
+    if bin_type == BT_BOOL:
+        return True if buf.push(1)[0] else False
+    if bin_type == BT_STRING:
+        ssize = <int32_t>load_le32(buf.push(4))
+        if ssize < 1:
+            raise MemoryError('bad bson string size: {}'.format(ssize))
+        return PyBytes_FromStringAndSize(<const char*>buf.push(ssize), ssize - 1)
+    if bin_type == BT_BYTES:
+        ssize = <int32_t>load_le32(buf.push(5))
+        if ssize < 0:
+            raise MemoryError('bad bson binary size: {}'.format(ssize))
+        return buf.read_slice(ssize)
+    if bin_type == BT_UINT64:
+        return <uint64_t>bson_read_integer(buf, bson_type)
+    if bin_type != BT_NONE:
+        return bson_read_integer(buf, bson_type)
+    raise TypeError('unsupported binary type: {}'.format(bin_type))
+
+cdef int bson_skip_value(ReadBuffer buf, int bson_type) except -1:
+    '''跳过一个值，不解码'''
+    if bson_type == BSON_DOUBLE or bson_type == BSON_DATETIME or \
+            bson_type == BSON_TIMESTAMP or bson_type == BSON_INT64:
+        buf.push(8)
+    elif bson_type == BSON_STRING or bson_type == BSON_JS_CODE:
+        buf.push(<int32_t>load_le32(buf.push(4)))
+    elif bson_type == BSON_DOCUMENT or bson_type == BSON_ARRAY:
+        buf.push(<int32_t>load_le32(buf.push(4)) - 4)
+    elif bson_type == BSON_BINARY:
+        buf.push(<int32_t>load_le32(buf.push(4)) + 1)
+    elif bson_type == BSON_OBJECT_ID:
+        buf.push(12)
+    elif bson_type == BSON_BOOL:
+        buf.push(1)
+    elif bson_type == BSON_REGEX:
+        bson_skip_cstring(buf)
+        bson_skip_cstring(buf)
+    elif bson_type == BSON_INT32:
+        buf.push(4)
+    elif bson_type == BSON_DECIMAL128:
+        buf.push(16)
+    elif bson_type == BSON_NULL or bson_type == BSON_MAX_KEY or bson_type == BSON_MIN_KEY:
+        pass
+    else:
+        raise MemoryError('unknown bson type: {}'.format(bson_type))
+    return 0
@@ -25,3 +25,5 @@ if using_c_data_model:
     from c_data_model import *
 else:
     from .data_model import *
+
+from .record_file import dump_many, RecordFile, RecordFileError
@@ -1,23 +1,102 @@
 # encoding=utf-8
 
 from __future__ import absolute_import
+import sys
+import threading
+from array import array
 from struct import pack_into, unpack_from
 
 INIT_BUFF_SIZE = 1024 * 4
-MORE_BUFF_SPACE = '\0' * 1024
+# 超过这个大小的buffer用完后不放回线程缓冲池，避免长期占用内存
+MAX_POOLED_BUFF_SIZE = 1024 * 1024
+# 每个线程缓冲池里最多保留的buffer个数
+MAX_POOLED_BUFF_COUNT = 4
 
 C_ARRAY_32 = chr(0xd0)
 C_MAP_32 = chr(0xd1)
 C_ID_MAP_32 = chr(0xd2)
+# 增量数据里map/id_map数据前面的删除key列表
+C_TOMBSTONES_32 = chr(0xd3)
+# 增量数据里代替整个数组的操作列表
+C_ARRAY_OPS_32 = chr(0xd4)
+
+# 数组操作。每个操作是1字节操作码 + uint32位置，remove以外的操作后面跟着元素的数据
+ARRAY_OP_APPEND = 1
+ARRAY_OP_SET = 2
+ARRAY_OP_INSERT = 3
+ARRAY_OP_REMOVE = 4
+ARRAY_OP_HEAD_SIZE = 5
+
+# 定长标量类型对应的struct格式字符。用于生成预编译的字段编解码器
+SCALAR_STRUCT_FORMATS = {
+    'int8'   : 'b',
+    'uint8'  : 'B',
+    'int16'  : 'h',
+    'uint16' : 'H',
+    'int32'  : 'i',
+    'uint32' : 'I',
+    'int64'  : 'q',
+    'uint64' : 'Q',
+    'float'  : 'f',
+    'double' : 'd',
+    'bool'   : '?',
+}
+
+# 定长标量类型编码后的字节数
+SCALAR_SIZES = {
+    'int8'   : 1,
+    'uint8'  : 1,
+    'int16'  : 2,
+    'uint16' : 2,
+    'int32'  : 4,
+    'uint32' : 4,
+    'int64'  : 8,
+    'uint64' : 8,
+    'float'  : 4,
+    'double' : 8,
+    'bool'   : 1,
+}
+
+# typed数组的元素类型对应的array类型码。只保留元素字节数和编码字节数一致的类型码，
+# 比如int64只在long是8字节的平台上可以用
+TYPED_ARRAY_CODES = dict(
+    (type_name, code) for type_name, code in (
+        ('int8', 'b'), ('uint8', 'B'), ('int16', 'h'), ('uint16', 'H'),
+        ('int32', 'i'), ('uint32', 'I'), ('int64', 'l'), ('uint64', 'L'),
+        ('float', 'f'), ('double', 'd'))
+    if array(code).itemsize == SCALAR_SIZES[type_name])
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+FIELD_INDEX_SIZE = 2
+CONTAINER_HEAD_SIZE = 5
+# 分帧格式里，每个字段index后面的4字节字段数据长度
+FIELD_FRAME_SIZE = 4
+# 分帧格式的数据以这个保留的字段index开头，解码时用来检查framed参数
+FRAMED_MARK = 0xffff
+# bytes类型的4字节数据长度
+BYTES_HEAD_SIZE = 4
 
 class WriteBuffer(object):
-    def __init__(self):
-        self.b = bytearray(INIT_BUFF_SIZE)
+    '''写缓冲区。
+        默认使用内部的bytearray，空间不够时按倍数增长。
+        如果指定了out(bytearray或者可写的memoryview)，直接写入out，且不会扩展out的大小。
+    '''
+    def __init__(self, size=INIT_BUFF_SIZE, out=None):
+        if out is not None:
+            self.b = out
+            self.growable = False
+        else:
+            self.b = bytearray(size)
+            self.growable = True
         self.offset = 0
 
     def check_size(self, new_size):
-        if len(self.b) < new_size:
-            self.b.expand(MORE_BUFF_SPACE)
+        size = len(self.b)
+        if size < new_size:
+            if not self.growable:
+                raise MemoryError('no more space')
+            self.b.extend(bytearray(max(size, new_size - size)))
 
     def pull(self, n):
         '''扩展更多写空间。返回内部buffer对象和新扩展的空间偏移地址。'''
@@ -27,13 +106,49 @@ class WriteBuffer(object):
         self.offset = new_offset
         return self.b, offset
 
+    def reset(self):
+        self.offset = 0
+
     def tostring(self):
-        return str(self.b[:self.offset])
+        return memoryview(self.b)[:self.offset].tobytes()
+
+_local = threading.local()
+
+def acquire_write_buffer():
+    '''从当前线程的缓冲池里取一个WriteBuffer。用完需调用release_write_buffer归还。'''
+    pool = getattr(_local, 'write_buffers', None)
+    if pool:
+        buf = pool.pop()
+        buf.reset()
+        return buf
+    return WriteBuffer()
+
+def release_write_buffer(buf):
+    if not buf.growable or len(buf.b) > MAX_POOLED_BUFF_SIZE:
+        return
+    pool = getattr(_local, 'write_buffers', None)
+    if pool is None:
+        pool = _local.write_buffers = []
+    if len(pool) < MAX_POOLED_BUFF_COUNT:
+        pool.append(buf)
+
+def calc_value_size(type_name, value):
+    '''计算基本类型数值编码后的字节数'''
+    size = SCALAR_SIZES.get(type_name)
+    if size is not None:
+        return size
+    if type_name == 'bytes':
+        return BYTES_HEAD_SIZE + len(value)
+    return 2 + len(value)
 
 class ReadBuffer(object):
-    def __init__(self, src):
+    '''读缓冲区。
+        copy_bytes  -> bytes字段解码成复制出来的str。默认解码成引用源数据的memoryview
+    '''
+    def __init__(self, src, copy_bytes=False):
         self.b = memoryview(src)
         self.offset = 0
+        self.copy_bytes = copy_bytes
 
     def push(self, n):
         '''增加读缓冲区内的读偏移地址。返回内部buff对象和push前的读偏移地址。'''
@@ -47,6 +162,10 @@ class ReadBuffer(object):
     def is_end(self):
         return self.offset >= len(self.b)
 
+    def left(self):
+        '''剩余可读字节数'''
+        return len(self.b) - self.offset
+
 def encode_int8(buf, value):
     b, offset = buf.pull(1)
     pack_into('!b', b, offset, value)
@@ -102,16 +221,45 @@ def encode_string(buf, value):
     fmt = str(ssize) + 's'
     pack_into(fmt, b, offset, value)
 
+def encode_bytes(buf, value):
+    '''value可以是str, bytearray, memoryview等支持buffer协议的对象'''
+    value = memoryview(value)
+    ssize = len(value)
+    if ssize >= 2 ** 32:
+        raise RuntimeError('length of bytes, %d' % ssize)
+    b, offset = buf.pull(BYTES_HEAD_SIZE + ssize)
+    pack_into('!I', b, offset, ssize)
+    offset += BYTES_HEAD_SIZE
+    b[offset:offset + ssize] = value
+
 def encode_field_index(buf, index):
     b, offset = buf.pull(2)
     pack_into('!H', b, offset, index)
 
+def encode_frame_begin(buf):
+    '''预留字段数据长度的空间。返回预留空间的偏移，字段数据写完后调用encode_frame_end回填长度'''
+    _, offset = buf.pull(FIELD_FRAME_SIZE)
+    return offset
+
+def encode_frame_end(buf, offset):
+    pack_into('!I', buf.b, offset, buf.offset - offset - FIELD_FRAME_SIZE)
+
 def encode_array_head(buf, size):
     b, offset = buf.pull(1)
     pack_into('c', b, offset, C_ARRAY_32)
     b, offset = buf.pull(4)
     pack_into('!I', b, offset, size)
 
+def encode_typed_array(buf, value):
+    '''编码typed数组。格式和普通数组相同，元素数据整块复制，小端机器上再整块做一次字节交换'''
+    encode_array_head(buf, len(value))
+    if _LITTLE_ENDIAN:
+        value = array(value.typecode, value.tostring())
+        value.byteswap()
+    data = value.tostring()
+    b, offset = buf.pull(len(data))
+    b[offset:offset + len(data)] = data
+
 def encode_map_head(buf, size):
     b, offset = buf.pull(1)
     pack_into('c', b, offset, C_MAP_32)
@@ -124,6 +272,22 @@ def encode_id_map_head(buf, size):
     b, offset = buf.pull(4)
     pack_into('!I', b, offset, size)
 
+def encode_tombstones_head(buf, size):
+    b, offset = buf.pull(1)
+    pack_into('c', b, offset, C_TOMBSTONES_32)
+    b, offset = buf.pull(4)
+    pack_into('!I', b, offset, size)
+
+def encode_array_ops_head(buf, size):
+    b, offset = buf.pull(1)
+    pack_into('c', b, offset, C_ARRAY_OPS_32)
+    b, offset = buf.pull(4)
+    pack_into('!I', b, offset, size)
+
+def encode_array_op(buf, op, index):
+    b, offset = buf.pull(ARRAY_OP_HEAD_SIZE)
+    pack_into('!BI', b, offset, op, index)
+
 def decode_int8(buf):
     b, offset = buf.push(1)
     return unpack_from('!b', b, offset)[0]
@@ -176,22 +340,65 @@ def decode_string(buf):
     fmt = str(ssize) + 's'
     return unpack_from(fmt, b, offset)[0]
 
+def decode_bytes(buf):
+    b, offset = buf.push(BYTES_HEAD_SIZE)
+    ssize = unpack_from('!I', b, offset)[0]
+    b, offset = buf.push(ssize)
+    value = b[offset:offset + ssize]
+    return value.tobytes() if buf.copy_bytes else value
+
 def decode_field_index(buf):
     b, offset = buf.push(2)
     return unpack_from('!H', b, offset)[0]
 
+def decode_frame_size(buf):
+    b, offset = buf.push(FIELD_FRAME_SIZE)
+    return unpack_from('!I', b, offset)[0]
+
 def decode_array_head(buf):
     b, offset = buf.push(1)
     assert C_ARRAY_32 == unpack_from('c', b, offset)[0]
     b, offset = buf.push(4)
     return unpack_from('!I', b, offset)[0]
 
+def decode_typed_array(buf, arr):
+    '''解码typed数组的数据，追加到arr，不修改arr的changed标志'''
+    n = decode_array_head(buf) * arr.itemsize
+    b, offset = buf.push(n)
+    data = array(arr.typecode, b[offset:offset + n].tobytes())
+    if _LITTLE_ENDIAN:
+        data.byteswap()
+    array.extend(arr, data)
+
 def decode_map_head(buf):
     b, offset = buf.push(1)
     assert C_MAP_32 == unpack_from('c', b, offset)[0]
     b, offset = buf.push(4)
     return unpack_from('!I', b, offset)[0]
 
+def decode_tombstones_head(buf):
+    '''返回删除key的个数。没有删除key列表时返回0，不移动读偏移'''
+    b, offset = buf.b, buf.offset
+    if offset >= len(b) or b[offset] != C_TOMBSTONES_32:
+        return 0
+    buf.push(1)
+    b, offset = buf.push(4)
+    return unpack_from('!I', b, offset)[0]
+
+def decode_array_ops_head(buf):
+    '''返回数组操作的个数。不是操作列表(是完整的数组)时返回None，不移动读偏移'''
+    b, offset = buf.b, buf.offset
+    if offset >= len(b) or b[offset] != C_ARRAY_OPS_32:
+        return None
+    buf.push(1)
+    b, offset = buf.push(4)
+    return unpack_from('!I', b, offset)[0]
+
+def decode_array_op(buf):
+    '''返回(操作码, 位置)'''
+    b, offset = buf.push(ARRAY_OP_HEAD_SIZE)
+    return unpack_from('!BI', b, offset)
+
 def decode_id_map_head(buf):
     b, offset = buf.push(1)
     assert C_ID_MAP_32 == unpack_from('c', b, offset)[0]
@@ -0,0 +1,191 @@
+# encoding=utf-8
+
+'''
+紧凑二进制格式(bin2)的编解码函数。
+
+    字段    -> varint(index << 3 | wire_type) + 字段值。tag为0表示对象结束
+    整数    -> varint。有符号整数先做zigzag编码，绝对值小的负数也只占很少字节
+    bool    -> varint 0/1
+    float   -> 4字节小端
+    double  -> 8字节小端
+    string  -> varint长度 + 内容
+    bytes   -> 同string
+    对象    -> 字段序列 + 结束tag
+    数组    -> varint个数 + 元素wire_type(1字节) + 元素序列
+    map     -> varint个数 + (key wire_type << 3 | value wire_type)(1字节) + (key, value)序列。
+               增量数据里有删除了的key时，类型字节加上MAP_TOMBSTONES，
+               后面接着varint个数 + 删除了的key序列，然后才是(key, value)序列
+
+每个值都带有wire_type，所以解码时可以跳过不认识的字段。
+'''
+
+from __future__ import absolute_import
+from struct import pack_into, unpack_from
+
+WT_VARINT = 0
+WT_FIXED64 = 1
+WT_BYTES = 2
+WT_OBJECT = 3
+WT_ARRAY = 4
+WT_FIXED32 = 5
+WT_MAP = 6
+WT_ID_MAP = 7
+
+# map的类型字节带有这个标志时，后面接着删除了的key(增量数据)
+MAP_TOMBSTONES = 0x40
+
+# 跳过不认识的字段时允许的最大嵌套层数。数据可能来自不可信的来源，递归不能没有限制
+MAX_SKIP_DEPTH = 64
+
+WIRE_TYPES = {
+    'int8'   : WT_VARINT,
+    'uint8'  : WT_VARINT,
+    'int16'  : WT_VARINT,
+    'uint16' : WT_VARINT,
+    'int32'  : WT_VARINT,
+    'uint32' : WT_VARINT,
+    'int64'  : WT_VARINT,
+    'uint64' : WT_VARINT,
+    'float'  : WT_FIXED32,
+    'double' : WT_FIXED64,
+    'bool'   : WT_VARINT,
+    'string' : WT_BYTES,
+    'bytes'  : WT_BYTES,
+}
+
+def encode_varint(buf, value):
+    if value < 0:
+        raise ValueError('varint must be unsigned: {}'.format(value))
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    b, offset = buf.pull(len(data))
+    b[offset:offset + len(data)] = data
+
+def decode_varint(buf):
+    result = 0
+    shift = 0
+    while True:
+        b, offset = buf.push(1)
+        byte = ord(b[offset])
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result
+        shift += 7
+        if shift >= 70:
+            raise MemoryError('varint too long')
+
+def zigzag_encode(value):
+    return (value << 1) ^ (value >> 63)
+
+def zigzag_decode(value):
+    return (value >> 1) ^ -(value & 1)
+
+def encode_tag(buf, index, wire_type):
+    encode_varint(buf, (index << 3) | wire_type)
+
+def decode_tag(buf):
+    '''返回(index, wire_type)'''
+    tag = decode_varint(buf)
+    return tag >> 3, tag & 0x07
+
+def encode_end(buf):
+    encode_varint(buf, 0)
+
+def encode_array_head(buf, size, wire_type):
+    encode_varint(buf, size)
+    encode_varint(buf, wire_type)
+
+def decode_array_head(buf):
+    '''返回(size, wire_type)'''
+    size = decode_varint(buf)
+    return size, decode_varint(buf)
+
+def encode_map_head(buf, size, key_wire_type, value_wire_type, tombstones=False):
+    '''tombstones为True时，调用者接着写入删除了的key的个数和key'''
+    encode_varint(buf, size)
+    types = (key_wire_type << 3) | value_wire_type
+    encode_varint(buf, types | MAP_TOMBSTONES if tombstones else types)
+
+def decode_map_head(buf):
+    '''返回(size, key_wire_type, value_wire_type, tombstones)'''
+    size = decode_varint(buf)
+    types = decode_varint(buf)
+    tombstones = bool(types & MAP_TOMBSTONES)
+    types &= ~MAP_TOMBSTONES
+    return size, types >> 3, types & 0x07, tombstones
+
+def _encode_unsigned(buf, value):
+    encode_varint(buf, value)
+
+def _encode_signed(buf, value):
+    encode_varint(buf, zigzag_encode(value))
+
+def _decode_signed(buf):
+    return zigzag_decode(decode_varint(buf))
+
+encode_int8 = _encode_signed
+encode_int16 = _encode_signed
+encode_int32 = _encode_signed
+encode_int64 = _encode_signed
+encode_uint8 = _encode_unsigned
+encode_uint16 = _encode_unsigned
+encode_uint32 = _encode_unsigned
+encode_uint64 = _encode_unsigned
+
+decode_int8 = _decode_signed
+decode_int16 = _decode_signed
+decode_int32 = _decode_signed
+decode_int64 = _decode_signed
+decode_uint8 = decode_varint
+decode_uint16 = decode_varint
+decode_uint32 = decode_varint
+decode_uint64 = decode_varint
+
+def encode_bool(buf, value):
+    encode_varint(buf, 1 if value else 0)
+
+def decode_bool(buf):
+    return True if decode_varint(buf) else False
+
+def encode_float(buf, value):
+    b, offset = buf.pull(4)
+    pack_into('<f', b, offset, value)
+
+def decode_float(buf):
+    b, offset = buf.push(4)
+    return unpack_from('<f', b, offset)[0]
+
+def encode_double(buf, value):
+    b, offset = buf.pull(8)
+    pack_into('<d', b, offset, value)
+
+def decode_double(buf):
+    b, offset = buf.push(8)
+    return unpack_from('<d', b, offset)[0]
+
+def encode_string(buf, value):
+    ssize = len(value)
+    encode_varint(buf, ssize)
+    b, offset = buf.pull(ssize)
+    b[offset:offset + ssize] = value
+
+def decode_string(buf):
+    ssize = decode_varint(buf)
+    b, offset = buf.push(ssize)
+    return b[offset:offset + ssize].tobytes()
+
+def encode_bytes(buf, value):
+    value = memoryview(value)
+    ssize = len(value)
+    encode_varint(buf, ssize)
+    b, offset = buf.pull(ssize)
+    b[offset:offset + ssize] = value
+
+def decode_bytes(buf):
+    ssize = decode_varint(buf)
+    b, offset = buf.push(ssize)
+    value = b[offset:offset + ssize]
+    return value.tobytes() if buf.copy_bytes else value
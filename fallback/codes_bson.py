@@ -0,0 +1,243 @@
+# encoding=utf-8
+
+'''
+BSON格式的编解码函数。对象直接编码成BSON文档，可以直接写入MongoDB，不需要先转成dict。
+
+    对象    -> 文档。字段名作为key
+    数组    -> BSON数组，key是'0', '1', ...
+    map     -> 文档。key按pack_to_dict的规则转成字符串
+    int8, uint8, int16, uint16, int32 -> int32
+    uint32, int64                     -> int64
+    uint64  -> int64。大于int64上限的数值按补码存储，解码时还原
+    float, double -> double
+    bool    -> bool
+    string  -> string
+    bytes   -> binary(subtype 0)
+
+BSON的整数都是小端。解码时整数字段也接受int32/int64，浮点字段也接受整数。
+'''
+
+from __future__ import absolute_import
+from struct import pack_into, unpack_from
+
+BSON_DOUBLE = 0x01
+BSON_STRING = 0x02
+BSON_DOCUMENT = 0x03
+BSON_ARRAY = 0x04
+BSON_BINARY = 0x05
+BSON_OBJECT_ID = 0x07
+BSON_BOOL = 0x08
+BSON_DATETIME = 0x09
+BSON_NULL = 0x0A
+BSON_REGEX = 0x0B
+BSON_JS_CODE = 0x0D
+BSON_INT32 = 0x10
+BSON_TIMESTAMP = 0x11
+BSON_INT64 = 0x12
+BSON_DECIMAL128 = 0x13
+BSON_MAX_KEY = 0x7F
+BSON_MIN_KEY = 0xFF
+
+_INTEGER_TYPES = (BSON_INT32, BSON_INT64)
+_NUMBER_TYPES = (BSON_DOUBLE, BSON_INT32, BSON_INT64)
+
+# pylint: disable=bad-whitespace
+ELEMENT_TYPES = {
+    'int8'   : BSON_INT32,
+    'uint8'  : BSON_INT32,
+    'int16'  : BSON_INT32,
+    'uint16' : BSON_INT32,
+    'int32'  : BSON_INT32,
+    'uint32' : BSON_INT64,
+    'int64'  : BSON_INT64,
+    'uint64' : BSON_INT64,
+    'float'  : BSON_DOUBLE,
+    'double' : BSON_DOUBLE,
+    'bool'   : BSON_BOOL,
+    'string' : BSON_STRING,
+    'bytes'  : BSON_BINARY,
+}
+
+# 解码时可以接受的BSON类型
+ACCEPTED_TYPES = {
+    'int8'   : _INTEGER_TYPES,
+    'uint8'  : _INTEGER_TYPES,
+    'int16'  : _INTEGER_TYPES,
+    'uint16' : _INTEGER_TYPES,
+    'int32'  : _INTEGER_TYPES,
+    'uint32' : _INTEGER_TYPES,
+    'int64'  : _INTEGER_TYPES,
+    'uint64' : _INTEGER_TYPES,
+    'float'  : _NUMBER_TYPES,
+    'double' : _NUMBER_TYPES,
+    'bool'   : (BSON_BOOL,),
+    'string' : (BSON_STRING,),
+    'bytes'  : (BSON_BINARY,),
+}
+# pylint: enable=bad-whitespace
+
+def encode_document_begin(buf):
+    '''预留文档长度的空间。返回文档的开始偏移，文档写完后调用encode_document_end回填长度'''
+    _, offset = buf.pull(4)
+    return offset
+
+def encode_document_end(buf, offset):
+    b, end = buf.pull(1)
+    pack_into('B', b, end, 0)
+    pack_into('<i', buf.b, offset, buf.offset - offset)
+
+def encode_element_head(buf, bson_type, name):
+    if '\0' in name:
+        raise ValueError('bson key contains NUL: {!r}'.format(name))
+    nsize = len(name)
+    b, offset = buf.pull(nsize + 2)
+    pack_into('B%dsx' % nsize, b, offset, bson_type, name)
+
+def decode_document_begin(buf):
+    '''返回文档的结束偏移'''
+    b, offset = buf.push(4)
+    size = unpack_from('<i', b, offset)[0]
+    if size < 5 or offset + size > len(b):
+        raise MemoryError('bad bson document size: {}'.format(size))
+    return offset + size
+
+def decode_document_end(buf, end):
+    if buf.offset != end:
+        raise MemoryError('bson document size mismatch')
+
+def decode_element_head(buf):
+    '''返回(bson_type, name)。文档结束时返回(0, None)'''
+    b, offset = buf.push(1)
+    bson_type = ord(b[offset])
+    if bson_type == 0:
+        return 0, None
+    return bson_type, _decode_cstring(buf)
+
+def _decode_cstring(buf):
+    b = buf.b
+    start = buf.offset
+    end = start
+    size = len(b)
+    while end < size and b[end] != '\0':
+        end += 1
+    buf.push(end - start + 1)  # 没有结束符时抛出MemoryError
+    return b[start:end].tobytes()
+
+def _encode_int32(buf, value):
+    b, offset = buf.pull(4)
+    pack_into('<i', b, offset, value)
+
+def _encode_int64(buf, value):
+    b, offset = buf.pull(8)
+    pack_into('<q', b, offset, value)
+
+def _decode_integer(buf, bson_type):
+    if bson_type == BSON_INT32:
+        b, offset = buf.push(4)
+        return unpack_from('<i', b, offset)[0]
+    b, offset = buf.push(8)
+    return unpack_from('<q', b, offset)[0]
+
+encode_int8 = _encode_int32
+encode_uint8 = _encode_int32
+encode_int16 = _encode_int32
+encode_uint16 = _encode_int32
+encode_int32 = _encode_int32
+encode_uint32 = _encode_int64
+encode_int64 = _encode_int64
+
+def encode_uint64(buf, value):
+    b, offset = buf.pull(8)
+    pack_into('<Q', b, offset, value)
+
+decode_int8 = _decode_integer
+decode_uint8 = _decode_integer
+decode_int16 = _decode_integer
+decode_uint16 = _decode_integer
+decode_int32 = _decode_integer
+decode_uint32 = _decode_integer
+decode_int64 = _decode_integer
+
+def decode_uint64(buf, bson_type):
+    return _decode_integer(buf, bson_type) & 0xffffffffffffffff
+
+def encode_double(buf, value):
+    b, offset = buf.pull(8)
+    pack_into('<d', b, offset, value)
+
+encode_float = encode_double
+
+def decode_double(buf, bson_type):
+    if bson_type != BSON_DOUBLE:
+        return float(_decode_integer(buf, bson_type))
+    b, offset = buf.push(8)
+    return unpack_from('<d', b, offset)[0]
+
+decode_float = decode_double
+
+def encode_bool(buf, value):
+    b, offset = buf.pull(1)
+    pack_into('B', b, offset, 1 if value else 0)
+
+def decode_bool(buf, bson_type):
+    b, offset = buf.push(1)
+    return True if ord(b[offset]) else False
+
+def encode_string(buf, value):
+    ssize = len(value)
+    b, offset = buf.pull(ssize + 5)
+    pack_into('<i%dsx' % ssize, b, offset, ssize + 1, value)
+
+def decode_string(buf, bson_type):
+    b, offset = buf.push(4)
+    ssize = unpack_from('<i', b, offset)[0]
+    if ssize < 1:
+        raise MemoryError('bad bson string size: {}'.format(ssize))
+    b, offset = buf.push(ssize)
+    return b[offset:offset + ssize - 1].tobytes()
+
+def encode_bytes(buf, value):
+    value = memoryview(value)
+    ssize = len(value)
+    b, offset = buf.pull(ssize + 5)
+    pack_into('<iB', b, offset, ssize, 0)
+    offset += 5
+    b[offset:offset + ssize] = value
+
+def decode_bytes(buf, bson_type):
+    b, offset = buf.push(5)
+    ssize = unpack_from('<i', b, offset)[0]
+    if ssize < 0:
+        raise MemoryError('bad bson binary size: {}'.format(ssize))
+    b, offset = buf.push(ssize)
+    value = b[offset:offset + ssize]
+    return value.tobytes() if buf.copy_bytes else value
+
+def skip_value(buf, bson_type):
+    '''跳过一个值，不解码'''
+    if bson_type in (BSON_DOUBLE, BSON_DATETIME, BSON_TIMESTAMP, BSON_INT64):
+        buf.push(8)
+    elif bson_type in (BSON_STRING, BSON_JS_CODE):
+        b, offset = buf.push(4)
+        buf.push(unpack_from('<i', b, offset)[0])
+    elif bson_type in (BSON_DOCUMENT, BSON_ARRAY):
+        b, offset = buf.push(4)
+        buf.push(unpack_from('<i', b, offset)[0] - 4)
+    elif bson_type == BSON_BINARY:
+        b, offset = buf.push(4)
+        buf.push(unpack_from('<i', b, offset)[0] + 1)
+    elif bson_type == BSON_OBJECT_ID:
+        buf.push(12)
+    elif bson_type == BSON_BOOL:
+        buf.push(1)
+    elif bson_type == BSON_REGEX:
+        _decode_cstring(buf)
+        _decode_cstring(buf)
+    elif bson_type == BSON_INT32:
+        buf.push(4)
+    elif bson_type == BSON_DECIMAL128:
+        buf.push(16)
+    elif bson_type in (BSON_NULL, BSON_MAX_KEY, BSON_MIN_KEY):
+        pass
+    else:
+        raise MemoryError('unknown bson type: {}'.format(bson_type))
@@ -34,6 +34,11 @@ def encode_bool(value):
 def encode_string(value):
     return value
 
+def encode_bytes(value):
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return bytes(value)
+
 def decode_int8(value):
     return int(value)
 
@@ -69,3 +74,6 @@ def decode_bool(value):
 
 def decode_string(value):
     return value
+
+def decode_bytes(value):
+    return bytes(value)
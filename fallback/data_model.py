@@ -57,6 +57,25 @@ DataModel某种程度上支持仅对对象数据有改变部分做序列化。
     result = rect.pack('dict', only_changed=True)
     >> result => {'lt': {'x': 100}, 'rb': {'y': 100}}
 
+clear_changed()，或者打包时指定clear_changed=True以后，没有改变的子对象和容器会设置clean标志，
+并记住自己所属的对象。字段改变的时候沿着所属对象向上清除clean标志，所以has_changed(recursive=True)
+和增量打包可以直接跳过clean的子树，开销只和有改变的部分有关。
+同一个子对象(不是ref)同时放在多个地方的时候，只会通知最后一次清除changed标志时所属的对象。
+
+changed标志只能给一个消费者用。字段和容器的每次修改还会记下递增的版本号，多个消费者(比如存盘和
+同步给客户端)可以各自记住看到的版本号，用pack_since取得之后的增量，不需要清除changed标志：
+
+    seen = current_version()
+    ...
+    delta, seen = rect.pack_since(seen)
+
+也可以用MutationRecorder按发生顺序记录修改，打包以后在另一端用replay_mutations重放。
+记录的开销只和修改的次数有关，不需要遍历对象：
+
+    recorder = MutationRecorder(rect)
+    rect.lt.x = 30
+    replay_mutations(rect2, recorder.pack())
+
 支持数据类型
 =============
 
@@ -76,6 +95,8 @@ DataModel用Field来定义字段的数据类型。支持的基本数据类型有
     double                    : double
     bool                      : bool
     string                    : 变长字符串
+    bytes                     : 变长二进制数据，长度上限4G。二进制格式解码成引用源数据的memoryview，
+                                memoryview不能hash，所以bytes不能作为map的key和oid的类型
     DataModel的子类           : -----
 
 除了基本类型。DataModel还支持定义Array和Map，IdMap三种集合。Array和Map即数组和字典：
@@ -108,6 +129,8 @@ Field附加属性
     min_value    【可选】如果字段是数字类型，表示最小值取值范围。sub_xxx函数会在发
                   现将减少到比min_value更小的数值前抛出异常。
     skip_changed 【可选】表示这个被排除在增量变化检测之外。总是会被判定为无改变。
+    typed        【可选】只用于元素是定长数值(bool除外)的ArrayField。数组用array.array
+                  存储(TypedArray)，二进制格式整块编解码。可以用numpy.frombuffer直接访问。
 
 除了标准附加属性外，使用者可以给Field附加任意属性，来修饰字段类型的定义。这些附加属
 性由使用者自己来使用和解释。
@@ -117,18 +140,54 @@ Field附加属性
 
 __reimport_disabled__ = True
 
+import weakref
 from functools import partial
+from itertools import izip
+from collections import OrderedDict, deque
+from struct import Struct
+from array import array
 from . import codes_dict
 from . import codes_bin
 from .codes_bin import decode_array_head, decode_field_index, decode_id_map_head
 from .codes_bin import decode_map_head, encode_array_head, encode_field_index
 from .codes_bin import encode_map_head, encode_id_map_head, WriteBuffer, ReadBuffer
+from .codes_bin import encode_typed_array, decode_typed_array
+from .codes_bin import encode_tombstones_head, decode_tombstones_head
+from .codes_bin import encode_array_ops_head, decode_array_ops_head, encode_array_op, decode_array_op
+from .codes_bin import ARRAY_OP_APPEND, ARRAY_OP_SET, ARRAY_OP_INSERT, ARRAY_OP_REMOVE
+from .codes_bin import ARRAY_OP_HEAD_SIZE
+from .codes_bin import SCALAR_STRUCT_FORMATS, SCALAR_SIZES, FIELD_INDEX_SIZE, CONTAINER_HEAD_SIZE
+from .codes_bin import acquire_write_buffer, release_write_buffer, calc_value_size
+from .codes_bin import FIELD_FRAME_SIZE, encode_frame_begin, encode_frame_end, decode_frame_size
+from .codes_bin import FRAMED_MARK
+from . import codes_bin2
+from .codes_bin2 import WT_VARINT, WT_FIXED64, WT_FIXED32, WT_BYTES
+from .codes_bin2 import WT_OBJECT, WT_ARRAY, WT_MAP, WT_ID_MAP, MAX_SKIP_DEPTH
+from . import codes_bson
+from .codes_bson import BSON_DOCUMENT, BSON_ARRAY, BSON_NULL
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # pylint: disable=protected-access,invalid-name,eval-used,too-many-branches,redefined-builtin
 # pylint: disable=too-many-instance-attributes,too-many-statements,too-many-locals
 
 CONFIG_CHECK_INIT_ARGS = False
 
+# 数组记录的操作个数上限。超过以后增量数据里输出整个数组
+MAX_ARRAY_OPS = 64
+
+# dict格式里数组操作的名字
+_array_op_names = {
+    ARRAY_OP_APPEND: 'append',
+    ARRAY_OP_SET: 'set',
+    ARRAY_OP_INSERT: 'insert',
+    ARRAY_OP_REMOVE: 'remove',
+}
+_array_op_codes = dict((name, op) for op, name in _array_op_names.iteritems())
+
 # pylint: disable=bad-whitespace
 _default_values = {
     'int8'   : 0,
@@ -143,6 +202,7 @@ _default_values = {
     'double' : 0.0,
     'bool'   : False,
     'string' : '',
+    'bytes'  : '',
 }
 
 _value2string = {
@@ -283,6 +343,28 @@ class SkipFromPack(DataModelError):
 
 SKIP_FROM_PACK = SkipFromPack()
 
+_version = 0
+_track_versions = False  # 有消费者用版本号以后才给字段和map的key记版本号
+_track_since = 0  # 开始记录时的版本号，更早的修改没有记下来
+
+def _next_version():
+    global _version
+    _version += 1
+    return _version
+
+def current_version():
+    '''当前的修改版本号。字段和容器的每次修改都分配一个新的、递增的版本号，参见pack_since。
+        第一次调用时开始给字段和map的key记录版本号
+    '''
+    _start_track_versions()
+    return _version
+
+def _start_track_versions():
+    global _track_versions, _track_since
+    if not _track_versions:
+        _track_versions = True
+        _track_since = _version
+
 def _mark_changed(field_index, self):
     _mark_changed_self_dict(field_index, self.__dict__)
 
@@ -302,11 +384,177 @@ def _try_check_changed(v):
 def _mark_changed_self_dict(field_index, self_dict):
     changed_set = self_dict.setdefault('__changed_set__', set())
     changed_set.add(field_index)
+    if _track_versions:
+        self_dict.setdefault('__versions__', {})[field_index] = _next_version()
+    if '__clean__' in self_dict:
+        _drop_clean(self_dict)
+
+def _drop_clean(obj_dict):
+    '''对象有了改变，沿着所属对象向上清除clean标志。
+        对象没有clean标志的时候，它的祖先也都没有，可以在这里停止。
+        容器不一定设置clean标志(比如ref容器)，总是继续向上。map同时记下改变了的元素的key，
+        数组记下对元素的set操作。
+    '''
+    while obj_dict.pop('__clean__', False):
+        owner = obj_dict.get('__owner__')
+        if owner is None:
+            return
+        if not isinstance(owner, DataModel):
+            if isinstance(owner, Map):
+                owner._dirty.add(obj_dict.get('__owner_key__'))
+            elif owner._ops is not None:
+                owner._log_element(obj_dict.get('__owner_key__'), obj_dict)
+            owner._clean = False
+            owner = owner._owner
+            if owner is None:
+                return
+        obj_dict = owner.__dict__
+
+def _propagate_dirty(container):
+    '''容器有了改变，清除容器和祖先的clean标志'''
+    container._clean = False
+    owner = container._owner
+    if owner is not None:
+        _drop_clean(owner.__dict__)
+
+def _is_held_by(owner, key, value):
+    '''value是否还在owner里。owner是对象时检查所有字段，是容器时检查key处的元素'''
+    if isinstance(owner, DataModel):
+        return any(v is value for v in owner.__dict__.itervalues())
+    if isinstance(owner, Map):
+        return dict.get(owner, key) is value
+    if isinstance(owner, Array):
+        return key is not None and 0 <= key < len(owner) and list.__getitem__(owner, key) is value
+    return False
+
+def _claim_owner(value_dict, owner, key, value):
+    '''把子对象value的所属对象设成owner，key是在所属容器里的key。
+        value还在原来的所属对象里(同一个对象放在了两个地方)的时候返回False，不修改：
+        改变只通知原来的所属对象，所以owner不能设置clean标志，打包时总是要检查value
+    '''
+    old = value_dict.get('__owner__')
+    if old is not None:
+        old_key = value_dict.get('__owner_key__')
+        if (old is not owner or old_key != key) and _is_held_by(old, old_key, value):
+            return False
+    value_dict['__owner__'] = owner
+    if key is None:
+        value_dict.pop('__owner_key__', None)
+    else:
+        value_dict['__owner_key__'] = key
+    return True
+
+def _claim_container(container, owner):
+    '''把容器的所属对象设成owner。同_claim_owner，容器还在原来的所属对象里的时候返回False'''
+    old = container._owner
+    if old is not None and old is not owner and _is_held_by(old, None, container):
+        return False
+    container._owner = owner
+    return True
+
+def _mark_clean(self, self_dict):
+    '''对象自己的changed标志清除以后调用。子对象和容器都clean的时候，设置对象的clean标志。
+        子对象和容器的__owner__指向对象，它们有改变的时候向上清除clean标志。
+        还没有解码的lazy字段算是clean的，解码的时候清除clean标志。
+        放在了多个地方的子对象和容器只指向一个所属对象，其他所属对象不设置clean标志。
+    '''
+    lazy = self_dict.get('__lazy__')
+    if lazy is not None and lazy.mark_change:
+        return
+    for field in self._fields:
+        if field.skip_changed:
+            continue
+        value = self_dict.get(field.key)
+        if value is None:
+            continue
+        if field.container_class is not None:
+            if not _claim_container(value, self):
+                return
+            if not field.ref and not value._clean:
+                return
+        elif field.is_data_model_type and not field.ref:
+            value_dict = value.__dict__
+            if '__clean__' not in value_dict or not _claim_owner(value_dict, self, None, value):
+                return
+    self_dict['__clean__'] = True
+
+def _is_ref_container(container):
+    field = getattr(container, 'value_field', None)
+    return field is not None and field.ref
+
+def _map_entries(m, only_changed):
+    '''打包时需要处理的元素。增量打包并且map记下了改变的key的时候只返回这些元素，否则返回map自己'''
+    if only_changed and m._tracked:
+        return dict((k, m[k]) for k in m._dirty if k in m)
+    return m
+
+def _array_ops(obj_dict, field, arr, only_changed):
+    '''增量打包时代替整个数组的操作列表。没有记录操作，操作不比元素少，
+        或者字段自己设置了changed标志(比如调用了set_changed)的时候返回None，输出整个数组
+    '''
+    if not only_changed or field.typed:
+        return None
+    ops = arr._ops
+    if ops is None or len(ops) >= len(arr):
+        return None
+    changed_set = obj_dict.get('__changed_set__')
+    if changed_set and (field.index in changed_set or '*' in changed_set):
+        return None
+    return ops
+
+def _apply_array_op(items, op, index, value):
+    '''把一个数组操作应用到list。位置和list不符的时候抛出UnpackError'''
+    size = len(items)
+    if op == ARRAY_OP_APPEND and index == size:
+        list.append(items, value)
+    elif op == ARRAY_OP_SET and 0 <= index < size:
+        list.__setitem__(items, index, value)
+    elif op == ARRAY_OP_INSERT and 0 <= index <= size:
+        list.insert(items, index, value)
+    elif op == ARRAY_OP_REMOVE and 0 <= index < size:
+        list.__delitem__(items, index)
+    else:
+        raise UnpackError('bad array op: op={}, index={}, size={}'.format(op, index, size))
+
+def _mark_container_dirty(container):
+    '''整个容器都需要打包的时候调用，比如容器赋值给了字段。map记下全部key，数组丢掉操作记录。
+        map的元素按增量打包，需要全部设置changed；数组的元素总是完整打包，不需要
+    '''
+    if isinstance(container, Map):
+        container.broadcast_changed()
+        container._dirty.update(container.iterkeys())
+        container._tracked = True
+    elif isinstance(container, Array):
+        container._ops = None
+
+def _is_elements_clean(container, items):
+    '''items是容器的(key, 元素)。返回元素是否都clean。对象元素的__owner__指向容器，
+        __owner_key__是元素的key。ref容器的元素属于别的对象，不算clean。
+        元素同时放在了别的地方(包括同一个容器的另一个位置)的时候也不算clean
+    '''
+    if _is_ref_container(container):
+        return False
+    field = getattr(container, 'value_field', None)
+    if field is not None and not field.is_data_model_type:
+        return True
+    for k, v in items:
+        if isinstance(v, DataModel):
+            v_dict = v.__dict__
+            if '__clean__' not in v_dict or not _claim_owner(v_dict, container, k, v):
+                return False
+        elif isinstance(v, (Array, Map)):
+            return False
+    return True
 
 def _set_changed(self, *field_names):
+    if '__clean__' in self.__dict__:
+        _drop_clean(self.__dict__)
+    versions = self.__dict__.setdefault('__versions__', {}) if _track_versions else None
     if len(field_names) == 0:
         changed_set = self.__dict__.setdefault('__changed_set__', set())
         changed_set.add('*')
+        if versions is not None:
+            versions['*'] = _next_version()
         return
     changed_set = self.__dict__.setdefault('__changed_set__', set())
     _fields_by_name = self._fields_by_name
@@ -316,10 +564,16 @@ def _set_changed(self, *field_names):
             raise NoFieldError('no such field: %s' % name)
         index = field.index
         changed_set.add(index)
+        if versions is not None:
+            versions[index] = _next_version()
 
 def _clear_field_changed(self, field, self_dict, recursive):
     if _can_clear_change(self, field) is False:
         return
+    if recursive and _is_lazy_pending(self_dict, field.key):
+        if self_dict['__lazy__'].mark_change:
+            # 延迟解码时还会设置changed标志，先解码出来再清除
+            _load_lazy_field(self_dict, field.key)
     changed_set = self_dict.get('__changed_set__', None)
     _fields_is_container = self._fields_is_container
 
@@ -348,6 +602,9 @@ def _clear_field_changed(self, field, self_dict, recursive):
 
 def _clear_changed(self, field_names, recursive=True):
     self_dict = self.__dict__
+    lazy = self_dict.get('__lazy__')
+    if lazy is not None and recursive and not field_names:
+        lazy.mark_change = False
     if field_names:
         _fields_by_name = self._fields_by_name
         for name in field_names:
@@ -357,12 +614,15 @@ def _clear_changed(self, field_names, recursive=True):
     else:
         for field in self._fields:
             _clear_field_changed(self, field, self_dict, recursive)
+        _mark_clean(self, self_dict)
 
 def _has_field_changed(self, field, recursive):
     if field.skip_changed:
         return False
 
     self_dict = self.__dict__
+    if '__clean__' in self_dict:
+        return False
     _fields_is_container = self._fields_is_container
     changed_set = self_dict.get('__changed_set__')
 
@@ -402,6 +662,8 @@ def _can_clear_change(self, field):
     return True
 
 def _has_changed(self, recursive=False):
+    if '__clean__' in self.__dict__:
+        return False
     for field in self._fields:
         if _has_field_changed(self, field, recursive):
             return True
@@ -410,34 +672,60 @@ def _has_changed(self, recursive=False):
 def _fget(key, default, self):
     return self.__dict__.get(key, default)
 
+def _fget_lazy(key, default, self):
+    obj_dict = self.__dict__
+    if key not in obj_dict and '__lazy__' in obj_dict:
+        _load_lazy_field(obj_dict, key)
+    return obj_dict.get(key, default)
+
 def _fget_container(key, container_class, self):
-    return self.__dict__.setdefault(key, container_class())
+    obj_dict = self.__dict__
+    if key not in obj_dict and '__lazy__' in obj_dict:
+        _load_lazy_field(obj_dict, key)
+    if key in obj_dict:
+        return obj_dict[key]
+    value = obj_dict[key] = container_class()
+    value._owner = self
+    if _recorders:
+        value._rec_parent = (self, self._fields_by_key[key])
+    return value
 
 def _is_default_value(self, name):
     field = self._fields_by_name.get(name)
     if not field:
         raise NoFieldError('no such field: %s' % name)
     key = field.key
+    if _is_lazy_pending(self.__dict__, key):
+        return False
     return self.__dict__.get(key) is None
 
 def _fset(key, field_index, self, value):
     if self.__dict__.get(key) != value:
         self.__dict__[key] = value
         _mark_changed(field_index, self)
+        if _recorders:
+            _record_field(self, field_index)
+
+def _fset_lazy(key, field_index, self, value):
+    _drop_lazy_field(self.__dict__, key)
+    _fset(key, field_index, self, value)
 
 def _fset_container(key, field_index, container_class, self, value):
-    if isinstance(value, container_class):
-        value.broadcast_changed()
-        self.__dict__[key] = value
-    else:
+    _drop_lazy_field(self.__dict__, key)
+    if not isinstance(value, container_class):
         value = container_class(value)
-        value.broadcast_changed()
-        self.__dict__[key] = value
+    self.__dict__[key] = value
+    _mark_container_dirty(value)
     _mark_changed(field_index, self)
+    if _recorders:
+        _record_field(self, field_index)
 
 def _fdel(key, self):
+    _drop_lazy_field(self.__dict__, key)
     if hasattr(self, key):
         delattr(self, key)
+        if _recorders:
+            _record_mutation(self, MUTATION_DEL_FIELD, self._fields_by_key[key])
 
 def _fdel_container(key, self):
     raise OperateError('cannot del a container field')
@@ -470,6 +758,8 @@ def _encode_to_dict(dict_data, cls, obj, recursive,
                     only_changed, clear_changed, field_filter=None):
     '''将对象数据转储到dict'''
     obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
 
     if only_changed:
         have_data = False
@@ -493,20 +783,35 @@ def _encode_to_dict(dict_data, cls, obj, recursive,
         kencoder = field.dict_key_encoder
 
         if field.array:
-            dict_data[field.name] = [
-                _field_value_to_dict(
-                    encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=field_filter,
-                    with_skip_from_pack=False)
-                for v in value
-            ]
+            # 解码的时候整个替换数组，或者按操作修改数组，元素需要完整打包
+            ops = _array_ops(obj_dict, field, value, only_changed)
+            if ops is not None:
+                dict_data[field.name] = {'ops': [
+                    [_array_op_names[op], index] if op == ARRAY_OP_REMOVE else
+                    [_array_op_names[op], index, _field_value_to_dict(
+                        encoder, field, v,
+                        recursive=recursive,
+                        only_changed=False,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter,
+                        with_skip_from_pack=False)]
+                    for op, index, v in ops
+                ]}
+            else:
+                dict_data[field.name] = [
+                    _field_value_to_dict(
+                        encoder, field, v,
+                        recursive=recursive,
+                        only_changed=False,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter,
+                        with_skip_from_pack=False)
+                    for v in value
+                ]
             have_data = True
         elif field.map:
             d = dict_data[field.name] = {}
-            for k, v in value.iteritems():
+            for k, v in _map_entries(value, only_changed).iteritems():
                 key = kencoder(k)
                 fvalue = _field_value_to_dict(
                     encoder, field, v,
@@ -518,13 +823,13 @@ def _encode_to_dict(dict_data, cls, obj, recursive,
                     d[key] = fvalue
                     have_data = True
             if only_changed:
-                for key in value._removed:
-                    d[key] = None
+                for key in _removed_map_keys(value):
+                    d[kencoder(key)] = None
                     have_data = True
         elif field.id_map:
             d = dict_data[field.name] = {}
             i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
-            for _, v in value.iteritems():
+            for v in _map_entries(value, only_changed).itervalues():
                 key = kencoder(v.oid)
                 fvalue = _field_value_to_dict(
                     encoder, field, v,
@@ -536,8 +841,8 @@ def _encode_to_dict(dict_data, cls, obj, recursive,
                     d[key] = fvalue
                     have_data = True
             if only_changed:
-                for key in value._removed:
-                    d[key] = None
+                for key in _removed_map_keys(value):
+                    d[kencoder(key)] = None
                     have_data = True
         else:
             fvalue = _field_value_to_dict(
@@ -554,13 +859,306 @@ def _encode_to_dict(dict_data, cls, obj, recursive,
 
     return have_data
 
-def _field_value_from_dict(decoder, field, dict_value, old_value, context):
+def _field_version(versions, field):
+    '''字段最后一次修改的版本号。set_changed()修改的是全部字段'''
+    if not versions:
+        return 0
+    return max(versions.get(field.index, 0), versions.get('*', 0))
+
+def _has_changed_since(value, version):
+    '''对象或容器在version之后有没有修改。ref的对象属于别的对象，不检查'''
+    if isinstance(value, DataModel):
+        obj_dict = value.__dict__
+        versions = obj_dict.get('__versions__')
+        if versions and max(versions.itervalues()) > version:
+            return True
+        for field in value._fields:
+            if field.ref or field.skip_changed:
+                continue
+            if field.container_class is not None or field.is_data_model_type:
+                v = obj_dict.get(field.key)
+                if v is not None and _has_changed_since(v, version):
+                    return True
+        return False
+    if isinstance(value, (Array, Map, TypedArray)):
+        if value._version > version:
+            return True
+        if isinstance(value, TypedArray) or _is_ref_container(value):
+            return False
+        for v in (value.itervalues() if isinstance(value, Map) else value):
+            if _has_changed_since(v, version):
+                return True
+    return False
+
+def _prune_versions(value, min_version):
+    '''删除对象树里map记下的不晚于min_version的key版本号。ref的对象属于别的对象，不处理'''
+    if isinstance(value, DataModel):
+        obj_dict = value.__dict__
+        for field in value._fields:
+            if field.ref or field.skip_changed:
+                continue
+            if field.container_class is not None or field.is_data_model_type:
+                v = obj_dict.get(field.key)
+                if v is not None:
+                    _prune_versions(v, min_version)
+    elif isinstance(value, (Array, Map)):
+        if isinstance(value, Map):
+            value.prune_versions(min_version)
+        if not _is_ref_container(value):
+            for v in (value.itervalues() if isinstance(value, Map) else value):
+                _prune_versions(v, min_version)
+
+def _full_value_to_dict(field, value, field_filter):
+    return _field_value_to_dict(field.dict_encoder, field, value,
+                                recursive=True,
+                                only_changed=False,
+                                clear_changed=False,
+                                field_filter=field_filter,
+                                with_skip_from_pack=False)
+
+def _map_since_to_dict(field, value, version, field_filter):
+    '''map在version之后的增量。修改过的key输出完整的值，删除了的key输出None，
+        其他对象元素输出它们自己的增量
+    '''
+    d = {}
+    kencoder = field.dict_key_encoder
+    if field.id_map:
+        field_filter = FieldFilter(field_filter, _exclude_oid_field)
+    versions = value._versions
+    nested = _is_object_value(field)
+    for k, v in value.iteritems():
+        if versions.get(k, 0) > version:
+            d[kencoder(k)] = _full_value_to_dict(field, v, field_filter)
+        elif nested:
+            sub = {}
+            if _encode_since_to_dict(sub, field.value_type, v, version, field_filter):
+                d[kencoder(k)] = sub
+    for k, ver in versions.iteritems():
+        if ver > version and k not in value:
+            d[kencoder(k)] = None
+    return d
+
+def _encode_since_to_dict(dict_data, cls, obj, version, field_filter=None):
+    '''把obj在version之后修改了的数据转储到dict_data，格式和pack_to_dict(only_changed=True)一样。
+        修改过的字段完整打包；没有修改的子对象和容器递归检查。返回是否有数据
+    '''
+    obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    versions = obj_dict.get('__versions__')
+    have_data = False
+    for field in cls._fields:
+        value = obj_dict.get(field.key)
+        if value is None or field.skip_changed:
+            continue
+        if field_filter and not field_filter(field):
+            continue
+        changed = _field_version(versions, field) > version
+        if field.array:
+            if changed or _has_changed_since(value, version):
+                dict_data[field.name] = [
+                    _full_value_to_dict(field, v, field_filter) for v in value]
+                have_data = True
+        elif field.map or field.id_map:
+            if changed:
+                ff = FieldFilter(field_filter, _exclude_oid_field) if field.id_map \
+                    else field_filter
+                d = dict((field.dict_key_encoder(k), _full_value_to_dict(field, v, ff))
+                         for k, v in value.iteritems())
+            else:
+                d = _map_since_to_dict(field, value, version, field_filter)
+            if d:
+                dict_data[field.name] = d
+                have_data = True
+        elif changed:
+            dict_data[field.name] = _full_value_to_dict(field, value, field_filter)
+            have_data = True
+        elif _is_object_value(field):
+            d = {}
+            if _encode_since_to_dict(d, field.value_type, value, version, field_filter):
+                dict_data[field.name] = d
+                have_data = True
+    return have_data
+
+# 只对原来的对象有效的内部状态，复制的时候去掉
+_CLONE_DROP_KEYS = ('__owner__', '__owner_key__', '__rec_parent__', '__recorder__')
+
+class _CloneContext(object):
+    '''复制对象树的状态。
+        memo       -> 已经复制了的对象，id => 新对象。同一个对象放在多个地方时只复制一次
+        refs       -> ref字段和ref容器的元素，(新dict或容器, key, 原对象)，复制完以后再指向新对象
+        keep_clean -> 深复制并且保留changed标志时，同时保留clean标志，所属对象改成复制出来的对象
+    '''
+    __slots__ = ('deep', 'with_changed', 'keep_clean', 'memo', 'refs')
+
+    def __init__(self, deep, with_changed):
+        self.deep = deep
+        self.with_changed = with_changed
+        self.keep_clean = deep and with_changed
+        self.memo = {}
+        self.refs = []
+
+def _set_clone_owner(value, owner, key=None):
+    '''保留了clean标志的对象指向新的所属对象'''
+    value_dict = value.__dict__
+    if '__clean__' in value_dict:
+        value_dict['__owner__'] = owner
+        if key is not None:
+            value_dict['__owner_key__'] = key
+
+def _clone_object(obj, ctx):
+    obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    cls = type(obj)
+    new = cls.__new__(cls)
+    ctx.memo[id(obj)] = new
+    # 基本类型的字段直接复制dict，只处理子对象和容器字段
+    new_dict = new.__dict__ = obj_dict.copy()
+    for key in _CLONE_DROP_KEYS:
+        new_dict.pop(key, None)
+    if not ctx.keep_clean:
+        new_dict.pop('__clean__', None)
+    if ctx.with_changed:
+        if '__changed_set__' in new_dict:
+            new_dict['__changed_set__'] = set(new_dict['__changed_set__'])
+        if '__versions__' in new_dict:
+            new_dict['__versions__'] = dict(new_dict['__versions__'])
+    else:
+        new_dict.pop('__changed_set__', None)
+        new_dict.pop('__versions__', None)
+    for field in cls._clone_fields:
+        key = field.key
+        value = new_dict.get(key)
+        if value is None:
+            continue
+        if field.container_class is not None:
+            new_dict[key] = _clone_container(value, field, new, ctx)
+        elif field.ref:
+            ctx.refs.append((new_dict, key, value))
+        elif ctx.deep:
+            value = new_dict[key] = _clone_value(value, ctx)
+            if ctx.keep_clean:
+                _set_clone_owner(value, new)
+    return new
+
+def _clone_value(value, ctx):
+    new = ctx.memo.get(id(value))
+    if new is None:
+        new = _clone_object(value, ctx)
+    return new
+
+def _clone_container(value, field, owner, ctx):
+    '''复制容器。元素是对象并且deep为True时复制元素，否则新容器和原容器共享元素。
+        共享的元素或者不保留clean标志的时候，元素的改变不会通知新容器，
+        所以map不再只跟踪记下的key，对象数组也不保留操作记录
+    '''
+    container_class = field.container_class
+    with_changed = ctx.with_changed
+    if field.typed:
+        new = container_class(value)
+        if with_changed:
+            new._changed = value._changed
+            new._version = value._version
+            if ctx.keep_clean:
+                new._clean = value._clean
+                new._owner = owner
+        return new
+    object_elements = field.is_data_model_type and not field.ref
+    cloned = object_elements and ctx.deep
+    exact = ctx.keep_clean or not object_elements
+    if field.array:
+        if cloned:
+            new = container_class([_clone_value(v, ctx) for v in value])
+        else:
+            new = container_class(value)
+        if field.ref:
+            ctx.refs.extend((new, k, v) for k, v in enumerate(value))
+        if with_changed:
+            new._changed = value._changed
+            new._version = value._version
+            if exact and value._ops is not None:
+                if cloned:
+                    new._ops = [(op, k, None if v is None else _clone_value(v, ctx))
+                                for op, k, v in value._ops]
+                else:
+                    new._ops = list(value._ops)
+        items = enumerate(new)
+    else:
+        if cloned:
+            new = container_class((k, _clone_value(v, ctx)) for k, v in value.iteritems())
+        else:
+            new = container_class(value)
+        if field.ref:
+            ctx.refs.extend((new, k, v) for k, v in value.iteritems())
+        if with_changed:
+            new._changed = value._changed
+            new._removed = set(value._removed)
+            new._versions = dict(value._versions)
+            new._version = value._version
+            if exact:
+                new._dirty = set(value._dirty)
+                new._tracked = value._tracked
+        items = new.iteritems()
+    if ctx.keep_clean:
+        new._clean = value._clean
+        new._owner = owner
+        if cloned:
+            for k, v in items:
+                _set_clone_owner(v, new, k)
+    return new
+
+def _clone(obj, deep, with_changed):
+    ctx = _CloneContext(deep, with_changed)
+    new = _clone_object(obj, ctx)
+    # ref指向被复制了的对象时，改成指向复制出来的对象。不修改changed标志
+    memo = ctx.memo
+    for container, k, v in ctx.refs:
+        target = memo.get(id(v))
+        if target is not None:
+            if isinstance(container, list):
+                list.__setitem__(container, k, target)
+            else:
+                dict.__setitem__(container, k, target)
+    return new
+
+def _make_field_paths(cls, fields):
+    '''把字段路径列表转成嵌套的dict。'a.b'表示子对象a(或者容器a里的对象)的b字段。
+        只指定到某个字段的时候需要它的全部子字段，用None表示。
+    '''
+    paths = {}
+    for path in fields:
+        node = paths
+        fcls = cls
+        names = path.split('.')
+        for i, name in enumerate(names):
+            field = fcls._fields_by_name.get(name) if fcls else None
+            if not field:
+                raise NoFieldError('no such field: %s' % path)
+            if i == len(names) - 1:
+                node[name] = None
+            elif name in node and node[name] is None:
+                # 已经需要全部子字段
+                break
+            else:
+                node = node.setdefault(name, {})
+                fcls = field.value_type if field.is_data_model_type and not field.ref else None
+    return paths
+
+def _is_decode_skipped(field, paths, context):
+    '''解码的时候是否跳过字段'''
+    if paths is not None and field.name not in paths:
+        return True
+    field_filter = context.field_filter
+    return field_filter is not None and not field_filter(field)
+
+def _field_value_from_dict(decoder, field, dict_value, old_value, context, paths=None):
     if decoder:
         return decoder(dict_value)
     else:
-        return _field_object_from_dict(field, None, dict_value, old_value, context)
+        return _field_object_from_dict(field, None, dict_value, old_value, context, paths)
 
-def _field_object_from_dict(field, oid, dict_value, old_value, context):
+def _field_object_from_dict(field, oid, dict_value, old_value, context, paths=None):
     if field.ref:
         return field.dict_ref_decoder(dict_value)
     else:
@@ -571,7 +1169,7 @@ def _field_object_from_dict(field, oid, dict_value, old_value, context):
             fobj = None
             obj_dict = {}
         fcls = field.value_type
-        _decode_from_dict(fobj, fcls, obj_dict, dict_value, context)
+        _decode_from_dict(fobj, fcls, obj_dict, dict_value, context, paths)
         if fobj is None:
             fobj = _create_object(field, fcls, obj_dict)
             _replace_obj_dict(fobj, obj_dict)
@@ -583,11 +1181,45 @@ def _field_object_from_dict(field, oid, dict_value, old_value, context):
         context.add_known_object(oid, fobj)
         return fobj
 
-def _decode_from_dict(obj, cls, obj_dict, dict_data, context):
+def _field_array(obj_dict, field):
+    '''按操作修改的数组。字段还没有数组的时候创建一个空数组'''
+    arr = obj_dict.get(field.key)
+    if arr is None:
+        arr = obj_dict[field.key] = field.container_class()
+    return arr
+
+def _add_array_refs(arr, context):
+    '''按操作修改了ref数组以后，把还没有解析的元素加入待解析列表。操作会改变元素的位置，
+        所以在全部操作完成以后再加入
+    '''
+    for k, v in enumerate(arr):
+        if not isinstance(v, DataModel):
+            context.add_unsolved_ref(('array', arr, k, v))
+
+def _decode_array_ops_from_dict(obj_dict, field, dvalue, context, paths=None):
+    '''把dict格式的数组操作应用到字段的数组'''
+    arr = _field_array(obj_dict, field)
+    decoder = field.dict_decoder
+    for dop in dvalue.get('ops', ()):
+        op = _array_op_codes.get(dop[0])
+        if op is None:
+            raise UnpackError('unknown array op: {}'.format(dop[0]))
+        value = None
+        if op != ARRAY_OP_REMOVE:
+            value = _field_value_from_dict(decoder, field, dop[2], None, context, paths)
+        arr._apply_op(op, dop[1], value)
+    if field.ref:
+        _add_array_refs(arr, context)
+
+def _decode_from_dict(obj, cls, obj_dict, dict_data, context, paths=None):
     '''从dict_data恢复对象数据
         recursive       -> 是否递归子对象
         only_changed    -> 是否仅包含有改变的字段
+        paths           -> 需要解码的字段路径，参见_make_field_paths。None表示全部字段
     '''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
     mark_change = context.mark_change
 
     for field in cls._fields:
@@ -595,16 +1227,23 @@ def _decode_from_dict(obj, cls, obj_dict, dict_data, context):
         dvalue = dict_data.get(fname)
         if dvalue is None: # 数据容错：不解码为None的值
             continue
+        if _is_decode_skipped(field, paths, context):
+            continue
+        sub_paths = paths[fname] if paths is not None else None
         decoder = field.dict_decoder
         kdecoder = field.dict_key_decoder
         field_key = field.key
-        if field.array:
+        if isinstance(dvalue, dict) and field.array:
+            if not context.sync_mode:
+                continue  # 非sync模式忽略数组操作
+            _decode_array_ops_from_dict(obj_dict, field, dvalue, context, sub_paths)
+        elif field.array:
             arr = obj_dict[field_key] = field.container_class()
             for dv in dvalue:
                 if not context.sync_mode:
                     if dv is None: # 数据容错：不解码为None的值
                         continue
-                value = _field_value_from_dict(decoder, field, dv, None, context)
+                value = _field_value_from_dict(decoder, field, dv, None, context, sub_paths)
                 arr._append(value)
                 if field.ref:
                     context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
@@ -627,7 +1266,7 @@ def _decode_from_dict(obj, cls, obj_dict, dict_data, context):
                     continue
                 if context.sync_mode:
                     old_value = m.get(key)
-                value = _field_value_from_dict(decoder, field, v, old_value, context)
+                value = _field_value_from_dict(decoder, field, v, old_value, context, sub_paths)
                 m._setitem(key, value)
                 if field.ref:
                     context.add_unsolved_ref(('map', m, key, value))
@@ -650,7 +1289,7 @@ def _decode_from_dict(obj, cls, obj_dict, dict_data, context):
                     continue
                 if context.sync_mode:
                     old_value = m.get(oid)
-                value = _field_object_from_dict(field, oid, v, old_value, context)
+                value = _field_object_from_dict(field, oid, v, old_value, context, sub_paths)
                 m._setitem(oid, value)
                 if field.ref:
                     context.add_unsolved_ref(('map', m, oid, value))
@@ -658,7 +1297,7 @@ def _decode_from_dict(obj, cls, obj_dict, dict_data, context):
             old_value = None
             if context.sync_mode:
                 old_value = obj_dict.get(field_key)
-            value = _field_value_from_dict(decoder, field, dvalue, old_value, context)
+            value = _field_value_from_dict(decoder, field, dvalue, old_value, context, sub_paths)
             obj_dict[field_key] = value
             if field.ref:
                 context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
@@ -669,7 +1308,7 @@ def _decode_from_dict(obj, cls, obj_dict, dict_data, context):
 
 def _field_value_to_binary(
         buf, encoder, field, value, recursive,
-        only_changed, clear_changed, field_filter=None):
+        only_changed, clear_changed, field_filter=None, framed=False):
     if encoder:
         encoder(buf, value)
     elif recursive:
@@ -680,15 +1319,185 @@ def _field_value_to_binary(
                               recursive=recursive,
                               only_changed=only_changed,
                               clear_changed=clear_changed,
-                              field_filter=field_filter)
+                              field_filter=field_filter,
+                              framed=framed)
+
+def _removed_map_keys(m):
+    '''增量数据里需要删除的key。删除以后又重新设置的key不算'''
+    return [k for k in m._removed if k not in m]
+
+def _encode_tombstones(buf, kencoder, m):
+    '''增量数据里，在map数据前面写入删除了的key'''
+    removed = _removed_map_keys(m)
+    if removed:
+        encode_tombstones_head(buf, len(removed))
+        for k in removed:
+            kencoder(buf, k)
+
+def _encode_field_to_binary(buf, field, obj, obj_dict, recursive,
+                            only_changed, clear_changed, field_filter, framed=False):
+    value = obj_dict.get(field.key)
+    if value is None:
+        return
+
+    if field_filter:
+        if not field_filter(field):
+            return
+
+    if only_changed:
+        if not _has_field_changed(obj, field, recursive):
+            return
+
+    encoder = field.bin_encoder
+    kencoder = field.bin_key_encoder
+
+    encode_field_index(buf, field.index)
+    if framed:
+        frame_offset = encode_frame_begin(buf)
+    if field.typed:
+        encode_typed_array(buf, value)
+    elif field.array:
+        # 增量数据里数组整个替换，或者按操作修改，元素需要完整打包
+        ops = _array_ops(obj_dict, field, value, only_changed)
+        if ops is not None:
+            encode_array_ops_head(buf, len(ops))
+            for op, index, v in ops:
+                encode_array_op(buf, op, index)
+                if op != ARRAY_OP_REMOVE:
+                    _field_value_to_binary(
+                        buf, encoder, field, v,
+                        recursive=recursive,
+                        only_changed=False,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter,
+                        framed=framed)
+        else:
+            encode_array_head(buf, len(value))
+            for v in value:
+                _field_value_to_binary(
+                    buf, encoder, field, v,
+                    recursive=recursive,
+                    only_changed=False,
+                    clear_changed=clear_changed,
+                    field_filter=field_filter,
+                    framed=framed)
+    elif field.map:
+        if only_changed:
+            _encode_tombstones(buf, kencoder, value)
+        entries = _map_entries(value, only_changed)
+        encode_map_head(buf, len(entries))
+        for k, v in entries.iteritems():
+            kencoder(buf, k)
+            _field_value_to_binary(
+                buf, encoder, field, v,
+                recursive=recursive,
+                only_changed=only_changed,
+                clear_changed=clear_changed,
+                field_filter=field_filter,
+                framed=framed)
+    elif field.id_map:
+        if only_changed:
+            _encode_tombstones(buf, kencoder, value)
+        entries = _map_entries(value, only_changed)
+        encode_id_map_head(buf, len(entries))
+        i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+        for v in entries.itervalues():
+            k = v.oid
+            kencoder(buf, k)
+            _field_value_to_binary(
+                buf, encoder, field, v,
+                recursive=recursive,
+                only_changed=only_changed,
+                clear_changed=clear_changed,
+                field_filter=i_field_filter,
+                framed=framed)
+    else:
+        _field_value_to_binary(
+            buf, encoder, field, value,
+            recursive=recursive,
+            only_changed=only_changed,
+            clear_changed=clear_changed,
+            field_filter=field_filter,
+            framed=framed)
+    if framed:
+        encode_frame_end(buf, frame_offset)
+
+def _encode_scalar_run(buf, run, obj, obj_dict, recursive, only_changed, field_filter):
+    '''用预编译的struct一次打包run内的全部字段。
+        run内有字段不需要输出时返回False，由调用者逐个字段打包。
+    '''
+    args = list(run.args_template)
+    pos = 1
+    for field in run.fields:
+        value = obj_dict.get(field.key)
+        if value is None:
+            return False
+        if field_filter:
+            if not field_filter(field):
+                return False
+        if only_changed:
+            if not _has_field_changed(obj, field, recursive):
+                return False
+        args[pos] = value
+        pos += 2
+    b, offset = buf.pull(run.size)
+    run.struct.pack_into(b, offset, *args)
+    return True
 
 def _encode_to_binary(buf, cls, obj, recursive, only_changed, clear_changed,
-                      field_filter=None):
+                      field_filter=None, framed=False):
     '''将对象数据转储到binary buff。
         recursive       -> 是否递归子对象
         only_changed    -> 是否仅包含有改变的字段
+        framed          -> 是否使用分帧格式。每个字段index后面带4字节的字段数据长度
     '''
     obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+
+    for item in cls._bin_codec.items:
+        if type(item) is ScalarRun:
+            if not framed and _encode_scalar_run(buf, item, obj, obj_dict, recursive,
+                                                 only_changed, field_filter):
+                continue
+            for field in item.fields:
+                _encode_field_to_binary(buf, field, obj, obj_dict, recursive,
+                                        only_changed, clear_changed, field_filter, framed)
+        else:
+            _encode_field_to_binary(buf, item, obj, obj_dict, recursive,
+                                    only_changed, clear_changed, field_filter, framed)
+
+    if clear_changed:
+        _clear_changed(obj, None, recursive=False)
+
+    encode_field_index(buf, 0)
+
+def _field_value_binary_size(field, value, recursive, only_changed, field_filter, framed=False):
+    if not field.is_data_model_type:
+        return calc_value_size(field.type_name, value)
+    elif recursive:
+        if field.ref:
+            return calc_value_size(field.value_type._fields_by_name['oid'].type_name, value.oid)
+        else:
+            return _calc_binary_size(field.value_type, value,
+                                     recursive=recursive,
+                                     only_changed=only_changed,
+                                     field_filter=field_filter,
+                                     framed=framed)
+    return 0
+
+def _tombstones_size(field, m):
+    removed = _removed_map_keys(m)
+    if not removed:
+        return 0
+    return CONTAINER_HEAD_SIZE + sum(calc_value_size(field.key_type_name, k) for k in removed)
+
+def _calc_binary_size(cls, obj, recursive, only_changed, field_filter=None, framed=False):
+    '''计算_encode_to_binary输出的字节数。不修改对象的changed标志。'''
+    obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    size = FIELD_INDEX_SIZE  # 结束标志
 
     for field in cls._fields:
         value = obj_dict.get(field.key)
@@ -703,55 +1512,45 @@ def _encode_to_binary(buf, cls, obj, recursive, only_changed, clear_changed,
             if not _has_field_changed(obj, field, recursive):
                 continue
 
-        encoder = field.bin_encoder
-        kencoder = field.bin_key_encoder
-
-        encode_field_index(buf, field.index)
-        if field.array:
-            encode_array_head(buf, len(value))
-            for v in value:
-                _field_value_to_binary(
-                    buf, encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=field_filter)
+        size += FIELD_INDEX_SIZE
+        if framed:
+            size += FIELD_FRAME_SIZE
+        if field.typed:
+            size += CONTAINER_HEAD_SIZE + len(value) * value.itemsize
+        elif field.array:
+            size += CONTAINER_HEAD_SIZE
+            ops = _array_ops(obj_dict, field, value, only_changed)
+            if ops is not None:
+                for op, _, v in ops:
+                    size += ARRAY_OP_HEAD_SIZE
+                    if op != ARRAY_OP_REMOVE:
+                        size += _field_value_binary_size(field, v, recursive, False,
+                                                         field_filter, framed)
+            else:
+                for v in value:
+                    size += _field_value_binary_size(field, v, recursive, False,
+                                                     field_filter, framed)
         elif field.map:
-            encode_map_head(buf, len(value))
-            for k, v in value.iteritems():
-                kencoder(buf, k)
-                _field_value_to_binary(
-                    buf, encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=field_filter)
+            size += CONTAINER_HEAD_SIZE
+            if only_changed:
+                size += _tombstones_size(field, value)
+            for k, v in _map_entries(value, only_changed).iteritems():
+                size += calc_value_size(field.key_type_name, k)
+                size += _field_value_binary_size(field, v, recursive, only_changed, field_filter, framed)
         elif field.id_map:
-            encode_id_map_head(buf, len(value))
+            size += CONTAINER_HEAD_SIZE
+            if only_changed:
+                size += _tombstones_size(field, value)
             i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
-            for v in value.itervalues():
-                k = v.oid
-                kencoder(buf, k)
-                _field_value_to_binary(
-                    buf, encoder, field, v,
-                    recursive=recursive,
-                    only_changed=only_changed,
-                    clear_changed=clear_changed,
-                    field_filter=i_field_filter)
+            for v in _map_entries(value, only_changed).itervalues():
+                size += calc_value_size(field.key_type_name, v.oid)
+                size += _field_value_binary_size(field, v, recursive, only_changed, i_field_filter, framed)
         else:
-            _field_value_to_binary(
-                buf, encoder, field, value,
-                recursive=recursive,
-                only_changed=only_changed,
-                clear_changed=clear_changed,
-                field_filter=field_filter)
-
-    if clear_changed:
-        _clear_changed(obj, None, recursive=False)
+            size += _field_value_binary_size(field, value, recursive, only_changed, field_filter, framed)
 
-    encode_field_index(buf, 0)
+    return size
 
-def _field_value_from_binary(buf, decoder, field, old_value, oid, context):
+def _field_value_from_binary(buf, decoder, field, old_value, oid, context, paths=None):
     if decoder:
         return decoder(buf)
     elif field.ref:
@@ -764,7 +1563,10 @@ def _field_value_from_binary(buf, decoder, field, old_value, oid, context):
             fobj = None
             obj_dict = {}
         fcls = field.value_type
-        _decode_from_binary(buf, fobj, fcls, obj_dict, context)
+        if context.lazy:
+            _decode_from_binary_lazy(buf, fcls, obj_dict, context, paths)
+        else:
+            _decode_from_binary(buf, fobj, fcls, obj_dict, context, paths)
         if fobj is None:
             fobj = _create_object(field, fcls, obj_dict)
             _replace_obj_dict(fobj, obj_dict)
@@ -773,88 +1575,765 @@ def _field_value_from_binary(buf, decoder, field, old_value, oid, context):
             context.add_known_object(oid, fobj)
         return fobj
 
-def _decode_from_binary(buf, obj, cls, obj_dict, context):
-    '''从binary buff恢复对象数据'''
+def _decode_scalar_run(buf, run, obj_dict):
+    '''run的第一个字段index已经读出。尝试用预编译的struct一次解出run内的全部字段。
+        数据里的字段序列和run不一致时(比如增量数据)返回False，且不移动读偏移。
+    '''
+    if buf.left() < run.tail_size:
+        return False
+    values = run.tail_struct.unpack_from(buf.b, buf.offset)
+    if values[1::2] != run.tail_indexes:
+        return False
+    buf.push(run.tail_size)
+    pos = 0
+    for key in run.keys:
+        obj_dict[key] = values[pos]
+        pos += 2
+    return True
+
+def _decode_tombstones(buf, kdecoder, m, context):
+    '''解码增量数据里删除了的key。sync模式下从m里删除，否则忽略'''
+    for _ in xrange(decode_tombstones_head(buf)):
+        key = kdecoder(buf)
+        if context.sync_mode and key in m:
+            m._delitem(key)  # 调用_delitem避免修改changed标志
+
+def _decode_field_from_binary(buf, field, obj_dict, context, paths=None):
+    '''字段index已经读出。解码一个字段的数据到obj_dict。paths是字段值对象需要解码的字段路径'''
+    decoder = field.bin_decoder
+    kdecoder = field.bin_key_decoder
+    field_key = field.key
+    if field.typed:
+        arr = obj_dict[field_key] = field.container_class()
+        decode_typed_array(buf, arr)
+    elif field.array:
+        op_count = decode_array_ops_head(buf)
+        if op_count is not None and not context.sync_mode:
+            _skip_array_ops(buf, field, op_count)  # 非sync模式忽略数组操作
+            return
+        if op_count is not None:
+            arr = _field_array(obj_dict, field)
+            for _ in xrange(op_count):
+                op, index = decode_array_op(buf)
+                value = None
+                if op != ARRAY_OP_REMOVE:
+                    value = _field_value_from_binary(
+                        buf, decoder, field, old_value=None,
+                        oid=None, context=context, paths=paths)
+                arr._apply_op(op, index, value)
+            if field.ref:
+                _add_array_refs(arr, context)
+            return
+        arr = obj_dict[field_key] = field.container_class()
+        asize = decode_array_head(buf)
+        for _ in xrange(asize):
+            value = _field_value_from_binary(
+                buf, decoder, field, old_value=None,
+                oid=None, context=context, paths=paths)
+            arr._append(value)  # 调用_append避免修改changed标志
+            if field.ref:
+                context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
+    elif field.map:
+        m = None
+        if context.sync_mode:
+            m = obj_dict.get(field_key)
+        if m is None:
+            m = field.container_class()
+            obj_dict[field_key] = m
+        _decode_tombstones(buf, kdecoder, m, context)
+        asize = decode_map_head(buf)
+        for _ in xrange(asize):
+            old_value = None
+            key = kdecoder(buf)
+            if context.sync_mode:
+                old_value = m.get(key)
+            value = _field_value_from_binary(
+                buf, decoder, field, old_value=old_value,
+                oid=None, context=context, paths=paths)
+            m._setitem(key, value)  # 调用_setitem避免修改changed标志
+            if field.ref:
+                context.add_unsolved_ref(('map', m, key, value))
+    elif field.id_map:
+        m = None
+        if context.sync_mode:
+            m = obj_dict.get(field_key)
+        if m is None:
+            m = field.container_class()
+            obj_dict[field_key] = m
+        _decode_tombstones(buf, kdecoder, m, context)
+        asize = decode_id_map_head(buf)
+        for _ in xrange(asize):
+            old_value = None
+            oid = kdecoder(buf)
+            if context.sync_mode:
+                old_value = m.get(oid)
+            value = _field_value_from_binary(
+                buf, decoder, field, old_value=old_value,
+                oid=oid, context=context, paths=paths)
+            m._setitem(oid, value)  # 调用_setitem避免修改changed标志
+            if field.ref:
+                context.add_unsolved_ref(('map', m, oid, value))
+    else:
+        old_value = None
+        if context.sync_mode:
+            old_value = obj_dict.get(field_key)
+        value = _field_value_from_binary(
+            buf, decoder, field, old_value=old_value,
+            oid=None, context=context, paths=paths)
+        obj_dict[field_key] = value
+        if field.ref:
+            context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
+
+def _check_frame_end(buf, frame_end, field_index):
+    if buf.offset != frame_end:
+        raise PackError('field size mismatch, index={}'.format(field_index))
+
+def _encode_framed_mark(buf, framed):
+    if framed:
+        encode_field_index(buf, FRAMED_MARK)
+
+def _decode_framed_mark(buf, framed):
+    '''检查数据开头的FRAMED_MARK和framed参数是否一致，不一致的话按另一种格式解码会得到错误的值'''
+    if buf.is_end():
+        return
+    offset = buf.offset
+    if decode_field_index(buf) == FRAMED_MARK:
+        if not framed:
+            raise UnpackError('data is framed, unpack with framed=True')
+    else:
+        if framed:
+            raise UnpackError('data is not framed, unpack with framed=False')
+        buf.offset = offset
+
+def _is_lazy_field(field):
+    '''延迟解码的时候，子对象和容器字段只记录数据偏移'''
+    return field.is_container() or (field.is_data_model_type and not field.ref)
+
+class LazyFields(object):
+    '''延迟解码的字段。保存在对象的__dict__['__lazy__']里。
+        data        -> 源数据
+        cls         -> 对象类型
+        offsets     -> 字段key => 字段数据在源数据里的偏移
+        context     -> 解码用的DecodeContext
+        paths       -> 需要解码的字段路径
+        mark_change -> 解码出来的字段是否设置changed标志
+        copy_bytes  -> 同ReadBuffer
+    '''
+    __slots__ = ('data', 'cls', 'offsets', 'context', 'paths', 'mark_change', 'copy_bytes')
+
+    def __init__(self, data, cls, offsets, context, paths, copy_bytes=False):
+        self.data = data
+        self.copy_bytes = copy_bytes
+        self.cls = cls
+        self.offsets = offsets
+        self.context = context
+        self.paths = paths
+        self.mark_change = context.mark_change
+
+def _is_lazy_pending(obj_dict, key):
+    lazy = obj_dict.get('__lazy__')
+    return lazy is not None and key in lazy.offsets
+
+def _drop_lazy_field(obj_dict, key):
+    lazy = obj_dict.get('__lazy__')
+    if lazy is not None:
+        lazy.offsets.pop(key, None)
+        if not lazy.offsets:
+            del obj_dict['__lazy__']
+
+def _load_lazy_field(obj_dict, key):
+    _drop_clean(obj_dict)
+    lazy = obj_dict['__lazy__']
+    offset = lazy.offsets.pop(key, None)
+    if not lazy.offsets:
+        del obj_dict['__lazy__']
+    if offset is None:
+        return
+    buf = ReadBuffer(lazy.data, lazy.copy_bytes)
+    buf.offset = offset
+    context = lazy.context
+    context.mark_change = lazy.mark_change
+    field = lazy.cls._fields_by_key[key]
+    paths = lazy.paths
+    _decode_field_from_binary(buf, field, obj_dict, context,
+                              paths[field.name] if paths is not None else None)
+    context.resolve_ref()
+
+def _load_all_lazy(obj_dict):
+    lazy = obj_dict.get('__lazy__')
+    if lazy is None:
+        return
+    for key in lazy.offsets.keys():
+        _load_lazy_field(obj_dict, key)
+
+def _skip_binary_scalar(buf, type_name):
+    size = SCALAR_SIZES.get(type_name)
+    if size is None:
+        if type_name == 'bytes':
+            size = codes_bin.decode_uint32(buf)
+        else:
+            # string
+            size = codes_bin.decode_uint16(buf)
+    buf.push(size)
+
+def _skip_binary_value(buf, field):
+    if field.ref:
+        _skip_binary_scalar(buf, field.value_type._fields_by_name['oid'].type_name)
+    elif field.is_data_model_type:
+        _skip_binary_object(buf, field.value_type)
+    else:
+        _skip_binary_scalar(buf, field.type_name)
+
+def _skip_array_ops(buf, field, op_count):
+    for _ in xrange(op_count):
+        op, _ = decode_array_op(buf)
+        if op != ARRAY_OP_REMOVE:
+            _skip_binary_value(buf, field)
+
+def _skip_binary_field(buf, field):
+    '''字段index已经读出。跳过字段数据，不解码'''
+    if field.array:
+        op_count = decode_array_ops_head(buf)
+        if op_count is not None:
+            _skip_array_ops(buf, field, op_count)
+        else:
+            for _ in xrange(decode_array_head(buf)):
+                _skip_binary_value(buf, field)
+    elif field.map or field.id_map:
+        for _ in xrange(decode_tombstones_head(buf)):
+            _skip_binary_scalar(buf, field.key_type_name)
+        if field.map:
+            asize = decode_map_head(buf)
+        else:
+            asize = decode_id_map_head(buf)
+        for _ in xrange(asize):
+            _skip_binary_scalar(buf, field.key_type_name)
+            _skip_binary_value(buf, field)
+    else:
+        _skip_binary_value(buf, field)
+
+def _skip_binary_object(buf, cls):
+    _fields_by_index = cls._fields_by_index
+    while not buf.is_end():
+        field_index = decode_field_index(buf)
+        if field_index == 0:
+            break
+        field = _fields_by_index.get(field_index)
+        if not field:
+            raise PackError('unkown field, ndex={}'.format(field_index))
+        _skip_binary_field(buf, field)
+
+def _decode_from_binary_lazy(buf, cls, obj_dict, context, paths=None):
+    '''从binary buff恢复对象数据。基本类型的字段直接解码，子对象和容器字段只记录
+        数据偏移，在第一次访问的时候再解码。
+    '''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
     mark_change = context.mark_change
+    framed = context.framed
     _fields_by_index = cls._fields_by_index
+    offsets = {}
 
-    while True:
-        if buf.is_end():
-            break
+    while not buf.is_end():
         field_index = decode_field_index(buf)
         if field_index == 0:
             # end of field
             break
+        if framed:
+            frame_size = decode_frame_size(buf)
+            frame_end = buf.offset + frame_size
         field = _fields_by_index.get(field_index)
         if not field:
+            if framed:
+                buf.push(frame_size)
+                continue
             raise PackError('unkown field, ndex={}'.format(field_index))
-        decoder = field.bin_decoder
-        kdecoder = field.bin_key_decoder
-        field_key = field.key
+        if _is_decode_skipped(field, paths, context):
+            if framed:
+                buf.push(frame_size)
+            else:
+                _skip_binary_field(buf, field)
+            continue
+        if _is_lazy_field(field):
+            offsets[field.key] = buf.offset
+            obj_dict.pop(field.key, None)
+            if framed:
+                buf.push(frame_size)
+            else:
+                _skip_binary_field(buf, field)
+        else:
+            _decode_field_from_binary(buf, field, obj_dict, context)
+            if framed:
+                _check_frame_end(buf, frame_end, field_index)
+
+        if mark_change:
+            _mark_changed_self_dict(field_index, obj_dict)
+
+    if offsets:
+        obj_dict['__lazy__'] = LazyFields(buf.b, cls, offsets, context, paths, buf.copy_bytes)
+
+def _decode_from_binary(buf, obj, cls, obj_dict, context, paths=None):
+    '''从binary buff恢复对象数据。paths是需要解码的字段路径，参见_make_field_paths'''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    mark_change = context.mark_change
+    framed = context.framed
+    filtered = paths is not None or context.field_filter is not None
+    _fields_by_index = cls._fields_by_index
+    runs_by_index = cls._bin_codec.runs_by_index
+
+    while True:
+        if buf.is_end():
+            break
+        field_index = decode_field_index(buf)
+        if field_index == 0:
+            # end of field
+            break
+        if framed:
+            frame_size = decode_frame_size(buf)
+            frame_end = buf.offset + frame_size
+        elif not filtered:
+            run = runs_by_index.get(field_index)
+            if run is not None and _decode_scalar_run(buf, run, obj_dict):
+                if mark_change:
+                    for index in run.indexes:
+                        _mark_changed_self_dict(index, obj_dict)
+                continue
+        field = _fields_by_index.get(field_index)
+        if not field:
+            if framed:
+                # 分帧格式可以直接跳过不认识的字段
+                buf.push(frame_size)
+                continue
+            raise PackError('unkown field, ndex={}'.format(field_index))
+        if filtered and _is_decode_skipped(field, paths, context):
+            if framed:
+                buf.push(frame_size)
+            else:
+                _skip_binary_field(buf, field)
+            continue
+        _decode_field_from_binary(buf, field, obj_dict, context,
+                                  paths[field.name] if paths is not None else None)
+        if framed:
+            _check_frame_end(buf, frame_end, field_index)
+
+        if mark_change:
+            _mark_changed_self_dict(field_index, obj_dict)
+
+def _field_value_to_binary2(buf, field, value, recursive, only_changed,
+                            clear_changed, field_filter=None):
+    encoder = field.bin2_encoder
+    if encoder:
+        encoder(buf, value)
+    elif field.ref:
+        field.bin2_ref_encoder(buf, value.oid)
+    else:
+        _encode_to_binary2(buf, field.value_type, value,
+                           recursive=recursive,
+                           only_changed=only_changed,
+                           clear_changed=clear_changed,
+                           field_filter=field_filter)
+
+def _encode_bin2_map_head(buf, field, size, removed):
+    '''写入bin2格式的map头。增量数据里有删除了的key时，接着写入删除了的key'''
+    codes_bin2.encode_map_head(buf, size, field.bin2_key_wire_type, field.bin2_wire_type,
+                               tombstones=bool(removed))
+    if removed:
+        codes_bin2.encode_varint(buf, len(removed))
+        kencoder = field.bin2_key_encoder
+        for k in removed:
+            kencoder(buf, k)
+
+def _encode_to_binary2(buf, cls, obj, recursive, only_changed, clear_changed,
+                       field_filter=None):
+    '''将对象数据转储成bin2格式。参数同_encode_to_binary。'''
+    obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+
+    for field in cls._fields:
+        value = obj_dict.get(field.key)
+        if value is None:
+            continue
+
+        if field_filter:
+            if not field_filter(field):
+                continue
+
+        if not recursive and field.bin2_wire_type == WT_OBJECT:
+            continue
+
+        if only_changed:
+            if not _has_field_changed(obj, field, recursive):
+                continue
+
+        codes_bin2.encode_tag(buf, field.index, field.bin2_field_wire_type)
+        if field.array:
+            # 解码的时候整个替换数组，元素需要完整打包
+            codes_bin2.encode_array_head(buf, len(value), field.bin2_wire_type)
+            for v in value:
+                _field_value_to_binary2(buf, field, v, recursive, False,
+                                        clear_changed, field_filter)
+        elif field.map:
+            entries = _map_entries(value, only_changed)
+            kencoder = field.bin2_key_encoder
+            _encode_bin2_map_head(buf, field, len(entries),
+                                  _removed_map_keys(value) if only_changed else None)
+            for k, v in entries.iteritems():
+                kencoder(buf, k)
+                _field_value_to_binary2(buf, field, v, recursive, only_changed,
+                                        clear_changed, field_filter)
+        elif field.id_map:
+            entries = _map_entries(value, only_changed)
+            kencoder = field.bin2_key_encoder
+            _encode_bin2_map_head(buf, field, len(entries),
+                                  _removed_map_keys(value) if only_changed else None)
+            i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+            for v in entries.itervalues():
+                kencoder(buf, v.oid)
+                _field_value_to_binary2(buf, field, v, recursive, only_changed,
+                                        clear_changed, i_field_filter)
+        else:
+            _field_value_to_binary2(buf, field, value, recursive, only_changed,
+                                    clear_changed, field_filter)
+
+    if clear_changed:
+        _clear_changed(obj, None, recursive=False)
+
+    codes_bin2.encode_end(buf)
+
+def _field_value_from_binary2(buf, field, old_value, oid, context, paths=None):
+    decoder = field.bin2_decoder
+    if decoder:
+        return decoder(buf)
+    elif field.ref:
+        return field.bin2_ref_decoder(buf)
+    else:
+        if old_value is not None:
+            fobj = old_value
+            obj_dict = fobj.__dict__
+        else:
+            fobj = None
+            obj_dict = {}
+        fcls = field.value_type
+        _decode_from_binary2(buf, fobj, fcls, obj_dict, context, paths)
+        if fobj is None:
+            fobj = _create_object(field, fcls, obj_dict)
+            _replace_obj_dict(fobj, obj_dict)
+        if oid is not None:
+            fobj._oid = oid
+            context.add_known_object(oid, fobj)
+        return fobj
+
+def _skip_bin2_value(buf, wire_type, depth=0):
+    '''跳过bin2格式的一个值，不解码。depth是值所在的嵌套层数'''
+    if depth >= MAX_SKIP_DEPTH:
+        raise UnpackError('bin2 data nested too deep')
+    if wire_type == WT_VARINT:
+        codes_bin2.decode_varint(buf)
+    elif wire_type == WT_FIXED64:
+        buf.push(8)
+    elif wire_type == WT_FIXED32:
+        buf.push(4)
+    elif wire_type == WT_BYTES:
+        buf.push(codes_bin2.decode_varint(buf))
+    elif wire_type == WT_OBJECT:
+        while True:
+            index, field_wire_type = codes_bin2.decode_tag(buf)
+            if index == 0:
+                break
+            _skip_bin2_value(buf, field_wire_type, depth + 1)
+    elif wire_type == WT_ARRAY:
+        size, elem_wire_type = codes_bin2.decode_array_head(buf)
+        for _ in xrange(size):
+            _skip_bin2_value(buf, elem_wire_type, depth + 1)
+    elif wire_type in (WT_MAP, WT_ID_MAP):
+        size, key_wire_type, value_wire_type, tombstones = codes_bin2.decode_map_head(buf)
+        if tombstones:
+            for _ in xrange(codes_bin2.decode_varint(buf)):
+                _skip_bin2_value(buf, key_wire_type, depth + 1)
+        for _ in xrange(size):
+            _skip_bin2_value(buf, key_wire_type, depth + 1)
+            _skip_bin2_value(buf, value_wire_type, depth + 1)
+    else:
+        raise UnpackError('unknown wire type: {}'.format(wire_type))
+
+def _check_wire_type(field, wire_type, expected):
+    if wire_type != expected:
+        raise PackError('wire type mismatch, field={}, wire_type={}'.format(field.name, wire_type))
+
+def _decode_from_binary2(buf, obj, cls, obj_dict, context, paths=None):
+    '''从bin2格式的数据恢复对象数据。不认识的字段会被跳过。paths同_decode_from_binary'''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    mark_change = context.mark_change
+    _fields_by_index = cls._fields_by_index
+
+    while True:
+        if buf.is_end():
+            break
+        field_index, wire_type = codes_bin2.decode_tag(buf)
+        if field_index == 0:
+            # end of field
+            break
+        field = _fields_by_index.get(field_index)
+        if not field:
+            _skip_bin2_value(buf, wire_type)
+            continue
+        if _is_decode_skipped(field, paths, context):
+            _skip_bin2_value(buf, wire_type)
+            continue
+        _check_wire_type(field, wire_type, field.bin2_field_wire_type)
+        sub_paths = paths[field.name] if paths is not None else None
+        field_key = field.key
         if field.array:
             arr = obj_dict[field_key] = field.container_class()
-            asize = decode_array_head(buf)
+            asize, elem_wire_type = codes_bin2.decode_array_head(buf)
+            _check_wire_type(field, elem_wire_type, field.bin2_wire_type)
             for _ in xrange(asize):
-                value = _field_value_from_binary(
-                    buf, decoder, field, old_value=None,
-                    oid=None, context=context)
+                value = _field_value_from_binary2(buf, field, None, None, context, sub_paths)
                 arr._append(value)  # 调用_append避免修改changed标志
                 if field.ref:
                     context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
-        elif field.map:
+        elif field.map or field.id_map:
             m = None
             if context.sync_mode:
                 m = obj_dict.get(field_key)
             if m is None:
                 m = field.container_class()
                 obj_dict[field_key] = m
-            asize = decode_map_head(buf)
+            asize, key_wire_type, value_wire_type, tombstones = codes_bin2.decode_map_head(buf)
+            _check_wire_type(field, key_wire_type, field.bin2_key_wire_type)
+            _check_wire_type(field, value_wire_type, field.bin2_wire_type)
+            kdecoder = field.bin2_key_decoder
+            if tombstones:
+                # 删除了的key。sync模式下从m里删除，否则忽略
+                for _ in xrange(codes_bin2.decode_varint(buf)):
+                    key = kdecoder(buf)
+                    if context.sync_mode and key in m:
+                        m._delitem(key)  # 调用_delitem避免修改changed标志
             for _ in xrange(asize):
                 old_value = None
                 key = kdecoder(buf)
                 if context.sync_mode:
                     old_value = m.get(key)
-                value = _field_value_from_binary(
-                    buf, decoder, field, old_value=old_value,
-                    oid=None, context=context)
+                oid = key if field.id_map else None
+                value = _field_value_from_binary2(buf, field, old_value, oid, context, sub_paths)
                 m._setitem(key, value)  # 调用_setitem避免修改changed标志
                 if field.ref:
                     context.add_unsolved_ref(('map', m, key, value))
-        elif field.id_map:
+        else:
+            old_value = None
+            if context.sync_mode:
+                old_value = obj_dict.get(field_key)
+            value = _field_value_from_binary2(buf, field, old_value, None, context, sub_paths)
+            obj_dict[field_key] = value
+            if field.ref:
+                context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
+
+        if mark_change:
+            _mark_changed_self_dict(field_index, obj_dict)
+
+def _field_value_to_bson(buf, field, value, recursive, only_changed,
+                         clear_changed, field_filter=None):
+    encoder = field.bson_encoder
+    if encoder:
+        encoder(buf, value)
+    elif field.ref:
+        field.bson_ref_encoder(buf, value.oid)
+    else:
+        _encode_to_bson(buf, field.value_type, value,
+                        recursive=recursive,
+                        only_changed=only_changed,
+                        clear_changed=clear_changed,
+                        field_filter=field_filter)
+
+def _encode_to_bson(buf, cls, obj, recursive, only_changed, clear_changed,
+                    field_filter=None):
+    '''将对象数据转储成BSON文档。参数同_encode_to_binary。
+        和pack_to_dict一样，增量打包时map里删除的key输出为null。
+    '''
+    obj_dict = obj.__dict__
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    doc_offset = codes_bson.encode_document_begin(buf)
+
+    for field in cls._fields:
+        value = obj_dict.get(field.key)
+        if value is None:
+            continue
+
+        if field_filter:
+            if not field_filter(field):
+                continue
+
+        if not recursive and field.bson_type == BSON_DOCUMENT:
+            continue
+
+        if only_changed:
+            if not _has_field_changed(obj, field, recursive):
+                continue
+
+        bson_type = field.bson_type
+        if field.array:
+            codes_bson.encode_element_head(buf, BSON_ARRAY, field.name)
+            offset = codes_bson.encode_document_begin(buf)
+            for i, v in enumerate(value):
+                codes_bson.encode_element_head(buf, bson_type, str(i))
+                _field_value_to_bson(buf, field, v, recursive, False,
+                                     clear_changed, field_filter)
+            codes_bson.encode_document_end(buf, offset)
+        elif field.map or field.id_map:
+            codes_bson.encode_element_head(buf, BSON_DOCUMENT, field.name)
+            offset = codes_bson.encode_document_begin(buf)
+            kencoder = field.dict_key_encoder
+            entries = _map_entries(value, only_changed)
+            if field.map:
+                for k, v in entries.iteritems():
+                    codes_bson.encode_element_head(buf, bson_type, kencoder(k))
+                    _field_value_to_bson(buf, field, v, recursive, only_changed,
+                                         clear_changed, field_filter)
+            else:
+                i_field_filter = FieldFilter(field_filter, _exclude_oid_field)
+                for v in entries.itervalues():
+                    codes_bson.encode_element_head(buf, bson_type, kencoder(v.oid))
+                    _field_value_to_bson(buf, field, v, recursive, only_changed,
+                                         clear_changed, i_field_filter)
+            if only_changed:
+                # 删除以后又重新设置的key不输出null，否则解码时会删除刚设置的元素
+                for k in _removed_map_keys(value):
+                    codes_bson.encode_element_head(buf, BSON_NULL, kencoder(k))
+            codes_bson.encode_document_end(buf, offset)
+        else:
+            codes_bson.encode_element_head(buf, bson_type, field.name)
+            _field_value_to_bson(buf, field, value, recursive, only_changed,
+                                 clear_changed, field_filter)
+
+    if clear_changed:
+        _clear_changed(obj, None, recursive=False)
+
+    codes_bson.encode_document_end(buf, doc_offset)
+
+def _check_bson_type(field, bson_type, accepted):
+    if bson_type not in accepted:
+        raise PackError('bson type mismatch, field={}, bson_type={}'.format(field.name, bson_type))
+
+def _field_value_from_bson(buf, field, bson_type, old_value, oid, context, paths=None):
+    _check_bson_type(field, bson_type, field.bson_accepted_types)
+    decoder = field.bson_decoder
+    if decoder:
+        return decoder(buf, bson_type)
+    elif field.ref:
+        return field.bson_ref_decoder(buf, bson_type)
+    else:
+        if old_value is not None:
+            fobj = old_value
+            obj_dict = fobj.__dict__
+        else:
+            fobj = None
+            obj_dict = {}
+        fcls = field.value_type
+        _decode_from_bson(buf, fobj, fcls, obj_dict, context, paths)
+        if fobj is None:
+            fobj = _create_object(field, fcls, obj_dict)
+            _replace_obj_dict(fobj, obj_dict)
+        if oid is not None:
+            fobj._oid = oid
+            context.add_known_object(oid, fobj)
+        return fobj
+
+def _decode_from_bson(buf, obj, cls, obj_dict, context, paths=None):
+    '''从BSON文档恢复对象数据。不认识的字段(比如MongoDB的_id)会被跳过。
+        和unpack_from_dict一样，不解码为null的值。sync模式下map里为null的key会被删除。
+        paths同_decode_from_binary
+    '''
+    _drop_clean(obj_dict)  # 解码直接修改字段和容器，不一定设置changed标志
+    if '__lazy__' in obj_dict:
+        _load_all_lazy(obj_dict)
+    mark_change = context.mark_change
+    _fields_by_name = cls._fields_by_name
+    end = codes_bson.decode_document_begin(buf)
+
+    while True:
+        bson_type, name = codes_bson.decode_element_head(buf)
+        if bson_type == 0:
+            # end of document
+            break
+        field = _fields_by_name.get(name)
+        if not field or bson_type == BSON_NULL or _is_decode_skipped(field, paths, context):
+            codes_bson.skip_value(buf, bson_type)
+            continue
+        sub_paths = paths[field.name] if paths is not None else None
+        field_key = field.key
+        if field.array:
+            _check_bson_type(field, bson_type, (BSON_ARRAY,))
+            arr = obj_dict[field_key] = field.container_class()
+            array_end = codes_bson.decode_document_begin(buf)
+            while True:
+                elem_type, _ = codes_bson.decode_element_head(buf)
+                if elem_type == 0:
+                    break
+                if elem_type == BSON_NULL:
+                    continue
+                value = _field_value_from_bson(buf, field, elem_type, None, None,
+                                               context, sub_paths)
+                arr._append(value)  # 调用_append避免修改changed标志
+                if field.ref:
+                    context.add_unsolved_ref(('array', arr, len(arr) - 1, value))
+            codes_bson.decode_document_end(buf, array_end)
+        elif field.map or field.id_map:
+            _check_bson_type(field, bson_type, (BSON_DOCUMENT,))
             m = None
             if context.sync_mode:
                 m = obj_dict.get(field_key)
             if m is None:
                 m = field.container_class()
                 obj_dict[field_key] = m
-            asize = decode_id_map_head(buf)
-            for _ in xrange(asize):
+            kdecoder = field.dict_key_decoder
+            map_end = codes_bson.decode_document_begin(buf)
+            while True:
+                elem_type, k = codes_bson.decode_element_head(buf)
+                if elem_type == 0:
+                    break
+                key = kdecoder(k)
+                if elem_type == BSON_NULL:
+                    if context.sync_mode and key in m:
+                        del m[key]
+                    continue
                 old_value = None
-                oid = kdecoder(buf)
                 if context.sync_mode:
-                    old_value = m.get(oid)
-                value = _field_value_from_binary(
-                    buf, decoder, field, old_value=old_value,
-                    oid=oid, context=context)
-                m._setitem(oid, value)  # 调用_setitem避免修改changed标志
+                    old_value = m.get(key)
+                oid = key if field.id_map else None
+                value = _field_value_from_bson(buf, field, elem_type, old_value, oid,
+                                               context, sub_paths)
+                m._setitem(key, value)  # 调用_setitem避免修改changed标志
                 if field.ref:
-                    context.add_unsolved_ref(('map', m, oid, value))
+                    context.add_unsolved_ref(('map', m, key, value))
+            codes_bson.decode_document_end(buf, map_end)
         else:
             old_value = None
             if context.sync_mode:
                 old_value = obj_dict.get(field_key)
-            value = _field_value_from_binary(
-                buf, decoder, field, old_value=old_value,
-                oid=None, context=context)
+            value = _field_value_from_bson(buf, field, bson_type, old_value, None,
+                                           context, sub_paths)
             obj_dict[field_key] = value
             if field.ref:
                 context.add_unsolved_ref(('obj_dict', obj_dict, field_key, value))
 
         if mark_change:
-            _mark_changed_self_dict(field_index, obj_dict)
+            _mark_changed_self_dict(field.index, obj_dict)
+
+    codes_bson.decode_document_end(buf, end)
 
 class DecodeContext(object):
-    def __init__(self, mode=None, resolve_ref=None, mark_change=False):
+    def __init__(self, mode=None, resolve_ref=None, mark_change=False, lazy=False, framed=False,
+                 field_filter=None):
+        self.lazy = lazy
+        self.framed = framed
+        self.field_filter = field_filter
         self.known_objects = {}
         self.tmp_unsolved_ref = []
         self.unsolved_ref = {}
@@ -899,19 +2378,41 @@ class DecodeContext(object):
                     self.unsolved_ref[v] = True
                     continue
                 container[k] = obj
+        self.tmp_unsolved_ref = []
 
 class Array(list):
+    '''数组。清除changed标志以后记录append, set, insert, remove操作，增量打包时输出操作代替整个数组。
+        操作个数超过MAX_ARRAY_OPS，或者有sort这样不能记录的改变时，增量数据里输出整个数组。
+    '''
     def __init__(self, *arg, **kwargs):
         list.__init__(self, *arg, **kwargs)
         self._changed = False
+        self._clean = False
+        self._owner = None
+        self._ops = None
+        self._version = 0
+        self._rec_parent = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_clean'] = False
+        state['_owner'] = None
+        state['_ops'] = None
+        state['_rec_parent'] = None
+        return state
 
     def set_changed(self):
         self._changed = True
+        self._ops = None
+        self._version = _next_version()
+        _propagate_dirty(self)
+        if _recorders:
+            _record_container(self, MUTATION_SET_FIELD)
 
     def has_changed(self, recursive=False):
         if self._changed:
             return self._changed
-        if recursive:
+        if recursive and not self._clean:
             for value in self:
                 if _try_check_changed(value):
                     return True
@@ -922,78 +2423,308 @@ class Array(list):
         if recursive:
             for value in self:
                 _try_clear_changed(value)
+            self._clean = _is_elements_clean(self, enumerate(self))
+        else:
+            self._clean = _is_elements_clean(self, self._changed_items())
+        # 元素都clean以后，元素的改变都会记成set操作。ref的元素不算改变
+        self._ops = [] if self._clean or _is_ref_container(self) else None
+
+    def _changed_items(self):
+        '''清除changed标志时需要检查的(位置, 元素)。只有append和set操作的时候，
+            其他元素的位置没有变，还是clean的
+        '''
+        ops = self._ops
+        if ops is None:
+            return enumerate(self)
+        indexes = set()
+        for op, index, _ in ops:
+            if op != ARRAY_OP_APPEND and op != ARRAY_OP_SET:
+                return enumerate(self)
+            indexes.add(index)
+        return [(k, self[k]) for k in indexes if k < len(self)]
+
+    def _log_op(self, op, index, value=None, record=True):
+        self._changed = True
+        self._version = _next_version()
+        _propagate_dirty(self)
+        ops = self._ops
+        if ops is not None:
+            if len(ops) < MAX_ARRAY_OPS:
+                ops.append((op, index, value))
+            else:
+                self._ops = None
+        if record and _recorders:
+            _record_container(self, MUTATION_ARRAY_OP, op, index, value)
+
+    def _log_element(self, k, v_dict):
+        '''位置k的对象元素有了改变，记成当前位置的set操作。之前的insert和remove改变了元素的位置时，
+            重新查找元素的位置
+        '''
+        if k >= len(self) or getattr(self[k], '__dict__', None) is not v_dict:
+            for k, v in enumerate(self):
+                if getattr(v, '__dict__', None) is v_dict:
+                    break
+            else:
+                return  # 元素已经不在数组里
+        self._log_op(ARRAY_OP_SET, k, self[k], False)  # 元素自己的修改已经记录了
+
+    def _apply_op(self, op, index, value):
+        '''解码的时候应用增量数据里的数组操作，不修改changed标志'''
+        _apply_array_op(self, op, index, value)
+        self._ops = None
+        _propagate_dirty(self)
 
     def __setitem__(self, k, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.__setitem__(self, k, v)
+        list.__setitem__(self, k, v)
+        if isinstance(k, slice):
+            self.set_changed()
+        else:
+            self._log_op(ARRAY_OP_SET, k + len(self) if k < 0 else k, v)
 
     def __delitem__(self, k):
-        self._changed = True
-        self.broadcast_changed()
-        return list.__delitem__(self, k)
+        if isinstance(k, slice):
+            list.__delitem__(self, k)
+            self.set_changed()
+        else:
+            if k < 0:
+                k += len(self)
+            list.__delitem__(self, k)
+            self._log_op(ARRAY_OP_REMOVE, k)
+
+    def __setslice__(self, i, j, v):
+        list.__setslice__(self, i, j, v)
+        self.set_changed()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.set_changed()
 
     def __iadd__(self, other):
-        self._changed = True
-        self.broadcast_changed()
-        return list.__iadd__(self, other)
+        self.extend(other)
+        return self
 
     def __imul__(self, other):
         raise NotImplementedError('unsupport')
 
     def append(self, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.append(self, v)
+        list.append(self, v)
+        self._log_op(ARRAY_OP_APPEND, len(self) - 1, v)
 
     def _append(self, v):
         return list.append(self, v)
 
     def extend(self, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.extend(self, v)
+        start = len(self)
+        list.extend(self, v)
+        for k in xrange(start, len(self)):
+            self._log_op(ARRAY_OP_APPEND, k, self[k])
 
     def insert(self, k, v):
-        self._changed = True
-        self.broadcast_changed()
-        return list.insert(self, k, v)
+        size = len(self)
+        if k < 0:
+            k = max(k + size, 0)
+        elif k > size:
+            k = size
+        list.insert(self, k, v)
+        self._log_op(ARRAY_OP_INSERT, k, v)
 
     def pop(self, k=None):
-        self._changed = True
-        self.broadcast_changed()
         if k is None:
-            return list.pop(self)
-        else:
-            return list.pop(self, k)
+            k = -1
+        if k < 0:
+            k += len(self)
+        v = list.pop(self, k)
+        self._log_op(ARRAY_OP_REMOVE, k)
+        return v
 
     def remove(self, x):
-        self._changed = True
-        self.broadcast_changed()
-        return list.remove(self, x)
+        k = list.index(self, x)
+        list.__delitem__(self, k)
+        self._log_op(ARRAY_OP_REMOVE, k)
 
     def sort(self, *arg, **kwargs):
-        self._changed = True
-        self.broadcast_changed()
-        return list.sort(self, *arg, **kwargs)
+        list.sort(self, *arg, **kwargs)
+        self.set_changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self.set_changed()
 
     def broadcast_changed(self):
         for v in self:
             _try_set_changed(v)
 
+class TypedArray(array):
+    '''typed数组。元素是定长数值，存储在连续的buffer里，二进制格式编解码的时候整块复制。
+        支持buffer协议，可以用numpy.frombuffer(arr, dtype)直接访问数据，不需要复制。
+        通过numpy修改的数据不会设置changed标志，需要自己调用set_changed。
+    '''
+    _typecode = None
+
+    def __new__(cls, *arg):
+        return array.__new__(cls, cls._typecode, *arg)
+
+    def __init__(self, *arg):
+        self._changed = False
+        self._clean = False
+        self._owner = None
+        self._version = 0
+        self._rec_parent = None
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self, memo):
+        return self.__class__(self)
+
+    def _touch(self):
+        '''修改以后调用。typed数组的修改记成整个字段的赋值'''
+        self._changed = True
+        self._version = _next_version()
+        _propagate_dirty(self)
+        if _recorders:
+            _record_container(self, MUTATION_SET_FIELD)
+
+    def set_changed(self):
+        self._touch()
+
+    def has_changed(self, recursive=False):
+        return self._changed
+
+    def clear_changed(self, recursive=False):
+        self._changed = False
+        self._clean = True
+
+    def broadcast_changed(self):
+        pass
+
+    def __setitem__(self, k, v):
+        result = array.__setitem__(self, k, v)
+        self._touch()
+        return result
+
+    def __delitem__(self, k):
+        result = array.__delitem__(self, k)
+        self._touch()
+        return result
+
+    def __setslice__(self, i, j, v):
+        result = array.__setslice__(self, i, j, v)
+        self._touch()
+        return result
+
+    def __delslice__(self, i, j):
+        result = array.__delslice__(self, i, j)
+        self._touch()
+        return result
+
+    def __iadd__(self, other):
+        result = array.__iadd__(self, other)
+        self._touch()
+        return result
+
+    def __imul__(self, other):
+        raise NotImplementedError('unsupport')
+
+    def append(self, v):
+        result = array.append(self, v)
+        self._touch()
+        return result
+
+    def _append(self, v):
+        return array.append(self, v)
+
+    def extend(self, v):
+        result = array.extend(self, v)
+        self._touch()
+        return result
+
+    def insert(self, k, v):
+        result = array.insert(self, k, v)
+        self._touch()
+        return result
+
+    def pop(self, k=-1):
+        result = array.pop(self, k)
+        self._touch()
+        return result
+
+    def remove(self, x):
+        result = array.remove(self, x)
+        self._touch()
+        return result
+
+    def reverse(self):
+        result = array.reverse(self)
+        self._touch()
+        return result
+
+    def byteswap(self):
+        result = array.byteswap(self)
+        self._touch()
+        return result
+
+    def fromlist(self, v):
+        result = array.fromlist(self, v)
+        self._touch()
+        return result
+
+    def fromstring(self, s):
+        result = array.fromstring(self, s)
+        self._touch()
+        return result
+
+    def fromfile(self, f, n):
+        result = array.fromfile(self, f, n)
+        self._touch()
+        return result
+
 class Map(dict):
     def __init__(self, *arg, **kwargs):
         dict.__init__(self, *arg, **kwargs)
         self._removed = set()
         self._changed = False
+        self._dirty = set()
+        self._tracked = False
+        self._clean = False
+        self._owner = None
+        self._versions = {}
+        self._version = 0
+        self._rec_parent = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tracked'] = False
+        state['_clean'] = False
+        state['_owner'] = None
+        state['_rec_parent'] = None
+        return state
 
     def set_changed(self):
         self._changed = True
+        self._stamp(self.iterkeys())
+        _propagate_dirty(self)
+
+    def _stamp(self, keys):
+        '''记下修改了的key(包括删除了的key)的版本号'''
+        version = self._version = _next_version()
+        if _track_versions:
+            versions = self._versions
+            for k in keys:
+                versions[k] = version
+
+    def prune_versions(self, min_version):
+        '''删除不晚于min_version的key版本号(包括删除了的key)。没有版本号的key当作没有修改过，
+            所以pack_since(version)的version不小于min_version时结果不变
+        '''
+        versions = self._versions
+        for k in [k for k, ver in versions.iteritems() if ver <= min_version]:
+            del versions[k]
 
     def has_changed(self, recursive=False):
         if self._changed:
             return self._changed
-        if recursive:
+        if recursive and not self._clean:
             for value in self.itervalues():
                 if _try_check_changed(value):
                     return True
@@ -1005,46 +2736,106 @@ class Map(dict):
         if recursive:
             for value in self.itervalues():
                 _try_clear_changed(value)
+            self._clean = _is_elements_clean(self, self.iteritems())
+        elif self._tracked:
+            # 没有记下key的元素都还是clean的
+            self._clean = _is_elements_clean(self, _map_entries(self, True).iteritems())
+        else:
+            self._clean = _is_elements_clean(self, self.iteritems())
+        # 元素都clean以后，只有记下了key的元素会有改变。ref的元素不算改变
+        self._tracked = self._clean or _is_ref_container(self)
+        self._dirty.clear()
 
     def __setitem__(self, k, v):
         self._changed = True
+        self._dirty.add(k)
+        self._stamp((k,))
+        _propagate_dirty(self)
         _try_set_changed(v)
-        return dict.__setitem__(self, k, v)
+        dict.__setitem__(self, k, v)
+        self._removed.discard(k)
+        if _recorders:
+            _record_container(self, MUTATION_MAP_SET, k, v)
 
     def __delitem__(self, k):
         self._changed = True
+        self._stamp((k,))
+        _propagate_dirty(self)
         self._removed.add(k)
-        return dict.__delitem__(self, k)
+        dict.__delitem__(self, k)
+        if _recorders:
+            _record_container(self, MUTATION_MAP_DEL, k)
 
     def _setitem(self, k, v):
+        self._tracked = False
+        _propagate_dirty(self)
         return dict.__setitem__(self, k, v)
 
+    def _delitem(self, k):
+        _propagate_dirty(self)
+        return dict.__delitem__(self, k)
+
     def clear(self):
         self._changed = True
+        # 清空以后记下的key都是删除了的，重新记录成这次修改的版本号，可以一次prune_versions掉
+        keys = set(self._versions)
+        keys.update(self.iterkeys())
+        self._versions = {}
+        self._stamp(keys)
+        _propagate_dirty(self)
         self._removed.update(self.iterkeys())
-        return dict.clear(self)
+        dict.clear(self)
+        if _recorders:
+            _record_container(self, MUTATION_SET_FIELD)
 
     def pop(self, key, *args, **kwargs):
         self._changed = True
+        self._stamp((key,))
+        _propagate_dirty(self)
         self._removed.add(key)
+        if _recorders and key in self:
+            value = dict.pop(self, key)
+            _record_container(self, MUTATION_MAP_DEL, key)
+            return value
         return dict.pop(self, key, *args, **kwargs)
 
     def popitem(self):
         self._changed = True
+        _propagate_dirty(self)
         key, value = dict.popitem(self)
         self._removed.add(key)
+        self._stamp((key,))
+        if _recorders:
+            _record_container(self, MUTATION_MAP_DEL, key)
         return (key, value)
 
     def setdefault(self, key, default=None):
         self._changed = True
+        self._dirty.add(key)
+        self._stamp((key,))
+        _propagate_dirty(self)
         if default is None:
             default = self.value_field.value_type()
+        if _recorders and key not in self:
+            dict.__setitem__(self, key, default)
+            _record_container(self, MUTATION_MAP_SET, key, default)
+            return default
         return dict.setdefault(self, key, default)
 
     def update(self, *arg, **kwargs):
+        # 只记下更新了的key，不需要遍历其它元素
+        items = dict(*arg, **kwargs)
         self._changed = True
-        self.broadcast_changed()
-        return dict.update(self, *arg, **kwargs)
+        self._dirty.update(items)
+        self._removed.difference_update(items)
+        self._stamp(items)
+        _propagate_dirty(self)
+        for v in items.itervalues():
+            _try_set_changed(v)
+        dict.update(self, items)
+        if _recorders:
+            for k, v in items.iteritems():
+                _record_container(self, MUTATION_MAP_SET, k, v)
 
     def broadcast_changed(self):
         for v in self.itervalues():
@@ -1077,11 +2868,13 @@ class Field(object):
             raise DefineError('unsupported type')
 
         self.index = index
-        if index <= 0 or index > 2 ** 16:
+        if index <= 0 or index >= FRAMED_MARK:
             raise DefineError('invalid index')
 
         self.define_in_class = None
         self.array = array
+        if key == 'bytes':
+            raise DefineError('bytes can not be used as map key')
         self.key_type_name = key
         self.map = map
         self.id_map = id_map
@@ -1091,6 +2884,7 @@ class Field(object):
         self.is_unsigned = True if self.type_name in _unsigned_types else False
         self.ref = False
         self.skip_changed = False
+        self.typed = False
         self.create = None
         self.conf_name = None
         self.__dict__.update(kwargs)
@@ -1115,10 +2909,49 @@ class Field(object):
             self.bin_ref_encoder = self.value_type._fields_by_name['oid'].bin_encoder
             self.bin_ref_decoder = self.value_type._fields_by_name['oid'].bin_decoder
 
+        self.bin2_encoder = _get_encoder(codes_bin2, self.type_name)
+        self.bin2_decoder = _get_decoder(codes_bin2, self.type_name)
+        self.bin2_wire_type = codes_bin2.WIRE_TYPES.get(self.type_name, WT_OBJECT)
+        self.bin2_key_encoder = None
+        self.bin2_key_decoder = None
+        self.bin2_key_wire_type = None
+        if self.ref:
+            oid_field = self.value_type._fields_by_name['oid']
+            self.bin2_ref_encoder = oid_field.bin2_encoder
+            self.bin2_ref_decoder = oid_field.bin2_decoder
+            self.bin2_wire_type = oid_field.bin2_wire_type
+
+        self.bson_encoder = _get_encoder(codes_bson, self.type_name)
+        self.bson_decoder = _get_decoder(codes_bson, self.type_name)
+        self.bson_type = codes_bson.ELEMENT_TYPES.get(self.type_name, BSON_DOCUMENT)
+        self.bson_accepted_types = codes_bson.ACCEPTED_TYPES.get(self.type_name, (BSON_DOCUMENT,))
+        if self.ref:
+            oid_field = self.value_type._fields_by_name['oid']
+            self.bson_ref_encoder = oid_field.bson_encoder
+            self.bson_ref_decoder = oid_field.bson_decoder
+            self.bson_type = oid_field.bson_type
+            self.bson_accepted_types = oid_field.bson_accepted_types
+
         if [self, array, self.map, self.id_map].count(True) > 1:
             raise DefineError('conflicted properties: array, map, id_map')
 
+        # 字段tag里的wire_type
         if self.array:
+            self.bin2_field_wire_type = WT_ARRAY
+        elif self.map:
+            self.bin2_field_wire_type = WT_MAP
+        elif self.id_map:
+            self.bin2_field_wire_type = WT_ID_MAP
+        else:
+            self.bin2_field_wire_type = self.bin2_wire_type
+
+        if self.typed:
+            typecode = codes_bin.TYPED_ARRAY_CODES.get(self.type_name)
+            if not self.array or typecode is None:
+                raise DefineError('unsupported typed array: {}'.format(self.type_name))
+            self.container_class = type('TypedArray_'+self.type_name,
+                                        (TypedArray,), {'value_field': self, '_typecode': typecode})
+        elif self.array:
             self.container_class = type('Array_'+self.type_name,
                                         (Array,), {'value_field': self})
         elif self.map or self.id_map:
@@ -1142,12 +2975,66 @@ class Field(object):
             self.bin_key_decoder = _get_decoder(codes_bin, self.key_type_name)
             assert self.bin_key_decoder
 
+            self.bin2_key_encoder = _get_encoder(codes_bin2, self.key_type_name)
+            self.bin2_key_decoder = _get_decoder(codes_bin2, self.key_type_name)
+            self.bin2_key_wire_type = codes_bin2.WIRE_TYPES[self.key_type_name]
+
     def is_container(self):
         return self.container_class is not None
 
     def __str__(self):
         return '<%s name=%s, index=%d>' % (self.__class__.__name__, self.name, self.index)
 
+class ScalarRun(object):
+    '''一段按index顺序连续排列的定长标量字段。
+        打包的时候用一个预编译的struct一次写入所有字段的(index, value)。解包的时候一次读出。
+        省去逐个字段调用编解码函数和解析格式串的开销。
+    '''
+    def __init__(self, fields):
+        self.fields = fields
+        self.keys = [field.key for field in fields]
+        self.indexes = tuple(field.index for field in fields)
+        self.tail_indexes = self.indexes[1:]
+        formats = [SCALAR_STRUCT_FORMATS[field.type_name] for field in fields]
+        self.struct = Struct('!' + ''.join('H' + f for f in formats))
+        self.size = self.struct.size
+        # 解包时第一个字段的index已经被读出，所以解包格式不包含它
+        self.tail_struct = Struct('!' + formats[0] + ''.join('H' + f for f in formats[1:]))
+        self.tail_size = self.tail_struct.size
+        self.args_template = []
+        for index in self.indexes:
+            self.args_template += [index, None]
+
+def _is_scalar_run_field(field):
+    if field.is_container() or field.is_data_model_type:
+        return False
+    return field.type_name in SCALAR_STRUCT_FORMATS
+
+class BinaryCodec(object):
+    '''DataModel类的二进制编解码器。由MetaDataModel在创建类的时候生成。
+        items       -> 按index顺序排列的ScalarRun或者Field
+        runs_by_index -> ScalarRun第一个字段的index => ScalarRun
+    '''
+    def __init__(self, fields):
+        self.items = []
+        self.runs_by_index = {}
+        run_fields = []
+        for field in fields:
+            if _is_scalar_run_field(field):
+                run_fields.append(field)
+                continue
+            self._add_run(run_fields)
+            run_fields = []
+            self.items.append(field)
+        self._add_run(run_fields)
+
+    def _add_run(self, fields):
+        if not fields:
+            return
+        run = ScalarRun(fields)
+        self.items.append(run)
+        self.runs_by_index[run.indexes[0]] = run
+
 def _copy_any_base_fields(bases, _fields, _fields_by_index, _fields_by_name, _fields_by_key):
     for base in bases:
         if getattr(base, '_fields_by_index', None) is not None:
@@ -1231,7 +3118,10 @@ def _signed_sub_func(self, name, key, value):
 def _make_get_func(key, default_type=None, default_value=None):
     if default_type is not None:
         def get_func(self):
-            return self.__dict__.setdefault(key, default_type())
+            obj_dict = self.__dict__
+            if key not in obj_dict and '__lazy__' in obj_dict:
+                _load_lazy_field(obj_dict, key)
+            return obj_dict.setdefault(key, default_type())
         return get_func
     else:
         def get_func(self):
@@ -1275,6 +3165,8 @@ class MetaDataModel(type):
             key = '_' + name
             field.name = name
             field.key = key
+            if name == 'oid' and field.type_name == 'bytes':
+                raise DefineError('bytes can not be used as oid')
 
             if field.is_container():
                 attrs[name] = property(
@@ -1283,6 +3175,11 @@ class MetaDataModel(type):
                     partial(_fdel_container, key))
                 get_func_name = _make_autogen_func_name(attrs, 'get', name)
                 attrs[get_func_name] = _make_get_func(key, default_type=field.container_class)
+            elif _is_lazy_field(field):
+                attrs[name] = property(
+                    partial(_fget_lazy, key, field.default),
+                    partial(_fset_lazy, key, field.index),
+                    partial(_fdel, key))
             else:
                 attrs[name] = property(
                     partial(_fget, key, field.default),
@@ -1330,6 +3227,11 @@ class MetaDataModel(type):
         newcls._fields_by_name = fields_define._fields_by_name
         newcls._fields_by_key = fields_define._fields_by_key
         newcls._fields_is_container = fields_define._fields_is_container
+        newcls._bin_codec = BinaryCodec(newcls._fields)
+        newcls._has_ref = any(field.ref or (field.is_data_model_type and field.value_type._has_ref)
+                              for field in newcls._fields)
+        newcls._clone_fields = [field for field in newcls._fields
+                                if field.container_class is not None or field.is_data_model_type]
 
         return newcls
 
@@ -1341,10 +3243,13 @@ class DataModel(object):
 
     def set_data(self, **kwargs):
         obj_dict = self.__dict__
+        _drop_clean(obj_dict)
         _fields_by_name = self._fields_by_name
         for name, value in kwargs.iteritems():
             field = _fields_by_name.get(name)
             if field:
+                if field.typed and not isinstance(value, field.container_class):
+                    value = field.container_class(value)
                 obj_dict[field.key] = value
             else:
                 if CONFIG_CHECK_INIT_ARGS:
@@ -1378,6 +3283,7 @@ class DataModel(object):
         return _is_default_value(self, field_name)
 
     def clear_data(self):
+        self.__dict__.pop('__lazy__', None)
         for field in self._fields:
             if hasattr(self, field.key):
                 delattr(self, field.key)
@@ -1392,37 +3298,204 @@ class DataModel(object):
                         field_filter=field_filter)
         return dict_data
 
-    def unpack_from_dict(self, dict_data, mode=None, resolve_ref=None, mark_change=False):
-        context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change)
-        _decode_from_dict(self, type(self), self.__dict__, dict_data, context)
+    def unpack_from_dict(self, dict_data, mode=None, resolve_ref=None, mark_change=False,
+                         fields=None, field_filter=None):
+        '''
+        @memo:
+            fields       只解码这些字段。可以用'a.b'指定子对象(或者容器里的对象)的字段，
+                         其他字段的数据会被跳过
+            field_filter 同pack_to_dict，返回False的字段不解码
+        '''
+        context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                field_filter=field_filter)
+        paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_from_dict(self, type(self), self.__dict__, dict_data, context, paths)
         context.resolve_ref()
         return context.unsolved_ref
 
     def get_changed_dict(self, recursive=False):
         return self.pack_to_dict(recursive, only_changed=True)
 
+    def pack_since(self, version, fmt='dict', field_filter=None):
+        '''打包version之后修改了的数据，返回(增量数据, 当前版本号)。不修改changed标志。
+            增量数据的格式同pack_to_dict(only_changed=True)，可以用unpack_from_dict(mode='sync')应用。
+            修改过的字段完整打包，没有修改的子对象和容器递归检查，开销和整个对象树的大小有关。
+            只支持dict格式。没有指定mark_change的解码不记录版本号。
+            version早于开始记录版本号的时候(参见current_version)不知道改了什么，打包全部数据
+        '''
+        if fmt != 'dict':
+            raise PackError('unsupported format: {}'.format(fmt))
+        if not _track_versions or version < _track_since:
+            _start_track_versions()
+            return self.pack_to_dict(field_filter=field_filter), _version
+        dict_data = {}
+        _encode_since_to_dict(dict_data, type(self), self, version, field_filter)
+        return dict_data, _version
+
+    def prune_versions(self, min_version):
+        '''删除对象树里map为删除了的key记下的版本号，避免反复增删key的时候占用的内存一直增长。
+            所有消费者都用pack_since同步到min_version以后调用，之后pack_since的version不能小于min_version
+        '''
+        _prune_versions(self, min_version)
+
+    def clone(self, deep=True, with_changed=False):
+        '''复制对象，比打包再解码快得多。deep为False时新对象和原对象共享子对象和容器里的对象，
+            容器总是复制。with_changed为True时保留changed标志和版本号，否则新对象没有改变。
+            ref字段(包括ref容器的元素)指向被复制了的对象时，改成指向复制出来的对象
+        '''
+        return _clone(self, deep, with_changed)
+
+    def calc_packed_size(self, recursive=True, only_changed=False, field_filter=None,
+                         framed=False):
+        '''计算pack_to_binary输出的字节数'''
+        return _calc_binary_size(type(self), self,
+                                 recursive=recursive,
+                                 only_changed=only_changed,
+                                 field_filter=field_filter,
+                                 framed=framed) + (FIELD_INDEX_SIZE if framed else 0)
+
     def pack_to_binary(self, recursive=True, only_changed=False,
-                       clear_changed=False, field_filter=None):
-        buf = WriteBuffer()
-        _encode_to_binary(buf, type(self), self,
-                          recursive=recursive,
-                          only_changed=only_changed,
-                          clear_changed=clear_changed,
-                          field_filter=field_filter)
-        return buf.tostring()
+                       clear_changed=False, field_filter=None, out=None, framed=False):
+        '''
+        @memo:
+            out    如果指定了out(bytearray或者可写的memoryview)，数据从out的开头写入，
+                   返回写入的字节数。out的大小可以用calc_packed_size预先算出。
+            framed 使用分帧格式。每个字段带有数据长度，解码时可以直接跳过不认识的字段。
+                   数据以FRAMED_MARK开头，解码时也需要指定framed，不一致的时候抛出UnpackError。
+        '''
+        if out is not None:
+            if clear_changed:
+                # 写到一半空间不够的话，已经清除的changed标志无法恢复，所以先检查大小
+                size = self.calc_packed_size(recursive, only_changed, field_filter, framed)
+                if len(out) < size:
+                    raise PackError('output buffer too small: {} < {}'.format(len(out), size))
+            buf = WriteBuffer(out=out)
+            try:
+                _encode_framed_mark(buf, framed)
+                _encode_to_binary(buf, type(self), self,
+                                  recursive=recursive,
+                                  only_changed=only_changed,
+                                  clear_changed=clear_changed,
+                                  field_filter=field_filter,
+                                  framed=framed)
+            except MemoryError:
+                raise PackError('output buffer too small: {}'.format(len(out)))
+            return buf.offset
+
+        buf = acquire_write_buffer()
+        try:
+            _encode_framed_mark(buf, framed)
+            _encode_to_binary(buf, type(self), self,
+                              recursive=recursive,
+                              only_changed=only_changed,
+                              clear_changed=clear_changed,
+                              field_filter=field_filter,
+                              framed=framed)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def unpack_from_binary(self, data, mode=None, resolve_ref=None, mark_change=False,
+                           lazy=False, framed=False, fields=None, field_filter=None,
+                           copy_bytes=False):
+        '''
+        @memo:
+            lazy   延迟解码。子对象和容器字段在第一次访问的时候才从data解码，解码前data
+                   不能被修改。不支持sync模式。有引用字段的时候需要指定resolve_ref。
+            framed data是分帧格式。不认识的字段会被跳过。
+            fields, field_filter 同unpack_from_dict。跳过的字段不分配对象
+            copy_bytes bytes字段解码成str。默认解码成引用data的memoryview，不复制数据，
+                   这时data在对象使用期间不能被修改
+        '''
+        buf = ReadBuffer(data, copy_bytes)
+        context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                lazy=lazy, framed=framed, field_filter=field_filter)
+        paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_framed_mark(buf, framed)
+        if lazy:
+            if context.sync_mode:
+                raise UnpackError('lazy unpack does not support sync mode')
+            if self._has_ref and resolve_ref is None:
+                raise UnpackError('lazy unpack of ref fields needs resolve_ref')
+            _decode_from_binary_lazy(buf, type(self), self.__dict__, context, paths)
+        else:
+            _decode_from_binary(buf, self, type(self), self.__dict__, context, paths)
+        context.resolve_ref()
+        return context.unsolved_ref
 
-    def unpack_from_binary(self, data, mode=None, resolve_ref=None, mark_change=False):
-        buf = ReadBuffer(data)
-        context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change)
+    def apply_patch(self, data, resolve_ref=None, mark_change=False, framed=False,
+                    copy_bytes=False):
+        '''把pack_to_binary(only_changed=True)打包的增量数据直接应用到对象上。
+            子对象和map里已有的对象原地修改，不创建新对象；数组整个替换，或者原地应用增量数据里的
+            数组操作；增量数据里删除了的map key也会被删除。参数同unpack_from_binary
+        '''
+        buf = ReadBuffer(data, copy_bytes)
+        context = DecodeContext(mode='sync', resolve_ref=resolve_ref, mark_change=mark_change,
+                                framed=framed)
+        _decode_framed_mark(buf, framed)
         _decode_from_binary(buf, self, type(self), self.__dict__, context)
         context.resolve_ref()
         return context.unsolved_ref
 
+    def pack_to_binary2(self, recursive=True, only_changed=False,
+                        clear_changed=False, field_filter=None):
+        '''打包成紧凑的bin2格式。参见codes_bin2'''
+        buf = acquire_write_buffer()
+        try:
+            _encode_to_binary2(buf, type(self), self,
+                               recursive=recursive,
+                               only_changed=only_changed,
+                               clear_changed=clear_changed,
+                               field_filter=field_filter)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def unpack_from_binary2(self, data, mode=None, resolve_ref=None, mark_change=False,
+                            fields=None, field_filter=None, copy_bytes=False):
+        '''fields, field_filter同unpack_from_dict。copy_bytes同unpack_from_binary'''
+        buf = ReadBuffer(data, copy_bytes)
+        context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                field_filter=field_filter)
+        paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_from_binary2(buf, self, type(self), self.__dict__, context, paths)
+        context.resolve_ref()
+        return context.unsolved_ref
+
+    def pack_to_bson(self, recursive=True, only_changed=False,
+                     clear_changed=False, field_filter=None):
+        '''打包成BSON文档。参见codes_bson'''
+        buf = acquire_write_buffer()
+        try:
+            _encode_to_bson(buf, type(self), self,
+                            recursive=recursive,
+                            only_changed=only_changed,
+                            clear_changed=clear_changed,
+                            field_filter=field_filter)
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def unpack_from_bson(self, data, mode=None, resolve_ref=None, mark_change=False,
+                         fields=None, field_filter=None, copy_bytes=False):
+        '''fields, field_filter同unpack_from_dict。copy_bytes同unpack_from_binary'''
+        buf = ReadBuffer(data, copy_bytes)
+        context = DecodeContext(mode=mode, resolve_ref=resolve_ref, mark_change=mark_change,
+                                field_filter=field_filter)
+        paths = _make_field_paths(type(self), fields) if fields is not None else None
+        _decode_from_bson(buf, self, type(self), self.__dict__, context, paths)
+        context.resolve_ref()
+        return context.unsolved_ref
+
     def pack(self, fmt, *args, **kwargs):
         if fmt == 'dict':
             return self.pack_to_dict(*args, **kwargs)
         elif fmt == 'bin':
             return self.pack_to_binary(*args, **kwargs)
+        elif fmt == 'bin2':
+            return self.pack_to_binary2(*args, **kwargs)
+        elif fmt == 'bson':
+            return self.pack_to_bson(*args, **kwargs)
         else:
             raise PackError('unsupported format: {}'.format(fmt))
 
@@ -1431,9 +3504,23 @@ class DataModel(object):
             return self.unpack_from_dict(*args, **kwargs)
         elif fmt == 'bin':
             return self.unpack_from_binary(*args, **kwargs)
+        elif fmt == 'bin2':
+            return self.unpack_from_binary2(*args, **kwargs)
+        elif fmt == 'bson':
+            return self.unpack_from_bson(*args, **kwargs)
         else:
             raise PackError('unsupported format: {}'.format(fmt))
 
+    def __getstate__(self):
+        # 所属对象和clean标志只对原来的对象有效，复制和pickle的时候去掉
+        state = self.__dict__.copy()
+        state.pop('__owner__', None)
+        state.pop('__owner_key__', None)
+        state.pop('__clean__', None)
+        state.pop('__rec_parent__', None)
+        state.pop('__recorder__', None)
+        return state
+
     def __str__(self):
         return self._long_repr_()
 
@@ -1463,6 +3550,11 @@ class DataModel(object):
     def _long_repr_(self):
         return self._get_info_(4)
 
+class SlotDataModel(DataModel):
+    '''c_data_model的SlotDataModel把基本类型的字段存放在C数组里。
+        纯python实现没有slot存储，字段仍然存放在__dict__里，用法和DataModel一样
+    '''
+
 def ArrayField(*arg, **kwarg):
     kwarg['array'] = True
     return Field(*arg, **kwarg)
@@ -1474,3 +3566,695 @@ def MapField(*arg, **kwarg):
 def IdMapField(*arg, **kwarg):
     kwarg['id_map'] = True
     return Field(*arg, **kwarg)
+
+def pack_many(objs, fmt='bin', recursive=True, only_changed=False,
+              clear_changed=False, field_filter=None, framed=False):
+    '''把objs依次打包到同一个buffer。
+    返回(data, offsets)。offsets是array('L')，第i个对象的数据是data[offsets[i]:offsets[i + 1]]。
+        fmt     -> 'bin', 'bin2'或者'bson'。'bson'格式的数据是依次排列的BSON文档
+        framed  -> 同pack_to_binary，只用于'bin'格式
+    '''
+    if fmt not in ('bin', 'bin2', 'bson'):
+        raise PackError('unsupported format: {}'.format(fmt))
+    offsets = array('L')
+    buf = acquire_write_buffer()
+    try:
+        for obj in objs:
+            offsets.append(buf.offset)
+            if fmt == 'bin':
+                _encode_framed_mark(buf, framed)
+                _encode_to_binary(buf, type(obj), obj,
+                                  recursive=recursive,
+                                  only_changed=only_changed,
+                                  clear_changed=clear_changed,
+                                  field_filter=field_filter,
+                                  framed=framed)
+            elif fmt == 'bin2':
+                _encode_to_binary2(buf, type(obj), obj,
+                                   recursive=recursive,
+                                   only_changed=only_changed,
+                                   clear_changed=clear_changed,
+                                   field_filter=field_filter)
+            else:
+                _encode_to_bson(buf, type(obj), obj,
+                                recursive=recursive,
+                                only_changed=only_changed,
+                                clear_changed=clear_changed,
+                                field_filter=field_filter)
+        offsets.append(buf.offset)
+        return buf.tostring(), offsets
+    finally:
+        release_write_buffer(buf)
+
+def unpack_many(cls, data, offsets=None, fmt='bin', resolve_ref=None, mark_change=False,
+                framed=False, copy_bytes=False):
+    '''从pack_many打包的数据解码出cls对象的列表。
+        offsets -> pack_many返回的offsets。为None时从头到尾依次解码
+        copy_bytes -> 同DataModel.unpack_from_binary
+    所有对象共用一个DecodeContext。有oid的对象也会被当作已知对象，对象之间的引用在最后统一解析。
+    '''
+    if fmt not in ('bin', 'bin2', 'bson'):
+        raise PackError('unsupported format: {}'.format(fmt))
+    buf = ReadBuffer(data, copy_bytes)
+    context = DecodeContext(resolve_ref=resolve_ref, mark_change=mark_change, framed=framed)
+    objs = []
+    i = 0
+    while True:
+        if offsets is not None:
+            if i >= len(offsets) - 1:
+                break
+            buf.offset = offsets[i]
+        elif buf.is_end():
+            break
+        obj = cls()
+        obj_dict = obj.__dict__
+        if fmt == 'bin':
+            _decode_framed_mark(buf, framed)
+            _decode_from_binary(buf, obj, cls, obj_dict, context)
+        elif fmt == 'bin2':
+            _decode_from_binary2(buf, obj, cls, obj_dict, context)
+        else:
+            _decode_from_bson(buf, obj, cls, obj_dict, context)
+        if offsets is not None and buf.offset != offsets[i + 1]:
+            raise UnpackError('record size mismatch, index={}'.format(i))
+        oid = obj_dict.get('_oid')
+        if oid is not None:
+            context.add_known_object(oid, obj)
+        objs.append(obj)
+        i += 1
+    context.resolve_ref()
+    return objs
+
+# 列数据的numpy dtype。string和bytes是变长的，用object
+# pylint: disable=bad-whitespace
+_COLUMN_DTYPES = {
+    'int8'   : 'int8',
+    'uint8'  : 'uint8',
+    'int16'  : 'int16',
+    'uint16' : 'uint16',
+    'int32'  : 'int32',
+    'uint32' : 'uint32',
+    'int64'  : 'int64',
+    'uint64' : 'uint64',
+    'float'  : 'float32',
+    'double' : 'float64',
+    'bool'   : 'bool',
+    'string' : 'object',
+    'bytes'  : 'object',
+}
+# pylint: enable=bad-whitespace
+
+def _column_fields(cls, names):
+    '''返回names对应的字段。只支持基本类型的非集合字段，names为None时返回全部这样的字段'''
+    if names is None:
+        return [field for field in cls._fields
+                if not field.is_container() and not field.is_data_model_type]
+    fields = []
+    for name in names:
+        field = cls._fields_by_name.get(name)
+        if field is None:
+            raise NoFieldError('no such field: %s' % name)
+        if field.is_container() or field.is_data_model_type:
+            raise PackError('unsupported column field: {}'.format(name))
+        fields.append(field)
+    return fields
+
+def to_columns(container, fields=None, structured=False):
+    '''把Array或者IdMap里的对象按字段导出成列数据，返回{字段名: 列}。
+        fields      -> 导出的字段名列表。默认导出全部基本类型的非集合字段
+        structured  -> 返回一个numpy结构化数组，而不是dict
+    安装了numpy时每一列是dtype和字段类型对应的numpy数组。否则数值列是array.array，其他列是list。
+    '''
+    if isinstance(container, dict):
+        objs = container.values()
+    else:
+        objs = list(container)
+    value_field = getattr(container, 'value_field', None)
+    if value_field is not None:
+        cls = value_field.value_type
+    elif objs:
+        cls = type(objs[0])
+    else:
+        raise PackError('unknown object class of empty container')
+    if structured and numpy is None:
+        raise PackError('structured columns require numpy')
+
+    fields = _column_fields(cls, fields)
+    columns = {}
+    for field in fields:
+        name = field.name
+        values = [getattr(obj, name) for obj in objs]
+        if numpy is not None:
+            columns[name] = numpy.array(values, dtype=_COLUMN_DTYPES[field.type_name])
+        else:
+            typecode = codes_bin.TYPED_ARRAY_CODES.get(field.type_name)
+            columns[name] = array(typecode, values) if typecode else values
+    if not structured:
+        return columns
+
+    result = numpy.empty(len(objs), dtype=[(field.name, columns[field.name].dtype)
+                                           for field in fields])
+    for field in fields:
+        result[field.name] = columns[field.name]
+    return result
+
+def from_columns(cls, columns):
+    '''to_columns的逆操作。从{字段名: 列}或者numpy结构化数组批量构造cls对象，返回对象列表。
+        构造出的对象不带changed标志。
+    '''
+    names = getattr(getattr(columns, 'dtype', None), 'names', None)
+    if names is not None:
+        columns = dict((name, columns[name]) for name in names)
+    keys = []
+    values = []
+    count = None
+    for field in _column_fields(cls, list(columns)):
+        column = columns[field.name]
+        column = column.tolist() if hasattr(column, 'tolist') else list(column)
+        if count is None:
+            count = len(column)
+        elif len(column) != count:
+            raise UnpackError('column size mismatch: {}'.format(field.name))
+        keys.append(field.key)
+        values.append(column)
+    objs = []
+    for row in izip(*values):
+        obj = cls()
+        obj.__dict__.update(izip(keys, row))
+        objs.append(obj)
+    return objs
+
+def _is_object_value(field):
+    '''字段的值(或者容器的元素)是否是嵌入的子对象'''
+    return field.is_data_model_type and not field.ref
+
+def _copy_delta(value):
+    '''复制解析出来的增量数据。合并时会原地修改dict和_MapDelta，不能引用输入的数据'''
+    if isinstance(value, dict):
+        return dict((k, _copy_delta(v)) for k, v in value.iteritems())
+    if isinstance(value, _MapDelta):
+        m = _MapDelta()
+        m.removed.update(value.removed)
+        for k, v in value.entries.iteritems():
+            m.entries[k] = _copy_delta(v)
+        return m
+    if isinstance(value, _ArrayDelta):
+        return _ArrayDelta(value.items, value.ops)
+    return value
+
+def _merge_dict_array_delta(old, new):
+    '''合并dict格式的数组数据。new是完整的数组时整个替换，是操作列表时应用到old，
+        old也是操作列表的时候把操作连起来
+    '''
+    if not isinstance(new, dict):
+        return new
+    if isinstance(old, dict):
+        return {'ops': old.get('ops', []) + new.get('ops', [])}
+    items = list(old)
+    for dop in new.get('ops', ()):
+        op = _array_op_codes.get(dop[0])
+        if op is None:
+            raise UnpackError('unknown array op: {}'.format(dop[0]))
+        _apply_array_op(items, op, dop[1], None if op == ARRAY_OP_REMOVE else dop[2])
+    return items
+
+def _merge_dict_delta(cls, old, new):
+    '''把dict格式的增量数据new合并到old。后面的值覆盖前面的值，子对象逐字段合并'''
+    _fields_by_name = cls._fields_by_name
+    for name, value in new.iteritems():
+        old_value = old.get(name)
+        field = _fields_by_name.get(name)
+        if field is None or old_value is None or value is None:
+            old[name] = _copy_delta(value)
+        elif field.array:
+            old[name] = _merge_dict_array_delta(old_value, value)
+        elif field.map or field.id_map:
+            for k, v in value.iteritems():
+                ov = old_value.get(k)
+                # None是删除标记。删除后又设置的key只能保留设置的值
+                if _is_object_value(field) and ov is not None and v is not None:
+                    _merge_dict_delta(field.value_type, ov, v)
+                else:
+                    old_value[k] = _copy_delta(v)
+        elif _is_object_value(field):
+            _merge_dict_delta(field.value_type, old_value, value)
+        else:
+            old[name] = value
+
+class _MapDelta(object):
+    '''从binary格式解析出来的map增量数据。key和基本类型的值都是原始数据。
+        removed -> 删除了的key。先删除再设置的key同时在removed和entries里
+        entries -> 设置了的key和值
+    '''
+    def __init__(self):
+        self.removed = OrderedDict()
+        self.entries = OrderedDict()
+
+class _ArrayDelta(object):
+    '''从binary格式解析出来的数组增量数据(typed数组除外)。元素都是原始数据
+        items -> 完整的数组。是操作列表时为None
+        ops   -> [(操作码, 位置, 元素)]。remove操作的元素是None
+    '''
+    def __init__(self, items=None, ops=None):
+        self.items = list(items) if items is not None else None
+        self.ops = list(ops) if ops is not None else None
+
+def _merge_array_delta(old, new):
+    '''合并_ArrayDelta。规则同_merge_dict_array_delta'''
+    if new.items is not None:
+        return _copy_delta(new)
+    if old.items is None:
+        return _ArrayDelta(ops=old.ops + new.ops)
+    items = list(old.items)
+    for op, index, v in new.ops:
+        _apply_array_op(items, op, index, v)
+    return _ArrayDelta(items=items)
+
+def _merge_binary_delta(cls, old, new):
+    '''把解析出来的binary格式增量数据new合并到old。规则同_merge_dict_delta'''
+    _fields_by_index = cls._fields_by_index
+    for index, value in new.iteritems():
+        old_value = old.get(index)
+        field = _fields_by_index[index]
+        if old_value is None:
+            old[index] = _copy_delta(value)
+        elif field.map or field.id_map:
+            for k in value.removed:
+                old_value.entries.pop(k, None)
+                old_value.removed[k] = True
+            for k, v in value.entries.iteritems():
+                ov = old_value.entries.get(k)
+                if _is_object_value(field) and ov is not None and k not in value.removed:
+                    _merge_binary_delta(field.value_type, ov, v)
+                else:
+                    old_value.entries[k] = _copy_delta(v)
+        elif isinstance(value, _ArrayDelta):
+            old[index] = _merge_array_delta(old_value, value)
+        elif _is_object_value(field) and not field.array:
+            _merge_binary_delta(field.value_type, old_value, value)
+        else:
+            old[index] = value
+
+def _read_raw(buf, skip, *args):
+    '''跳过一段数据，返回这段数据的复制'''
+    start = buf.offset
+    skip(buf, *args)
+    return buf.b[start:buf.offset].tobytes()
+
+def _read_binary_delta(buf, cls):
+    '''把binary格式的增量数据解析成{字段index: 值}，不创建对象。
+        子对象解析成嵌套的dict，map解析成_MapDelta，其他字段保留原始数据
+    '''
+    delta = {}
+    _fields_by_index = cls._fields_by_index
+    while not buf.is_end():
+        field_index = decode_field_index(buf)
+        if field_index == 0:
+            break
+        field = _fields_by_index.get(field_index)
+        if field is None:
+            raise UnpackError('unknown field, index={}'.format(field_index))
+        if field.map or field.id_map:
+            m = delta[field_index] = _MapDelta()
+            for _ in xrange(decode_tombstones_head(buf)):
+                m.removed[_read_raw(buf, _skip_binary_scalar, field.key_type_name)] = True
+            asize = decode_map_head(buf) if field.map else decode_id_map_head(buf)
+            for _ in xrange(asize):
+                key = _read_raw(buf, _skip_binary_scalar, field.key_type_name)
+                if _is_object_value(field):
+                    m.entries[key] = _read_binary_delta(buf, field.value_type)
+                else:
+                    m.entries[key] = _read_raw(buf, _skip_binary_value, field)
+        elif field.array and not field.typed:
+            delta[field_index] = _read_array_delta(buf, field)
+        elif _is_object_value(field):
+            delta[field_index] = _read_binary_delta(buf, field.value_type)
+        else:
+            delta[field_index] = _read_raw(buf, _skip_binary_field, field)
+    return delta
+
+def _read_array_delta(buf, field):
+    op_count = decode_array_ops_head(buf)
+    if op_count is None:
+        return _ArrayDelta(items=[_read_raw(buf, _skip_binary_value, field)
+                                  for _ in xrange(decode_array_head(buf))])
+    ops = []
+    for _ in xrange(op_count):
+        op, index = decode_array_op(buf)
+        v = None if op == ARRAY_OP_REMOVE else _read_raw(buf, _skip_binary_value, field)
+        ops.append((op, index, v))
+    return _ArrayDelta(ops=ops)
+
+def _write_raw(buf, data):
+    b, offset = buf.pull(len(data))
+    b[offset:offset + len(data)] = data
+
+def _write_binary_delta(buf, cls, delta):
+    for field in cls._fields:
+        value = delta.get(field.index)
+        if value is None:
+            continue
+        encode_field_index(buf, field.index)
+        if field.map or field.id_map:
+            if value.removed:
+                encode_tombstones_head(buf, len(value.removed))
+                for k in value.removed:
+                    _write_raw(buf, k)
+            if field.map:
+                encode_map_head(buf, len(value.entries))
+            else:
+                encode_id_map_head(buf, len(value.entries))
+            for k, v in value.entries.iteritems():
+                _write_raw(buf, k)
+                if _is_object_value(field):
+                    _write_binary_delta(buf, field.value_type, v)
+                else:
+                    _write_raw(buf, v)
+        elif isinstance(value, _ArrayDelta):
+            if value.items is not None:
+                encode_array_head(buf, len(value.items))
+                for v in value.items:
+                    _write_raw(buf, v)
+            else:
+                encode_array_ops_head(buf, len(value.ops))
+                for op, k, v in value.ops:
+                    encode_array_op(buf, op, k)
+                    if v is not None:
+                        _write_raw(buf, v)
+        elif isinstance(value, dict):
+            _write_binary_delta(buf, field.value_type, value)
+        else:
+            _write_raw(buf, value)
+    encode_field_index(buf, 0)
+
+def merge_deltas(cls, deltas, fmt='dict'):
+    '''把依次打包的一组cls对象的增量数据(only_changed=True)合并成一个等价的增量数据。
+        fmt -> 'dict'或者'bin'。'bin'格式不支持分帧数据
+    同一字段后面的值覆盖前面的值；子对象和map里的子对象逐字段合并；数组整个替换，或者应用
+    数组操作；map里删除了的key会被保留下来。合并的时候不创建cls对象。
+    dict格式不能同时表示删除和重新设置同一个key，这样的key只保留最后设置的值。
+    '''
+    if fmt == 'dict':
+        merged = {}
+        for delta in deltas:
+            _merge_dict_delta(cls, merged, delta)
+        return merged
+    if fmt != 'bin':
+        raise PackError('unsupported format: {}'.format(fmt))
+    merged = {}
+    for delta in deltas:
+        _merge_binary_delta(cls, merged, _read_binary_delta(ReadBuffer(delta), cls))
+    buf = acquire_write_buffer()
+    try:
+        _write_binary_delta(buf, cls, merged)
+        return buf.tostring()
+    finally:
+        release_write_buffer(buf)
+
+# MutationRecorder记录的修改类型
+MUTATION_SET_FIELD = 1  # 字段赋值。值是字段的完整数据
+MUTATION_DEL_FIELD = 2  # 删除字段
+MUTATION_MAP_SET = 3    # 设置map(或IdMap)的key
+MUTATION_MAP_DEL = 4    # 删除map的key
+MUTATION_ARRAY_OP = 5   # 数组操作，同增量数据里的数组操作
+
+_recorders = 0  # 活动的MutationRecorder个数。没有的时候修改不需要查找记录器
+
+def _link_tree(value, parent, key):
+    '''记下value以及它的子对象和容器在树里的位置(所属的对象或容器, 字段或key)，
+        修改的时候沿着位置找到根对象的记录器。数组元素的key是位置。ref的对象属于别的对象，不记录
+    '''
+    if isinstance(value, DataModel):
+        obj_dict = value.__dict__
+        obj_dict['__rec_parent__'] = (parent, key)
+        if '__lazy__' in obj_dict:
+            _load_all_lazy(obj_dict)
+        for field in value._fields:
+            v = obj_dict.get(field.key)
+            if v is not None and not field.ref and \
+                    (field.container_class is not None or field.is_data_model_type):
+                _link_tree(v, value, field)
+    elif isinstance(value, (Array, Map, TypedArray)):
+        value._rec_parent = (parent, key)
+        if isinstance(value, TypedArray) or _is_ref_container(value) or \
+                not value.value_field.is_data_model_type:
+            return
+        if isinstance(value, Map):
+            for k, v in value.iteritems():
+                _link_tree(v, value, k)
+        else:
+            for k, v in enumerate(value):
+                _link_tree(v, value, k)
+
+def _relink_elements(arr, start):
+    '''insert和remove以后，更新start之后的数组元素记下的位置'''
+    if _is_ref_container(arr) or not arr.value_field.is_data_model_type:
+        return
+    for k in xrange(start, len(arr)):
+        v = arr[k]
+        if v is not None:
+            v.__dict__['__rec_parent__'] = (arr, k)
+
+def _container_owner(container):
+    '''返回容器所属的(对象, 字段)。容器已经不在所属对象上的时候返回(None, None)'''
+    link = getattr(container, '_rec_parent', None)
+    if link is None:
+        return None, None
+    owner, field = link
+    if owner is None or owner.__dict__.get(field.key) is not container:
+        return None, None
+    return owner, field
+
+def _find_recorder(obj):
+    '''返回(记录器, 从根对象到obj的路径)。路径是[(字段, key)]，子对象字段的key是None，
+        容器元素的key是map的key或者数组的位置。obj不在记录的树里时返回(None, None)
+    '''
+    steps = []
+    while True:
+        obj_dict = obj.__dict__
+        recorder_ref = obj_dict.get('__recorder__')
+        if recorder_ref is not None:
+            recorder = recorder_ref()
+            if recorder is None:
+                return None, None
+            steps.reverse()
+            return recorder, steps
+        link = obj_dict.get('__rec_parent__')
+        if link is None or link[0] is None:
+            return None, None
+        parent, key = link
+        if isinstance(parent, DataModel):
+            if parent.__dict__.get(key.key) is not obj:
+                return None, None
+            steps.append((key, None))
+        else:
+            # 容器的元素。数组元素记下的位置在insert和remove的时候更新
+            if isinstance(parent, Array):
+                if key is None or key >= len(parent) or parent[key] is not obj:
+                    return None, None
+            elif parent.get(key) is not obj:
+                return None, None
+            container = parent
+            parent, field = _container_owner(container)
+            if parent is None:
+                return None, None
+            steps.append((field, key))
+        obj = parent
+
+def _encode_mutation_head(buf, kind, steps, field):
+    codes_bin.encode_uint8(buf, kind)
+    codes_bin.encode_uint8(buf, len(steps))
+    for sfield, key in steps:
+        encode_field_index(buf, sfield.index)
+        if sfield.array:
+            codes_bin.encode_uint32(buf, key)
+        elif key is not None:
+            sfield.bin_key_encoder(buf, key)
+    encode_field_index(buf, field.index)
+
+def _record_mutation(obj, kind, field, *args):
+    '''obj在记录的树里时，把obj上field的修改打包后交给记录器'''
+    recorder, steps = _find_recorder(obj)
+    if recorder is None:
+        return
+    buf = acquire_write_buffer()
+    try:
+        _encode_mutation_head(buf, kind, steps, field)
+        if kind == MUTATION_SET_FIELD:
+            value = obj.__dict__.get(field.key)
+            _encode_field_to_binary(buf, field, obj, obj.__dict__, True, False, False, None)
+            if not field.ref:
+                _link_tree(value, obj, field)
+        elif kind == MUTATION_MAP_SET or kind == MUTATION_MAP_DEL:
+            key = args[0]
+            field.bin_key_encoder(buf, key)
+            if kind == MUTATION_MAP_SET:
+                value = args[1]
+                ff = FieldFilter(None, _exclude_oid_field) if field.id_map else None
+                _field_value_to_binary(buf, field.bin_encoder, field, value, True, False, False,
+                                       ff)
+                if not field.ref:
+                    _link_tree(value, obj.__dict__[field.key], key)
+        elif kind == MUTATION_ARRAY_OP:
+            op, index, value = args
+            encode_array_op(buf, op, index)
+            if op != ARRAY_OP_REMOVE:
+                _field_value_to_binary(buf, field.bin_encoder, field, value, True, False, False)
+            if not field.ref:
+                arr = obj.__dict__[field.key]
+                if op != ARRAY_OP_REMOVE:
+                    _link_tree(value, arr, index)
+                if op == ARRAY_OP_INSERT:
+                    _relink_elements(arr, index + 1)
+                elif op == ARRAY_OP_REMOVE:
+                    _relink_elements(arr, index)
+        recorder._push(buf.tostring())
+    finally:
+        release_write_buffer(buf)
+
+def _record_field(obj, field_index):
+    '''字段赋值以后调用。值是None的时候记成删除字段'''
+    field = obj._fields_by_index[field_index]
+    if obj.__dict__.get(field.key) is None:
+        _record_mutation(obj, MUTATION_DEL_FIELD, field)
+    else:
+        _record_mutation(obj, MUTATION_SET_FIELD, field)
+
+def _record_container(container, kind, *args):
+    '''容器修改以后调用。整个容器的改变(比如sort)记成所属字段的赋值'''
+    owner, field = _container_owner(container)
+    if owner is not None:
+        _record_mutation(owner, kind, field, *args)
+
+class MutationRecorder(object):
+    '''记录root对象树上的修改：字段赋值(包括add_xxx, sub_xxx)、map和数组的修改。
+        每个修改在发生时打包成(路径, 操作, 值)，保存在容量为capacity的环形缓冲里。
+        pack()把记录的修改打包成binary格式，另一端用replay_mutations依次重放。
+        开销只和修改的次数有关，和对象树的大小无关。
+
+        缓冲满了以后最早的修改被丢弃，pack()会抛出PackError，这时需要重新同步整个对象，再调用reset()。
+        和changed标志一样，解码修改的数据不记录。解码替换了子对象或容器以后，需要调用reset()。
+        root只保存记录器的弱引用，记录器没有close()就被回收的时候也会停止记录。
+    '''
+    def __init__(self, root, capacity=4096):
+        global _recorders
+        self._active = False
+        recorder_ref = root.__dict__.get('__recorder__')
+        if recorder_ref is not None and recorder_ref() is not None:
+            raise OperateError('object already has a recorder')
+        self.root = root
+        self.dropped = 0
+        self._ops = deque(maxlen=capacity)
+        self._ref = weakref.ref(self)
+        root.__dict__['__recorder__'] = self._ref
+        self._active = True
+        _recorders += 1
+        _link_tree(root, None, None)
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def _push(self, data):
+        if len(self._ops) == self._ops.maxlen:
+            self.dropped += 1
+        self._ops.append(data)
+
+    def pack(self, clear=True):
+        '''把记录的修改打包成binary格式。clear为True时清空记录'''
+        if self.dropped:
+            raise PackError('{} mutations dropped, resync needed'.format(self.dropped))
+        buf = acquire_write_buffer()
+        try:
+            codes_bin.encode_uint32(buf, len(self._ops))
+            for data in self._ops:
+                _write_raw(buf, data)
+            if clear:
+                self._ops.clear()
+            return buf.tostring()
+        finally:
+            release_write_buffer(buf)
+
+    def reset(self):
+        '''清空记录，重新记下对象树里每个子对象和容器的位置'''
+        self._ops.clear()
+        self.dropped = 0
+        _link_tree(self.root, None, None)
+
+    def close(self):
+        '''停止记录'''
+        global _recorders
+        if self._active:
+            self._active = False
+            _recorders -= 1
+            if self.root.__dict__.get('__recorder__') is self._ref:
+                del self.root.__dict__['__recorder__']
+
+def _mutation_field(obj, field_index):
+    field = obj._fields_by_index.get(field_index)
+    if field is None:
+        raise UnpackError('unknown field, index={}'.format(field_index))
+    return field
+
+def replay_mutations(obj, data, resolve_ref=None, copy_bytes=False):
+    '''把MutationRecorder.pack()打包的修改依次应用到obj上。obj和记录的根对象是同一个类型，
+        并且和记录开始时的数据一致。和解码一样，不修改changed标志。返回没有解析的引用。
+        resolve_ref, copy_bytes同unpack_from_binary
+    '''
+    buf = ReadBuffer(data, copy_bytes)
+    context = DecodeContext(resolve_ref=resolve_ref)
+    for _ in xrange(codes_bin.decode_uint32(buf)):
+        kind = codes_bin.decode_uint8(buf)
+        target = obj
+        for _ in xrange(codes_bin.decode_uint8(buf)):
+            field = _mutation_field(target, decode_field_index(buf))
+            value = getattr(target, field.name)
+            try:
+                if field.array:
+                    value = value[codes_bin.decode_uint32(buf)]
+                elif field.map or field.id_map:
+                    value = value[field.bin_key_decoder(buf)]
+            except (IndexError, KeyError):
+                raise UnpackError('bad mutation path: {}'.format(field.name))
+            if not isinstance(value, DataModel):
+                raise UnpackError('bad mutation path: {}'.format(field.name))
+            target = value
+        obj_dict = target.__dict__
+        _drop_clean(obj_dict)
+        field = _mutation_field(target, decode_field_index(buf))
+        if kind == MUTATION_SET_FIELD:
+            if decode_field_index(buf) != field.index:
+                raise UnpackError('bad mutation field: {}'.format(field.name))
+            _drop_lazy_field(obj_dict, field.key)
+            _decode_field_from_binary(buf, field, obj_dict, context)
+        elif kind == MUTATION_DEL_FIELD:
+            _drop_lazy_field(obj_dict, field.key)
+            obj_dict.pop(field.key, None)
+        elif kind == MUTATION_MAP_SET or kind == MUTATION_MAP_DEL:
+            m = getattr(target, field.name)
+            key = field.bin_key_decoder(buf)
+            if kind == MUTATION_MAP_DEL:
+                if key in m:
+                    m._delitem(key)
+                continue
+            value = _field_value_from_binary(buf, field.bin_decoder, field, None,
+                                             key if field.id_map else None, context)
+            m._setitem(key, value)
+            if field.ref:
+                context.add_unsolved_ref(('map', m, key, value))
+        elif kind == MUTATION_ARRAY_OP:
+            arr = getattr(target, field.name)
+            op, index = decode_array_op(buf)
+            value = None
+            if op != ARRAY_OP_REMOVE:
+                value = _field_value_from_binary(buf, field.bin_decoder, field, None, None,
+                                                 context)
+            arr._apply_op(op, index, value)
+            if field.ref:
+                _add_array_refs(arr, context)
+        else:
+            raise UnpackError('unknown mutation: {}'.format(kind))
+    context.resolve_ref()
+    return context.unsolved_ref
@@ -0,0 +1,196 @@
+# encoding=utf-8
+
+'''
+记录文件。把大量DataModel对象用二进制格式打包后依次写入一个文件，文件末尾带有按oid排序的索引。
+读取的时候通过mmap访问文件，不需要把整个文件读入内存:
+
+    dump_many(path, objs)
+    with RecordFile(path, Player) as rf:
+        player = rf.get(1001)       # 只解码一条记录
+        for player in rf:           # 按写入顺序逐条解码
+            ...
+
+文件格式(整数都是大端):
+
+    文件头  -> 'CDMR' + uint16 版本 + uint16 标志(FLAG_FRAMED: 记录使用分帧格式)
+    记录    -> uint32 数据长度 + pack_to_binary的数据
+    索引    -> (uint64 oid, uint64 记录偏移) * 记录数，按oid排序。oid必须是0 ~ 2**64-1的整数
+    文件尾  -> uint64 索引偏移 + uint32 记录数 + 'CDMI'
+'''
+
+from __future__ import absolute_import
+import os
+import mmap
+from struct import Struct
+
+MAGIC = 'CDMR'
+INDEX_MAGIC = 'CDMI'
+VERSION = 1
+
+FLAG_FRAMED = 0x01
+
+_header = Struct('!4sHH')
+_record_head = Struct('!I')
+_index_entry = Struct('!QQ')
+_trailer = Struct('!QI4s')
+
+_MAX_OID = 2 ** 64
+
+class RecordFileError(Exception):
+    pass
+
+def _check_oid(obj):
+    oid = getattr(obj, 'oid', None)
+    if oid is None:
+        raise RecordFileError('object has no oid: {!r}'.format(obj))
+    if not isinstance(oid, (int, long)) or isinstance(oid, bool) or not 0 <= oid < _MAX_OID:
+        raise RecordFileError('oid must be an unsigned 64-bit integer: {!r}'.format(oid))
+    return oid
+
+def _replace(src, dst):
+    '''把src改名为dst。Windows上os.rename不能覆盖已有的文件，需要先删除dst'''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if os.name != 'nt' or not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+def dump_many(path, objs, framed=False):
+    '''把objs依次打包写入path。对象必须有oid字段，oid是无符号64位整数且不能重复。
+        先写到临时文件，写完后再改名为path，避免中途出错留下不完整的文件。出错的时候删除临时文件。
+    返回写入的记录数。
+    '''
+    index = []
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_header.pack(MAGIC, VERSION, FLAG_FRAMED if framed else 0))
+            offset = _header.size
+            for obj in objs:
+                oid = _check_oid(obj)
+                data = obj.pack_to_binary(framed=framed)
+                f.write(_record_head.pack(len(data)))
+                f.write(data)
+                index.append((oid, offset))
+                offset += _record_head.size + len(data)
+
+            index.sort()
+            for i in xrange(1, len(index)):
+                if index[i][0] == index[i - 1][0]:
+                    raise RecordFileError('duplicate oid: {}'.format(index[i][0]))
+            for oid, record_offset in index:
+                f.write(_index_entry.pack(oid, record_offset))
+            f.write(_trailer.pack(offset, len(index), INDEX_MAGIC))
+        _replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return len(index)
+
+class RecordFile(object):
+    '''只读的记录文件。get和迭代返回的是cls的新对象。
+        关闭文件以后，不能再使用延迟解码(lazy)的对象里还没有解码的字段。
+        bytes字段默认复制出来(copy_bytes=True)。指定copy_bytes=False时字段直接引用文件数据，
+        关闭文件以后不能再使用。
+    '''
+    def __init__(self, path, cls):
+        self.cls = cls
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        try:
+            self._load_header()
+        except Exception:
+            self.close()
+            raise
+
+    def _load_header(self):
+        mm = self._mm
+        if len(mm) < _header.size + _trailer.size:
+            raise RecordFileError('file too small')
+        magic, version, flags = _header.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RecordFileError('bad file header')
+        index_offset, count, index_magic = _trailer.unpack_from(mm, len(mm) - _trailer.size)
+        if index_magic != INDEX_MAGIC or \
+                index_offset + count * _index_entry.size + _trailer.size != len(mm):
+            raise RecordFileError('bad file index')
+        self.framed = bool(flags & FLAG_FRAMED)
+        self._index_offset = index_offset
+        self._count = count
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, oid):
+        '''在索引里二分查找oid，返回记录偏移。找不到时返回None'''
+        mm = self._mm
+        base = self._index_offset
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, offset = _index_entry.unpack_from(mm, base + mid * _index_entry.size)
+            if key < oid:
+                lo = mid + 1
+            elif key > oid:
+                hi = mid
+            else:
+                return offset
+        return None
+
+    def _record_data(self, offset):
+        '''返回记录数据的memoryview，不复制数据'''
+        size, = _record_head.unpack_from(self._mm, offset)
+        return memoryview(buffer(self._mm, offset + _record_head.size, size))
+
+    def _decode(self, data, kwargs):
+        kwargs.setdefault('copy_bytes', True)
+        obj = self.cls()
+        obj.unpack_from_binary(data, framed=self.framed, **kwargs)
+        return obj
+
+    def __contains__(self, oid):
+        return self._find(oid) is not None
+
+    def get(self, oid, default=None, **kwargs):
+        '''解码oid对应的记录。kwargs传给unpack_from_binary，比如fields'''
+        offset = self._find(oid)
+        if offset is None:
+            return default
+        return self._decode(self._record_data(offset), kwargs)
+
+    def oids(self):
+        '''按oid顺序遍历全部oid'''
+        mm = self._mm
+        base = self._index_offset
+        for i in xrange(self._count):
+            yield _index_entry.unpack_from(mm, base + i * _index_entry.size)[0]
+
+    def iter(self, **kwargs):
+        '''按写入顺序逐条解码全部记录。kwargs同get'''
+        offset = _header.size
+        end = self._index_offset
+        while offset < end:
+            data = self._record_data(offset)
+            offset += _record_head.size + len(data)
+            yield self._decode(data, kwargs)
+
+    def __iter__(self):
+        return self.iter()
@@ -1,69 +1,123 @@
 #pragma once
 
-#include <set>
-#include <bitset>
+#include <vector>
+#include <algorithm>
+#include <stdint.h>
+#if defined(_MSC_VER)
+#include <intrin.h>
+#endif
 
 typedef unsigned short FieldIdx;
-const int BASE_FIELDS_COUNT = 128;
 
+// 字段的改变标志，按位存储。第一个字(index 0~63)内嵌在对象里，大多数类不需要
+// 额外分配内存；只有设置了更大index的改变标志时，才在堆上扩展后面的字。
 class FieldDirtySet {
 private:
-    typedef std::set<FieldIdx> FieldSet;
+    typedef uint64_t Word;
+    static const int WORD_BITS = 64;
 private:
-    std::bitset<BASE_FIELDS_COUNT> base_fields;
-    FieldSet extra_fields;
+    Word first;
+    std::vector<Word> rest;
     int dirty_count;
-public:
-    FieldDirtySet(): dirty_count(0) {}
 
-    bool is_field_dirty(FieldIdx f) {
-        if (f < BASE_FIELDS_COUNT) {
-            return base_fields[f];
-        } else {
-            return extra_fields.find(f) != extra_fields.end();
+    static int lowest_bit(Word w) {
+#if defined(__GNUC__) || defined(__clang__)
+        return __builtin_ctzll(w);
+#elif defined(_MSC_VER) && defined(_WIN64)
+        unsigned long i;
+        _BitScanForward64(&i, w);
+        return (int)i;
+#else
+        int i = 0;
+        while (!(w & 1)) {
+            w >>= 1;
+            i ++;
         }
+        return i;
+#endif
+    }
+
+    size_t word_count() const {
+        return rest.size() + 1;
+    }
+
+    Word get_word(size_t i) const {
+        return i == 0 ? first : rest[i - 1];
+    }
+
+    Word &word_at(size_t i) {
+        return i == 0 ? first : rest[i - 1];
+    }
+
+public:
+    FieldDirtySet(): first(0), dirty_count(0) {}
+
+    bool is_field_dirty(FieldIdx f) const {
+        size_t i = f / WORD_BITS;
+        return i < word_count() && ((get_word(i) >> (f % WORD_BITS)) & 1);
     }
 
-    bool has_any_dirty() {
+    bool has_any_dirty() const {
         return dirty_count > 0;
     }
 
-    bool _set_field_dirty(FieldIdx f, bool value) {
-        if (f < BASE_FIELDS_COUNT) {
-            if (base_fields[f] != value) {
-                base_fields[f] = value;
-                return true;
-            }
-        } else {
-            bool cur_value = (extra_fields.find(f) != extra_fields.end());
-            if (cur_value != value) {
-                if (value) {
-                    extra_fields.insert(f);
-                } else {
-                    extra_fields.erase(f);
-                }
-                return true;
-            }
-        }
-        return false;
+    int get_dirty_count() const {
+        return dirty_count;
     }
 
     void set_field_dirty(FieldIdx f) {
-        if (_set_field_dirty(f, true)) {
+        size_t i = f / WORD_BITS;
+        if (i >= word_count()) {
+            rest.resize(i, 0);
+        }
+        Word &w = word_at(i);
+        Word mask = (Word)1 << (f % WORD_BITS);
+        if (!(w & mask)) {
+            w |= mask;
             dirty_count ++;
         }
     }
 
     void clear_field_dirty(FieldIdx f) {
-        if (_set_field_dirty(f, false)) {
+        size_t i = f / WORD_BITS;
+        if (i >= word_count()) {
+            return;
+        }
+        Word &w = word_at(i);
+        Word mask = (Word)1 << (f % WORD_BITS);
+        if (w & mask) {
+            w &= ~mask;
             dirty_count --;
         }
-	}
+    }
 
     void clear_all_dirty() {
-        base_fields.reset();
-        extra_fields.clear();
-        dirty_count = 0;
+        if (dirty_count > 0) {
+            first = 0;
+            std::fill(rest.begin(), rest.end(), 0);
+            dirty_count = 0;
+        }
     }
 
+    // 返回不小于start的下一个有改变的字段index，没有的时候返回-1。遍历全部有改变的字段:
+    //     for (int f = s.next_dirty(0); f >= 0; f = s.next_dirty(f + 1))
+    int next_dirty(int start) const {
+        if (dirty_count == 0 || start < 0) {
+            return -1;
+        }
+        size_t i = start / WORD_BITS;
+        if (i >= word_count()) {
+            return -1;
+        }
+        Word w = get_word(i) & (~(Word)0 << (start % WORD_BITS));
+        while (true) {
+            if (w) {
+                return (int)(i * WORD_BITS) + lowest_bit(w);
+            }
+            if (++i >= word_count()) {
+                return -1;
+            }
+            w = get_word(i);
+        }
+    }
 };
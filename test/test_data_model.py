@@ -9,12 +9,16 @@ import sys
 sys.path.insert(0, '.')
 
 import os
+import shutil
+import struct
+import tempfile
 
 import pytest
 import pprint
 
 # from c_data_model_v2 import *
 from c_data_model import *
+from fallback.record_file import dump_many, RecordFile, RecordFileError
 
 class Point(DataModel):
     x = Field('int32', 1, arithm=True, min_value=-1, conf_name='xx', no_sync=True)
@@ -97,10 +101,42 @@ class Objects(DataModel):
 class MapSet(DataModel):
     data = MapField('uint8', 1, key='uint32', desc='map set')
 
+class Stats(DataModel):
+    level = Field('uint16', 1)
+    hp    = Field('int32', 2)
+    speed = Field('float', 3)
+    alive = Field('bool', 4)
+    name  = Field('string', 5)
+    exp   = Field('uint64', 6)
+    score = Field('double', 7)
+
+class Player(DataModel):
+    stats = Field(Stats, 1)
+    items = IdMapField(Object, 2, key='uint32')
+    gold  = Field('int64', 3)
+
 class SkipChangedData(DataModel):
     a = Field('uint32', 1, skip_changed=True)
     b = Field('uint32', 2)
 
+class SlotItem(SlotDataModel):
+    oid   = Field('string', 1)
+    count = Field('int32', 2, arithm=True)
+    price = Field('double', 3)
+    sold  = Field('bool', 4)
+    pos   = Field(Point, 5)
+    tags  = ArrayField('uint16', 6)
+
+# 纯python实现没有slot存储，SlotDataModel的字段仍然在__dict__里
+HAS_SLOT_STORAGE = 'SlotStorage' in globals()
+
+class SlotItems(DataModel):
+    items = IdMapField(SlotItem, 1, key='string')
+    refs  = MapField(SlotItem, 2, key='string', ref=True)
+
+    def resolve_ref(self, ref):
+        return self.items.get(ref)
+
 
 def test_array():
     b = Box()
@@ -584,6 +620,889 @@ def test_part_pack():
     assert out == {'y': 100}
 
 
+def test_binary_pack():
+    player = Player(stats=Stats(level=3, hp=-20, speed=1.5, alive=True,
+                                name='hero', exp=2 ** 40, score=0.125),
+                    gold=100)
+    player.items.add(Object(oid=1, name='sword'))
+    out = player.pack('bin')
+    print repr(out)
+
+    player2 = Player()
+    player2.unpack('bin', out)
+    assert player2.pack_to_dict() == player.pack_to_dict()
+    assert player2.stats.alive is True
+    assert player2.items[1].oid == 1
+
+    # 增量数据只包含run里的部分字段
+    player.clear_changed()
+    player.stats.hp = 50
+    player.stats.exp = 1
+    out = player.pack('bin', only_changed=True)
+    player2.unpack('bin', out, mode='sync')
+    assert player2.stats.hp == 50
+    assert player2.stats.exp == 1
+    assert player2.stats.level == 3
+
+
+def test_pack_to_buffer():
+    box = Box(points=[Point(x=i, y=i) for i in xrange(2000)])
+    out1 = box.pack('bin')
+    assert len(out1) == box.calc_packed_size()
+
+    # 线程缓冲池里的buffer会被复用，返回的数据不能互相影响
+    out2 = Player(gold=1).pack('bin')
+    assert box.pack('bin') == out1
+    assert Player(gold=1).pack('bin') == out2
+
+    buf = bytearray(box.calc_packed_size() + 10)
+    size = box.pack_to_binary(out=buf)
+    assert size == len(out1)
+    assert bytes(buf[:size]) == out1
+
+    view = memoryview(buf)[10:]
+    size = box.pack_to_binary(out=view)
+    assert view[:size].tobytes() == out1
+
+    with pytest.raises(PackError):
+        box.pack_to_binary(out=bytearray(100))
+
+
+def test_unpack_from_buffer():
+    player = Player(gold=-7)
+    player.stats = Stats(level=3, hp=-100, speed=1.5, alive=True, name='abc', exp=2 ** 40, score=0.25)
+    player.items[5] = Object(name='x')
+    data = player.pack('bin')
+
+    # 可以直接从支持buffer协议的对象解包，不需要先复制成str
+    for src in (data, bytearray(data), memoryview(bytearray(data))):
+        p2 = Player()
+        p2.unpack('bin', src)
+        assert p2.pack('bin') == data
+
+    with pytest.raises(MemoryError):
+        Player().unpack('bin', data[:-3])
+
+
+def test_binary2_pack():
+    player = Player(gold=-7)
+    player.stats = Stats(level=3, hp=-100, speed=1.5, alive=True, name='abc', exp=2 ** 40, score=0.25)
+    player.items.add(Object(oid=5, name='x'))
+    player.items.add(Object(oid=70000, name='y'))
+    data = player.pack('bin2')
+    assert len(data) < len(player.pack('bin'))
+
+    p2 = Player()
+    p2.unpack('bin2', data)
+    assert p2.pack('dict') == player.pack('dict')
+    assert p2.items[70000].oid == 70000
+
+    # 增量打包
+    p2.clear_changed()
+    p2.stats.hp = 5
+    p2.gold = 100
+    delta = p2.pack('bin2', only_changed=True)
+    player.unpack('bin2', delta, mode='sync')
+    assert player.stats.hp == 5 and player.stats.name == 'abc'
+    assert player.gold == 100
+
+    # 不认识的字段会被跳过
+    class PlayerGold(DataModel):
+        gold = Field('int64', 3)
+    p3 = PlayerGold()
+    p3.unpack('bin2', data)
+    assert p3.gold == -7
+
+    # 不认识的字段嵌套太深，或者元素的wire_type不对时抛出UnpackError
+    with pytest.raises(UnpackError):
+        p3.unpack('bin2', chr(43) * 1000000 + '\x00' * 1000000)
+    with pytest.raises(UnpackError):
+        p3.unpack('bin2', chr(44) + chr(1) + chr(9) + '\x00')
+
+    # 增量数据里删除了的key，map和IdMap都在sync模式下删除
+    p2.clear_changed()
+    del p2.items[5]
+    delta = p2.pack('bin2', only_changed=True)
+    player.unpack('bin2', delta, mode='sync')
+    assert player.items.keys() == [70000]
+    p3.unpack('bin2', delta)  # 跳过带有删除了的key的map
+    scene = Scene()
+    scene.coords['a'] = Coord(oid='a')
+    scene.coords['b'] = Coord(oid='b')
+    replica = Scene()
+    replica.unpack('bin2', scene.pack('bin2'))
+    scene.clear_changed()
+    del scene.coords['a']
+    replica.unpack('bin2', scene.pack('bin2', only_changed=True), mode='sync')
+    assert replica.coords.keys() == ['b']
+
+
+def test_lazy_unpack():
+    player = Player(gold=-7)
+    player.stats = Stats(level=3, hp=-100, name='abc')
+    player.items.add(Object(oid=5, name='x'))
+    data = player.pack('bin')
+
+    p2 = Player()
+    p2.unpack('bin', data, lazy=True)
+    # 基本类型的字段直接解码，子对象和容器字段在访问的时候才解码
+    assert p2.gold == -7
+    assert '_stats' not in p2.__dict__ and '_items' not in p2.__dict__
+    assert p2.stats.hp == -100
+    assert '_stats' in p2.__dict__ and '_items' not in p2.__dict__
+    assert p2.pack('bin') == data
+    assert p2.get_items()[5].name == 'x'
+    # 子对象字段不生成get_xxx，不会因为读取而修改对象
+    assert not hasattr(p2, 'get_stats')
+
+    p3 = Player()
+    p3.unpack('bin', data, lazy=True, mark_change=True)
+    p3.clear_changed()
+    assert not p3.has_changed(recursive=True)
+    assert p3.items[5].name == 'x'
+
+    with pytest.raises(UnpackError):
+        Player().unpack('bin', data, mode='sync', lazy=True)
+
+    class RefData(DataModel):
+        objects = IdMapField(Object, 1, key='uint32')
+        obj = Field(Object, 2, ref=True)
+    r = RefData()
+    r.objects.add(Object(oid=1))
+    r.obj = r.objects[1]
+    with pytest.raises(UnpackError):
+        RefData().unpack('bin', r.pack('bin'), lazy=True)
+    r2 = RefData()
+    r2.unpack('bin', r.pack('bin'), lazy=True, resolve_ref=lambda oid: 'obj%d' % oid)
+    assert r2.obj == 'obj1'
+
+
+def test_binary_framed():
+    player = Player(gold=-7)
+    player.stats = Stats(level=3, hp=-100, name='abc')
+    player.items.add(Object(oid=5, name='x'))
+    data = player.pack('bin', framed=True)
+    assert len(data) == player.calc_packed_size(framed=True)
+
+    p2 = Player()
+    p2.unpack('bin', data, framed=True)
+    assert p2.pack('dict') == player.pack('dict')
+
+    # 不认识的字段会被跳过
+    class PlayerGold(DataModel):
+        gold = Field('int64', 3)
+    p3 = PlayerGold()
+    with pytest.raises(PackError):
+        p3.unpack('bin', player.pack('bin'))
+    p3.unpack('bin', data, framed=True)
+    assert p3.gold == -7
+
+    # framed参数和数据不一致的时候报错，不会解码出错误的值
+    with pytest.raises(UnpackError):
+        Player().unpack('bin', data)
+    with pytest.raises(UnpackError):
+        Player().unpack('bin', player.pack('bin'), framed=True)
+    with pytest.raises(UnpackError):
+        Player().unpack('bin', data, lazy=True)
+    with pytest.raises(UnpackError):
+        Player().apply_patch(player.pack('bin', only_changed=True), framed=True)
+    p4 = Player()
+    p4.unpack('bin', data, lazy=True, framed=True)
+    assert p4.items[5].name == 'x'
+    data, offsets = pack_many([player, player], framed=True)
+    assert [p.pack('dict') for p in unpack_many(Player, data, offsets, framed=True)] == [player.pack('dict')] * 2
+    with pytest.raises(UnpackError):
+        unpack_many(Player, data, offsets)
+    with pytest.raises(DefineError):
+        Field('int32', 0xffff)
+
+
+def test_unpack_field_filter():
+    player = Player(gold=-7)
+    player.stats = Stats(level=3, hp=-100, name='abc')
+    player.items.add(Object(oid=5, name='x'))
+
+    for fmt in ('dict', 'bin', 'bin2'):
+        data = player.pack(fmt)
+        p2 = Player()
+        p2.unpack(fmt, data, fields=['gold', 'stats.hp'])
+        assert p2.pack('dict') == {'gold': -7, 'stats': {'hp': -100}}
+
+        # 容器里对象的字段
+        p2 = Player()
+        p2.unpack(fmt, data, fields=['items.name'])
+        assert p2.items[5].name == 'x' and p2.stats is None
+
+        p2 = Player()
+        p2.unpack(fmt, data, field_filter=lambda field: field.name != 'name')
+        assert p2.stats.is_default_value('name') and p2.items[5].is_default_value('name')
+        assert p2.stats.hp == -100 and p2.gold == -7
+
+    with pytest.raises(NoFieldError):
+        Player().unpack('dict', {}, fields=['stats.no_such_field'])
+
+
+def test_record_file():
+    objs = [Object(oid=oid, name='obj%d' % oid) for oid in (30, 10, 20)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'objects.rec')
+        assert dump_many(path, objs) == 3
+        with RecordFile(path, Object) as rf:
+            assert len(rf) == 3
+            assert list(rf.oids()) == [10, 20, 30]
+            assert rf.get(20).name == 'obj20'
+            assert rf.get(40) is None and 40 not in rf
+            assert [obj.oid for obj in rf] == [30, 10, 20]
+            assert rf.get(10, fields=['name']).is_default_value('oid')
+
+        dump_many(path, objs, framed=True)
+        with RecordFile(path, Object) as rf:
+            assert rf.framed
+            assert rf.get(30).pack('dict') == objs[0].pack('dict')
+
+        # 不支持的oid在写入前报错，不留下临时文件，原来的文件不变
+        class NamedObject(DataModel):
+            oid = Field('string', 1)
+        class SignedObject(DataModel):
+            oid = Field('int64', 1)
+        for bad in ([NamedObject(oid='a')], [SignedObject(oid=-1)], objs + [Object(oid=10)]):
+            with pytest.raises(RecordFileError):
+                dump_many(path, bad)
+            assert os.listdir(tmp_dir) == ['objects.rec']
+            with RecordFile(path, Object) as rf:
+                assert len(rf) == 3
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_pack_many():
+    objs = [Object(oid=oid, name='obj%d' % oid) for oid in xrange(1, 4)]
+    for fmt in ('bin', 'bin2'):
+        data, offsets = pack_many(objs, fmt)
+        assert len(offsets) == 4 and offsets[-1] == len(data)
+        assert data[offsets[1]:offsets[2]] == objs[1].pack(fmt)
+        objs2 = unpack_many(Object, data, offsets, fmt)
+        assert [o.pack('dict') for o in objs2] == [o.pack('dict') for o in objs]
+        objs2 = unpack_many(Object, data, fmt=fmt)
+        assert [o.oid for o in objs2] == [1, 2, 3]
+
+    # 批量内对象之间的引用
+    class Node(DataModel):
+        oid = Field('uint32', 1)
+        next = Field(Object, 2, ref=True)
+    data, offsets = pack_many([Node(oid=1, next=Node(oid=2)), Node(oid=2)])
+    nodes = unpack_many(Node, data, offsets)
+    assert nodes[0].next is nodes[1]
+
+
+def test_bson_pack():
+    player = Player(gold=-7)
+    player.stats = Stats(level=3, hp=-100, speed=1.5, alive=True, name='abc', exp=2 ** 64 - 1, score=0.25)
+    player.items.add(Object(oid=5, name='x'))
+    player.items.add(Object(oid=70000, name='y'))
+    data = player.pack('bson')
+    assert struct.unpack_from('<i', data)[0] == len(data)
+
+    p2 = Player()
+    p2.unpack('bson', data)
+    assert p2.pack('dict') == player.pack('dict')
+    assert p2.items[70000].oid == 70000
+    assert p2.stats.exp == 2 ** 64 - 1
+
+    box = Box()
+    box.points.append(Point(x=1, y=2))
+    box.points.append(Point(x=-3))
+    b2 = Box()
+    b2.unpack('bson', box.pack('bson'))
+    assert b2.pack('dict') == box.pack('dict')
+
+    # 增量打包，删除的key是null
+    p2.clear_changed()
+    p2.stats.hp = 5
+    del p2.items[5]
+    delta = p2.pack('bson', only_changed=True)
+    player.unpack('bson', delta, mode='sync')
+    assert player.stats.hp == 5 and player.stats.name == 'abc'
+    assert player.items.keys() == [70000]
+
+    # MongoDB返回的文档带有_id(ObjectId)，会被跳过
+    elem = '\x07_id\x00' + '\x01' * 12
+    doc = struct.pack('<i', len(data) + len(elem)) + elem + data[4:]
+    p3 = Player()
+    p3.unpack('bson', doc)
+    assert p3.gold == -7 and p3.stats.level == 3
+
+    # 整数字段也接受int64，浮点字段也接受整数
+    doc = '\x12level\x00' + struct.pack('<q', 9) + '\x10score\x00' + struct.pack('<i', 2)
+    doc = struct.pack('<i', len(doc) + 5) + doc + '\x00'
+    stats = Stats()
+    stats.unpack('bson', doc)
+    assert stats.level == 9 and stats.score == 2.0
+
+    with pytest.raises(PackError):
+        stats.unpack('bson', struct.pack('<i', 13) + '\x02hp\x00' + struct.pack('<i', 1) + '\x00\x00')
+
+
+def test_bytes_field():
+    class Blob(DataModel):
+        oid  = Field('uint32', 1)
+        data = Field('bytes', 2)
+        parts = ArrayField('bytes', 3)
+
+    big = '\x00\xff' * 40000  # 超过string的65535字节上限
+    blob = Blob(oid=1, data=big)
+    blob.parts.append(bytearray('ab'))
+    blob.parts.append(memoryview('xcdx')[1:3])
+    assert blob.pack('dict') == {'oid': 1, 'data': big, 'parts': ['ab', 'cd']}
+    assert blob.calc_packed_size() == len(blob.pack('bin'))
+
+    for fmt in ('bin', 'bin2', 'bson'):
+        data = bytearray(blob.pack(fmt))
+        b2 = Blob()
+        b2.unpack(fmt, data)
+        # 默认引用源数据，不复制
+        assert isinstance(b2.data, memoryview) and b2.data == big
+        assert b2.pack(fmt) == data
+        data[-3] = ord('!')
+        assert b2.pack('dict')['parts'] != ['ab', 'cd']
+
+        b3 = Blob()
+        b3.unpack(fmt, str(blob.pack(fmt)), copy_bytes=True)
+        assert type(b3.data) is str and b3.parts == ['ab', 'cd']
+
+    b4 = Blob()
+    b4.unpack_from_binary(blob.pack('bin'), lazy=True, copy_bytes=True)
+    assert b4.parts == ['ab', 'cd'] and type(b4.parts[0]) is str
+
+    # memoryview不能hash，bytes不能作为map的key和oid
+    with pytest.raises(DefineError):
+        MapField('string', 1, key='bytes')
+    with pytest.raises(DefineError):
+        class BytesId(DataModel):
+            oid = Field('bytes', 1)
+
+
+def test_typed_array():
+    class Samples(DataModel):
+        values = ArrayField('int32', 1, typed=True)
+        weights = ArrayField('double', 2, typed=True)
+        names = ArrayField('string', 3)
+
+    s = Samples(values=[1, -2, 3])
+    assert s.values.tolist() == [1, -2, 3]
+    s.weights.extend([0.5, 1.5])
+    s.names.append('a')
+    # 和普通数组的二进制格式相同
+    class Plain(DataModel):
+        values = ArrayField('int32', 1)
+        weights = ArrayField('double', 2)
+        names = ArrayField('string', 3)
+    plain = Plain(values=[1, -2, 3], weights=[0.5, 1.5], names=['a'])
+    assert s.pack('bin') == plain.pack('bin')
+    assert s.calc_packed_size() == len(s.pack('bin'))
+
+    for fmt in ('dict', 'bin', 'bin2', 'bson'):
+        s2 = Samples()
+        s2.unpack(fmt, s.pack(fmt))
+        assert s2.values.tolist() == [1, -2, 3]
+        assert s2.weights.tolist() == [0.5, 1.5]
+        assert not s2.has_changed()
+
+    # buffer里是本机字节序的连续数据
+    assert str(buffer(s.values)) == struct.pack('=3i', 1, -2, 3)
+
+    s.clear_changed()
+    s.values[1] = 7
+    assert s.pack('dict', only_changed=True) == {'values': [1, 7, 3]}
+    s.clear_changed()
+    s.values[0:2] = s.values[1:3]
+    assert s.has_changed('values') and s.values.tolist() == [7, 3, 3]
+
+    try:
+        class Bad(DataModel):
+            names = ArrayField('string', 1, typed=True)
+        assert False
+    except DefineError:
+        pass
+
+
+def test_columns():
+    class Item(DataModel):
+        oid = Field('uint32', 1)
+        count = Field('int16', 2)
+        name = Field('string', 3)
+        tags = ArrayField('int32', 4)
+
+    class Bag(DataModel):
+        items = IdMapField(Item, 1, key='uint32')
+
+    bag = Bag()
+    for i in range(1, 4):
+        bag.items.add(Item(oid=i, count=i * 10, name='n%d' % i))
+    columns = to_columns(bag.items)
+    assert sorted(columns) == ['count', 'name', 'oid']
+    rows = sorted(zip(columns['oid'], columns['count'], columns['name']))
+    assert rows == [(1, 10, 'n1'), (2, 20, 'n2'), (3, 30, 'n3')]
+
+    items = from_columns(Item, columns)
+    assert sorted(item.pack('dict') for item in items) == \
+        sorted(item.pack('dict') for item in bag.items.itervalues())
+    assert not any(item.has_changed() for item in items)
+
+    assert list(to_columns([Item(oid=5)], fields=['count'])['count']) == [0]
+    with pytest.raises(PackError):
+        to_columns(bag.items, fields=['tags'])
+    with pytest.raises(UnpackError):
+        from_columns(Item, {'oid': [1, 2], 'count': [1]})
+
+
+def test_binary_delta():
+    player = Player(gold=1)
+    for i in range(1, 4):
+        player.items.add(Object(oid=i, name='o%d' % i))
+    replica = Player()
+    replica.unpack('bin', player.pack('bin'))
+    item = replica.items[2]
+
+    player.clear_changed()
+    del player.items[1]
+    player.items[2].name = 'x'
+    player.gold = 5
+    delta = player.pack('bin', only_changed=True)
+    assert len(delta) == player.calc_packed_size(only_changed=True)
+
+    replica.apply_patch(delta)
+    assert replica.pack('dict') == player.pack('dict')
+    assert sorted(replica.items) == [2, 3]
+    # 已有的对象原地修改
+    assert replica.items[2] is item and item.name == 'x'
+    assert not replica.has_changed()
+
+    # 非sync模式忽略删除的key
+    other = Player()
+    other.unpack('bin', delta)
+    assert 1 not in other.items and other.items[2].name == 'x'
+
+    # 数组整个替换
+    box = Box()
+    box.points.extend([Point(x=1, y=1), Point(x=2, y=2)])
+    box2 = Box()
+    box2.unpack('bin', box.pack('bin'))
+    box.clear_changed()
+    box.points[1].y = 7
+    box2.apply_patch(box.pack('bin', only_changed=True))
+    assert box2.pack('dict') == box.pack('dict')
+
+
+def test_merge_deltas():
+    for fmt in ('bin', 'dict'):
+        player = Player(gold=1, stats=Stats(level=1, hp=10))
+        for i in range(1, 4):
+            player.items.add(Object(oid=i, name='o%d' % i))
+        replica = Player()
+        replica.unpack(fmt, player.pack(fmt))
+        player.clear_changed()
+
+        deltas = []
+        player.gold = 2
+        player.stats.hp = 20
+        del player.items[1]
+        deltas.append(player.pack(fmt, only_changed=True, clear_changed=True))
+        player.gold = 3
+        player.stats.level = 5
+        player.items[2].name = 'x'
+        player.items.add(Object(oid=9, name='nine'))
+        deltas.append(player.pack(fmt, only_changed=True, clear_changed=True))
+        del player.items[3]
+        deltas.append(player.pack(fmt, only_changed=True, clear_changed=True))
+
+        merged = merge_deltas(Player, deltas, fmt)
+        if fmt == 'bin':
+            assert len(merged) < sum(len(d) for d in deltas)
+        else:
+            assert merged['gold'] == 3 and merged['stats'] == {'level': 5, 'hp': 20}
+        replica.unpack(fmt, merged, mode='sync')
+        assert replica.pack('dict') == player.pack('dict')
+        assert sorted(replica.items) == [2, 9]
+
+    with pytest.raises(PackError):
+        merge_deltas(Player, [], 'bin2')
+
+
+def test_dirty_propagation():
+    player = Player(gold=1, stats=Stats(level=1))
+    for i in range(1, 4):
+        player.items.add(Object(oid=i, name='o%d' % i))
+    player.clear_changed()
+    assert not player.has_changed(recursive=True)
+
+    # 子孙的改变沿着所属对象向上通知
+    player.items[2].name = 'x'
+    assert player.has_changed(recursive=True)
+    assert player.has_changed('items', recursive=True)
+    assert not player.has_changed('stats', recursive=True)
+    assert player.pack_to_dict(only_changed=True, clear_changed=True) == {'items': {'2': {'name': 'x'}}}
+    assert not player.has_changed(recursive=True)
+
+    player.stats.hp = 5
+    assert player.has_changed(recursive=True)
+    player.pack_to_binary(only_changed=True, clear_changed=True)
+    assert not player.has_changed(recursive=True)
+
+    # 新加入的对象在下一次清除标志以后也会通知
+    player.items.add(Object(oid=9))
+    player.clear_changed()
+    player.items[9].name = 'nine'
+    assert player.pack_to_dict(only_changed=True) == {'items': {'9': {'name': 'nine'}}}
+    player.clear_changed()
+
+    # 解码以后替换了的子对象，修改时同样可以检测到
+    src = Player(stats=Stats(level=7))
+    player.unpack_from_dict(src.pack_to_dict(), mode='sync')
+    player.clear_changed()
+    player.stats.level = 8
+    assert player.pack_to_dict(only_changed=True) == {'stats': {'level': 8}}
+
+    # 同一个子对象放在了两个地方，改变对两边都可见
+    p = Point(x=1)
+    a = Rect(lt=p)
+    a.clear_changed()
+    b = Rect(lt=p)
+    a.clear_changed()
+    b.clear_changed()
+    p.x = 2
+    assert a.has_changed(recursive=True) and b.has_changed(recursive=True)
+    assert a.pack_to_dict(only_changed=True) == {'lt': {'x': 2}}
+    assert b.pack_to_dict(only_changed=True) == {'lt': {'x': 2}}
+
+    # 同一个元素在两个数组里，同一个数组在两个对象里，或者同一个map的两个key下
+    box1, box2 = Box(), Box()
+    box1.points.append(p)
+    box2.points.append(p)
+    box3 = Box(points=box1.points)
+    kp = KeyPoints()
+    kp.points['a'] = kp.points['b'] = p
+    for obj in (box1, box2, box3, kp):
+        obj.clear_changed()
+    p.y = 3
+    for obj in (box1, box2, box3, kp):
+        assert obj.has_changed(recursive=True)
+    assert kp.pack_to_dict(only_changed=True) == {'points': {'a': {'y': 3}, 'b': {'y': 3}}}
+
+
+def test_map_dirty_keys():
+    player = Player()
+    for i in range(1, 101):
+        player.items.add(Object(oid=i, name='o%d' % i))
+    replica = Player()
+    replica.unpack('bin', player.pack('bin'))
+    player.clear_changed()
+
+    player.items[5].name = 'x'
+    player.items.add(Object(oid=200, name='new'))
+    assert player.pack_to_dict(only_changed=True) == \
+        {'items': {'5': {'name': 'x'}, '200': {'name': 'new'}}}
+    # 增量数据里只有改变了的元素
+    delta = player.pack('bin', only_changed=True, clear_changed=True)
+    assert len(delta) < len(player.pack('bin')) // 10
+    replica.apply_patch(delta)
+    assert replica.pack('dict') == player.pack('dict')
+
+    player.items[7].name = 'y'
+    assert player.pack_to_dict(only_changed=True) == {'items': {'7': {'name': 'y'}}}
+    player.clear_changed()
+
+    # sync解码以后没有记下改变的key，逐个检查元素
+    player.unpack_from_dict({'items': {'300': {'oid': 300}}}, mode='sync')
+    player.items[300].name = 'z'
+    player.items[8].name = 'w'
+    delta = player.pack_to_dict(only_changed=True)
+    assert delta['items']['300'] == {'name': 'z'} and delta['items']['8'] == {'name': 'w'}
+
+    # 同一个增量窗口里先删除再重新设置的key，增量数据里不能再带删除标记
+    player.clear_changed()
+    del player.items[9]
+    player.items[9] = Object(oid=9, name='again')
+    assert player.pack_to_dict(only_changed=True) == {'items': {'9': {'name': 'again'}}}
+    for fmt in ('dict', 'bson', 'bin', 'bin2'):
+        replica = Player()
+        replica.unpack('bin', player.pack('bin'))
+        replica.items[9].name = 'old'
+        replica.unpack(fmt, player.pack(fmt, only_changed=True), mode='sync')
+        assert replica.items[9].name == 'again'
+
+
+def test_array_ops():
+    box = Box()
+    for i in range(20):
+        box.points.append(Point(x=i, y=i))
+    replica = Box()
+    replica.unpack('bin', box.pack('bin'))
+    points = replica.points
+    box.clear_changed()
+
+    box.points.append(Point(x=100, y=1))
+    box.points[3].y = 7
+    assert box.pack_to_dict(only_changed=True) == {'points': {'ops': [
+        ['append', 20, {'x': 100, 'y': 1}], ['set', 3, {'x': 3, 'y': 7}]]}}
+    # 增量数据里只有操作，sync解码时原地修改数组
+    delta = box.pack('bin', only_changed=True)
+    assert len(delta) == box.calc_packed_size(only_changed=True)
+    assert len(delta) < len(box.pack('bin')) // 5
+    replica.apply_patch(delta)
+    assert replica.points is points
+    assert replica.pack('dict') == box.pack('dict')
+    box.clear_changed()
+
+    # insert以后元素的位置变了，set操作用新的位置
+    box.points.insert(0, Point(x=-1))
+    box.points[5].x = 50
+    box.points.pop()
+    del box.points[1]
+    dict_delta = box.pack_to_dict(only_changed=True)
+    replica.unpack_from_dict(dict_delta, mode='sync')
+    assert replica.pack('dict') == box.pack('dict')
+    assert merge_deltas(Box, [delta, box.pack('bin', only_changed=True)], 'bin')
+    box.clear_changed()
+
+    # 不能记录的改变输出整个数组
+    box.points.sort(key=lambda p: -p.x)
+    assert isinstance(box.pack_to_dict(only_changed=True)['points'], list)
+    replica.apply_patch(box.pack('bin', only_changed=True, clear_changed=True))
+    assert replica.pack('dict') == box.pack('dict')
+
+
+def test_container_mutation_dirty():
+    kp = KeyPoints()
+    for i in range(10):
+        kp.points[str(i)] = Point(x=i, y=i)
+    box = Box()
+    for i in range(10):
+        box.points.append(Point(x=i, y=i))
+    kp.clear_changed(recursive=True)
+    box.clear_changed(recursive=True)
+
+    # update只影响更新了的key，不会把其它元素设置成changed
+    kp.points.update({'3': Point(x=30, y=3), '20': Point(x=20, y=20)})
+    assert not kp.points['5'].has_changed()
+    assert kp.pack_to_dict(only_changed=True) == {'points': {
+        '3': {'x': 30, 'y': 3}, '20': {'x': 20, 'y': 20}}}
+
+    # 数组的改变只记在数组上
+    box.points.append(Point(x=100))
+    box.points.insert(0, Point(x=-1))
+    assert not any(p.has_changed() for p in box.points[1:-1])
+
+    # 整个容器赋值的时候仍然完整打包
+    m = kp.points
+    kp.clear_changed(recursive=True)
+    kp.points = m
+    assert kp.pack_to_dict(only_changed=True) == kp.pack_to_dict()
+
+
+def test_pack_since():
+    player = Player(gold=10)
+    for i in range(5):
+        player.items.add(Object(oid=i, name='obj%d' % i))
+    db_replica = Player()
+    db_replica.unpack('dict', player.pack('dict'))
+    client_replica = Player()
+    client_replica.unpack('dict', player.pack('dict'))
+    db = client = current_version()
+    assert player.pack_since(db) == ({}, db)
+
+    player.gold = 20
+    player.items[1].name = 'new'
+    # 一个消费者取走增量，不影响另一个消费者
+    delta, db = player.pack_since(db)
+    assert delta == {'gold': 20, 'items': {'1': {'name': 'new'}}}
+    db_replica.unpack_from_dict(delta, mode='sync')
+
+    del player.items[2]
+    player.items.add(Object(oid=10, name='obj10'))
+    player.clear_changed(recursive=True)  # changed标志不影响版本号
+    delta, client = player.pack_since(client)
+    assert delta == {'gold': 20, 'items': {
+        '1': {'name': 'new'}, '2': None, '10': {'name': 'obj10'}}}
+    client_replica.unpack_from_dict(delta, mode='sync')
+    assert client_replica.pack('dict') == player.pack('dict')
+
+    delta, db = player.pack_since(db)
+    assert delta == {'items': {'2': None, '10': {'name': 'obj10'}}}
+    db_replica.unpack_from_dict(delta, mode='sync')
+    assert db_replica.pack('dict') == player.pack('dict')
+    assert player.pack_since(db)[0] == player.pack_since(client)[0] == {}
+
+    # 反复增删key留下的版本号，在所有消费者同步以后删掉
+    for i in xrange(100, 200):
+        player.items.add(Object(oid=i))
+        del player.items[i]
+    delta, db = player.pack_since(db)
+    assert len(delta['items']) == 100
+    db_replica.unpack_from_dict(delta, mode='sync')
+    delta, client = player.pack_since(client)
+    client_replica.unpack_from_dict(delta, mode='sync')
+    player.prune_versions(min(db, client))
+    assert player.pack_since(0)[0] == player.pack('dict')
+    assert player.pack_since(db)[0] == {}
+
+    # clear以后删除所有key
+    player.items.clear()
+    player.items.add(Object(oid=1, name='again'))
+    delta, db = player.pack_since(db)
+    db_replica.unpack_from_dict(delta, mode='sync')
+    assert db_replica.pack('dict') == player.pack('dict')
+
+
+def test_record_mutations():
+    player = Player(gold=10, stats=Stats(level=1))
+    for i in range(3):
+        player.items.add(Object(oid=i, name='obj%d' % i))
+    replica = Player()
+    replica.unpack('bin', player.pack('bin'))
+    recorder = MutationRecorder(player)
+
+    player.gold = 20
+    player.gold += 5
+    player.stats.hp = 100
+    player.items[1].name = 'new'
+    del player.items[2]
+    player.items.add(Object(oid=10, name='obj10'))
+    player.items[10].name = 'obj10b'
+    assert len(recorder) == 7
+    replay_mutations(replica, recorder.pack())
+    assert replica.pack('dict') == player.pack('dict')
+    assert len(recorder) == 0
+
+    box = Box()
+    box.points.append(Point(x=1, y=1))
+    box_replica = Box()
+    box_replica.unpack('bin', box.pack('bin'))
+    box_recorder = MutationRecorder(box)
+    box.points.insert(0, Point(x=2, y=2))
+    box.points[1].x = 3  # 元素的位置已经改变
+    box.points.append(Point(x=4, y=4))
+    box.points.pop(0)
+    replay_mutations(box_replica, box_recorder.pack())
+    assert box_replica.pack('dict') == box.pack('dict')
+
+    # 数组元素记下的位置随insert和remove更新
+    for i in range(5, 10):
+        box.points.append(Point(x=i))
+    box.points.insert(2, Point(x=20))
+    box.points[6].y = 6
+    box.points.remove(box.points[0])
+    box.points[-1].y = 9
+    del box.points[3]
+    box.points[3].y = 3
+    removed = box.points.pop(1)
+    removed.y = 100  # 已经不在数组里，不记录
+    box.points.sort(key=lambda p: -p.x)
+    box.points[0].y = 1
+    replay_mutations(box_replica, box_recorder.pack())
+    assert box_replica.pack('dict') == box.pack('dict')
+
+    # 没有close就被回收的记录器不再记录
+    box_recorder = None
+    box.points[0].y = 2
+    box_recorder = MutationRecorder(box)
+    assert len(box_recorder) == 0
+
+    # 环形缓冲满了以后需要重新同步
+    small = MutationRecorder(Player(), capacity=2)
+    for i in range(3):
+        small.root.gold = i
+    try:
+        small.pack()
+        assert False
+    except PackError:
+        pass
+    small.reset()
+    small.root.gold = 5
+    assert len(small) == 1
+    small.pack()
+    small.close()
+    small.root.gold = 100
+    assert len(small) == 0
+
+
+def test_clone():
+    scene = Scene2(point1=Point(x=1, y=2))
+    for i in range(3):
+        scene.coords[str(i)] = Coord(oid=str(i), x=i)
+    scene.refs['a'] = scene.coords['1']
+    scene.clear_changed()
+    scene.coords['2'].x = 20
+
+    c = scene.clone()
+    assert c.pack('dict') == scene.pack('dict')
+    assert c.coords['1'] is not scene.coords['1']
+    assert c.refs['a'] is c.coords['1']  # ref指向复制出来的对象
+    assert not c.has_changed(recursive=True)
+    c.point1.x = 100
+    assert scene.point1.x == 1
+
+    c = scene.clone(with_changed=True)
+    assert c.pack('dict', only_changed=True) == scene.pack('dict', only_changed=True)
+    c.clear_changed()
+    c.coords['0'].y = 5
+    assert c.pack('dict', only_changed=True) == {'coords': {'0': {'y': 5}}}
+    assert scene.coords['0'].y == 100
+
+    c = scene.clone(deep=False)
+    assert c.point1 is scene.point1
+    assert c.coords is not scene.coords and c.coords['1'] is scene.coords['1']
+
+    # 同一个对象放在多个地方时只复制一次，只被一个容器引用的对象各自复制
+    shared = Scene()
+    shared.coords['a'] = shared.coords['b'] = Coord(oid='a')
+    shared.coords['c'] = Coord(oid='c')
+    c = shared.clone()
+    assert c.coords['a'] is c.coords['b'] and c.coords['a'] is not shared.coords['a']
+    assert c.coords['c'] is not shared.coords['c'] and c.coords['c'].oid == 'c'
+
+
+def test_slot_storage():
+    item = SlotItem(oid='a', count=3, price=1.5, pos=Point(x=1, y=2))
+    if HAS_SLOT_STORAGE:
+        # 基本类型字段在slot里，子对象和容器字段在__dict__里
+        assert '_count' not in item.__dict__ and '_pos' in item.__dict__
+    assert item.count == 3 and item._count == 3 and item.sold is False
+    assert not hasattr(item, '_sold')
+    item.add_count(2)
+    assert item.count == 5 and item.has_changed('count')
+    item.tags.append(7)
+
+    bag = SlotItems()
+    bag.items.add(item)
+    bag.refs['x'] = item
+    for fmt in ('dict', 'bin', 'bin2', 'bson'):
+        bag2 = SlotItems()
+        bag2.unpack(fmt, bag.pack(fmt), resolve_ref=bag2.resolve_ref)
+        assert bag2.pack('dict') == bag.pack('dict')
+        assert bag2.refs['x'] is bag2.items['a']
+        if HAS_SLOT_STORAGE:
+            assert '_count' not in bag2.items['a'].__dict__
+
+    c = item.clone()
+    c.count = 10
+    assert item.count == 5 and c.pack('dict')['count'] == 10
+    assert from_columns(SlotItem, to_columns(bag.items))[0].count == 5
+
+    del item.count
+    assert item.count == 0 and item.is_default_value('count')
+    assert item.get_count() == 0 and not item.is_default_value('count')
+
+    # 和DataModel一样，设置成None以后读出来是None，删除以后才是默认值
+    item.price = None
+    assert item.price is None and item._price is None and item.get_price() is None
+    assert item.has_changed('price') and item.is_default_value('price')
+    assert item.clone().price is None
+    del item.price
+    assert item.price == 0.0 and not hasattr(item, '_price')
+
+
 def main():
     test_base_1()
     test_base_usage()
@@ -608,6 +1527,29 @@ def main():
     test_field_filter()
     test_skip_changed()
     test_part_pack()
+    test_binary_pack()
+    test_pack_to_buffer()
+    test_unpack_from_buffer()
+    test_binary2_pack()
+    test_lazy_unpack()
+    test_binary_framed()
+    test_unpack_field_filter()
+    test_record_file()
+    test_pack_many()
+    test_bson_pack()
+    test_bytes_field()
+    test_typed_array()
+    test_columns()
+    test_binary_delta()
+    test_merge_deltas()
+    test_dirty_propagation()
+    test_map_dirty_keys()
+    test_array_ops()
+    test_container_mutation_dirty()
+    test_pack_since()
+    test_record_mutations()
+    test_clone()
+    test_slot_storage()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,198 @@
+# encoding=utf-8
+
+import sys
+sys.path.insert(0, '.')
+
+import pytest
+
+from c_data_model_v2 import *
+
+
+class Point(DataModel):
+    x = Field('int32', 1)
+    y = Field('uint32', 2)
+
+
+class Coord(DataModel):
+    oid = Field('string', 1)
+    x   = Field('int32', 2, default=100)
+
+
+class Scene(DataModel):
+    coords = MapField(Coord, 1, key='string')
+    refs   = MapField(Coord, 2, key='string', ref=True)
+    points = ArrayField(Point, 3)
+    point  = Field(Point, 4)
+    ids    = IdMapField(Coord, 5, key='string')
+    name   = Field('string', 6)
+
+    def resolve_ref(self, ref):
+        return self.coords.get(ref)
+
+
+class Wide(DataModel):
+    a = Field('int32', 1)
+    b = Field('int32', 63)
+    c = Field('int32', 64)
+    d = Field('int32', 65)
+    e = Field('int32', 127)
+    f = Field('int32', 128)
+    g = Field('int32', 129)
+    h = Field('int32', 200)
+    point = Field(Point, 130)
+
+
+def make_scene():
+    scene = Scene(point=Point(x=-1, y=2), name='s')
+    for i in range(3):
+        scene.coords[str(i)] = Coord(oid=str(i), x=i)
+    scene.refs['r'] = scene.coords['1']
+    scene.points.append(Point(x=3, y=4))
+    scene.ids.add(Coord(oid='c', x=5))
+    return scene
+
+
+def test_binary_pack():
+    scene = make_scene()
+    data = scene.pack('bin')
+    assert scene.calc_packed_size() == len(data)
+
+    scene2 = Scene()
+    scene2.unpack('bin', data, resolve_ref=scene2.resolve_ref)
+    assert scene2.pack('dict') == scene.pack('dict')
+    assert scene2.refs['r'] is scene2.coords['1']
+    assert scene2.point.x == -1
+
+
+def test_binary_pack_delta():
+    scene = make_scene()
+    scene2 = Scene()
+    scene2.unpack('bin', scene.pack('bin'), resolve_ref=scene2.resolve_ref)
+    old_point = scene2.point
+
+    scene.clear_changed()
+    scene.point.x = 10
+    scene.coords['2'].x = 20
+    scene.refs['r'] = scene.coords['2']
+    data = scene.pack('bin', only_changed=True)
+    assert scene.calc_packed_size(only_changed=True) == len(data)
+    assert len(data) < len(scene.pack('bin'))
+
+    scene2.unpack('bin', data, mode='sync', resolve_ref=scene2.resolve_ref)
+    assert scene2.pack('dict') == scene.pack('dict')
+    assert scene2.point is old_point  # sync模式原地修改子对象
+    assert scene2.refs['r'] is scene2.coords['2']
+
+    scene.clear_changed()
+    assert scene.calc_packed_size(only_changed=True) == len(scene.pack('bin', only_changed=True))
+
+
+def test_pack_to_buffer():
+    scene = make_scene()
+    size = scene.calc_packed_size()
+    out = bytearray(size)
+    assert scene.pack_to_binary(out=out) == size
+    assert bytes(out) == scene.pack('bin')
+    with pytest.raises(PackError):
+        scene.pack_to_binary(out=bytearray(size - 1))
+
+
+def test_dirty_fields_above_64():
+    names = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+    for dirty in (names, ['c'], ['b', 'f'], ['e', 'h'], ['a', 'h'], ['g']):
+        obj = Wide()
+        assert not obj.has_changed()
+        for i, name in enumerate(dirty):
+            setattr(obj, name, i + 1)
+        for name in names:
+            assert obj.has_changed(name) == (name in dirty)
+        data = obj.pack('bin', only_changed=True)
+        assert obj.calc_packed_size(only_changed=True) == len(data)
+        obj2 = Wide()
+        obj2.unpack('bin', data)
+        assert obj2.pack('dict') == obj.pack('dict')
+        assert sorted(obj2.pack('dict')) == sorted(dirty)
+
+        obj.clear_changed(dirty[0])
+        assert not obj.has_changed(dirty[0])
+        assert obj.has_changed() == (len(dirty) > 1)
+        obj.clear_changed()
+        assert not obj.has_changed()
+        assert obj.pack('bin', only_changed=True) == Wide().pack('bin', only_changed=True)
+
+
+def test_dirty_fields_with_nested_above_64():
+    obj = Wide(point=Point(x=1))
+    obj.clear_changed()
+    obj.point.y = 2
+    obj.f = 3
+    obj.h = 4
+    obj2 = Wide()
+    obj2.unpack('bin', obj.pack('bin', only_changed=True))
+    assert obj2.pack('dict') == {'f': 3, 'h': 4, 'point': {'y': 2}}
+
+
+def test_array_mutation_dirty():
+    mutations = [
+        lambda a: a.append(Point(x=100)),
+        lambda a: a.extend([Point(x=101), Point(x=102)]),
+        lambda a: a.insert(0, Point(x=-1)),
+        lambda a: a.pop(),
+        lambda a: a.pop(0),
+        lambda a: a.remove(a[1]),
+        lambda a: a.sort(key=lambda p: -p.x),
+        lambda a: a.__setitem__(2, Point(x=200)),
+        lambda a: a.__delitem__(3),
+        lambda a: a.__iadd__([Point(x=103)]),
+    ]
+    for mutate in mutations:
+        scene = Scene()
+        for i in range(5):
+            scene.points.append(Point(x=i, y=i))
+        scene2 = Scene()
+        scene2.unpack('bin', scene.pack('bin'))
+        scene.clear_changed()
+        assert not scene.points.has_changed()
+
+        mutate(scene.points)
+        assert scene.points.has_changed()
+        assert scene.has_changed(recursive=True)
+        # 数组的改变只记在数组上
+        assert not any(p.has_changed() for p in scene.points)
+
+        data = scene.pack('bin', only_changed=True)
+        assert scene.calc_packed_size(only_changed=True) == len(data)
+        scene2.unpack('bin', data, mode='sync')
+        assert scene2.pack('dict') == scene.pack('dict')
+
+        scene.clear_changed()
+        assert not scene.points.has_changed()
+        assert not scene.has_changed(recursive=True)
+
+
+def test_map_update_dirty():
+    scene = Scene()
+    for i in range(10):
+        scene.coords[str(i)] = Coord(oid=str(i), x=i)
+    scene2 = Scene()
+    scene2.unpack('bin', scene.pack('bin'))
+    scene.clear_changed()
+
+    # update只影响更新了的key，不会把其它元素设置成changed
+    scene.coords.update({'3': Coord(oid='3', x=30), '20': Coord(oid='20', x=20)})
+    assert scene.has_changed('coords', recursive=True)
+    assert not scene.coords['5'].has_changed()
+    assert scene.coords['3'].has_changed()
+    assert scene.coords['20'].has_changed()
+
+    data = scene.pack('bin', only_changed=True)
+    assert scene.calc_packed_size(only_changed=True) == len(data)
+    scene2.unpack('bin', data, mode='sync')
+    assert scene2.pack('dict') == scene.pack('dict')
+
+    scene.clear_changed()
+    scene.coords.update(c=Coord(oid='c'))
+    assert not scene.coords['3'].has_changed()
+    assert scene.coords['c'].has_changed()
+    scene2.unpack('bin', scene.pack('bin', only_changed=True), mode='sync')
+    assert scene2.pack('dict') == scene.pack('dict')